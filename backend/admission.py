@@ -0,0 +1,221 @@
+"""
+XRay Federation System - Admission control for expensive routes
+Routes are grouped into classes (full listings, federation queries, QR
+rendering, ...). Each class can have a token bucket per client, so one
+kiosk or scraper looping over /api/patients runs out of tokens instead of
+taking the process's threads from everyone else, and a cap on requests in
+progress at once in this process, for routes that keep a CPU busy while
+they run. A request over either limit is refused straight away (429, or 503
+when the class is saturated) with a Retry-After header, rather than being
+queued until it and everything behind it time out.
+
+A client is the API key in the RATE_LIMIT_KEY_HEADER header when that key
+is one of RATE_LIMIT_API_KEYS, otherwise its address: an unknown key
+doesn't get a fresh bucket, or a scraper could pick a new one per request.
+The address is the one TRUSTED_PROXY_HOPS reverse proxies forwarded (see
+app.py), and federation peers send the key they were given for this node.
+Buckets and caps are per process, like every other limit here; under
+gunicorn a client spread over N workers gets up to N times its rate.
+"""
+import functools
+import math
+import threading
+import time
+
+from flask import jsonify, make_response, request
+
+import metrics
+from cache import LRUCache
+
+MAX_CLIENTS = 100000        # buckets kept per process; the least recently seen client starts afresh
+DEFAULT_WAIT = 0.05         # seconds a request may wait for a slot of a saturated class
+
+# class -> (requests per second, burst) per client, and requests in progress per process
+DEFAULT_RATES = {
+    'listing': (5.0, 20),       # full dumps of GET /api/patients and hospital study lists (not pages, not 304s)
+    'federation': (20.0, 50),
+    'qr': (20.0, 100),          # patient/study QR codes; cached ones are cheap, misses render
+    'qr_sheet': (0.5, 5),
+    'preview': (20.0, 100),
+}
+DEFAULT_CONCURRENCY = {
+    'listing': 8,
+    'qr': 4,
+    'qr_sheet': 2,
+    'preview': 4,
+}
+
+
+def parse_rates(value):
+    """{class: (rate, burst)} from class=rate:burst,... text; a rate of 0 lifts the limit"""
+    rates = {}
+    for item in (value or '').split(','):
+        if not item.strip():
+            continue
+        name, _, spec = item.partition('=')
+        rate, _, burst = spec.partition(':')
+        rate = float(rate)
+        rates[name.strip()] = (rate, int(burst) if burst else max(1, math.ceil(rate)))
+    return rates
+
+
+def parse_concurrency(value):
+    """{class: slots} from class=slots,... text; 0 lifts the cap"""
+    return {name.strip(): int(slots) for name, _, slots in
+            (item.partition('=') for item in (value or '').split(',') if item.strip())}
+
+
+class TokenBucket:
+    """`burst` tokens, refilled at `rate` per second; not thread-safe on its own"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """0 when a token was taken, else the seconds until one is available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class Refused(Exception):
+    def __init__(self, status, retry_after, message):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Slot:
+    """One claimed slot of a class; release() is safe to call more than once"""
+
+    def __init__(self, slots, on_release):
+        self._slots = slots
+        self._on_release = on_release
+
+    def release(self):
+        slots, self._slots = self._slots, None
+        if slots is not None:
+            self._on_release()
+            slots.release()
+
+
+class AdmissionControl:
+    def __init__(self, enabled=True, rates=None, concurrency=None, wait=DEFAULT_WAIT,
+                 api_keys=(), key_header='X-API-Key', max_clients=MAX_CLIENTS):
+        self.enabled = enabled
+        self.rates = dict(DEFAULT_RATES, **(rates or {}))
+        self.concurrency = dict(DEFAULT_CONCURRENCY, **(concurrency or {}))
+        self.wait = wait
+        self.api_keys = frozenset(api_keys)
+        self.key_header = key_header
+        self._buckets = LRUCache(max_entries=max_clients)
+        self._lock = threading.Lock()
+        self._slots = {name: threading.BoundedSemaphore(n) for name, n in self.concurrency.items() if n > 0}
+        self.in_progress = {name: 0 for name in self._slots}
+
+    def client(self):
+        key = request.headers.get(self.key_header)
+        if key and key in self.api_keys:
+            return 'key:' + key
+        return request.remote_addr or '-'
+
+    def check_rate(self, route_class, client):
+        """Take a token from the client's bucket for the class; Refused (429) when it is empty"""
+        rate, burst = self.rates.get(route_class, (0, 0))
+        if rate <= 0:
+            return
+        key = (route_class, client)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(rate, burst)
+                self._buckets.set(key, bucket)
+            wait = bucket.take(time.monotonic())
+        if wait:
+            metrics.admission_refused.inc(route_class, 'rate_limited')
+            raise Refused(429, math.ceil(wait), "Too many requests; slow down")
+
+    def acquire(self, route_class):
+        """A slot of the class (None when it has no cap); Refused (503) when none frees up in time"""
+        slots = self._slots.get(route_class)
+        if slots is None:
+            return None
+        if not slots.acquire(timeout=self.wait):
+            metrics.admission_refused.inc(route_class, 'saturated')
+            raise Refused(503, 1, "Server busy; try again shortly")
+        with self._lock:
+            self.in_progress[route_class] += 1
+        return Slot(slots, functools.partial(self._released, route_class))
+
+    def _released(self, route_class):
+        with self._lock:
+            self.in_progress[route_class] -= 1
+
+    def stats(self):
+        with self._lock:
+            in_progress = dict(self.in_progress)
+        return {
+            "enabled": self.enabled,
+            "clients": len(self._buckets),
+            "classes": {name: dict(zip(("rate", "burst"), self.rates.get(name, (0, 0))),
+                                   max_concurrent=self.concurrency.get(name, 0),
+                                   in_progress=in_progress.get(name, 0))
+                        for name in sorted(set(self.rates) | set(self.concurrency))},
+        }
+
+
+admission = AdmissionControl(enabled=False)
+
+
+def configure(**settings):
+    """Replace the process's limits (buckets start full again)"""
+    global admission
+    admission = AdmissionControl(**settings)
+    return admission
+
+
+def limit(route_class, methods=None, unless=None):
+    """Decorator: admit the request under its class's rate limit and concurrency cap
+
+    methods limits it to some HTTP methods (a GET listing but not the POST
+    that shares its URL), and unless(), when true for a request, lets it
+    through uncharged (one bounded page of a listing). The slot is held until
+    a streamed body has been sent, otherwise only while the view runs.
+    """
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            control = admission
+            if (not control.enabled or (methods and request.method not in methods)
+                    or (unless and unless())):
+                return view(*args, **kwargs)
+            try:
+                control.check_rate(route_class, control.client())
+                slot = control.acquire(route_class)
+            except Refused as e:
+                refused = jsonify({"error": str(e)})
+                refused.status_code = e.status
+                refused.headers['Retry-After'] = str(e.retry_after)
+                return refused
+            if slot is None:
+                return view(*args, **kwargs)
+            try:
+                response = make_response(view(*args, **kwargs))
+            except BaseException:
+                slot.release()
+                raise
+            if response.is_streamed:
+                response.call_on_close(slot.release)
+            else:
+                slot.release()
+            return response
+        return wrapper
+    return decorate
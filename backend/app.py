@@ -1,68 +1,169 @@
 """
 XRay Federation System - Basic Starter
 This is the simplest version to get started
+
+Development: python app.py
+Production:  gunicorn -c gunicorn.conf.py wsgi:app   (see wsgi.py)
 """
-from flask import Flask, jsonify, request, send_from_directory, send_file
+from flask import Flask, Response, g, jsonify, request, send_file
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import sqlite3
 import os
+import hashlib
+import time
+import shutil
 from datetime import datetime
-import uuid
-import qrcode
-import io
+
+import admission
+import audit
+import db
+from db import get_db
+from migrations import migrate, current_version, LATEST_VERSION
+from ids import patient_id_for, new_study_id, new_study_key, insert_patient, insert_study
+import bulk
+import dicom_preview
+import export
+import fastjson
+import http_cache
+import jobs
+import qr
+import qr_sheet
+import orthanc
+import orthanc_sync
+import search
+import static_assets
+import storage
+import study_layout
+import metrics
+from federation_cache import FederationCache
+import federation_peers
+from pagination import paged, page_args, wants_ndjson, stream_ndjson, stream_json_array, json_page, DEFAULT_LIMIT
+from config import config
 
 app = Flask(__name__)
+app.json = fastjson.JSONProvider(app)
+app.config.from_object(config[os.environ.get('FLASK_CONFIG', 'default')])
 CORS(app)
+# The client address behind TRUSTED_PROXY_HOPS reverse proxies (set in configure_app)
+_proxy_fix = ProxyFix(app.wsgi_app, x_for=0, x_proto=0)
+# Outermost layer, so streamed bodies are timed until their last byte
+app.wsgi_app = metrics.MetricsMiddleware(_proxy_fix)
+
+# Rendered QR PNGs are content-addressed, so they can be cached indefinitely
+QR_MAX_AGE = 86400
+# Study thumbnails are keyed by the DICOMs they were rendered from
+PREVIEW_MAX_AGE = 86400
+
+def configure_app():
+    """(Re)build everything derived from app.config: the connection pool and caches"""
+    global federation_cache, peer_registry, qr_renderer, dicom_previews, frontend_assets
+    # remote_addr (rate limit buckets, the audit log) from that many X-Forwarded-For entries
+    _proxy_fix.x_for = _proxy_fix.x_proto = app.config.get('TRUSTED_PROXY_HOPS', 0)
+    db.init_app(app)
+    storage.init_app(app)
+    metrics.configure(app.config.get('METRICS_DIR'))
+    export.configure(app.config.get('EXPORT_MAX_CONCURRENT'))
+    http_cache.init_app(app)
+    jobs.configure(workers=app.config.get('JOB_WORKERS'), job_dir=app.config.get('JOB_DIR'),
+                   context=app.app_context)
+    # Per-client token buckets and per-process caps for the expensive routes
+    admission.configure(
+        enabled=app.config.get('RATE_LIMIT_ENABLED', True),
+        rates=admission.parse_rates(app.config.get('RATE_LIMITS')),
+        concurrency=admission.parse_concurrency(app.config.get('CONCURRENCY_LIMITS')),
+        wait=app.config.get('ADMISSION_WAIT', admission.DEFAULT_WAIT),
+        api_keys=app.config.get('RATE_LIMIT_API_KEYS') or (),
+        key_header=app.config.get('RATE_LIMIT_KEY_HEADER', 'X-API-Key'),
+    )
+    # Access events queue here and are written in batches by a thread per process
+    audit.configure(
+        directory=app.config.get('AUDIT_DIR', 'audit'),
+        enabled=app.config.get('AUDIT_ENABLED', True),
+        segment=app.config.get('AUDIT_SEGMENT', 'month'),
+        retention_days=app.config.get('AUDIT_RETENTION_DAYS', 0),
+        queue_size=app.config.get('AUDIT_QUEUE_SIZE', audit.DEFAULT_QUEUE_SIZE),
+        batch_size=app.config.get('AUDIT_BATCH_SIZE', audit.DEFAULT_BATCH_SIZE),
+        on_full=app.config.get('AUDIT_ON_FULL', 'reject'),
+        enqueue_timeout=app.config.get('AUDIT_ENQUEUE_TIMEOUT', audit.DEFAULT_ENQUEUE_TIMEOUT),
+        user_header=app.config.get('AUDIT_USER_HEADER', 'X-User'),
+    )
+    # Per-patient federation query results; every write below invalidates its patient,
+    # and the writes of other processes are picked up from patient_changes
+    federation_cache = FederationCache(
+        max_entries=app.config.get('FEDERATION_CACHE_SIZE', 10000),
+        ttl=app.config.get('FEDERATION_CACHE_TTL', 300.0),
+        sync_interval=app.config.get('FEDERATION_CACHE_SYNC_INTERVAL', 1.0),
+    )
+    # Other federation nodes asked by /api/federation/query, under one deadline
+    peer_registry = federation_peers.PeerRegistry(
+        federation_peers.load_peers(app.config.get('FEDERATION_PEERS'), app.config.get('FEDERATION_PEERS_FILE')),
+        deadline=app.config.get('FEDERATION_PEER_DEADLINE', federation_peers.DEFAULT_DEADLINE),
+        timeout=app.config.get('FEDERATION_PEER_TIMEOUT', federation_peers.DEFAULT_TIMEOUT),
+        negative_ttl=app.config.get('FEDERATION_PEER_NEGATIVE_TTL', federation_peers.DEFAULT_NEGATIVE_TTL),
+        breaker_failures=app.config.get('FEDERATION_PEER_BREAKER_FAILURES', federation_peers.BREAKER_FAILURES),
+        breaker_reset=app.config.get('FEDERATION_PEER_BREAKER_RESET', federation_peers.BREAKER_RESET),
+        api_key=app.config.get('FEDERATION_PEER_API_KEY'),
+        key_header=app.config.get('RATE_LIMIT_KEY_HEADER', 'X-API-Key'),
+    )
+    qr_renderer = qr.QRRenderer(
+        max_entries=app.config.get('QR_CACHE_SIZE', 1024),
+        cache_dir=app.config.get('QR_CACHE_DIR'),
+    )
+    dicom_previews = dicom_preview.Previewer(
+        get_client=lambda: orthanc.get_client(app.config),
+        dicom_dir=app.config.get('DICOM_DIR'),
+        cache_dir=app.config.get('PREVIEW_CACHE_DIR'),
+        max_cache_bytes=app.config.get('PREVIEW_CACHE_MAX_MB', 512) * 1024 * 1024,
+        workers=app.config.get('PREVIEW_WORKERS'),
+    )
+    # Frontend files, read and compressed once here (again on change when FRONTEND_RELOAD)
+    frontend_assets = static_assets.AssetStore(
+        app.config.get('FRONTEND_DIR') or os.path.join(os.path.dirname(__file__), '..', 'frontend'),
+        reload=app.config.get('FRONTEND_RELOAD', False),
+        min_size=app.config.get('COMPRESSION_MIN_SIZE', 1024),
+    )
 
-# Simple SQLite database setup
+configure_app()
+
+def create_app(config_name=None):
+    """Application factory for WSGI servers (wsgi.py)
+
+    Loads config[config_name], defaulting to $FLASK_CONFIG, and applies
+    pending migrations. Under gunicorn's preload_app this runs once in the
+    master; the pool is then emptied so no SQLite handle crosses fork().
+    """
+    app.config.from_object(config[config_name or os.environ.get('FLASK_CONFIG', 'default')])
+    configure_app()
+    init_db()
+    db.get_pool().close_all()
+    return app
+
+def reset_after_fork():
+    """Per-worker setup for pre-forking servers (gunicorn's post_fork hook)
+
+    The pool, the Orthanc session, the peer fan-out threads, the audit
+    writer and the QR/preview process pools all belong to the parent; each
+    worker starts its own on first use, and counts its own metrics from zero.
+    """
+    db.get_pool().after_fork()
+    storage.reset_after_fork()
+    jobs.reset_after_fork()
+    orthanc.reset_client()
+    peer_registry.reset_after_fork()
+    audit.reset_after_fork()
+    qr_sheet.reset_pool()
+    dicom_preview.reset_pool()
+    metrics.REGISTRY.reset()
+
+# Simple SQLite database setup - schema lives in migrations.py
 def init_db():
-    conn = sqlite3.connect('federation.db')
-    cursor = conn.cursor()
-    
-    # Create hospitals table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS hospitals (
-            id TEXT PRIMARY KEY,
-            name TEXT NOT NULL,
-            address TEXT,
-            phone TEXT,
-            email TEXT,
-            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Create patients table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS patients (
-            id TEXT PRIMARY KEY,
-            national_id TEXT UNIQUE NOT NULL,
-            first_name TEXT NOT NULL,
-            last_name TEXT NOT NULL,
-            date_of_birth DATE,
-            gender TEXT,
-            phone TEXT,
-            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Create studies table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS studies (
-            id TEXT PRIMARY KEY,
-            patient_id TEXT,
-            hospital_id TEXT,
-            study_date TIMESTAMP,
-            modality TEXT,
-            description TEXT,
-            orthanc_study_id TEXT,
-            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (patient_id) REFERENCES patients (id),
-            FOREIGN KEY (hospital_id) REFERENCES hospitals (id)
-        )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    with db.connection() as conn:
+        migrate(conn)
+        # A new database gets STUDY_LAYOUT right away; an existing one is converted offline
+        target = app.config.get('STUDY_LAYOUT', study_layout.ROWID)
+        if study_layout.apply(conn, target) != target:
+            print(f"⚠️  studies is not in the {target} layout; run scripts/cluster_studies.py --to {target}")
     print("✅ Database initialized successfully!")
 
 @app.route('/')
@@ -73,13 +174,102 @@ def home():
         "timestamp": datetime.now().isoformat()
     })
 
+@app.before_request
+def label_route():
+    # Metrics are labelled by URL rule, not raw path, to keep the series count bounded
+    request.environ['xray.route'] = request.url_rule.rule if request.url_rule else '<unmatched>'
+
+@app.before_request
+def start_job_workers():
+    # Once per process, so queued jobs are picked up even before anything is submitted here
+    jobs.runner.start()
+
+@metrics.REGISTRY.collector
+def _pool_and_cache_metrics():
+    pool = db.get_pool().stats()
+    federation = federation_cache.stats()
+    qr_cache = qr_renderer.memory.stats()
+    previews = dicom_previews.stats()
+    admitted = admission.admission.stats()['classes']
+    return [
+        ('xray_db_pool_connections', 'gauge', 'Pooled SQLite connections by state', ('state',),
+         [(('open',), pool['open']), (('idle',), pool['idle'])]),
+        ('xray_federation_cache_lookups_total', 'counter', 'Federation cache lookups', ('result',),
+         [(('hit',), federation['hits']), (('miss',), federation['misses'])]),
+        ('xray_federation_cache_entries', 'gauge', 'Cached federation results', (),
+         [((), federation['entries'])]),
+        ('xray_qr_cache_lookups_total', 'counter', 'QR PNG memory cache lookups', ('result',),
+         [(('hit',), qr_cache['hits']), (('miss',), qr_cache['misses'])]),
+        ('xray_dicom_preview_cache_lookups_total', 'counter', 'DICOM thumbnail disk cache lookups',
+         ('result',), [(('hit',), previews.get('hits', 0)), (('miss',), previews.get('misses', 0))]),
+        ('xray_admission_in_progress', 'gauge', 'Requests in progress per capped route class', ('route_class',),
+         [((name,), c['in_progress']) for name, c in admitted.items() if c['max_concurrent']]),
+    ]
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint"""
+    return Response(metrics.REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+# Health checks are polled often; don't hit Orthanc on every one of them
+ORTHANC_PROBE_TTL = 5.0
+_orthanc_probe = (0.0, None)
+
 @app.route('/api/status')
 def status():
-    return jsonify({"status": "running", "database": "connected"})
+    """Health check: 200 while the database answers with a current schema, 503 otherwise
+
+    Orthanc being unreachable only degrades the status, since every
+    route except ?enrich=1 and the sync works without it.
+    """
+    database = _probe_database()
+    orthanc_status = _probe_orthanc()
+    healthy = database["status"] == "ok"
+    overall = "running" if healthy and orthanc_status["status"] == "ok" else "degraded" if healthy else "down"
+    return jsonify({
+        "status": overall,
+        "database": "connected" if healthy else "unavailable",
+        "checks": {"database": database, "orthanc": orthanc_status},
+    }), 200 if healthy else 503
+
+def _probe_database():
+    start = time.perf_counter()
+    try:
+        with db.connection(timeout=2.0) as conn:
+            conn.execute('SELECT 1').fetchone()
+            version = current_version(conn)
+            layout = study_layout.layout(conn) if version >= LATEST_VERSION else None
+    except (sqlite3.Error, RuntimeError) as e:
+        return {"status": "error", "error": str(e)}
+    return {
+        # A newer schema is fine (migrations only add); an older one lacks what routes expect
+        "status": "ok" if version >= LATEST_VERSION else "migrations_pending",
+        "latency_ms": round((time.perf_counter() - start) * 1000, 2),
+        "schema_version": version,
+        "study_layout": layout,
+        "pool": db.get_pool().stats(),
+    }
+
+def _probe_orthanc():
+    global _orthanc_probe
+    expires, result = _orthanc_probe
+    if result is not None and time.monotonic() < expires:
+        return result
+    start = time.perf_counter()
+    try:
+        system = orthanc.get_client(app.config).probe(timeout=2.0)
+        result = {"status": "ok", "version": system.get('Version'),
+                  "latency_ms": round((time.perf_counter() - start) * 1000, 2)}
+    except orthanc.OrthancError as e:
+        result = {"status": "unreachable", "error": str(e)}
+    result["url"] = app.config.get('ORTHANC_URL')
+    _orthanc_probe = (time.monotonic() + ORTHANC_PROBE_TTL, result)
+    return result
 
 @app.route('/api/hospitals', methods=['GET', 'POST'])
+@http_cache.conditional('hospitals')
 def hospitals():
-    conn = sqlite3.connect('federation.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     if request.method == 'POST':
@@ -89,13 +279,13 @@ def hospitals():
             VALUES (?, ?, ?, ?, ?)
         ''', (data['id'], data['name'], data.get('address'), data.get('phone'), data.get('email')))
         conn.commit()
-        conn.close()
+        # Studies filed under a hospital that didn't exist yet now join into results
+        federation_cache.clear()
         return jsonify({"message": "Hospital registered successfully"}), 201
     
     else:  # GET request
         cursor.execute('SELECT * FROM hospitals')
         hospitals_data = cursor.fetchall()
-        conn.close()
         
         hospital_list = []
         for hospital in hospitals_data:
@@ -111,53 +301,87 @@ def hospitals():
         return jsonify(hospital_list)
 
 @app.route('/api/patients', methods=['GET', 'POST'])
+@http_cache.conditional('patients')
+@admission.limit('listing', methods=('GET',), unless=paged)
 def patients():
-    conn = sqlite3.connect('federation.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     if request.method == 'POST':
         data = request.json
         
-        # Generate patient ID
-        patient_id = f"PAT-{data['national_id'][-6:]}"
-        
-        cursor.execute('''
+        # Generate patient ID (a fresh one if another national ID already has it)
+        patient_id = insert_patient(cursor, '''
             INSERT INTO patients (id, national_id, first_name, last_name, date_of_birth, gender, phone)
             VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (patient_id, data['national_id'], data['first_name'], data['last_name'], 
-              data.get('date_of_birth'), data.get('gender'), data.get('phone')))
+        ''', (patient_id_for(data['national_id']), data['national_id'], data['first_name'], data['last_name'],
+              data.get('date_of_birth'), data.get('gender'), data.get('phone')))[0]
         
         conn.commit()
-        conn.close()
+        federation_cache.invalidate(national_id=data['national_id'], patient_id=patient_id)
         return jsonify({"message": "Patient registered", "patient_id": patient_id}), 201
     
-    else:  # GET request
-        cursor.execute('SELECT * FROM patients')
-        patients_data = cursor.fetchall()
-        conn.close()
+    else:  # GET request - keyset paginated on id when ?limit=/?after= are given
+        try:
+            limit, after = page_args()
+            if after and len(after) != 1:
+                raise ValueError("Invalid cursor")
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
         
-        patient_list = []
-        for patient in patients_data:
-            patient_list.append({
-                "id": patient[0],
-                "national_id": patient[1],
-                "first_name": patient[2],
-                "last_name": patient[3],
-                "date_of_birth": patient[4],
-                "gender": patient[5],
-                "phone": patient[6]
-            })
+        query = 'SELECT * FROM patients'
+        params = []
+        if after:
+            query += ' WHERE id > ?'
+            params.append(after[0])
+        query += ' ORDER BY id'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit + 1)  # one extra row tells us whether a next page exists
+        
+        if wants_ndjson():
+            return stream_ndjson(db.stream(query, params), limit, _patient_dict, _patient_cursor)
+        if limit is None:
+            return stream_json_array(db.stream(query, params), _patient_dict)
         
-        return jsonify(patient_list)
+        cursor.execute(query, params)
+        return json_page(cursor, limit, _patient_dict, _patient_cursor)
+
+def _patient_dict(patient):
+    return {
+        "id": patient[0],
+        "national_id": patient[1],
+        "first_name": patient[2],
+        "last_name": patient[3],
+        "date_of_birth": patient[4],
+        "gender": patient[5],
+        "phone": patient[6]
+    }
+
+def _patient_cursor(patient):
+    return [patient[0]]
+
+@app.route('/api/patients/bulk', methods=['POST'])
+def bulk_patients():
+    """Upsert many patients (JSON array or NDJSON body), keyed on national_id"""
+    if _wants_async():
+        return _submit_bulk_job('bulk_patients')
+    try:
+        rows = bulk.iter_request_rows(request)
+        result = bulk.upsert_patients(get_db(), rows, chunk_size=_bulk_chunk_size(),
+                                      on_written=_invalidate_patients)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(result.to_dict("upserted"))
 
 @app.route('/api/patients/<patient_id>', methods=['GET'])
+@audit.audited('patient.read')
 def get_patient(patient_id):
-    conn = sqlite3.connect('federation.db')
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('SELECT * FROM patients WHERE id = ?', (patient_id,))
     patient = cursor.fetchone()
-    conn.close()
     
     if not patient:
         return jsonify({"error": "Patient not found"}), 404
@@ -173,147 +397,520 @@ def get_patient(patient_id):
     })
 
 @app.route('/api/patients/<patient_id>/qr')
+@admission.limit('qr')
+@audit.audited('patient.qr')
 def generate_patient_qr(patient_id):
     """Generate QR code for patient record access"""
-    try:
-        # Create patient access URL
-        access_url = f"http://localhost:5000/patient-access/{patient_id}"
-        
-        # Generate QR code
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(access_url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Convert to bytes for web response
-        img_bytes = io.BytesIO()
-        img.save(img_bytes, format='PNG')
-        img_bytes.seek(0)
-        
-        return send_file(img_bytes, mimetype='image/png')
-        
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return qr_response(f"{_public_base_url()}/patient-access/{patient_id}")
 
 @app.route('/patient-access/<patient_id>')
 def patient_access(patient_id):
-    """Patient access page"""
-    return open('../frontend/patient-records.html').read()
+    """Patient access page (what QR codes open); the page reads the ID from its URL"""
+    return _frontend_page('patient-records.html')
 
 @app.route('/api/hospitals/<hospital_id>/studies', methods=['GET', 'POST'])
+@http_cache.conditional('studies', 'patients', pools=lambda hospital_id: storage.pools([hospital_id]))
+@admission.limit('listing', methods=('GET',), unless=paged)
 def hospital_studies(hospital_id):
-    conn = sqlite3.connect('federation.db')
-    cursor = conn.cursor()
-    
     if request.method == 'POST':
         data = request.json
         
-        # Generate study ID with a short UUID suffix to ensure uniqueness
-        study_id = f"STU-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
-        
-        cursor.execute('''
-            INSERT INTO studies (id, patient_id, hospital_id, study_date, modality, description, orthanc_study_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (study_id, data['patient_id'], hospital_id, data.get('study_date'), 
-              data.get('modality'), data.get('description'), data.get('orthanc_study_id')))
+        storage.record_patients(hospital_id, [data['patient_id']])
+        conn = storage.get_db(hospital_id)
+        study_id = insert_study(conn, '''
+            INSERT INTO studies (id, patient_id, hospital_id, study_date, modality, description, orthanc_study_id, rowid)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (new_study_id(), data['patient_id'], hospital_id, data.get('study_date'), 
+              data.get('modality'), data.get('description'), data.get('orthanc_study_id'), new_study_key()))[0]
         
         conn.commit()
-        conn.close()
+        federation_cache.invalidate(patient_id=data['patient_id'])
         return jsonify({"message": "Study registered", "study_id": study_id}), 201
     
-    else:  # GET request
-        cursor.execute('''
-            SELECT s.*, p.first_name, p.last_name, p.national_id
+    else:  # GET request - keyset paginated on (study_date, id) when ?limit=/?after= are given
+        try:
+            limit, after = page_args()
+            if after and len(after) != 2:
+                raise ValueError("Invalid cursor")
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        
+        query = f'''
+            SELECT {storage.STUDY_COLUMNS}, p.first_name, p.last_name, p.national_id
             FROM studies s
             JOIN patients p ON s.patient_id = p.id
             WHERE s.hospital_id = ?
-        ''', (hospital_id,))
-        
-        studies = cursor.fetchall()
-        conn.close()
+        '''
+        params = [hospital_id]
+        if after:
+            after_date, after_id = after
+            if after_date is None:
+                # Undated studies sort first; finish them before moving on to dated ones
+                query += ' AND ((s.study_date IS NULL AND s.id > ?) OR s.study_date IS NOT NULL)'
+                params.append(after_id)
+            else:
+                query += ' AND (s.study_date, s.id) > (?, ?)'
+                params += [after_date, after_id]
+        query += ' ORDER BY s.study_date, s.id'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit + 1)
         
-        study_list = []
-        for study in studies:
-            study_list.append({
-                "id": study[0],
-                "patient_id": study[1],
-                "hospital_id": study[2],
-                "study_date": study[3],
-                "modality": study[4],
-                "description": study[5],
-                "orthanc_study_id": study[6],
-                "patient_name": f"{study[8]} {study[9]}",
-                "national_id": study[10]
-            })
+        pool = storage.reader_pool(hospital_id)
+        if wants_ndjson():
+            return stream_ndjson(db.stream(query, params, pool=pool), limit, _study_dict, _study_cursor)
+        if limit is None:
+            return stream_json_array(db.stream(query, params, pool=pool), _study_dict)
         
-        return jsonify(study_list)
+        cursor = storage.get_db(hospital_id, create=False).execute(query, params)
+        return json_page(cursor, limit, _study_dict, _study_cursor)
+
+def _study_dict(study):
+    return {
+        "id": study[0],
+        "patient_id": study[1],
+        "hospital_id": study[2],
+        "study_date": study[3],
+        "modality": study[4],
+        "description": study[5],
+        "orthanc_study_id": study[6],
+        "patient_name": f"{study[8]} {study[9]}",
+        "national_id": study[10]
+    }
+
+def _study_cursor(study):
+    return [study[3], study[0]]
+
+@app.route('/api/hospitals/<hospital_id>/studies/bulk', methods=['POST'])
+def bulk_hospital_studies(hospital_id):
+    """Register many studies for one hospital (JSON array or NDJSON body)"""
+    if _wants_async():
+        return _submit_bulk_job('bulk_studies', hospital_id=hospital_id)
+    try:
+        rows = bulk.iter_request_rows(request)
+        result = bulk.insert_studies(get_db(), rows, hospital_id=hospital_id,
+                                     chunk_size=_bulk_chunk_size(), on_written=_invalidate_studies,
+                                     shards=_bulk_shards())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(result.to_dict("inserted"))
+
+@app.route('/api/studies/bulk', methods=['POST'])
+def bulk_studies():
+    """Register many studies across hospitals; each row carries its hospital_id"""
+    if _wants_async():
+        return _submit_bulk_job('bulk_studies')
+    try:
+        rows = bulk.iter_request_rows(request)
+        result = bulk.insert_studies(get_db(), rows, chunk_size=_bulk_chunk_size(),
+                                     on_written=_invalidate_studies, shards=_bulk_shards())
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(result.to_dict("inserted"))
+
+def _bulk_chunk_size():
+    return app.config.get('BULK_CHUNK_SIZE', bulk.DEFAULT_CHUNK_SIZE)
+
+def _bulk_shards():
+    return storage if storage.sharded() else None
+
+def _submit_bulk_job(kind, **params):
+    """Spool the body to the job's directory and queue it; the request ends here"""
+    job_id = jobs.new_job_id()
+    with open(jobs.runner.file_path(job_id, 'body'), 'wb') as f:
+        shutil.copyfileobj(request.stream, f, 1 << 16)
+    return _submit_job(kind, dict(params, mimetype=request.mimetype), job_id=job_id)
+
+@jobs.handler('bulk_patients')
+def _bulk_patients_job(job, params):
+    rows = bulk.iter_file_rows(job.file_path('body'), params['mimetype'])
+    result = bulk.upsert_patients(get_db(), rows, chunk_size=_bulk_chunk_size(),
+                                  on_written=_bulk_job_progress(job, _invalidate_patients))
+    return result.to_dict("upserted")
+
+@jobs.handler('bulk_studies')
+def _bulk_studies_job(job, params):
+    rows = bulk.iter_file_rows(job.file_path('body'), params['mimetype'])
+    result = bulk.insert_studies(get_db(), rows, hospital_id=params.get('hospital_id'),
+                                 chunk_size=_bulk_chunk_size(), shards=_bulk_shards(),
+                                 on_written=_bulk_job_progress(job, _invalidate_studies))
+    return result.to_dict("inserted")
+
+def _bulk_job_progress(job, invalidate):
+    """on_written for bulk jobs: invalidate, report rows so far, stop between chunks if cancelled"""
+    written = 0
+    def on_written(rows):
+        nonlocal written
+        invalidate(rows)
+        written += len(rows)
+        job.progress(written, message="rows written")
+        job.check_cancelled()
+    return on_written
+
+def _invalidate_patients(rows):
+    for row in rows:
+        federation_cache.invalidate(national_id=row[1], patient_id=row[0])
+
+def _invalidate_studies(rows):
+    _invalidate_patient_ids({row[1] for row in rows})
+
+def _invalidate_patient_ids(patient_ids):
+    for patient_id in patient_ids:
+        federation_cache.invalidate(patient_id=patient_id)
 
 @app.route('/api/studies/<study_id>/qr')
+@admission.limit('qr')
+@audit.audited('study.qr')
 def generate_study_qr(study_id):
     """Generate QR code for specific study"""
+    audit.annotate(patient_id=_study_patients([study_id]).get(study_id))
+    return qr_response(f"{_public_base_url()}/study-access/{study_id}")
+
+def _study_patients(study_ids):
+    """{study_id: patient_id} for the studies found, in every shard (one lookup per 500 IDs each)"""
+    found = {}
+    for start in range(0, len(study_ids), 500):
+        chunk = study_ids[start:start + 500]
+        sql = f"SELECT id, patient_id FROM studies WHERE id IN ({','.join('?' * len(chunk))})"
+        for rows in storage.fan_out(storage.pools(), lambda conn: conn.execute(sql, chunk).fetchall()):
+            found.update(rows)
+    return found
+
+@app.route('/api/studies/<study_id>/preview')
+@admission.limit('preview')
+def study_preview(study_id):
+    """Thumbnail of the study's middle image: ?size=&format=jpeg|webp&hospital_id="""
+    return _preview_response(study_id, None)
+
+@app.route('/api/studies/<study_id>/instances')
+def study_instances(study_id):
+    """The study's DICOM instances, each with its thumbnail URL"""
+    try:
+        instance_ids = dicom_previews.instances(_preview_source(study_id))
+    except (dicom_preview.PreviewNotFound, orthanc.OrthancNotFound) as e:
+        return jsonify({"error": str(e)}), 404
+    except orthanc.OrthancError as e:
+        return jsonify({"error": str(e)}), 502
+    return jsonify({
+        "study_id": study_id,
+        "instances": [{"id": i, "preview_url": f"/api/studies/{study_id}/instances/{i}/preview"}
+                      for i in instance_ids],
+    })
+
+@app.route('/api/studies/<study_id>/instances/<path:instance_id>/preview')
+@admission.limit('preview')
+def instance_preview(study_id, instance_id):
+    """Thumbnail of one instance of the study (IDs from /instances)"""
+    return _preview_response(study_id, instance_id)
+
+def _preview_source(study_id):
+    """Where the study's DICOMs are; the study is looked up in every shard unless ?hospital_id="""
+    hospital_id = request.args.get('hospital_id')
+    rows = storage.fan_out(
+        storage.pools([hospital_id] if hospital_id else None),
+        lambda conn: conn.execute('SELECT orthanc_study_id FROM studies WHERE id = ?', (study_id,)).fetchone())
+    rows = [row for row in rows if row]
+    if not rows:
+        raise dicom_preview.PreviewNotFound("Study not found")
+    return dicom_previews.source(study_id, rows[0][0])
+
+def _preview_response(study_id, instance_id):
+    """Cached thumbnail; If-None-Match is answered without fetching any DICOM"""
+    try:
+        size, fmt = dicom_preview.render_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     try:
-        # Create study access URL
-        access_url = f"http://localhost:5000/study-access/{study_id}"
+        source = _preview_source(study_id)
+        key = dicom_previews.cache_key(source, instance_id, size, fmt)
+        if key in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = Response(dicom_previews.thumbnail(source, instance_id, size, fmt, key=key),
+                                mimetype=dicom_preview.FORMATS[fmt][0])
+    except (dicom_preview.PreviewNotFound, orthanc.OrthancNotFound) as e:
+        return jsonify({"error": str(e)}), 404
+    except dicom_preview.PreviewError as e:
+        return jsonify({"error": str(e)}), 422
+    except orthanc.OrthancError as e:
+        return jsonify({"error": str(e)}), 502
+    response.set_etag(key)
+    response.headers['Cache-Control'] = f"public, max-age={PREVIEW_MAX_AGE}"
+    return response
+
+def _public_base_url():
+    return app.config.get('PUBLIC_BASE_URL', 'http://localhost:5000')
+
+def qr_response(access_url):
+    """Cached PNG for a QR code; If-None-Match is answered without rendering"""
+    try:
+        params = qr.render_params(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    try:
+        key = qr.cache_key(access_url, params)
+        if key in request.if_none_match:
+            response = Response(status=304)
+        else:
+            response = Response(qr_renderer.png(access_url, params, key=key), mimetype='image/png')
+        response.set_etag(key)
+        response.headers['Cache-Control'] = f"public, max-age={QR_MAX_AGE}"
+        return response
         
-        # Generate QR code
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/qr/sheet', methods=['POST'])
+@admission.limit('qr_sheet')
+@audit.audited('qr.sheet')
+def generate_qr_sheet():
+    """One printable sheet (PNG grid or PDF) of QR codes for many patients/studies"""
+    data = request.get_json(silent=True) or {}
+    patient_ids = data.get('patient_ids') or []
+    study_ids = data.get('study_ids') or []
+    fmt = str(data.get('format') or 'png').lower()
+    
+    if not isinstance(patient_ids, list) or not isinstance(study_ids, list):
+        return jsonify({"error": "patient_ids and study_ids must be lists"}), 400
+    if not patient_ids and not study_ids:
+        return jsonify({"error": "Provide patient_ids and/or study_ids"}), 400
+    if len(patient_ids) + len(study_ids) > qr_sheet.MAX_CODES:
+        return jsonify({"error": f"At most {qr_sheet.MAX_CODES} codes per sheet"}), 400
+    if fmt not in ('png', 'pdf'):
+        return jsonify({"error": "format must be png or pdf"}), 400
+    try:
+        columns = int(data.get('columns', 4))
+        if not 1 <= columns <= 20:
+            raise ValueError("columns must be between 1 and 20")
+        params = qr.render_params({k: str(data[k]) for k in qr.DEFAULT_PARAMS if k in data})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Label patient codes with the patient's name (one lookup per 500 IDs)
+    names = {}
+    cursor = get_db().cursor()
+    patient_ids = [str(p) for p in patient_ids]
+    for start in range(0, len(patient_ids), 500):
+        chunk = patient_ids[start:start + 500]
+        cursor.execute(
+            f"SELECT id, first_name, last_name FROM patients WHERE id IN ({','.join('?' * len(chunk))})",
+            chunk
         )
-        qr.add_data(access_url)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        img_bytes = io.BytesIO()
-        img.save(img_bytes, format='PNG')
-        img_bytes.seek(0)
-        
-        return send_file(img_bytes, mimetype='image/png')
-        
+        names.update((row[0], f"{row[1]} {row[2]}") for row in cursor.fetchall())
+    
+    study_ids = [str(s) for s in study_ids]
+    study_patients = _study_patients(study_ids)
+    audit.annotate(patient_ids=patient_ids, studies=[(sid, study_patients.get(sid)) for sid in study_ids])
+    base = _public_base_url()
+    items = [(f"{base}/patient-access/{pid}", f"{pid} - {names[pid]}" if pid in names else pid)
+             for pid in patient_ids]
+    items += [(f"{base}/study-access/{sid}", str(sid)) for sid in study_ids]
+    if _wants_async():
+        return _submit_job('qr_sheet', {"items": items, "params": params, "columns": columns, "format": fmt})
+    
+    try:
+        body, mimetype = qr_sheet.render_sheet(items, params, columns=columns, fmt=fmt,
+                                               workers=app.config.get('QR_SHEET_WORKERS'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'inline; filename="qr-sheet.{fmt}"'
+    return response
+
+@jobs.handler('qr_sheet')
+def _qr_sheet_job(job, params):
+    fmt = params['format']
+    body, mimetype = qr_sheet.render_sheet([tuple(item) for item in params['items']], params['params'],
+                                           columns=params['columns'], fmt=fmt,
+                                           workers=app.config.get('QR_SHEET_WORKERS'))
+    with open(job.file_path(f'qr-sheet.{fmt}'), 'wb') as f:
+        f.write(body)
+    return job.file_result(f'qr-sheet.{fmt}', mimetype, codes=len(params['items']))
+
+@app.route('/api/search')
+@http_cache.conditional('patients', 'studies', 'hospitals')
+def search_records():
+    """Ranked full-text search: ?q=&type=patients|studies|all&limit=&offset="""
+    text = request.args.get('q', '').strip()
+    kind = request.args.get('type', 'all')
+    if not text:
+        return jsonify({"error": "Provide q"}), 400
+    if kind not in ('patients', 'studies', 'all'):
+        return jsonify({"error": "type must be patients, studies or all"}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', search.DEFAULT_LIMIT)), 1), search.MAX_LIMIT)
+        offset = max(int(request.args.get('offset', 0)), 0)
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+
+    terms, date_range = search.parse_query(text)
+    conn = get_db()
+    result = {"query": text, "terms": terms, "limit": limit, "offset": offset}
+    if date_range:
+        result["study_date_from"], result["study_date_to"] = date_range
+
+    # One extra row tells us whether another page exists
+    if kind in ('patients', 'all'):
+        rows = search.search_patients(conn, terms, limit + 1, offset)
+        result["patients"] = [dict(_patient_dict(row), score=row[-1]) for row in rows[:limit]]
+        result["more_patients"] = len(rows) > limit
+    if kind in ('studies', 'all'):
+        if storage.sharded():
+            pools = storage.pools()
+            # Rank on every shard or on none, by the matches of all of them, so that
+            # each shard orders its rows by the keys they are merged on
+            ranked = sum(storage.fan_out(pools, lambda shard: search.study_matches(shard, terms))) \
+                <= search.RANK_WINDOW
+            results = storage.fan_out(pools, lambda shard: search.search_studies(
+                shard, terms, date_range, offset + limit + 1, 0, ranked=ranked))
+            rows = search.merge_studies(results, limit + 1, offset, by_key=bool(terms))
+        else:
+            rows = search.search_studies(conn, terms, date_range, limit + 1, offset)
+        result["studies"] = [dict(_study_dict(row), score=row[-1]) for row in rows[:limit]]
+        result["more_studies"] = len(rows) > limit
+
+    return jsonify(result)
+
+@app.route('/api/export/studies')
+def export_studies():
+    """Studies with patient and hospital fields for analytics
+
+    ?format=csv|arrow|parquet&from=&to=&hospital_id=&modality=
+    Streamed from a read-only connection outside the pool, so a full
+    export neither holds a pooled connection nor blocks writers.
+    """
+    fmt = request.args.get('format', 'csv').lower()
+    try:
+        export.check_format(fmt)
+        query, params = export.studies_query(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except LookupError as e:
+        return jsonify({"error": str(e)}), 501
+
+    slot = export.try_acquire()
+    if slot is None:
+        response = jsonify({"error": "Too many exports running, try again shortly"})
+        response.headers['Retry-After'] = '30'
+        return response, 429
+
+    mimetype, extension = export.FORMATS[fmt]
+    # One read-only connection per studies database (each shard in turn when sharded)
+    readers = [pool.read_only for pool in storage.pools(export.hospital_ids(request.args))]
+    body = export.stream(readers, query, params, fmt,
+                         chunk_rows=app.config.get('EXPORT_CHUNK_ROWS', export.CHUNK_ROWS),
+                         on_finish=slot.release)
+    response = Response(body, mimetype=mimetype)
+    # Also covers a body the server closes before iterating it
+    response.call_on_close(slot.release)
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    response.headers['Content-Disposition'] = f'attachment; filename="studies-{stamp}.{extension}"'
+    return response
+
+def _wants_enrich():
+    return request.args.get('enrich', '').lower() in ('1', 'true', 'yes')
+
+def _queries_peers():
+    # Peers ask each other with ?scope=local, so a query never travels further than one hop
+    return bool(peer_registry) and request.args.get('scope') != 'local'
+
+def _live_federation_result():
+    # Orthanc or peer data: the local table versions don't describe such responses
+    return _wants_enrich() or _queries_peers()
+
+def _federation_cached():
+    """The cached (result, digest) of this query, or None; looked up once per request"""
+    if 'federation_cached' not in g:
+        # Hot patients are served from the cache without touching the database; other
+        # processes' writes are read from patient_changes every FEDERATION_CACHE_SYNC_INTERVAL
+        federation_cache.sync(_federation_change_pools())
+        g.federation_cached = federation_cache.get(
+            federation_cache.key(request.args.get('national_id'), request.args.get('patient_id')))
+    return g.federation_cached
+
+def _federation_revalidation():
+    """Whether this revalidates the cached local result, i.e. gets a 304 (not charged)"""
+    if not request.if_none_match or _live_federation_result():
+        return False
+    cached = _federation_cached()
+    return cached is not None and request.if_none_match.contains_weak(http_cache.content_etag(cached[1]))
 
 @app.route('/api/federation/query')
+@admission.limit('federation', unless=_federation_revalidation)
+@audit.audited('federation.query')
 def federation_query():
-    """Query patient studies across all hospitals"""
-    conn = sqlite3.connect('federation.db')
-    cursor = conn.cursor()
-    
+    """Query patient studies across all hospitals, and across federation peers when configured"""
     national_id = request.args.get('national_id')
     patient_id = request.args.get('patient_id')
     
     if not national_id and not patient_id:
         return jsonify({"error": "Provide national_id or patient_id"}), 400
     
-    query = '''
-        SELECT s.*, p.first_name, p.last_name, p.national_id, h.name as hospital_name
-        FROM studies s
-        JOIN patients p ON s.patient_id = p.id
-        JOIN hospitals h ON s.hospital_id = h.id
-        WHERE 1=1
-    '''
+    cached = _federation_cached()
+    if cached is None:
+        cache_key = federation_cache.key(national_id, patient_id)
+        token = federation_cache.token()
+        result = _federation_lookup(national_id, patient_id)
+        cached = (result, hashlib.sha1(fastjson.dumps(result).encode()).hexdigest())
+        federation_cache.set(cache_key, cached, _federation_tags(result, national_id, patient_id), token)
+    result, digest = cached
+    if result['patient']['id']:
+        audit.annotate(patient_id=result['patient']['id'])
+    
+    if not _live_federation_result():
+        # Tagged by its content, so the tag always describes the body it comes with
+        return http_cache.respond(http_cache.content_etag(digest), lambda: jsonify(result))
+    
+    if _queries_peers():
+        # Only the local part is cached; peers are asked every time (bar recent "unknown here" answers)
+        peer_results, peer_status = peer_registry.query(national_id, patient_id)
+        result = federation_peers.merge(result, peer_results)
+        result["peers"] = peer_status
+        result["partial"] = any(p["status"] in ('timeout', 'error', 'rate_limited', 'circuit_open')
+                                for p in peer_status)
+    
+    if _wants_enrich():
+        # Enrichment is live Orthanc data: decorate a copy, never the cached entry.
+        # Studies from peers reference their own Orthanc, not ours.
+        result = dict(result, studies=[dict(s) for s in result['studies']])
+        _enrich_with_orthanc([s for s in result['studies'] if not s.get('peer')])
+    
+    return jsonify(result)
+
+FEDERATION_STUDIES = f'''
+    SELECT {storage.STUDY_COLUMNS}, p.first_name, p.last_name, p.national_id, h.name as hospital_name,
+           s.study_instance_uid
+    FROM studies s
+    JOIN patients p ON s.patient_id = p.id
+    JOIN hospitals h ON s.hospital_id = h.id
+    WHERE s.patient_id = ?
+'''
+
+def _federation_lookup(national_id, patient_id):
+    query = 'SELECT id FROM patients WHERE 1=1'
     params = []
     
     if national_id:
-        query += ' AND p.national_id = ?'
+        query += ' AND national_id = ?'
         params.append(national_id)
     
     if patient_id:
-        query += ' AND p.id = ?'
+        query += ' AND id = ?'
         params.append(patient_id)
     
-    cursor.execute(query, params)
-    studies = cursor.fetchall()
-    conn.close()
+    patient = get_db().execute(query, params).fetchone()
+    studies = []
+    if patient:
+        # Every shard holding the patient's studies, queried in parallel
+        # (a single query against the main database unless sharded)
+        for rows in storage.fan_out(storage.pools_for_patient(patient[0]),
+                                    lambda conn: conn.execute(FEDERATION_STUDIES, (patient[0],)).fetchall()):
+            studies += rows
+        studies.sort(key=lambda study: (study[3] is not None, study[3] or ''))
     
     study_list = []
     for study in studies:
@@ -327,10 +924,11 @@ def federation_query():
             "orthanc_study_id": study[6],
             "patient_name": f"{study[8]} {study[9]}",
             "national_id": study[10],
-            "hospital_name": study[11]
+            "hospital_name": study[11],
+            "study_instance_uid": study[12]
         })
     
-    return jsonify({
+    return {
         "patient": {
             "id": study_list[0]['patient_id'] if study_list else None,
             "name": study_list[0]['patient_name'] if study_list else None,
@@ -339,143 +937,347 @@ def federation_query():
         "studies": study_list,
         "total_studies": len(study_list),
         "hospitals_accessed": len(set(s['hospital_id'] for s in study_list))
+    }
+
+def _federation_change_pools():
+    """Every database a federation result is read from, the main one first"""
+    return [db.get_pool()] + (storage.pools() if storage.sharded() else [])
+
+def _federation_tags(result, national_id, patient_id):
+    """Both identifiers of the patient a cached result describes"""
+    patient = result['patient']
+    if patient['id'] is None:
+        # No studies yet: look the patient up so a first study filed under
+        # either identifier still evicts this (empty) entry
+        row = get_db().execute(
+            'SELECT id, national_id FROM patients WHERE id = ? OR national_id = ?',
+            (patient_id, national_id)
+        ).fetchone()
+        patient = {"id": row[0], "national_id": row[1]} if row else patient
+    return (federation_cache.tags_for(national_id, patient_id)
+            | federation_cache.tags_for(patient['national_id'], patient['id']))
+
+@app.route('/api/federation/cache')
+def federation_cache_stats():
+    return jsonify(federation_cache.stats())
+
+@app.route('/api/federation/peers')
+def federation_peer_status():
+    """Configured peers with their circuit breaker states"""
+    return jsonify({"peers": peer_registry.stats(), "deadline": peer_registry.deadline})
+
+@app.route('/api/admission')
+def admission_status():
+    """Rate limits and concurrency caps per route class, with the requests in progress here"""
+    return jsonify(admission.admission.stats())
+
+def _enrich_with_orthanc(study_list):
+    """Attach Orthanc metadata to each study, fetched concurrently under one deadline"""
+    orthanc_ids = [s['orthanc_study_id'] for s in study_list if s['orthanc_study_id']]
+    if not orthanc_ids:
+        return
+    summaries = orthanc.get_client(app.config).study_summaries(
+        orthanc_ids, deadline=app.config.get('ORTHANC_ENRICH_DEADLINE', 3.0))
+    for study in study_list:
+        if study['orthanc_study_id']:
+            study['orthanc'] = summaries.get(study['orthanc_study_id'])
+
+@app.route('/api/dashboard/summary')
+@http_cache.conditional('hospitals', 'patients', 'studies')
+def dashboard_summary():
+    """Everything the dashboard shows, in one request"""
+    try:
+        recent = min(max(int(request.args.get('recent', 10)), 0), 100)
+    except ValueError:
+        return jsonify({"error": "recent must be an integer"}), 400
+    
+    cursor = get_db().cursor()
+    
+    cursor.execute('SELECT (SELECT COUNT(*) FROM hospitals), (SELECT COUNT(*) FROM patients)')
+    hospital_count, patient_count = cursor.fetchone()
+    
+    cursor.execute('SELECT id, name FROM hospitals ORDER BY id')
+    by_hospital = {h_id: {"hospital_id": h_id, "hospital_name": name, "studies": 0, "modalities": {}}
+                   for h_id, name in cursor.fetchall()}
+    
+    # Single pass over the (hospital_id, modality) index for every study total
+    # (per shard, in parallel, when studies are sharded)
+    shards = storage.pools()
+    totals = storage.fan_out(shards, lambda conn: conn.execute('''
+        SELECT hospital_id, modality, COUNT(*)
+        FROM studies
+        GROUP BY hospital_id, modality
+    ''').fetchall())
+    by_modality = {}
+    study_count = 0
+    for h_id, modality, count in (row for rows in totals for row in rows):
+        study_count += count
+        by_modality[modality] = by_modality.get(modality, 0) + count
+        hospital = by_hospital.setdefault(
+            h_id, {"hospital_id": h_id, "hospital_name": None, "studies": 0, "modalities": {}})
+        hospital["studies"] += count
+        hospital["modalities"][modality or "unknown"] = count
+    
+    newest = storage.fan_out(shards, lambda conn: conn.execute(f'''
+        SELECT {storage.STUDY_COLUMNS}, p.first_name, p.last_name, p.national_id, h.name as hospital_name
+        FROM studies s
+        JOIN patients p ON s.patient_id = p.id
+        LEFT JOIN hospitals h ON s.hospital_id = h.id
+        ORDER BY s.study_date DESC
+        LIMIT ?
+    ''', (recent,)).fetchall())
+    rows = sorted((row for rows in newest for row in rows),
+                  key=lambda row: (row[3] is not None, row[3] or ''), reverse=True)[:recent]
+    recent_studies = [dict(_study_dict(row), hospital_name=row[11]) for row in rows]
+    
+    return jsonify({
+        "hospital_count": hospital_count,
+        "patient_count": patient_count,
+        "study_count": study_count,
+        "studies_by_hospital": list(by_hospital.values()),
+        "studies_by_modality": [{"modality": m, "studies": n} for m, n in
+                                sorted(by_modality.items(), key=lambda item: -item[1])],
+        "recent_studies": recent_studies
     })
 
+@app.route('/api/orthanc/sync', methods=['GET', 'POST'])
+def orthanc_sync_status():
+    """Change-feed sync status; POST runs one pass immediately"""
+    synchronizer = get_orthanc_synchronizer()
+    if synchronizer is None:
+        return jsonify({"error": "Set ORTHANC_SYNC_HOSPITAL_ID to enable Orthanc sync"}), 404
+    if request.method == 'POST':
+        if _wants_async():
+            return _submit_job('orthanc_sync')
+        try:
+            result = synchronizer.run_once()
+        except orthanc.OrthancError as e:
+            return jsonify({"error": str(e)}), 502
+        return jsonify(result)
+    return jsonify(synchronizer.status())
+
+@jobs.handler('orthanc_sync')
+def _orthanc_sync_job(job, params):
+    """Catch up with the whole change feed, one page at a time"""
+    synchronizer = get_orthanc_synchronizer()
+    if synchronizer is None:
+        raise ValueError("Set ORTHANC_SYNC_HOSPITAL_ID to enable Orthanc sync")
+    totals = {"pages": 0, "studies": 0, "pending": 0}
+    while True:
+        stats = synchronizer.run_once()
+        totals["pages"] += 1
+        totals["studies"] += stats["studies"]
+        totals["pending"] += stats["pending"]
+        totals["last"] = stats["last"]
+        job.progress(totals["studies"], message=f"change feed at {stats['last']}")
+        if stats["done"]:
+            return totals
+        job.check_cancelled()
+
+_orthanc_synchronizer = None
+
+def get_orthanc_synchronizer():
+    global _orthanc_synchronizer
+    if _orthanc_synchronizer is None and app.config.get('ORTHANC_SYNC_HOSPITAL_ID'):
+        _orthanc_synchronizer = orthanc_sync.from_config(
+            orthanc.get_client(app.config), app.config,
+            on_written=_invalidate_patient_ids)
+    return _orthanc_synchronizer
+
+def _wants_async():
+    """?async=1 or Prefer: respond-async: queue the work as a background job"""
+    return (request.args.get('async', '').lower() in ('1', 'true', 'yes')
+            or 'respond-async' in request.headers.get('Prefer', ''))
+
+def _submit_job(kind, params=None, job_id=None):
+    """202 Accepted with the job's ID; its status URL is also the Location"""
+    job_id = jobs.runner.submit(kind, params, job_id=job_id)
+    status_url = f"/api/jobs/{job_id}"
+    response = jsonify({"job_id": job_id, "status": "queued", "status_url": status_url})
+    response.headers['Location'] = status_url
+    return response, 202
+
+@app.route('/api/jobs')
+def list_jobs():
+    """Recent background jobs, newest first: ?status=&kind=&limit="""
+    status = request.args.get('status')
+    if status and status not in jobs.STATUSES:
+        return jsonify({"error": f"status must be one of {', '.join(jobs.STATUSES)}"}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    return jsonify({"jobs": jobs.runner.list(status=status, kind=request.args.get('kind'), limit=limit)})
+
+@app.route('/api/jobs/<job_id>', methods=['GET', 'DELETE'])
+def get_job(job_id):
+    """A job's status and progress; DELETE cancels it, like POST .../cancel"""
+    if request.method == 'DELETE':
+        return cancel_job(job_id)
+    job = jobs.runner.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel a queued job; a running one stops at its next checkpoint"""
+    job = jobs.runner.cancel(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 202 if job['status'] == 'running' else 200
+
+@app.route('/api/jobs/<job_id>/result')
+def job_result(job_id):
+    """What the job produced: a file (e.g. a QR sheet) or its JSON result"""
+    job = jobs.runner.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job['status'] != 'succeeded':
+        return jsonify({"error": f"Job is {job['status']}", "job": job}), 409
+    path = jobs.runner.result_file(job)
+    if path is None:
+        return jsonify(job['result'])
+    if not os.path.exists(path):
+        return jsonify({"error": "Result file no longer available"}), 410
+    return send_file(path, mimetype=job['result']['mimetype'], download_name=job['result']['file'])
+
+@app.route('/api/audit/events')
+def audit_events():
+    """Access events, newest first: ?patient_id= &national_id= &actor= &action= &from= &to= &limit= &after="""
+    try:
+        limit, after = page_args()
+        if after and (len(after) != 2 or not isinstance(after[1], int)):
+            raise ValueError("Invalid cursor")
+        since, until = audit.time_range(request.args.get('from'), request.args.get('to'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    limit = limit or DEFAULT_LIMIT
+    filters = {k: request.args.get(k) for k in ('patient_id', 'national_id', 'actor', 'action')}
+    rows = audit.audit_log.events(limit, after=after, since=since, until=until, **filters)
+    columns = ['ts'] + [c.strip() for c in audit.COLUMNS.split(',')][1:]
+    return json_page(rows, limit, lambda row: dict(zip(columns, row[2:])), lambda row: [row[0], row[1]])
+
+@app.route('/api/audit/patients/<patient_id>')
+def audit_patient(patient_id):
+    """Who accessed a patient's data, how often and when (?from= &to=)"""
+    try:
+        since, until = audit.time_range(request.args.get('from'), request.args.get('to'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    row = get_db().execute('SELECT national_id FROM patients WHERE id = ?', (patient_id,)).fetchone()
+    accessors = audit.audit_log.accessors(patient_id, national_id=row[0] if row else None,
+                                          since=since, until=until)
+    return jsonify({"patient_id": patient_id, "accessors": accessors,
+                    "accesses": sum(a["accesses"] for a in accessors)})
+
+@app.route('/api/audit/status')
+def audit_status():
+    """Audit queue, writer and segment state"""
+    return jsonify(audit.audit_log.stats())
+
 @app.route('/federation-access')
 def federation_access_page():
-    """Page for cross-hospital access"""
-    national_id = request.args.get('national_id')
-    
-    html = f"""
-    <html>
-    <head><title>Federation Access</title></head>
-    <body>
-        <h1>Cross-Hospital Medical Access</h1>
-        <form method="GET">
-            <label>National ID: </label>
-            <input type="text" name="national_id" value="{national_id or ''}">
-            <button type="submit">Search</button>
-        </form>
-    """
-    
-    if national_id:
-        html += f"""
-        <div id="results">
-            <h2>Searching for: {national_id}</h2>
-            <div id="results-content">Loading...</div>
-        </div>
-        <script>
-            fetch('/api/federation/query?national_id={national_id}')
-                .then(r => r.json())
-                .then(data => {{
-                    const content = document.getElementById('results-content');
-                    if (data.studies.length > 0) {{
-                        content.innerHTML = `
-                            <h3>Patient: ${{data.patient.name}}</h3>
-                            <p>Total Studies: ${{data.total_studies}} across ${{data.hospitals_accessed}} hospitals</p>
-                            <ul>
-                                ${{data.studies.map(study => `
-                                    <li>
-                                        <strong>${{study.description}}</strong> - 
-                                        ${{study.hospital_name}} - 
-                                        ${{new Date(study.study_date).toLocaleDateString()}}
-                                        <a href="/api/studies/${{study.study_id}}/qr" target="_blank">QR Code</a>
-                                    </li>
-                                `).join('')}}
-                            </ul>
-                        `;
-                    }} else {{
-                        content.innerHTML = '<p>No studies found for this patient.</p>';
-                    }}
-                }});
-        </script>
-        """
-    
-    html += "</body></html>"
-    return html
+    """Page for cross-hospital access; ?national_id= is read by its script"""
+    return _frontend_page('federation-access.html')
 
 @app.route('/dashboard')
 def dashboard():
-    try:
-        return send_from_directory('../frontend', 'dashboard.html')
-    except:
-        return "Dashboard file not found", 404
+    return _frontend_page('dashboard.html')
 
 @app.route('/frontend/<path:path>')
 def serve_frontend(path):
-    return send_from_directory('../frontend', path)
+    return _frontend_page(path)
+
+def _frontend_page(path):
+    response = frontend_assets.response(path)
+    if response is None:
+        return "File not found", 404
+    return response
 
 @app.route('/api/admin/reset-demo', methods=['POST'])
 def reset_demo():
     """Admin endpoint to safely re-run demo data creation (idempotent)"""
+    if _wants_async():
+        return _submit_job('reset_demo')
     try:
-        conn = sqlite3.connect('federation.db')
-        cursor = conn.cursor()
-        
-        # Create hospitals (skip if exist)
-        hospitals = [
-            ("HOS-001", "Central General Hospital", "123 Main St"),
-            ("HOS-002", "City Medical Center", "456 Health Ave"),
-            ("HOS-003", "Regional Hospital", "789 Care Road")
-        ]
-        
-        for h_id, name, addr in hospitals:
-            try:
-                cursor.execute('INSERT INTO hospitals (id, name, address) VALUES (?, ?, ?)', (h_id, name, addr))
-            except sqlite3.IntegrityError:
-                pass  # Hospital exists
-        
-        # Create patients (skip if exist)
-        patients = [
-            ("PAT-901234", "199012345678901234", "John", "Doe", "1990-05-15", "M"),
-            ("PAT-556677", "198511223344556677", "Mary", "Smith", "1985-11-22", "F"),
-            ("PAT-554433", "197808997766554433", "Robert", "Johnson", "1978-08-09", "M")
-        ]
-        
-        for p_id, nat_id, fname, lname, dob, gender in patients:
-            try:
-                cursor.execute(
-                    'INSERT INTO patients (id, national_id, first_name, last_name, date_of_birth, gender) VALUES (?, ?, ?, ?, ?, ?)',
-                    (p_id, nat_id, fname, lname, dob, gender)
-                )
-            except sqlite3.IntegrityError:
-                pass  # Patient exists
-        
-        # Create studies (always new with unique IDs)
-        studies = [
-            ("PAT-901234", "HOS-001", "2024-01-15 10:30:00", "XR", "Chest X-Ray"),
-            ("PAT-901234", "HOS-002", "2024-01-20 14:15:00", "CT", "Head CT Scan"),
-            ("PAT-556677", "HOS-003", "2024-01-18 09:45:00", "US", "Abdominal Ultrasound"),
-            ("PAT-554433", "HOS-001", "2024-01-22 11:20:00", "XR", "Spine X-Ray")
-        ]
-        
-        for p_id, h_id, study_date, modality, desc in studies:
-            study_id = f"STU-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
-            cursor.execute(
-                'INSERT INTO studies (id, patient_id, hospital_id, study_date, modality, description) VALUES (?, ?, ?, ?, ?, ?)',
-                (study_id, p_id, h_id, study_date, modality, desc)
-            )
-        
-        conn.commit()
-        conn.close()
-        
-        return jsonify({
-            "message": "Demo data reset successfully",
-            "hospitals": len(hospitals),
-            "patients": len(patients),
-            "studies": len(studies)
-        }), 200
+        return jsonify(dict(_reset_demo_data(), message="Demo data reset successfully")), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@jobs.handler('reset_demo')
+def _reset_demo_job(job, params):
+    return _reset_demo_data()
+
+def _reset_demo_data():
+    """Create the demo hospitals and patients if missing, plus a fresh set of studies"""
+    conn = get_db()
+    cursor = conn.cursor()
+    
+    # Create hospitals (skip if exist)
+    hospitals = [
+        ("HOS-001", "Central General Hospital", "123 Main St"),
+        ("HOS-002", "City Medical Center", "456 Health Ave"),
+        ("HOS-003", "Regional Hospital", "789 Care Road")
+    ]
+    
+    for h_id, name, addr in hospitals:
+        try:
+            cursor.execute('INSERT INTO hospitals (id, name, address) VALUES (?, ?, ?)', (h_id, name, addr))
+        except sqlite3.IntegrityError:
+            pass  # Hospital exists
+    
+    # Create patients (skip if exist)
+    patients = [
+        ("PAT-901234", "199012345678901234", "John", "Doe", "1990-05-15", "M"),
+        ("PAT-556677", "198511223344556677", "Mary", "Smith", "1985-11-22", "F"),
+        ("PAT-554433", "197808997766554433", "Robert", "Johnson", "1978-08-09", "M")
+    ]
+    
+    for p_id, nat_id, fname, lname, dob, gender in patients:
+        try:
+            cursor.execute(
+                'INSERT INTO patients (id, national_id, first_name, last_name, date_of_birth, gender) VALUES (?, ?, ?, ?, ?, ?)',
+                (p_id, nat_id, fname, lname, dob, gender)
+            )
+        except sqlite3.IntegrityError:
+            pass  # Patient exists
+    
+    # Create studies (always new with unique IDs)
+    studies = [
+        ("PAT-901234", "HOS-001", "2024-01-15 10:30:00", "XR", "Chest X-Ray"),
+        ("PAT-901234", "HOS-002", "2024-01-20 14:15:00", "CT", "Head CT Scan"),
+        ("PAT-556677", "HOS-003", "2024-01-18 09:45:00", "US", "Abdominal Ultrasound"),
+        ("PAT-554433", "HOS-001", "2024-01-22 11:20:00", "XR", "Spine X-Ray")
+    ]
+    
+    conn.commit()
+    
+    for p_id, h_id, study_date, modality, desc in studies:
+        storage.record_patients(h_id, [p_id])
+        shard = storage.get_db(h_id)
+        insert_study(
+            shard,
+            'INSERT INTO studies (id, patient_id, hospital_id, study_date, modality, description, rowid) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (new_study_id(), p_id, h_id, study_date, modality, desc, new_study_key())
+        )
+        shard.commit()
+    federation_cache.clear()
+    return {"hospitals": len(hospitals), "patients": len(patients), "studies": len(studies)}
+
 if __name__ == '__main__':
-    # Initialize database on first run
-    if not os.path.exists('federation.db'):
-        init_db()
+    # Create the database on first run and apply any pending migrations
+    init_db()
+    
+    if app.config.get('ORTHANC_SYNC_ENABLED') and get_orthanc_synchronizer():
+        get_orthanc_synchronizer().start()
+        print("🔄 Orthanc change-feed sync running")
     
     print("🚀 Starting XRay Federation System...")
     print("📍 Access at: http://localhost:5000")
     print("📍 API Status: http://localhost:5000/api/status")
     print("📍 Dashboard: http://localhost:5000/dashboard")
     
-    app.run(debug=True, host='0.0.0.0', port=5000)
+    # Development server only; production runs wsgi.py under gunicorn/waitress
+    app.run(debug=app.config.get('DEBUG', False), host='0.0.0.0', port=5000)
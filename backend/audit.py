@@ -0,0 +1,449 @@
+"""
+XRay Federation System - Access audit log
+Every read of a patient's data (patient records, federation lookups, QR
+codes) is recorded: when, by whom (the AUDIT_USER_HEADER a proxy or kiosk
+sets, and the client address), which patient or study, through which
+route and with what outcome.
+
+Routes never write the log themselves. @audited puts the event on a
+bounded in-memory queue and a writer thread per process appends whatever
+has accumulated in one transaction (group commit), into SQLite segment
+files of their own under AUDIT_DIR, one per month (or day), so auditing
+never takes the main database's writer lock. Segments are append-only
+(triggers reject UPDATE and DELETE) and are only ever removed whole,
+once older than AUDIT_RETENTION_DAYS (0 = kept forever).
+
+Durability: a batch is committed with synchronous=FULL, so once written
+an event survives a power loss. Until then it is only in memory: a
+process killed outright loses what is queued (normally well under a
+second's worth); a clean exit (atexit, gunicorn's worker_exit) drains
+the queue first.
+
+Backpressure: when the queue is full, because the disk is slow or the
+writer keeps failing, AUDIT_ON_FULL decides. 'reject' (the default)
+waits up to AUDIT_ENQUEUE_TIMEOUT for room and otherwise answers 503 in
+place of the data, so nothing is ever disclosed unaudited; 'drop' serves
+the data and only counts the lost event.
+"""
+import atexit
+import functools
+import glob
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from flask import g, jsonify, make_response, request
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_ENQUEUE_TIMEOUT = 0.5   # seconds a request waits for queue room under 'reject'
+ON_FULL = ('reject', 'drop')
+SEGMENTS = {'month': 7, 'day': 10}   # length of the timestamp prefix naming a segment
+SEGMENT_PREFIX = 'audit-'
+SEGMENT_SUFFIX = '.db'
+RETRY_DELAYS = (0.1, 0.5, 1.0, 2.0, 5.0)   # after a failed write; the last one repeats
+
+COLUMNS = 'ts, action, patient_id, national_id, study_id, actor, client, method, path, status'
+
+SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS audit_events (
+        id INTEGER PRIMARY KEY,
+        ts TEXT NOT NULL,           -- UTC, YYYY-MM-DD HH:MM:SS.mmm
+        action TEXT NOT NULL,
+        patient_id TEXT,
+        national_id TEXT,
+        study_id TEXT,
+        actor TEXT,
+        client TEXT,
+        method TEXT,
+        path TEXT,
+        status INTEGER
+    )
+    ''',
+    # Newest first per patient/actor: the rowid is the index's implicit last column
+    'CREATE INDEX IF NOT EXISTS idx_audit_patient ON audit_events (patient_id)',
+    'CREATE INDEX IF NOT EXISTS idx_audit_national_id ON audit_events (national_id)',
+    'CREATE INDEX IF NOT EXISTS idx_audit_actor ON audit_events (actor)',
+    '''
+    CREATE TRIGGER IF NOT EXISTS audit_events_no_update BEFORE UPDATE ON audit_events BEGIN
+        SELECT RAISE(ABORT, 'the audit log is append-only');
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS audit_events_no_delete BEFORE DELETE ON audit_events BEGIN
+        SELECT RAISE(ABORT, 'the audit log is append-only');
+    END
+    ''',
+]
+
+
+class AuditUnavailable(Exception):
+    """The event could not be queued and the policy is to refuse the access"""
+
+
+def _now():
+    now = datetime.now(timezone.utc)
+    return now.strftime('%Y-%m-%d %H:%M:%S.') + f'{now.microsecond // 1000:03d}'
+
+
+def _bound(value, end=False):
+    """A date or 'YYYY-MM-DD HH:MM[:SS]' as a timestamp to compare with"""
+    value = value.strip().replace('T', ' ')
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            parsed = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        if end and fmt == '%Y-%m-%d':
+            return parsed.strftime('%Y-%m-%d') + ' 23:59:59.999'
+        return parsed.strftime('%Y-%m-%d %H:%M:%S') + ('.999' if end else '.000')
+    raise ValueError(f"Invalid date {value!r}; use YYYY-MM-DD or YYYY-MM-DD HH:MM:SS")
+
+
+def time_range(since, until):
+    """?from= and ?to= as (since, until) timestamps, either None; to a date means the whole day"""
+    return (_bound(since) if since else None), (_bound(until, end=True) if until else None)
+
+
+class AuditLog:
+    """The queue, this process's writer thread, and reads over the segments"""
+
+    def __init__(self, directory='audit', enabled=True, queue_size=DEFAULT_QUEUE_SIZE,
+                 batch_size=DEFAULT_BATCH_SIZE, on_full='reject', enqueue_timeout=DEFAULT_ENQUEUE_TIMEOUT,
+                 segment='month', retention_days=0, user_header='X-User'):
+        if on_full not in ON_FULL:
+            raise ValueError(f"AUDIT_ON_FULL must be one of {', '.join(ON_FULL)}")
+        if segment not in SEGMENTS:
+            raise ValueError(f"AUDIT_SEGMENT must be one of {', '.join(SEGMENTS)}")
+        self.directory = directory
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.on_full = on_full
+        self.enqueue_timeout = enqueue_timeout
+        self.segment = segment
+        self.retention_days = retention_days
+        self.user_header = user_header
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._connections = {}   # segment -> connection, writer thread only
+        self._next_cleanup = 0.0
+        self.written = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.batches = 0
+        self.last_error = None
+
+    # -- recording -------------------------------------------------------------
+
+    def record(self, action, patient_id=None, national_id=None, study_id=None, status=None):
+        """Queue one event for the current request; False if it was lost (see AUDIT_ON_FULL)
+
+        Raises AuditUnavailable instead when the policy is to refuse.
+        """
+        if not self.enabled:
+            return True
+        self.start()
+        event = (_now(), action, patient_id, national_id, study_id,
+                 request.headers.get(self.user_header), request.remote_addr,
+                 request.method, request.path, status)
+        try:
+            if self.on_full == 'reject':
+                self._queue.put(event, timeout=self.enqueue_timeout)
+            else:
+                self._queue.put_nowait(event)
+        except queue.Full:
+            if self.on_full == 'reject':
+                self.rejected += 1
+                metrics.audit_events.inc('rejected')
+                raise AuditUnavailable()
+            self.dropped += 1
+            metrics.audit_events.inc('dropped')
+            return False
+        return True
+
+    def start(self):
+        """Start this process's writer (lazily, so forked workers get their own)"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._write_loop, name='audit-writer', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+        atexit.register(self.close)
+
+    def close(self, timeout=5.0):
+        """Write out what is queued and stop the writer"""
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        self._pid = None
+        self._thread = None
+
+    def reset_after_fork(self):
+        """A forked worker starts its own writer on first use; the parent's queue isn't its to write"""
+        self._queue = queue.Queue(maxsize=self._queue.maxsize)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._thread = None
+        self._pid = None
+
+    # -- the writer --------------------------------------------------------------
+
+    def _write_loop(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=0.5)]
+            except queue.Empty:
+                if self._stop.is_set():
+                    break
+                self._cleanup()
+                continue
+            # Group commit: everything that queued up while the last batch was written
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write_with_retry(batch)
+            metrics.audit_queue.set(self._queue.qsize())
+        for conn in self._connections.values():
+            conn.close()
+        self._connections = {}
+
+    def _write_with_retry(self, batch):
+        """Retry until written; meanwhile the queue fills up and AUDIT_ON_FULL takes over"""
+        attempt = 0
+        while True:
+            try:
+                self._write(batch)
+                return
+            except Exception as e:  # disk full, directory gone, locked...: the writer must live on
+                self.last_error = f"{_now()}: {e}"
+                log.error("Audit write of %d events failed: %s", len(batch), e)
+                for conn in self._connections.values():
+                    conn.close()
+                self._connections = {}
+            if self._stop.is_set() and attempt >= 2:
+                break
+            time.sleep(RETRY_DELAYS[min(attempt, len(RETRY_DELAYS) - 1)])
+            attempt += 1
+        self.dropped += len(batch)
+        metrics.audit_events.inc('dropped', amount=len(batch))
+        log.error("Gave up on %d audit events at shutdown", len(batch))
+
+    def _write(self, batch):
+        by_segment = {}
+        for event in batch:
+            by_segment.setdefault(event[0][:SEGMENTS[self.segment]], []).append(event)
+        for key, events in by_segment.items():
+            conn = self._connection(key)
+            with conn:
+                conn.executemany(f'INSERT INTO audit_events ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 events)
+        # Segments of earlier months/days are finished with
+        current = max(by_segment)
+        for key in [k for k in self._connections if k < current]:
+            self._connections.pop(key).close()
+        self.written += len(batch)
+        self.batches += 1
+        metrics.audit_events.inc('written', amount=len(batch))
+
+    def _connection(self, key):
+        conn = self._connections.get(key)
+        if conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.path(key), timeout=30.0, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            # One fsync per batch, not per event: the point of batching
+            conn.execute('PRAGMA synchronous=FULL')
+            with conn:
+                for statement in SCHEMA:
+                    conn.execute(statement)
+            self._connections[key] = conn
+        return conn
+
+    def _cleanup(self):
+        """Remove segments past the retention period (checked at most hourly)"""
+        if not self.retention_days or time.monotonic() < self._next_cleanup:
+            return
+        self._next_cleanup = time.monotonic() + 3600
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.retention_days)).strftime('%Y-%m-%d')
+        for key in self.segments():
+            # A segment is expired once its whole period lies before the cutoff
+            if key < cutoff[:len(key)]:
+                for path in glob.glob(self.path(key) + '*'):
+                    os.remove(path)
+                log.info("Removed audit segment %s (older than %d days)", key, self.retention_days)
+
+    # -- reading -----------------------------------------------------------------
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{SEGMENT_PREFIX}{key}{SEGMENT_SUFFIX}')
+
+    def segments(self):
+        """Segment keys ('2026-10' or '2026-10-17'), newest first"""
+        names = glob.glob(os.path.join(self.directory, f'{SEGMENT_PREFIX}*{SEGMENT_SUFFIX}'))
+        return sorted((os.path.basename(n)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)] for n in names),
+                      reverse=True)
+
+    def _read(self, since, until):
+        """(key, read-only connection) per segment that can hold events in [since, until], newest first"""
+        for key in self.segments():
+            if (since and key < since[:len(key)]) or (until and key > until[:len(key)]):
+                continue
+            try:
+                conn = sqlite3.connect(f'file:{self.path(key)}?mode=ro', uri=True, timeout=5.0)
+            except sqlite3.OperationalError:
+                continue   # removed by retention meanwhile
+            try:
+                yield key, conn
+            finally:
+                conn.close()
+
+    def events(self, limit, after=None, since=None, until=None, **filters):
+        """Up to limit + 1 events matching the filters, newest first, from after = [segment, id]
+
+        filters: patient_id, national_id, actor, action (exact matches).
+        """
+        where, params = [], []
+        for column in ('patient_id', 'national_id', 'actor', 'action'):
+            if filters.get(column):
+                where.append(f'{column} = ?')
+                params.append(filters[column])
+        if since:
+            where.append('ts >= ?')
+            params.append(since)
+        if until:
+            where.append('ts <= ?')
+            params.append(until)
+        rows = []
+        for key, conn in self._read(since, until):
+            if after and key > after[0]:
+                continue
+            clauses, values = list(where), list(params)
+            if after and key == after[0]:
+                clauses.append('id < ?')
+                values.append(after[1])
+            sql = (f'SELECT id, {COLUMNS} FROM audit_events'
+                   + (' WHERE ' + ' AND '.join(clauses) if clauses else '')
+                   + ' ORDER BY id DESC LIMIT ?')
+            rows += [(key,) + row for row in conn.execute(sql, values + [limit + 1 - len(rows)])]
+            if len(rows) > limit:
+                break
+        return rows
+
+    def accessors(self, patient_id, national_id=None, since=None, until=None):
+        """Who accessed a patient: per (actor, client), how often, first and last, by action
+
+        Events naming only the national_id (lookups by it that never reached
+        the database, e.g. revalidations answered 304) count when it is given.
+        """
+        range_sql, range_params = '', []
+        if since:
+            range_sql += ' AND ts >= ?'
+            range_params.append(since)
+        if until:
+            range_sql += ' AND ts <= ?'
+            range_params.append(until)
+        merged = {}
+        for _, conn in self._read(since, until):
+            for actor, client, action, count, first, last in conn.execute(
+                    f'SELECT actor, client, action, COUNT(*), MIN(ts), MAX(ts) FROM audit_events '
+                    f'WHERE (patient_id = ? OR national_id = ?){range_sql} GROUP BY actor, client, action',
+                    [patient_id, national_id] + range_params):
+                entry = merged.setdefault((actor, client), {
+                    "actor": actor, "client": client, "accesses": 0, "actions": {},
+                    "first_access": first, "last_access": last})
+                entry["accesses"] += count
+                entry["actions"][action] = entry["actions"].get(action, 0) + count
+                entry["first_access"] = min(entry["first_access"], first)
+                entry["last_access"] = max(entry["last_access"], last)
+        return sorted(merged.values(), key=lambda e: e["last_access"], reverse=True)
+
+    def stats(self):
+        return {"enabled": self.enabled, "directory": os.path.abspath(self.directory),
+                "segment": self.segment, "segments": len(self.segments()),
+                "retention_days": self.retention_days, "on_full": self.on_full,
+                "queue": {"depth": self._queue.qsize(), "size": self._queue.maxsize},
+                "writer_running": self._thread is not None and self._thread.is_alive(),
+                "written": self.written, "batches": self.batches, "dropped": self.dropped,
+                "rejected": self.rejected, "last_error": self.last_error}
+
+
+audit_log = AuditLog(enabled=False)
+
+
+def configure(**settings):
+    """Replace the process's audit log (writing out the old one's queue first)"""
+    global audit_log
+    audit_log.close()
+    audit_log = AuditLog(**settings)
+    return audit_log
+
+
+def reset_after_fork():
+    audit_log.reset_after_fork()
+
+
+def annotate(**subject):
+    """Name the patient(s)/study(ies) a request turned out to access, for @audited
+
+    patient_id, national_id, study_id, or patient_ids / studies for one
+    event each (QR sheets); studies are (study_id, patient_id) pairs, the
+    patient None if unknown, so a patient's accesses include its studies'.
+    """
+    g.setdefault('audit_subject', {}).update(subject)
+
+
+def audited(action):
+    """Decorator: record an access event once the view has answered
+
+    The subject is taken from the query string (patient_id / national_id),
+    the URL (patient_id / study_id) and annotate(), each overriding the
+    one before. Failed attempts are recorded as well, with their status.
+    """
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            response = make_response(view(*args, **kwargs))
+            subject = {"patient_id": request.args.get('patient_id'),
+                       "national_id": request.args.get('national_id')}
+            subject.update((k, kwargs[k]) for k in ('patient_id', 'study_id') if k in kwargs)
+            subject.update(g.pop('audit_subject', {}))
+            patient_ids = subject.pop('patient_ids', None)
+            studies = subject.pop('studies', None)
+            try:
+                if patient_ids is None and studies is None:
+                    audit_log.record(action, status=response.status_code, **subject)
+                else:
+                    for patient_id in patient_ids or []:
+                        audit_log.record(action, patient_id=patient_id, status=response.status_code)
+                    for study_id, patient_id in studies or []:
+                        audit_log.record(action, patient_id=patient_id, study_id=study_id,
+                                         status=response.status_code)
+            except AuditUnavailable:
+                # Fail closed: the data is withheld rather than disclosed unaudited
+                refused = jsonify({"error": "Audit log unavailable; try again shortly"})
+                refused.status_code = 503
+                refused.headers['Retry-After'] = '1'
+                return refused
+            return response
+        return wrapper
+    return decorate
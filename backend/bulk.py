@@ -0,0 +1,326 @@
+"""
+XRay Federation System - Bulk ingestion of patients and studies
+Rows are written with executemany in chunked transactions; rows that fail
+are reported back by their position in the request body.
+"""
+import json
+import sqlite3
+
+import db
+from ids import (patient_id_for, new_study_id, new_study_key, id_collision, with_new_ids,
+                 patient_id_collision, with_new_patient_id)
+
+DEFAULT_CHUNK_SIZE = 5000
+MAX_REPORTED_FAILURES = 1000
+
+PATIENT_FIELDS = ('national_id', 'first_name', 'last_name', 'date_of_birth', 'gender', 'phone')
+STUDY_FIELDS = ('patient_id', 'national_id', 'hospital_id', 'study_date', 'modality', 'description',
+                'orthanc_study_id')
+# What a row can still fail with once its fields have been checked: constraint violations,
+# and anything binding lets through that the checks missed
+ROW_ERRORS = (sqlite3.IntegrityError, sqlite3.InterfaceError, sqlite3.ProgrammingError, OverflowError)
+INT64 = (-2 ** 63, 2 ** 63 - 1)
+
+UPSERT_PATIENT = '''
+    INSERT INTO patients (id, national_id, first_name, last_name, date_of_birth, gender, phone)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (national_id) DO UPDATE SET
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        date_of_birth = COALESCE(excluded.date_of_birth, patients.date_of_birth),
+        gender = COALESCE(excluded.gender, patients.gender),
+        phone = COALESCE(excluded.phone, patients.phone)
+'''
+
+INSERT_STUDY = '''
+    INSERT INTO studies (id, patient_id, hospital_id, study_date, modality, description, orthanc_study_id, rowid)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+class BulkResult:
+    """Counts and per-row failures for one bulk request"""
+
+    def __init__(self):
+        self.written = 0
+        self.failed_count = 0
+        self.failures = []
+
+    def fail(self, index, error):
+        self.failed_count += 1
+        if len(self.failures) < MAX_REPORTED_FAILURES:
+            self.failures.append({"index": index, "error": error})
+
+    def to_dict(self, written_key):
+        return {
+            written_key: self.written,
+            "failed": self.failed_count,
+            "failures": self.failures,
+            "failures_truncated": self.failed_count > len(self.failures)
+        }
+
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl')
+
+
+def iter_request_rows(request):
+    """Rows from a JSON array body or, for NDJSON, lazily line by line"""
+    if request.mimetype in NDJSON_MIMETYPES:
+        yield from _ndjson_rows(request.stream)
+        return
+    yield from _array_rows(request.get_json(silent=True))
+
+
+def iter_file_rows(path, mimetype):
+    """Like iter_request_rows, for a body spooled to a file (background jobs)"""
+    with open(path, 'rb') as f:
+        if mimetype in NDJSON_MIMETYPES:
+            yield from _ndjson_rows(f)
+            return
+        try:
+            data = json.load(f)
+        except ValueError:
+            data = None
+    yield from _array_rows(data)
+
+
+def _ndjson_rows(stream):
+    for line in _read_lines(stream):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            yield ValueError(f"Invalid JSON line: {e}")
+
+
+def _array_rows(data):
+    if isinstance(data, dict):
+        data = data.get('items')
+    if not isinstance(data, list):
+        raise ValueError("Body must be a JSON array or NDJSON")
+    yield from data
+
+
+def _read_lines(stream, block_size=1 << 16):
+    """Split a body stream into lines reading large blocks (readline is per-byte slow)"""
+    pending = b''
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        lines = (pending + block).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+
+def _invalid_fields(row, fields):
+    """Fields of the row SQLite can't bind: objects, lists, integers beyond 64 bits"""
+    invalid = []
+    for field in fields:
+        value = row.get(field)
+        if isinstance(value, int) and not INT64[0] <= value <= INT64[1]:
+            invalid.append(field)
+        elif value is not None and not isinstance(value, (str, int, float)):
+            invalid.append(field)
+    return invalid
+
+
+def _check_row(row, fields):
+    """None if the row can be written, else why not"""
+    if not isinstance(row, dict):
+        return str(row) if isinstance(row, Exception) else "Row must be an object"
+    invalid = _invalid_fields(row, fields)
+    if invalid:
+        return f"Field(s) must be a string or number: {', '.join(invalid)}"
+    return None
+
+
+def _chunks(rows, size):
+    chunk = []
+    for index, row in enumerate(rows):
+        chunk.append((index, row))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _write_chunk(conn, table, sql, params, result, reissue=None):
+    """executemany in one transaction; if a row fails (ROW_ERRORS), replay row by row
+
+    params is a list of (index, tuple). The replay uses a savepoint per row
+    so the good rows of a chunk still land in a single commit. reissue(p, error)
+    may return replacement parameters to retry a row once (e.g. a fresh ID).
+    table's change counter is bumped once per transaction. Returns the
+    parameter tuples that were committed.
+    """
+    if not params:
+        return []
+    try:
+        with db.batched_versions(conn, table):
+            conn.executemany(sql, [p for _, p in params])
+        conn.commit()
+        result.written += len(params)
+        return [p for _, p in params]
+    except ROW_ERRORS:
+        conn.rollback()
+
+    written = []
+    conn.execute('BEGIN')
+    with db.batched_versions(conn, table):
+        for index, p in params:
+            conn.execute('SAVEPOINT bulk_row')
+            try:
+                conn.execute(sql, p)
+                conn.execute('RELEASE bulk_row')
+                written.append(p)
+            except ROW_ERRORS as e:
+                conn.execute('ROLLBACK TO bulk_row')
+                error = e
+                retry = reissue(p, e) if reissue and isinstance(e, sqlite3.IntegrityError) else None
+                if retry is not None:
+                    try:
+                        conn.execute(sql, retry)
+                        written.append(retry)
+                        error = None
+                    except ROW_ERRORS as retry_error:
+                        conn.execute('ROLLBACK TO bulk_row')
+                        error = retry_error
+                if error is not None:
+                    result.fail(index, str(error))
+                conn.execute('RELEASE bulk_row')
+    conn.commit()
+    result.written += len(written)
+    return written
+
+
+def upsert_patients(conn, rows, chunk_size=DEFAULT_CHUNK_SIZE, on_written=None):
+    """Insert patients, updating existing ones that share a national_id
+
+    on_written, if given, is called after each chunk commits with the list of
+    (id, national_id, ...) tuples that were written. A new patient whose
+    derived ID (ids.patient_id_for) another national ID already has gets a
+    fresh one.
+    """
+    result = BulkResult()
+    # Chunks of national-ID lookups must stay under SQLite's bound-parameter limit
+    chunk_size = min(chunk_size, 30000)
+    for chunk in _chunks(rows, chunk_size):
+        # Existing patients keep (and report) the ID they have, which need not be the derived one
+        existing = _resolve_national_ids(conn, {str(row['national_id']) for _, row in chunk
+                                                if _check_row(row, PATIENT_FIELDS) is None
+                                                and row.get('national_id')})
+        params = []
+        for index, row in chunk:
+            error = _check_row(row, PATIENT_FIELDS)
+            if error:
+                result.fail(index, error)
+                continue
+            missing = [f for f in ('national_id', 'first_name', 'last_name') if not row.get(f)]
+            if missing:
+                result.fail(index, f"Missing required field(s): {', '.join(missing)}")
+                continue
+            national_id = str(row['national_id'])
+            params.append((index, (
+                existing.get(national_id) or patient_id_for(national_id), national_id,
+                row['first_name'], row['last_name'],
+                row.get('date_of_birth'), row.get('gender'), row.get('phone')
+            )))
+
+        written = _write_chunk(conn, 'patients', UPSERT_PATIENT, params, result, reissue=_reissue_patient_id)
+        if on_written and written:
+            on_written(written)
+    return result
+
+
+def _resolve_national_ids(conn, national_ids):
+    """national_id -> patient id for one chunk, in a single indexed lookup"""
+    if not national_ids:
+        return {}
+    national_ids = list(national_ids)
+    placeholders = ','.join('?' * len(national_ids))
+    rows = conn.execute(
+        f'SELECT national_id, id FROM patients WHERE national_id IN ({placeholders})',
+        national_ids
+    ).fetchall()
+    return dict(rows)
+
+
+def insert_studies(conn, rows, hospital_id=None, chunk_size=DEFAULT_CHUNK_SIZE, on_written=None,
+                   shards=None):
+    """Insert studies for one hospital, or for the hospital_id given on each row
+
+    Rows may reference the patient by patient_id or by national_id. on_written
+    gets the committed (id, patient_id, hospital_id, ...) tuples per chunk.
+
+    shards, if given, is the storage module: each chunk is then split by
+    hospital and written to that hospital's shard (one commit per shard),
+    after its patients are added to the global patient index. conn still
+    resolves national IDs.
+    """
+    result = BulkResult()
+    # Chunks of national-ID lookups must stay under SQLite's bound-parameter limit
+    chunk_size = min(chunk_size, 30000)
+    for chunk in _chunks(rows, chunk_size):
+        national_ids = {str(row['national_id']) for _, row in chunk
+                        if _check_row(row, STUDY_FIELDS) is None
+                        and not row.get('patient_id') and row.get('national_id')}
+        by_national_id = _resolve_national_ids(conn, national_ids)
+
+        params = []
+        for index, row in chunk:
+            error = _check_row(row, STUDY_FIELDS)
+            if error:
+                result.fail(index, error)
+                continue
+            patient_id = row.get('patient_id')
+            if not patient_id and row.get('national_id'):
+                patient_id = by_national_id.get(str(row['national_id']))
+                if not patient_id:
+                    result.fail(index, f"Unknown national_id: {row['national_id']}")
+                    continue
+            if not patient_id:
+                result.fail(index, "Missing required field: patient_id or national_id")
+                continue
+            study_hospital = hospital_id or row.get('hospital_id')
+            if not study_hospital:
+                result.fail(index, "Missing required field: hospital_id")
+                continue
+            params.append((index, (
+                new_study_id(), patient_id, study_hospital, row.get('study_date'),
+                row.get('modality'), row.get('description'), row.get('orthanc_study_id')
+            )))
+        # Keys in patient order: in the clustered layout the chunk is then written in key order,
+        # one patient's pages after the next, instead of at random places in the table
+        params.sort(key=lambda p: p[1][1])
+        params = [(index, p + (new_study_key(),)) for index, p in params]
+
+        if shards is None:
+            written = _write_chunk(conn, 'studies', INSERT_STUDY, params, result, reissue=_reissue_study_id)
+        else:
+            by_hospital = {}
+            for index, p in params:
+                by_hospital.setdefault(p[2], []).append((index, p))
+            written = []
+            for study_hospital, group in by_hospital.items():
+                shards.record_patients(study_hospital, {p[1] for _, p in group})
+                written += _write_chunk(shards.get_db(study_hospital), 'studies', INSERT_STUDY, group, result,
+                                        reissue=_reissue_study_id)
+        if on_written and written:
+            on_written(written)
+    return result
+
+
+def _reissue_patient_id(params, error):
+    """A fresh ID for a new patient whose derived one is taken (ids.patient_id_collision)"""
+    return with_new_patient_id(params) if patient_id_collision(error) else None
+
+
+def _reissue_study_id(params, error):
+    """Fresh generated IDs for a row whose study ID or key clashed (ids.id_collision)"""
+    return with_new_ids(params) if id_collision(error) else None
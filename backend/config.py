@@ -4,6 +4,127 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'dev-secret-key-change-in-production'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///federation.db'
     ORTHANC_URL = os.environ.get('ORTHANC_URL') or 'http://localhost:8042'
+    ORTHANC_USERNAME = os.environ.get('ORTHANC_USERNAME')
+    ORTHANC_PASSWORD = os.environ.get('ORTHANC_PASSWORD')
+    ORTHANC_TIMEOUT = float(os.environ.get('ORTHANC_TIMEOUT') or 5.0)            # seconds per request
+    ORTHANC_RETRIES = int(os.environ.get('ORTHANC_RETRIES') or 3)
+    ORTHANC_MAX_CONNECTIONS = int(os.environ.get('ORTHANC_MAX_CONNECTIONS') or 16)
+    ORTHANC_ENRICH_DEADLINE = float(os.environ.get('ORTHANC_ENRICH_DEADLINE') or 3.0)  # whole ?enrich=1 lookup
+
+    # Orthanc change-feed synchronizer (orthanc_sync.py)
+    ORTHANC_SYNC_ENABLED = os.environ.get('ORTHANC_SYNC_ENABLED', '').lower() in ('1', 'true', 'yes')
+    ORTHANC_SYNC_HOSPITAL_ID = os.environ.get('ORTHANC_SYNC_HOSPITAL_ID')   # hospital owning this Orthanc
+    ORTHANC_SYNC_BATCH_SIZE = int(os.environ.get('ORTHANC_SYNC_BATCH_SIZE') or 100)       # changes per page
+    ORTHANC_SYNC_POLL_INTERVAL = float(os.environ.get('ORTHANC_SYNC_POLL_INTERVAL') or 5.0)  # seconds when idle
+
+    # SQLite connection pool (see db.py)
+    DATABASE_PATH = os.environ.get('DATABASE_PATH') or 'federation.db'
+    DATABASE_POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE') or 8)
+    DATABASE_MMAP_SIZE = int(os.environ.get('DATABASE_MMAP_SIZE') or 256 * 1024 * 1024)
+    DATABASE_CACHE_SIZE = int(os.environ.get('DATABASE_CACHE_SIZE') or -64000)  # negative = KiB
+
+    # Per-hospital study shards (storage.py): one SQLite file per hospital under this
+    # directory instead of the studies table of DATABASE_PATH. Unset = single database.
+    STUDY_SHARD_DIR = os.environ.get('STUDY_SHARD_DIR')
+    STUDY_SHARD_POOL_SIZE = int(os.environ.get('STUDY_SHARD_POOL_SIZE') or 4)   # connections per shard
+    FEDERATION_FANOUT_WORKERS = int(os.environ.get('FEDERATION_FANOUT_WORKERS') or 8)  # parallel shard queries
+    # Physical layout of studies tables (study_layout.py): 'rowid', or 'clustered' to store each
+    # patient's studies together. New databases and shards get it; existing ones are converted
+    # with scripts/cluster_studies.py
+    STUDY_LAYOUT = os.environ.get('STUDY_LAYOUT') or 'rowid'
+
+    # Base URL encoded into patient/study QR codes
+    PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL') or 'http://localhost:5000'
+
+    # Rendered QR PNG cache: in-memory LRU entries, plus an optional directory
+    QR_CACHE_SIZE = int(os.environ.get('QR_CACHE_SIZE') or 1024)
+    QR_CACHE_DIR = os.environ.get('QR_CACHE_DIR')
+    # Worker processes for /api/qr/sheet matrix generation (default: one per CPU)
+    QR_SHEET_WORKERS = int(os.environ.get('QR_SHEET_WORKERS') or 0) or None
+
+    # DICOM study thumbnails (dicom_preview.py): studies without an orthanc_study_id are looked
+    # up under DICOM_DIR/<study_id>/; rendered thumbnails are kept in PREVIEW_CACHE_DIR
+    DICOM_DIR = os.environ.get('DICOM_DIR')
+    PREVIEW_CACHE_DIR = os.environ.get('PREVIEW_CACHE_DIR') or 'preview-cache'
+    PREVIEW_CACHE_MAX_MB = int(os.environ.get('PREVIEW_CACHE_MAX_MB') or 512)
+    PREVIEW_WORKERS = int(os.environ.get('PREVIEW_WORKERS') or 0) or None   # default: one per CPU
+
+    # Federation query result cache (per process). Writes of other processes are read from
+    # the patient_changes log at most every FEDERATION_CACHE_SYNC_INTERVAL seconds, the
+    # longest another worker's write can go unseen; 0 reads it on every query
+    FEDERATION_CACHE_SIZE = int(os.environ.get('FEDERATION_CACHE_SIZE') or 10000)
+    FEDERATION_CACHE_TTL = float(os.environ.get('FEDERATION_CACHE_TTL') or 300.0)   # seconds
+    FEDERATION_CACHE_SYNC_INTERVAL = float(os.environ.get('FEDERATION_CACHE_SYNC_INTERVAL') or 1.0)
+
+    # Remote federation peers (federation_peers.py): OrthancPeers-style JSON ({"name": "http://host:5000"})
+    # or name=url,name=url, and/or a JSON file of the same; asked concurrently under one deadline
+    FEDERATION_PEERS = os.environ.get('FEDERATION_PEERS')
+    FEDERATION_PEERS_FILE = os.environ.get('FEDERATION_PEERS_FILE')
+    FEDERATION_PEER_DEADLINE = float(os.environ.get('FEDERATION_PEER_DEADLINE') or 2.0)     # whole fan-out
+    FEDERATION_PEER_TIMEOUT = float(os.environ.get('FEDERATION_PEER_TIMEOUT') or 5.0)       # per peer
+    FEDERATION_PEER_NEGATIVE_TTL = float(os.environ.get('FEDERATION_PEER_NEGATIVE_TTL') or 60.0)
+    FEDERATION_PEER_BREAKER_FAILURES = int(os.environ.get('FEDERATION_PEER_BREAKER_FAILURES') or 5)
+    FEDERATION_PEER_BREAKER_RESET = float(os.environ.get('FEDERATION_PEER_BREAKER_RESET') or 30.0)  # seconds
+    # Sent to peers in RATE_LIMIT_KEY_HEADER (a peer's own "ApiKey" wins), so that each
+    # peer's admission control counts this node as a client of its own
+    FEDERATION_PEER_API_KEY = os.environ.get('FEDERATION_PEER_API_KEY')
+
+    # Access audit log (audit.py): patient, federation and QR reads, written in batches to
+    # segment databases under AUDIT_DIR, one per AUDIT_SEGMENT (month or day). The user is
+    # taken from AUDIT_USER_HEADER, set by the proxy or kiosk in front of the API. When the
+    # queue is full, 'reject' answers 503 rather than serve unaudited data; 'drop' serves it
+    AUDIT_ENABLED = os.environ.get('AUDIT_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    AUDIT_DIR = os.environ.get('AUDIT_DIR') or 'audit'
+    AUDIT_SEGMENT = os.environ.get('AUDIT_SEGMENT') or 'month'
+    AUDIT_RETENTION_DAYS = int(os.environ.get('AUDIT_RETENTION_DAYS') or 0)   # 0 = keep every segment
+    AUDIT_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE') or 10000)        # events per process
+    AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE') or 1000)         # events per commit, at most
+    AUDIT_ON_FULL = os.environ.get('AUDIT_ON_FULL') or 'reject'
+    AUDIT_ENQUEUE_TIMEOUT = float(os.environ.get('AUDIT_ENQUEUE_TIMEOUT') or 0.5)   # seconds, for 'reject'
+    AUDIT_USER_HEADER = os.environ.get('AUDIT_USER_HEADER') or 'X-User'
+
+    # Admission control (admission.py) for the expensive routes, grouped in classes: listing,
+    # federation, qr, qr_sheet, preview. RATE_LIMITS sets per-client token buckets as
+    # class=rate:burst (requests per second), CONCURRENCY_LIMITS the requests a class may
+    # have in progress per process as class=slots; 0 lifts a limit, unlisted classes keep
+    # their defaults. Clients are told apart by a known API key, else by address
+    RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1').lower() in ('1', 'true', 'yes')
+    RATE_LIMITS = os.environ.get('RATE_LIMITS')
+    CONCURRENCY_LIMITS = os.environ.get('CONCURRENCY_LIMITS')
+    ADMISSION_WAIT = float(os.environ.get('ADMISSION_WAIT') or 0.05)   # seconds for a free slot, then 503
+    RATE_LIMIT_API_KEYS = [k.strip() for k in (os.environ.get('RATE_LIMIT_API_KEYS') or '').split(',') if k.strip()]
+    RATE_LIMIT_KEY_HEADER = os.environ.get('RATE_LIMIT_KEY_HEADER') or 'X-API-Key'
+    # Reverse proxies in front of the app that append to X-Forwarded-For; without this every
+    # client behind them is the proxy's address. Only set it when the proxies can't be bypassed
+    TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS') or 0)
+
+    # Shared directory where gunicorn workers publish metrics so /metrics covers all of them
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+
+    # /api/export/studies: rows per chunk read and encoded, and exports streaming at once per process
+    EXPORT_CHUNK_ROWS = int(os.environ.get('EXPORT_CHUNK_ROWS') or 10000)
+    EXPORT_MAX_CONCURRENT = int(os.environ.get('EXPORT_MAX_CONCURRENT') or 2)
+
+    # Frontend files (static_assets.py), served from memory; with FRONTEND_RELOAD they are
+    # re-read when one changes on disk (on in development)
+    FRONTEND_DIR = os.environ.get('FRONTEND_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                  '..', 'frontend')
+    FRONTEND_RELOAD = os.environ.get('FRONTEND_RELOAD', '').lower() in ('1', 'true', 'yes')
+
+    # Response compression (http_cache.py): bodies smaller than this go out as they are;
+    # brotli is used when the package is installed and the client accepts it
+    COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE') or 1024)   # bytes
+    COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL') or 6)
+    COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY') or 4)
+
+    # Rows per transaction for the /bulk ingestion endpoints
+    BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE') or 5000)
+
+    # Background jobs (jobs.py): worker threads per process (0 = only queue jobs here,
+    # for web workers next to job_worker.py), and where job files (spooled uploads,
+    # rendered results) are kept
+    JOB_WORKERS = int(os.environ.get('JOB_WORKERS') or 2)
+    JOB_DIR = os.environ.get('JOB_DIR') or 'jobs'
     
 class ProductionConfig(Config):
     DEBUG = False
@@ -12,6 +133,7 @@ class ProductionConfig(Config):
 class DevelopmentConfig(Config):
     DEBUG = True
     TESTING = True
+    FRONTEND_RELOAD = os.environ.get('FRONTEND_RELOAD', '1').lower() in ('1', 'true', 'yes')
 
 config = {
     'development': DevelopmentConfig,
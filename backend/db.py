@@ -0,0 +1,305 @@
+"""
+XRay Federation System - Data access layer
+Pooled SQLite connections shared by every route in app.py
+"""
+import os
+import sqlite3
+import threading
+import queue
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from flask import g
+
+import metrics
+
+DEFAULT_DATABASE = 'federation.db'
+DEFAULT_POOL_SIZE = 8
+
+# Connection tuning applied once per physical connection. The busy timeout is
+# the pool's timeout, which sqlite3.connect() sets; a busy_timeout pragma here
+# would override it.
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',        # readers no longer block on the writer
+    'PRAGMA synchronous=NORMAL',      # fsync on checkpoint only (safe with WAL)
+    'PRAGMA temp_store=MEMORY',
+)
+
+READ_ONLY_PRAGMAS = (
+    'PRAGMA query_only=ON',
+    'PRAGMA temp_store=MEMORY',
+)
+
+# sqlite3 keeps a per-connection LRU of compiled statements; since connections
+# are reused across requests, this is what makes prepared statements stick.
+STATEMENT_CACHE_SIZE = 256
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records each statement's execute time in metrics"""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.sql_statements.observe(time.perf_counter() - start, metrics.statement_type(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.sql_statements.observe(time.perf_counter() - start, metrics.statement_type(sql))
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose shortcuts and cursors go through TimedCursor
+
+    Only execute()/executemany() and commit are timed; rows fetched
+    afterwards are part of the caller's own time.
+    """
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            metrics.sql_statements.observe(time.perf_counter() - start, 'COMMIT')
+
+
+class ConnectionPool:
+    """Bounded pool of SQLite connections that can be shared across threads"""
+
+    def __init__(self, database=DEFAULT_DATABASE, size=DEFAULT_POOL_SIZE,
+                 mmap_size=256 * 1024 * 1024, cache_size=-64000, timeout=30.0, attach=None):
+        self.database = database
+        # {schema name: path} of databases each connection attaches read-only
+        self.attach = dict(attach or {})
+        self.size = size
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._inherited = []
+
+    def after_fork(self):
+        """Start empty in a forked worker process
+
+        Connections opened by the parent are parked rather than used or
+        closed: SQLite handles must not cross fork(), and finalizing them
+        here could disturb the parent's locks.
+        """
+        while True:
+            try:
+                self._inherited.append(self._idle.get_nowait())
+            except queue.Empty:
+                break
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _connect(self, read_only=False):
+        # mode=ro can't create or change the file, so the journal pragmas
+        # are left to the pooled connections
+        pragmas = READ_ONLY_PRAGMAS if read_only else PRAGMAS
+        uri = read_only or bool(self.attach)
+        conn = sqlite3.connect(
+            _uri(self.database, read_only) if uri else self.database,
+            timeout=self.timeout,
+            check_same_thread=False,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            factory=TimedConnection,
+            uri=uri,
+        )
+        for pragma in pragmas:
+            conn.execute(pragma)
+        for schema, path in self.attach.items():
+            conn.execute(f'ATTACH DATABASE ? AS {schema}', (_uri(path, read_only=True),))
+        conn.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+        if not read_only:
+            conn.execute(f'PRAGMA cache_size={int(self.cache_size)}')
+        return conn
+
+    def acquire(self, timeout=None):
+        """Take an idle connection, opening a new one while under the pool size
+
+        Waits up to timeout seconds (default: the pool's) for one to be released.
+        """
+        if self._pid != os.getpid():
+            self.after_fork()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+
+        try:
+            return self._idle.get(timeout=self.timeout if timeout is None else timeout)
+        except queue.Empty:
+            raise RuntimeError("Database connection pool exhausted")
+
+    def release(self, conn):
+        """Return a connection to the pool, discarding any unfinished transaction"""
+        if conn.in_transaction:
+            conn.rollback()
+        self._idle.put(conn)
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @contextmanager
+    def read_only(self):
+        """A dedicated read-only connection outside the pool, closed afterwards
+
+        For long reads (exports): they never hold one of the pool's
+        connections, and under WAL their snapshot doesn't block writers.
+        It keeps SQLite's default small page cache, since a one-pass scan
+        would only evict the pool's hot pages from a bigger one.
+        """
+        conn = self._connect(read_only=True)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def stats(self):
+        return {"size": self.size, "open": self._created, "idle": self._idle.qsize()}
+
+    def close_all(self):
+        """Close every idle connection (used on shutdown and in tests)"""
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            conn.close()
+            with self._lock:
+                self._created -= 1
+
+
+def _uri(path, read_only=False):
+    return f"file:{quote(os.path.abspath(path))}" + ('?mode=ro' if read_only else '')
+
+
+_pool = ConnectionPool()
+
+
+def configure(database=None, pool_size=None, mmap_size=None, cache_size=None):
+    """Replace the shared pool, e.g. to point at another database file"""
+    global _pool
+    old = _pool
+    _pool = ConnectionPool(
+        database=database or old.database,
+        size=pool_size or old.size,
+        mmap_size=old.mmap_size if mmap_size is None else mmap_size,
+        cache_size=old.cache_size if cache_size is None else cache_size,
+    )
+    old.close_all()
+    return _pool
+
+
+def get_pool():
+    return _pool
+
+
+def connection(timeout=None):
+    """Context manager for code running outside a request (scripts, generators)"""
+    return _pool.connection(timeout)
+
+
+def stream(sql, params=(), pool=None):
+    """Context manager factory yielding a lazy row iterator on its own connection
+
+    Used by streaming responses, whose generators outlive the request's
+    get_db() connection. pool defaults to the main one.
+    """
+    @contextmanager
+    def open_rows():
+        with (pool or _pool).connection() as conn:
+            cursor = conn.execute(sql, params)
+            try:
+                yield cursor
+            finally:
+                cursor.close()
+    return open_rows
+
+
+def get_db():
+    """Connection bound to the current request, returned to the pool on teardown"""
+    if 'db' not in g:
+        g.db = _pool.acquire()
+    return g.db
+
+
+def close_db(exc=None):
+    conn = g.pop('db', None)
+    if conn is not None:
+        _pool.release(conn)
+
+
+@contextmanager
+def transaction(conn):
+    """Commit on success, roll back on error"""
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+@contextmanager
+def batched_versions(conn, *tables):
+    """Bump the tables' change counters once for a batch of writes, not once per row
+
+    Runs inside the transaction holding the writes: the counters are bumped
+    and their row triggers muted up front, and unmuted on the way out, so
+    other connections never see them muted. Don't commit inside the block.
+    """
+    names = ','.join('?' * len(tables))
+    conn.execute(f'UPDATE table_versions SET version = version + 1, batched = 1 WHERE name IN ({names})',
+                 tables)
+    try:
+        yield conn
+    finally:
+        conn.execute(f'UPDATE table_versions SET batched = 0 WHERE name IN ({names})', tables)
+
+
+def init_app(app):
+    """Wire the pool into a Flask app using its DATABASE_* settings"""
+    configure(
+        database=app.config.get('DATABASE_PATH', DEFAULT_DATABASE),
+        pool_size=app.config.get('DATABASE_POOL_SIZE', DEFAULT_POOL_SIZE),
+        mmap_size=app.config.get('DATABASE_MMAP_SIZE'),
+        cache_size=app.config.get('DATABASE_CACHE_SIZE'),
+    )
+    if close_db not in app.teardown_appcontext_funcs:
+        app.teardown_appcontext(close_db)
@@ -0,0 +1,302 @@
+"""
+XRay Federation System - DICOM folder ingestion
+Registers the studies of a folder of DICOM files (a PACS export, a CD, an
+old archive) in patients/studies, for one hospital. Only headers are read:
+each file is memory-mapped and parsed up to the pixel data, keeping just
+the tags below, so a file costs a few pages of I/O however large its
+images. Files are read in batches across a process pool; studies are
+written in chunked transactions once the walk has moved past them (a
+study whose files turn up again much later keeps the modalities seen by
+then).
+
+Re-running over the same folder skips studies already registered (matched
+on StudyInstanceUID). Patients missing from the registry are created from
+the DICOM PatientID (as national_id), name, birth date and sex; existing
+patients are never modified.
+
+    cd backend
+    python dicom_ingest.py /mnt/archive --hospital HOS-001
+"""
+import logging
+import mmap
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+import db
+import storage
+from ids import new_study_id, new_study_key, patient_id_for, insert_patients, insert_studies
+from orthanc_sync import dicom_datetime
+
+log = logging.getLogger(__name__)
+
+HEADER_TAGS = ['SpecificCharacterSet', 'PatientID', 'PatientName', 'PatientBirthDate', 'PatientSex',
+               'StudyInstanceUID', 'StudyDate', 'StudyTime', 'StudyDescription', 'Modality']
+# Files per process-pool task: large enough that IPC is negligible next to the parsing
+BATCH_FILES = 256
+# Studies per transaction
+DEFAULT_CHUNK_SIZE = 5000
+# A study unseen for this many batches is taken to be complete and written
+SETTLE_BATCHES = 4
+
+# Only a national ID already registered is skipped; a derived patient ID that another
+# national ID has raises, so ids.insert_patients can retry it with a fresh one
+INSERT_PATIENT = '''
+    INSERT INTO patients (id, national_id, first_name, last_name, date_of_birth, gender)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (national_id) DO NOTHING
+'''
+
+# Only a StudyInstanceUID already registered is skipped; a clash of the generated
+# study ID or key raises, so ids.insert_studies can retry it with fresh ones
+INSERT_STUDY = '''
+    INSERT INTO studies
+        (id, patient_id, hospital_id, study_date, modality, description, study_instance_uid, rowid)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (study_instance_uid) WHERE study_instance_uid IS NOT NULL DO NOTHING
+'''
+
+
+# -- reading (runs in the process pool) ----------------------------------------
+
+def read_header(path):
+    """The fields of one file's header, or None if it is not a DICOM file"""
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            ds = pydicom.dcmread(data, stop_before_pixels=True, specific_tags=HEADER_TAGS)
+            return {
+                "study_uid": str(ds.get('StudyInstanceUID') or '') or None,
+                "dicom_patient_id": str(ds.get('PatientID') or '').strip() or None,
+                "patient_name": str(ds.get('PatientName') or ''),
+                "birth_date": str(ds.get('PatientBirthDate') or ''),
+                "sex": str(ds.get('PatientSex') or '').upper() or None,
+                "study_date": dicom_datetime(str(ds.get('StudyDate') or ''), str(ds.get('StudyTime') or '')),
+                "description": str(ds.get('StudyDescription') or '') or None,
+                "modality": str(ds.get('Modality') or '') or None,
+            }
+    except (OSError, ValueError, InvalidDicomError, EOFError):
+        return None  # unreadable, empty (can't be mapped), or not DICOM
+
+
+def read_headers(paths):
+    """One batch: (studies merged by StudyInstanceUID, files read, files skipped)"""
+    studies, skipped = {}, 0
+    for path in paths:
+        header = read_header(path)
+        if header is None or not header['study_uid']:
+            skipped += 1
+            continue
+        modality = header.pop('modality')
+        study = studies.setdefault(header['study_uid'], dict(header, modalities=set()))
+        if modality:
+            study['modalities'].add(modality)
+    return list(studies.values()), len(paths) - skipped, skipped
+
+
+def iter_files(root):
+    """Every regular file under root, directory by directory, without listing it all first"""
+    stack = [root]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = sorted(os.scandir(directory), key=lambda e: e.name)
+        except OSError as e:
+            log.warning("Skipping %s: %s", directory, e)
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+
+def _batches(paths, size):
+    batch = []
+    for path in paths:
+        batch.append(path)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# -- writing -------------------------------------------------------------------
+
+def _split_name(name):
+    """DICOM PN 'Family^Given^Middle' -> (first_name, last_name)"""
+    parts = name.split('=')[0].split('^')
+    last = parts[0].strip()
+    first = ' '.join(p.strip() for p in parts[1:3] if p.strip())
+    return first or '-', last or '-'
+
+
+def _dicom_date(value):
+    return f"{value[0:4]}-{value[4:6]}-{value[6:8]}" if len(value) >= 8 and value[:8].isdigit() else None
+
+
+class Ingest:
+    """Merges header batches per study and writes settled studies in chunks"""
+
+    def __init__(self, hospital_id, chunk_size=DEFAULT_CHUNK_SIZE, dry_run=False):
+        self.hospital_id = hospital_id
+        self.chunk_size = chunk_size
+        self.dry_run = dry_run
+        self.pending = {}      # study_uid -> (merged header, last batch it was seen in)
+        self.batches = 0
+        self.stats = {"files": 0, "dicom_files": 0, "skipped_files": 0, "studies": 0,
+                      "registered": 0, "already_registered": 0, "patients_created": 0,
+                      "without_patient_id": 0, "patient_id_collisions": 0, "id_collisions": 0}
+
+    def add(self, studies, read, skipped):
+        """Merge the next batch (in walk order), then write studies that have settled"""
+        batch_number = self.batches
+        self.batches += 1
+        self.stats["files"] += read + skipped
+        self.stats["dicom_files"] += read
+        self.stats["skipped_files"] += skipped
+        for study in studies:
+            merged = self.pending.get(study['study_uid'])
+            if merged is None:
+                self.pending[study['study_uid']] = (study, batch_number)
+            else:
+                merged[0]['modalities'] |= study['modalities']
+                self.pending[study['study_uid']] = (merged[0], batch_number)
+        settled = [uid for uid, (_, seen) in self.pending.items() if seen <= batch_number - SETTLE_BATCHES]
+        if len(settled) >= self.chunk_size:
+            self.write([self.pending.pop(uid)[0] for uid in settled])
+
+    def finish(self):
+        studies = [study for study, _ in self.pending.values()]
+        self.pending.clear()
+        self.write(studies)
+        return self.stats
+
+    def write(self, studies):
+        """Register a chunk of studies: missing patients first, then the studies (one commit each)"""
+        for start in range(0, len(studies), self.chunk_size):
+            self._write_chunk(studies[start:start + self.chunk_size])
+
+    def _write_chunk(self, studies):
+        self.stats["studies"] += len(studies)
+        with_patient = [s for s in studies if s['dicom_patient_id']]
+        self.stats["without_patient_id"] += len(studies) - len(with_patient)
+        if self.dry_run or not with_patient:
+            return
+
+        patients = {}
+        for s in with_patient:
+            first, last = _split_name(s['patient_name'])
+            patients.setdefault(s['dicom_patient_id'], (
+                patient_id_for(s['dicom_patient_id']), s['dicom_patient_id'], first, last,
+                _dicom_date(s['birth_date']), s['sex']))
+        with db.connection() as conn, db.transaction(conn), db.batched_versions(conn, 'patients'):
+            # rowcount, not total_changes: the FTS triggers' writes would count too
+            created, collisions = insert_patients(conn, INSERT_PATIENT, list(patients.values()))
+            ids = _patient_ids(conn, list(patients))
+        self.stats["patients_created"] += created
+        self.stats["patient_id_collisions"] += collisions
+
+        # In patient order, as bulk.insert_studies writes them (for the clustered layout)
+        rows = [(new_study_id(), ids[s['dicom_patient_id']], self.hospital_id, s['study_date'],
+                 '/'.join(sorted(s['modalities'])) or None, s['description'], s['study_uid'],
+                 new_study_key())
+                for s in sorted(with_patient, key=lambda s: ids[s['dicom_patient_id']])]
+        storage.record_patients(self.hospital_id, {row[1] for row in rows})
+        with storage.connection(self.hospital_id) as conn, db.transaction(conn), \
+                db.batched_versions(conn, 'studies'):
+            written, collisions = insert_studies(conn, INSERT_STUDY, rows)
+        self.stats["registered"] += written
+        self.stats["id_collisions"] += collisions
+        self.stats["already_registered"] += len(rows) - written
+
+
+def _patient_ids(conn, national_ids):
+    ids = {}
+    for start in range(0, len(national_ids), 500):
+        chunk = national_ids[start:start + 500]
+        ids.update(conn.execute(
+            f"SELECT national_id, id FROM patients WHERE national_id IN ({','.join('?' * len(chunk))})",
+            chunk).fetchall())
+    return ids
+
+
+def ingest(root, hospital_id, workers=None, batch_files=BATCH_FILES, chunk_size=DEFAULT_CHUNK_SIZE,
+           dry_run=False, progress=None):
+    """Register every study under root for hospital_id; returns the stats dict
+
+    At most two batches per worker are in flight, so memory is bounded by
+    the batch size and the studies not yet written, never by the archive.
+    progress(stats), if given, is called after every batch.
+    """
+    workers = workers or os.cpu_count() or 1
+    with db.connection() as conn:
+        if not conn.execute('SELECT 1 FROM hospitals WHERE id = ?', (hospital_id,)).fetchone():
+            raise ValueError(f"Unknown hospital: {hospital_id}")
+
+    run = Ingest(hospital_id, chunk_size=chunk_size, dry_run=dry_run)
+    in_flight = deque()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        def take():
+            # In submission order, so a study's "last seen" batch follows the walk
+            run.add(*in_flight.popleft().result())
+            if progress:
+                progress(run.stats)
+
+        for batch in _batches(iter_files(root), batch_files):
+            in_flight.append(pool.submit(read_headers, batch))
+            if len(in_flight) >= workers * 2:
+                take()
+        while in_flight:
+            take()
+    return run.finish()
+
+
+if __name__ == '__main__':
+    import argparse
+    from config import config
+    from migrations import migrate
+
+    parser = argparse.ArgumentParser(description="Register the studies of a folder of DICOM files")
+    parser.add_argument('root', help='folder to scan (recursively)')
+    parser.add_argument('--hospital', required=True, help='hospital the studies belong to')
+    parser.add_argument('--workers', type=int, help='header-reading processes (default: one per CPU)')
+    parser.add_argument('--batch-files', type=int, default=BATCH_FILES, help='files per worker task')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='studies per transaction')
+    parser.add_argument('--dry-run', action='store_true', help='read and count, write nothing')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config_class = config[os.environ.get('FLASK_CONFIG', 'default')]
+    settings = {k: getattr(config_class, k) for k in dir(config_class) if k.isupper()}
+    db.configure(database=settings['DATABASE_PATH'])
+    with db.connection() as conn:
+        migrate(conn)
+    storage.configure(shard_dir=settings.get('STUDY_SHARD_DIR'),
+                      pool_size=settings.get('STUDY_SHARD_POOL_SIZE'), layout=settings.get('STUDY_LAYOUT'))
+
+    start = time.perf_counter()
+    last_report = [start]
+
+    def report(stats):
+        now = time.perf_counter()
+        if now - last_report[0] >= 5:
+            last_report[0] = now
+            print(f"  {stats['files']} files ({stats['files'] / (now - start):.0f}/s), "
+                  f"{stats['registered']} studies registered")
+
+    print(f"📥 Ingesting {args.root} for {args.hospital} into {settings['DATABASE_PATH']}")
+    try:
+        stats = ingest(args.root, args.hospital, workers=args.workers, batch_files=args.batch_files,
+                       chunk_size=args.chunk_size, dry_run=args.dry_run, progress=report)
+    except ValueError as e:
+        raise SystemExit(f"❌ {e}")
+    print(f"✅ Done in {time.perf_counter() - start:.1f}s: " + ', '.join(f"{k} {v}" for k, v in stats.items()))
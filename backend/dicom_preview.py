@@ -0,0 +1,332 @@
+"""
+XRay Federation System - DICOM previews
+Small JPEG/WebP thumbnails decoded from a study's pixel data, so a patient's
+history can show its images without the browser downloading full-resolution
+DICOMs. Files come from Orthanc or from a local directory
+(<DICOM_DIR>/<study_id>/...); decoding and downscaling run in a process
+pool, and the thumbnails are kept in a size-bounded disk cache.
+"""
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pydicom
+from pydicom.multival import MultiValue
+from PIL import Image
+
+import metrics
+
+DEFAULT_SIZE = 256
+MIN_SIZE, MAX_SIZE = 32, 1024
+# format -> (mimetype, Pillow format, save options)
+FORMATS = {
+    'jpeg': ('image/jpeg', 'JPEG', {'quality': 85}),
+    'webp': ('image/webp', 'WEBP', {'quality': 80, 'method': 4}),
+}
+# Part of every cache key: bump it when rendering changes so old thumbnails are not served
+RENDER_VERSION = 1
+DEFAULT_CACHE_BYTES = 512 * 1024 * 1024
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class PreviewError(Exception):
+    """The DICOM has no pixel data this process can decode"""
+
+
+class PreviewNotFound(PreviewError):
+    """No images for the study, or no such instance"""
+
+
+def render_params(args):
+    """(size, format) from ?size=&format=, validated"""
+    try:
+        size = int(args.get('size', DEFAULT_SIZE))
+    except ValueError:
+        raise ValueError("size must be an integer")
+    if not MIN_SIZE <= size <= MAX_SIZE:
+        raise ValueError(f"size must be between {MIN_SIZE} and {MAX_SIZE}")
+    fmt = args.get('format', 'jpeg').lower()
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    return size, fmt
+
+
+# -- decoding (runs in the process pool) ---------------------------------------
+
+def render(dicom, size, fmt):
+    """DICOM file (bytes or a path) -> thumbnail bytes no larger than size x size"""
+    try:
+        ds = pydicom.dcmread(io.BytesIO(dicom) if isinstance(dicom, bytes) else dicom, force=True)
+        pixels = ds.pixel_array
+    except Exception as e:  # no pixel data, or a transfer syntax without a decoder installed
+        raise PreviewError(f"Cannot decode pixel data: {e}")
+    image = to_image(ds, pixels, size)
+    _, pil_format, options = FORMATS[fmt]
+    out = io.BytesIO()
+    image.save(out, pil_format, **options)
+    return out.getvalue()
+
+
+def to_image(ds, pixels, size):
+    """Middle frame, decimated and windowed to 8 bits, then resampled to fit size"""
+    frames = int(ds.get('NumberOfFrames') or 1)
+    if frames > 1:
+        pixels = pixels[frames // 2]
+    # Drop rows/columns by striding before any float math; only ~2x the target is resampled
+    step = max(1, max(pixels.shape[:2]) // (2 * size))
+    pixels = pixels[::step, ::step]
+    if int(ds.get('SamplesPerPixel') or 1) == 1:
+        image = Image.fromarray(window(ds, pixels), 'L')
+    else:
+        # pixel_array already converts YBR color to RGB
+        if pixels.dtype != np.uint8:
+            pixels = (pixels.astype(np.float32) * (255.0 / max(float(pixels.max()), 1.0))).astype(np.uint8)
+        image = Image.fromarray(np.ascontiguousarray(pixels), 'RGB')
+    image.thumbnail((size, size), Image.Resampling.LANCZOS)
+    return image
+
+
+def window(ds, pixels):
+    """Grayscale pixels to uint8: rescale slope/intercept, then the VOI window"""
+    values = pixels.astype(np.float32)
+    slope = float(ds.get('RescaleSlope') or 1)
+    intercept = float(ds.get('RescaleIntercept') or 0)
+    if slope != 1 or intercept:
+        values = values * slope + intercept
+    center, width = _window(ds, values)
+    out = (values - (center - width / 2)) * (255.0 / width)
+    np.clip(out, 0, 255, out=out)
+    if ds.get('PhotometricInterpretation') == 'MONOCHROME1':
+        out = 255 - out
+    return out.astype(np.uint8)
+
+
+def _window(ds, values):
+    center, width = ds.get('WindowCenter'), ds.get('WindowWidth')
+    if center is not None and width is not None:
+        center, width = _first(center), _first(width)
+        if width > 0:
+            return center, width
+    # No usable window in the header: stretch the 1st-99th percentile range
+    low, high = np.percentile(values, (1, 99))
+    return (low + high) / 2, max(float(high - low), 1.0)
+
+
+def _first(value):
+    return float(value[0] if isinstance(value, MultiValue) else value)
+
+
+def _get_pool(workers=None):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def reset_pool():
+    """Forget the parent's process pool in a forked worker without shutting it down"""
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+# -- choosing and fetching files -----------------------------------------------
+
+def representative(instances):
+    """The middle instance of the first series: (series, number, id) tuples -> id"""
+    first = min(series for series, _, _ in instances)
+    series = sorted((number, instance_id) for s, number, instance_id in instances if s == first)
+    return series[len(series) // 2][1]
+
+
+def _instance_number(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _local_instances(directory):
+    """(series directory, file name, instance id) for every file under a study's directory"""
+    instances = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in files:
+            if not name.startswith('.'):
+                rel = os.path.relpath(os.path.join(root, name), directory)
+                instances.append((os.path.dirname(rel), name, rel.replace(os.sep, '/')))
+    return instances
+
+
+class PreviewCache:
+    """Thumbnails on disk, least recently used removed once over max_bytes
+
+    Reads refresh a file's mtime, which is what eviction orders by. Processes
+    sharing the directory each track an estimate of its size; eviction walks
+    the directory, so it corrects whatever they missed.
+    """
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def set(self, key, data):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write-then-rename so concurrent readers never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            return  # the disk cache is best effort
+        with self._lock:
+            self._size = self._files_size() if self._size is None else self._size + len(data)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _files(self):
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, os.path.join(root, name)))
+        return files
+
+    def _files_size(self):
+        return sum(size for _, size, _ in self._files())
+
+    def _evict(self):
+        """Remove the oldest files until 90% of max_bytes is left"""
+        files = sorted(self._files())
+        size = sum(size for _, size, _ in files)
+        for _, file_size, path in files:
+            if size <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                size -= file_size
+            except OSError:
+                pass
+        self._size = size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes": self._size,
+                "max_bytes": self.max_bytes, "cache_dir": self.cache_dir}
+
+
+class Previewer:
+    """Thumbnails for studies: where their DICOMs are, the cache, the process pool"""
+
+    def __init__(self, get_client, dicom_dir=None, cache_dir=None, max_cache_bytes=DEFAULT_CACHE_BYTES,
+                 workers=None):
+        self.get_client = get_client     # -> OrthancClient, built on first use
+        self.dicom_dir = dicom_dir
+        self.cache = PreviewCache(cache_dir, max_cache_bytes) if cache_dir else None
+        self.workers = workers
+        self.renders = 0
+
+    def source(self, study_id, orthanc_study_id):
+        """('orthanc', id) or ('local', directory) for a study; PreviewNotFound if neither"""
+        if orthanc_study_id:
+            return ('orthanc', orthanc_study_id)
+        if self.dicom_dir:
+            directory = os.path.join(self.dicom_dir, study_id)
+            if (study_id not in ('.', '..') and os.path.basename(directory) == study_id
+                    and os.path.isdir(directory)):
+                return ('local', directory)
+        raise PreviewNotFound("No images for this study")
+
+    def instances(self, source):
+        """Instance IDs of a study, series by series"""
+        return [instance_id for _, _, instance_id in sorted(self._instances(source))]
+
+    def _instances(self, source):
+        kind, ref = source
+        if kind == 'local':
+            return _local_instances(ref)
+        return [(i.get('ParentSeries') or '', _instance_number(i.get('MainDicomTags', {}).get('InstanceNumber')),
+                 i['ID']) for i in self.get_client().study_instances(ref)]
+
+    def cache_key(self, source, instance_id, size, fmt):
+        """What the thumbnail is rendered from; doubles as its ETag"""
+        kind, ref = source
+        # Orthanc IDs are hashes of the DICOM UIDs, so their content never changes;
+        # a local study directory is versioned by its mtime
+        version = os.stat(ref).st_mtime_ns if kind == 'local' else None
+        raw = json.dumps([RENDER_VERSION, kind, ref, version, instance_id, size, fmt])
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def thumbnail(self, source, instance_id, size, fmt, key=None):
+        """Thumbnail bytes of an instance, or of the study's representative one when None"""
+        key = key or self.cache_key(source, instance_id, size, fmt)
+        data = self.cache.get(key) if self.cache else None
+        if data is not None:
+            return data
+        start = time.perf_counter()
+        dicom = self._fetch(source, instance_id)
+        data = _get_pool(self.workers).submit(render, dicom, size, fmt).result()
+        metrics.dicom_preview.observe(time.perf_counter() - start, source[0])
+        self.renders += 1
+        if self.cache:
+            self.cache.set(key, data)
+        return data
+
+    def _fetch(self, source, instance_id):
+        """Bytes of an Orthanc instance, or the path of a local file"""
+        kind, ref = source
+        instances = self._instances(source)
+        if not instances:
+            raise PreviewNotFound("No images for this study")
+        if instance_id is None:
+            instance_id = representative(instances)
+        elif instance_id not in {i for _, _, i in instances}:
+            raise PreviewNotFound("No such instance in this study")
+        if kind == 'orthanc':
+            return self.get_client().instance_file(instance_id)
+        return os.path.join(ref, *instance_id.split('/'))
+
+    def stats(self):
+        stats = self.cache.stats() if self.cache else {}
+        stats.update(renders=self.renders, dicom_dir=self.dicom_dir)
+        return stats
@@ -0,0 +1,247 @@
+"""
+XRay Federation System - Bulk export of studies for analytics
+Studies joined with their patient and hospital, streamed as gzip CSV or
+as Arrow/Parquet (pyarrow, optional), one chunk of rows at a time
+"""
+import csv
+import io
+import threading
+import zlib
+from datetime import datetime, timedelta
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # CSV export works without it
+    pa = pq = None
+
+import metrics
+
+# Rows per fetchmany() and per Arrow record batch / Parquet row group
+CHUNK_ROWS = 10000
+DEFAULT_MAX_CONCURRENT = 2
+GZIP_LEVEL = 6
+
+COLUMNS = (
+    ('study_id', 's.id'),
+    # TIMESTAMP/DATE columns have NUMERIC affinity; keep every column text
+    ('study_date', 'CAST(s.study_date AS TEXT)'),
+    ('modality', 's.modality'),
+    ('description', 's.description'),
+    ('orthanc_study_id', 's.orthanc_study_id'),
+    ('patient_id', 's.patient_id'),
+    ('national_id', 'p.national_id'),
+    ('first_name', 'p.first_name'),
+    ('last_name', 'p.last_name'),
+    ('date_of_birth', 'CAST(p.date_of_birth AS TEXT)'),
+    ('gender', 'p.gender'),
+    ('hospital_id', 's.hospital_id'),
+    ('hospital_name', 'h.name'),
+)
+
+# format -> (mimetype, file extension)
+FORMATS = {
+    'csv': ('application/gzip', 'csv.gz'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+_slots = threading.BoundedSemaphore(DEFAULT_MAX_CONCURRENT)
+
+
+def configure(max_concurrent=None):
+    """Set how many exports may stream at once (per process)"""
+    global _slots
+    _slots = threading.BoundedSemaphore(max_concurrent or DEFAULT_MAX_CONCURRENT)
+
+
+class Slot:
+    """One claimed export slot; release() is safe to call more than once"""
+
+    def __init__(self, slots):
+        self._slots = slots
+
+    def release(self):
+        slots, self._slots = self._slots, None
+        if slots is not None:
+            slots.release()
+
+
+def try_acquire():
+    """Claim an export slot without waiting; None when all are streaming"""
+    return Slot(_slots) if _slots.acquire(blocking=False) else None
+
+
+def check_format(fmt):
+    """Raise ValueError for an unknown format, LookupError if it needs pyarrow"""
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    if fmt != 'csv' and pa is None:
+        raise LookupError(f"format {fmt} needs pyarrow installed; use format=csv")
+
+
+def _list_arg(args, name):
+    """?name=a,b and ?name=a&name=b both give ['a', 'b']"""
+    return [v.strip() for value in args.getlist(name) for v in value.split(',') if v.strip()]
+
+
+def _date_arg(args, name):
+    value = args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise ValueError(f"{name} must be a YYYY-MM-DD date")
+
+
+def studies_query(args):
+    """SQL and parameters for ?from=&to=&hospital_id=&modality=
+
+    from/to are inclusive dates; hospital_id and modality take one or more
+    values. Rows come in whatever order the chosen index yields them:
+    an ORDER BY the index can't satisfy would sort the whole export in a
+    temp B-tree before the first row.
+    """
+    where, params = [], []
+    start, end = _date_arg(args, 'from'), _date_arg(args, 'to')
+    if start:
+        where.append('s.study_date >= ?')
+        params.append(start.strftime('%Y-%m-%d'))
+    if end:
+        where.append('s.study_date < ?')
+        params.append((end + timedelta(days=1)).strftime('%Y-%m-%d'))
+    hospital_ids = _list_arg(args, 'hospital_id')
+    if hospital_ids:
+        where.append(f"s.hospital_id IN ({','.join('?' * len(hospital_ids))})")
+        params += hospital_ids
+    modalities = _list_arg(args, 'modality')
+    if modalities:
+        where.append(f"s.modality IN ({','.join('?' * len(modalities))})")
+        params += modalities
+
+    sql = f'''
+        SELECT {', '.join(expr for _, expr in COLUMNS)}
+        FROM studies s
+        LEFT JOIN patients p ON p.id = s.patient_id
+        LEFT JOIN hospitals h ON h.id = s.hospital_id
+    '''
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    return sql, params
+
+
+def hospital_ids(args):
+    """The ?hospital_id= filter, e.g. to pick the study shards to read"""
+    return _list_arg(args, 'hospital_id') or None
+
+
+def _chunks(open_connections, sql, params, chunk_rows):
+    for open_connection in open_connections:
+        with open_connection() as conn:
+            cursor = conn.execute(sql, params)
+            try:
+                while True:
+                    rows = cursor.fetchmany(chunk_rows)
+                    if not rows:
+                        break
+                    yield rows
+            finally:
+                cursor.close()
+
+
+def stream(open_connections, sql, params, fmt, chunk_rows=CHUNK_ROWS, on_finish=None):
+    """Generator of encoded body bytes
+
+    open_connections are context manager factories (ConnectionPool.read_only),
+    one per studies database, read in turn. Each is entered only once the
+    body gets to it, so connections are opened and closed by the streaming
+    response. At most one chunk of rows and its encoding are in memory at
+    a time, whatever the size of the export.
+    on_finish runs once the last byte is produced or the client goes away.
+    """
+    chunks = _chunks(open_connections, sql, params, chunk_rows)
+    encode = {'csv': _csv_gzip, 'arrow': _arrow_stream, 'parquet': _parquet}[fmt]
+    try:
+        for data in encode(_counted(chunks, fmt)):
+            if data:
+                yield data
+    finally:
+        if on_finish:
+            on_finish()
+
+
+def _counted(chunks, fmt):
+    for rows in chunks:
+        metrics.export_rows.inc(fmt, amount=len(rows))
+        yield rows
+
+
+def _csv_gzip(chunks):
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # wbits 31: gzip container
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow([name for name, _ in COLUMNS])
+    for rows in chunks:
+        writer.writerows(rows)
+        yield compressor.compress(text.getvalue().encode('utf-8'))
+        text.seek(0)
+        text.truncate()
+    yield compressor.compress(text.getvalue().encode('utf-8'))
+    yield compressor.flush()
+
+
+class _Sink(io.RawIOBase):
+    """Write-only file that hands back what was written since the last drain"""
+
+    def __init__(self):
+        super().__init__()
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _schema():
+    # Everything is TEXT in SQLite, dates included ('YYYY-MM-DD HH:MM:SS')
+    return pa.schema([(name, pa.string()) for name, _ in COLUMNS])
+
+
+def _batch(schema, rows):
+    columns = list(zip(*rows))
+    return pa.record_batch([pa.array(column, pa.string()) for column in columns], schema=schema)
+
+
+def _arrow_stream(chunks):
+    """Arrow IPC streaming format: schema, then one record batch per chunk"""
+    schema, sink = _schema(), _Sink()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        yield sink.drain()
+        for rows in chunks:
+            writer.write_batch(_batch(schema, rows))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _parquet(chunks):
+    """Parquet with one row group per chunk; the footer goes out last"""
+    schema, sink = _schema(), _Sink()
+    with pq.ParquetWriter(sink, schema, compression='zstd') as writer:
+        for rows in chunks:
+            writer.write_batch(_batch(schema, rows))
+            yield sink.drain()
+    yield sink.drain()
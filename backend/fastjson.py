@@ -0,0 +1,61 @@
+"""
+XRay Federation System - Fast JSON encoding
+jsonify() and the streaming helpers encode with orjson when it is
+installed (several times faster than the json module on the large
+listings), and fall back to the standard library otherwise. The output
+is the same JSON either way, only without the optional whitespace.
+"""
+import json
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional; everything works without it, more slowly
+    orjson = None
+
+
+def _default(obj):
+    # Whatever the encoder can't handle itself is encoded as Flask's provider would
+    return DefaultJSONProvider.default(obj)
+
+
+if orjson is not None:
+    # Dates through `default` so they stay HTTP dates, as with jsonify()
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(obj):
+        """obj as compact JSON text"""
+        return orjson.dumps(obj, default=_default, option=_OPTIONS).decode()
+else:
+    def dumps(obj):
+        """obj as compact JSON text"""
+        return json.dumps(obj, default=_default, separators=(',', ':'))
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask's JSON provider, encoding through orjson when available
+
+    Sorted keys and indentation (app.json.sort_keys, pretty-printed debug
+    responses) are honoured with orjson's options; anything else unusual
+    in the arguments goes to the standard provider.
+    """
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or set(kwargs) - {'indent', 'sort_keys', 'default', 'separators', 'ensure_ascii'}:
+            return super().dumps(obj, **kwargs)
+        option = _OPTIONS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, default=kwargs.get('default', self.default), option=option).decode()
+        except TypeError:
+            # e.g. integers beyond 64 bits, or keys orjson can't sort
+            return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
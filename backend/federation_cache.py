@@ -0,0 +1,196 @@
+"""
+XRay Federation System - Per-patient federation query result cache
+
+Entries are tagged with the patient they describe (by patient id and by
+national id) so a write for one patient evicts exactly that patient's
+results, and a hit reads no database. This process's own writes evict
+straight away (invalidate()). Those of other processes (workers,
+job_worker.py, the Orthanc sync, DICOM ingest) are found by sync():
+triggers append every patient whose record or studies are written to
+patient_changes, in the main database and in each shard, and sync() evicts
+the patients logged since it last looked (everything, if the log was
+pruned past what it had read). It reads the logs at most every
+sync_interval seconds, which is how long another process's write can go
+unseen here. A changed hospital (its name is in every result) clears the
+lot. The TTL only bounds memory.
+"""
+import threading
+import time
+from collections import OrderedDict, deque
+
+import storage
+
+# Evictions remembered for set() to check a result computed meanwhile against
+RECENT_EVICTIONS = 1024
+
+LAST_CHANGE = 'SELECT IFNULL(MAX(seq), 0) FROM patient_changes'
+CHANGES_SINCE = 'SELECT seq, patient_id, national_id FROM patient_changes WHERE seq > ? ORDER BY seq'
+HOSPITALS_VERSION = "SELECT version FROM table_versions WHERE name = 'hospitals'"
+
+
+class FederationCache:
+    def __init__(self, max_entries=10000, ttl=300.0, sync_interval=1.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.sync_interval = sync_interval
+        self._entries = OrderedDict()   # key -> (expires_at, tags, value)
+        self._tags = {}                 # tag -> set of keys
+        self._lock = threading.Lock()
+        self._generation = 0            # bumped by every eviction for a write
+        self._recent = deque(maxlen=RECENT_EVICTIONS)   # (generation, tags) of the latest ones
+        self._cleared = 0               # generation of the last clear()
+        self._seen = {}                 # database path -> last patient_changes seq evicted for
+        self._hospitals = None          # hospitals change counter at the last sync
+        self._synced_at = None
+        self._sync_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.syncs = 0
+
+    @staticmethod
+    def key(national_id=None, patient_id=None):
+        return (national_id, patient_id)
+
+    @staticmethod
+    def tags_for(national_id=None, patient_id=None):
+        tags = set()
+        if national_id:
+            tags.add(('national_id', national_id))
+        if patient_id:
+            tags.add(('patient_id', patient_id))
+        return tags
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def token(self):
+        """Taken before computing a value, for set() to tell whether it went stale meanwhile"""
+        return self._generation
+
+    def set(self, key, value, tags, token=None):
+        """Cache value, unless one of its tags was evicted since token was taken"""
+        with self._lock:
+            if token is not None and self._stale(tags, token):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, frozenset(tags), value)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _stale(self, tags, token):
+        if token == self._generation:
+            return False
+        # Evictions since the token that are no longer remembered may have been this patient's
+        if token < self._cleared or not self._recent or self._recent[0][0] > token + 1:
+            return True
+        return any(generation > token and not evicted.isdisjoint(tags) for generation, evicted in self._recent)
+
+    def _remove(self, key):
+        _, tags, _ = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def invalidate(self, national_id=None, patient_id=None):
+        """Drop every cached result that involves this patient"""
+        tags = self.tags_for(national_id, patient_id)
+        with self._lock:
+            self._generation += 1
+            self._recent.append((self._generation, frozenset(tags)))
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    if key in self._entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._cleared = self._generation
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._tags.clear()
+
+    def sync(self, pools):
+        """Evict the patients other processes wrote since the last sync
+
+        pools are every database patients and studies are written to, the
+        main one first. Until sync_interval has passed since the last sync
+        this returns straight away, so most lookups read no database.
+        """
+        if self._synced_at is not None and time.monotonic() - self._synced_at < self.sync_interval:
+            return
+        with self._sync_lock:
+            if self._synced_at is not None and time.monotonic() - self._synced_at < self.sync_interval:
+                return
+            with self._lock:
+                fresh = not self._entries
+            hospitals = _read(pools[0], lambda conn: conn.execute(HOSPITALS_VERSION).fetchone())
+            if fresh:
+                # Nothing cached to evict: start from the ends of the logs. clear() turns
+                # away results still being computed from before this point.
+                for pool in pools:
+                    self._seen[pool.database] = _read(pool, lambda conn: conn.execute(LAST_CHANGE).fetchone()[0])
+                self.clear()
+            else:
+                if hospitals != self._hospitals:
+                    self.clear()
+                for pool in pools:
+                    # A database seen for the first time (a new shard) is read from its start
+                    seen = self._seen.get(pool.database, 0)
+                    changes = _read(pool, lambda conn: conn.execute(CHANGES_SINCE, (seen,)).fetchall())
+                    if not changes:
+                        continue
+                    if changes[0][0] > seen + 1:
+                        # Pruned before this process read them: whose they were is lost
+                        self.clear()
+                    for patient_id, national_id in {(p, n) for _, p, n in changes}:
+                        self.invalidate(national_id, patient_id)
+                    self._seen[pool.database] = changes[-1][0]
+            self._hospitals = hospitals
+            self.syncs += 1
+            self._synced_at = time.monotonic()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "sync_interval_seconds": self.sync_interval,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "syncs": self.syncs,
+            }
+
+
+def _read(pool, fn):
+    # On the request's own connection for the main database (see storage.fan_out)
+    return storage.fan_out([pool], fn)[0]
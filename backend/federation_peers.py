@@ -0,0 +1,360 @@
+"""
+XRay Federation System - Remote federation peers
+Other XRay federation nodes (regional hospitals running this same API)
+that /api/federation/query asks alongside the local database. Every peer
+is queried concurrently over its own keep-alive pool, and the whole
+fan-out gets one deadline: peers that haven't answered by then are
+reported as timed out, and the local studies plus whatever did arrive are
+returned. A slow peer therefore costs at most the deadline, never its own
+timeout.
+
+Each peer has a circuit breaker: after BREAKER_FAILURES consecutive
+failures or timeouts it is skipped for BREAKER_RESET seconds, then one
+trial request decides whether it is back. "Patient unknown here" answers
+are cached per peer for a while, since most patients only exist in a few
+regions and asking every other peer each time is wasted work.
+
+Peers are listed in the format of Orthanc's OrthancPeers setting, either
+{"name": "http://host:5000"} or {"name": {"Url": ..., "Username": ...,
+"Password": ..., "ApiKey": ...}} (or a [url, username, password] list).
+The API key (or the registry's default one) goes in the peer's
+RATE_LIMIT_KEY_HEADER, so the peer's admission control counts this node
+as a client of its own rather than lumping it in with its address. A 429
+from a peer is reported as rate_limited: it is busy, not down, so it
+doesn't count against its circuit breaker.
+"""
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from cache import LRUCache
+
+DEFAULT_DEADLINE = 2.0        # seconds for the whole fan-out
+DEFAULT_TIMEOUT = 5.0         # per peer request; the deadline usually cuts it shorter
+BREAKER_FAILURES = 5
+BREAKER_RESET = 30.0          # seconds a tripped breaker stays open
+DEFAULT_NEGATIVE_TTL = 60.0   # seconds an empty answer from a peer is reused
+MAX_CONNECTIONS = 4           # per peer
+
+
+class PeerError(Exception):
+    pass
+
+
+class PeerTimeout(PeerError):
+    """The request ran out of time (its timeout is what was left of the deadline)"""
+
+
+class PeerRateLimited(PeerError):
+    """The peer refused the request with a 429"""
+
+
+def _text(value, field, required=False):
+    """A study field as text: numbers are converted, None passes unless required"""
+    if isinstance(value, str) and value:
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    if value in (None, '') and not required:
+        return None
+    raise PeerError(f"returned a study with an invalid {field}")
+
+
+def normalize(result):
+    """A peer's federation result, checked study by study before merge() relies on it
+
+    Every study must be an object with a hospital_id and a study_id; those
+    and study_date/study_instance_uid are turned into text (or None), so
+    one peer's odd types can't break sorting or deduplication for the rest.
+    """
+    if not isinstance(result, dict) or not isinstance(result.get('studies'), list):
+        raise PeerError("returned an invalid federation result")
+    patient = result.get('patient')
+    if patient is not None and not isinstance(patient, dict):
+        raise PeerError("returned an invalid patient")
+    studies = []
+    for study in result['studies']:
+        if not isinstance(study, dict):
+            raise PeerError("returned a study that is not an object")
+        studies.append(dict(
+            study,
+            hospital_id=_text(study.get('hospital_id'), 'hospital_id', required=True),
+            study_id=_text(study.get('study_id'), 'study_id', required=True),
+            study_date=_text(study.get('study_date'), 'study_date'),
+            study_instance_uid=_text(study.get('study_instance_uid'), 'study_instance_uid'),
+        ))
+    return dict(result, patient=patient or {}, studies=studies)
+
+
+def parse_peers(value):
+    """{name: {"url", "username", "password", "api_key"}} from OrthancPeers-style JSON or name=url,... text"""
+    if not value:
+        return {}
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith('{'):
+            value = json.loads(value)
+        else:
+            value = dict(item.split('=', 1) for item in value.split(',') if item.strip())
+    peers = {}
+    for name, spec in value.items():
+        if isinstance(spec, str):
+            spec = {"Url": spec}
+        elif isinstance(spec, (list, tuple)):
+            spec = dict(zip(("Url", "Username", "Password"), spec))
+        peers[name.strip()] = {"url": spec["Url"].strip().rstrip('/'),
+                               "username": spec.get("Username"), "password": spec.get("Password"),
+                               "api_key": spec.get("ApiKey")}
+    return peers
+
+
+def load_peers(peers=None, peers_file=None):
+    """Peers from a setting's value and/or a JSON file (file entries win on a name clash)"""
+    result = parse_peers(peers)
+    if peers_file:
+        with open(peers_file) as f:
+            result.update(parse_peers(json.load(f)))
+    return result
+
+
+class CircuitBreaker:
+    """closed -> open after `failures` in a row -> half-open after `reset` s -> one trial"""
+
+    def __init__(self, failures=BREAKER_FAILURES, reset=BREAKER_RESET):
+        self.failures = failures
+        self.reset = reset
+        self.consecutive = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self.opened_at >= self.reset else 'open'
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record(self, ok):
+        with self._lock:
+            self.trial_running = False
+            if ok:
+                self.consecutive = 0
+                self.opened_at = None
+                return
+            self.consecutive += 1
+            if self.opened_at is not None or self.consecutive >= self.failures:
+                self.opened_at = time.monotonic()   # (re)open; a failed trial restarts the wait
+
+
+class Peer:
+    """One remote node: its connection pool, the threads using it, and its breaker
+
+    Threads are per peer, as many as connections, so requests piling up on
+    a slow peer never hold up those to the others.
+    """
+
+    def __init__(self, name, url, username=None, password=None, timeout=DEFAULT_TIMEOUT,
+                 max_connections=MAX_CONNECTIONS, breaker=None, api_key=None, key_header='X-API-Key'):
+        self.name = name
+        self.url = url
+        self.timeout = timeout
+        self.breaker = breaker or CircuitBreaker()
+        # No retries: a retry would only spend the deadline the other peers share
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if username:
+            self.session.auth = (username, password or '')
+        if api_key:
+            self.session.headers[key_header] = api_key
+        self.max_connections = max_connections
+        self.requests = 0
+        self.failures = 0
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_connections,
+                                                    thread_name_prefix=f'federation-peer-{self.name}')
+            return self._executor.submit(fn, *args)
+
+    def query(self, national_id, patient_id, timeout):
+        """The peer's own (local-only) federation result for a patient"""
+        params = {"scope": "local"}   # peers answer from their database, never fan out again
+        if national_id:
+            params["national_id"] = national_id
+        if patient_id:
+            params["patient_id"] = patient_id
+        try:
+            response = self.session.get(self.url + '/api/federation/query', params=params,
+                                        timeout=(min(2.0, timeout), timeout))
+        except requests.Timeout:
+            raise PeerTimeout("timed out")
+        except requests.RequestException as e:
+            raise PeerError(f"unreachable: {e}")
+        if response.status_code == 429:
+            raise PeerRateLimited(f"rate limited (Retry-After: {response.headers.get('Retry-After', '-')})")
+        if response.status_code >= 400:
+            raise PeerError(f"returned HTTP {response.status_code}")
+        try:
+            result = response.json()
+        except ValueError:
+            result = None
+        return normalize(result)
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+        self.session.close()
+
+    def reset_after_fork(self):
+        self._executor = None
+        self._executor_lock = threading.Lock()
+
+
+class PeerRegistry:
+    """The configured peers and the fan-out over them"""
+
+    def __init__(self, peers=None, deadline=DEFAULT_DEADLINE, timeout=DEFAULT_TIMEOUT,
+                 negative_ttl=DEFAULT_NEGATIVE_TTL, breaker_failures=BREAKER_FAILURES,
+                 breaker_reset=BREAKER_RESET, max_connections=MAX_CONNECTIONS, api_key=None,
+                 key_header='X-API-Key'):
+        self.deadline = deadline
+        self.negative_ttl = negative_ttl
+        self.peers = {
+            name: Peer(name, spec['url'], spec.get('username'), spec.get('password'), timeout=timeout,
+                       max_connections=max_connections,
+                       breaker=CircuitBreaker(breaker_failures, breaker_reset),
+                       api_key=spec.get('api_key') or api_key, key_header=key_header)
+            for name, spec in (peers or {}).items()
+        }
+        self._negative = LRUCache(max_entries=10000)   # (peer, national_id, patient_id) -> expires_at
+
+    def __bool__(self):
+        return bool(self.peers)
+
+    def query(self, national_id, patient_id, deadline=None):
+        """Ask every peer at once; returns (results by peer name, status per peer)
+
+        Results are only those that arrived within the deadline. Statuses:
+        ok, cached (a recent "unknown here"), timeout, error, rate_limited,
+        circuit_open.
+        """
+        deadline = self.deadline if deadline is None else deadline
+        start = time.monotonic()
+        statuses, futures = {}, {}
+        for name, peer in self.peers.items():
+            expires = self._negative.get((name, national_id, patient_id))
+            if expires is not None and expires > start:
+                statuses[name] = {"status": "cached", "studies": 0}
+            elif not peer.breaker.allow():
+                statuses[name] = {"status": "circuit_open"}
+            else:
+                futures[name] = peer.submit(self._timed, peer, national_id, patient_id, start + deadline)
+
+        wait(futures.values(), timeout=deadline)
+        results = {}
+        for name, future in futures.items():
+            peer = self.peers[name]
+            if future.done():
+                try:
+                    result, elapsed = future.result()
+                    status = {"status": "ok", "studies": len(result['studies']),
+                              "elapsed_ms": round(elapsed * 1000, 1)}
+                except PeerTimeout:
+                    result, elapsed = None, time.monotonic() - start
+                    status = {"status": "timeout", "elapsed_ms": round(elapsed * 1000, 1)}
+                except PeerRateLimited as e:
+                    result, elapsed = None, time.monotonic() - start
+                    status = {"status": "rate_limited", "error": str(e)}
+                except PeerError as e:
+                    result, elapsed = None, time.monotonic() - start
+                    status = {"status": "error", "error": str(e)}
+            else:
+                # Left to finish on its own (its timeout is the deadline); the answer is dropped
+                future.cancel()
+                result, elapsed = None, time.monotonic() - start
+                status = {"status": "timeout", "elapsed_ms": round(elapsed * 1000, 1)}
+            peer.requests += 1
+            peer.failures += result is None
+            peer.breaker.record(result is not None or status['status'] == 'rate_limited')
+            metrics.federation_peer.observe(elapsed, name, status['status'])
+            statuses[name] = status
+            if result is not None:
+                results[name] = result
+                if not result['studies']:
+                    self._negative.set((name, national_id, patient_id), time.monotonic() + self.negative_ttl)
+        return results, [dict(status, name=name) for name, status in sorted(statuses.items())]
+
+    @staticmethod
+    def _timed(peer, national_id, patient_id, expires):
+        start = time.monotonic()
+        # Whatever is left of the deadline: the request may have queued behind others to this peer
+        remaining = expires - start
+        if remaining <= 0:
+            raise PeerTimeout("deadline passed before a connection was free")
+        result = peer.query(national_id, patient_id, timeout=min(peer.timeout, remaining))
+        return result, time.monotonic() - start
+
+    def stats(self):
+        return [{"name": name, "url": peer.url, "breaker": peer.breaker.state,
+                 "consecutive_failures": peer.breaker.consecutive,
+                 "requests": peer.requests, "failures": peer.failures}
+                for name, peer in sorted(self.peers.items())]
+
+    def close(self):
+        for peer in self.peers.values():
+            peer.close()
+
+    def reset_after_fork(self):
+        """Forget the parent's fan-out threads in a forked worker"""
+        for peer in self.peers.values():
+            peer.reset_after_fork()
+
+
+def merge(local, peer_results):
+    """Local federation result plus the peers' studies, deduplicated, oldest first
+
+    A study is the same study on two nodes when its StudyInstanceUID
+    matches, or else its (hospital_id, study_id); the first copy seen (the
+    local one, then peers by name) is kept. Remote studies are marked with
+    the peer they came from.
+    """
+    seen = set()
+    studies = []
+    for peer, result in [(None, local)] + sorted(peer_results.items()):
+        for study in result['studies']:
+            key = (('uid', study['study_instance_uid']) if study.get('study_instance_uid')
+                   else ('id', study.get('hospital_id'), study.get('study_id')))
+            if key in seen:
+                continue
+            seen.add(key)
+            studies.append(dict(study, peer=peer) if peer else study)
+    studies.sort(key=lambda study: (study.get('study_date') is not None, study.get('study_date') or ''))
+
+    patient = local['patient']
+    if patient['id'] is None:
+        patient = next((result['patient'] for _, result in sorted(peer_results.items())
+                        if result.get('patient', {}).get('id')), patient)
+    return dict(local, patient=patient, studies=studies, total_studies=len(studies),
+                hospitals_accessed=len({s['hospital_id'] for s in studies}))
@@ -0,0 +1,101 @@
+"""
+XRay Federation System - gunicorn settings
+    cd backend
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Every setting can be overridden from the environment (GUNICORN_*).
+
+Reloading:
+    kill -HUP <master pid>    re-read this file and replace workers gracefully;
+                              with preload_app the app code itself is not reloaded
+    kill -USR2 <master pid>   start a new master with new code, then
+    kill -QUIT <old pid>      drain and stop the old one (zero-downtime deploy)
+
+The Orthanc change-feed sync should run as its own process
+(python orthanc_sync.py), not inside the web workers. Background jobs do
+too: the master starts job_worker.py with GUNICORN_JOB_WORKERS threads
+(0 to run it separately) and stops it on exit; web workers only queue jobs.
+"""
+import glob
+import os
+import subprocess
+import sys
+import tempfile
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+
+# One process per core; each serves several requests at once on threads, which
+# covers time spent waiting on Orthanc or on SQLite's single writer lock.
+workers = int(os.environ.get('GUNICORN_WORKERS') or os.cpu_count() or 2)
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS') or 4)
+
+# Every thread can hold a pooled connection, plus headroom for streamed responses
+os.environ.setdefault('DATABASE_POOL_SIZE', str(threads * 2))
+
+# Workers publish metrics snapshots here so /metrics on any worker covers all of them
+os.environ.setdefault('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'xray-metrics'))
+
+# Web workers queue background jobs; job_worker.py (started below) runs them
+os.environ.setdefault('JOB_WORKERS', '0')
+job_workers = int(os.environ.get('GUNICORN_JOB_WORKERS') or 2)
+
+# Import the app and run migrations once in the master; workers fork with it
+# already loaded (copy-on-write) instead of each importing it again
+preload_app = True
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT') or 60)
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT') or 30)
+keepalive = 5
+
+# Recycle workers now and then so in-process caches and fragmentation stay bounded;
+# the jitter keeps them from all restarting at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS') or 10000)
+max_requests_jitter = max_requests // 10
+
+# Worker heartbeat files on tmpfs, not a possibly slow disk
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+accesslog = os.environ.get('GUNICORN_ACCESS_LOG', '-')
+errorlog = '-'
+
+
+def on_starting(server):
+    # Counters restart with the server; drop the previous run's snapshots
+    for path in glob.glob(os.path.join(os.environ['METRICS_DIR'], '*.json')):
+        os.remove(path)
+
+
+def when_ready(server):
+    if job_workers:
+        env = dict(os.environ, JOB_WORKERS=str(job_workers))
+        server.job_worker = subprocess.Popen(
+            [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'job_worker.py')],
+            env=env)
+        server.log.info("Started job worker (pid %s)", server.job_worker.pid)
+
+
+def on_exit(server):
+    job_worker = getattr(server, 'job_worker', None)
+    if job_worker and job_worker.poll() is None:
+        job_worker.terminate()
+        try:
+            job_worker.wait(graceful_timeout)
+        except subprocess.TimeoutExpired:
+            job_worker.kill()
+
+
+def post_fork(server, worker):
+    # Fresh connection pool, Orthanc session and QR process pool per worker
+    from app import reset_after_fork
+    reset_after_fork()
+
+
+def worker_exit(server, worker):
+    # Publish the final counts; they are folded into the retired totals on the next scrape
+    import metrics
+    metrics.REGISTRY.flush()
+    # Write out the access events still queued
+    import audit
+    audit.audit_log.close()
@@ -0,0 +1,206 @@
+"""
+XRay Federation System - Conditional GET and response compression
+Listings carry a weak ETag derived from the change counters of the tables
+they read (table_versions, bumped by triggers on every write), so a client
+revalidating with If-None-Match gets a 304 after one primary-key lookup,
+before the listing's own query runs. Federation results, which come from
+a per-patient cache, are tagged by a digest of their content instead, so
+that a hit reads no database either. Compressible responses are gzip- or
+brotli-encoded (brotli when installed and accepted), streamed ones chunk
+by chunk as they are generated.
+"""
+import functools
+import hashlib
+import os
+import zlib
+
+from flask import Response, make_response, request
+
+import db
+import storage
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is always available
+    brotli = None
+
+COMPRESSIBLE = {'application/json', 'application/x-ndjson', 'text/html', 'text/css', 'text/plain',
+                'text/csv', 'text/javascript', 'application/javascript', 'image/svg+xml'}
+# Below this a compressed body saves less than the encoding costs
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_GZIP_LEVEL = 6
+DEFAULT_BROTLI_QUALITY = 4   # dynamic content: close to gzip's speed, smaller output
+
+_settings = {"min_size": DEFAULT_MIN_SIZE, "gzip_level": DEFAULT_GZIP_LEVEL,
+             "brotli_quality": DEFAULT_BROTLI_QUALITY}
+
+
+# -- conditional GET ---------------------------------------------------------
+
+def table_versions(tables, pools=None):
+    """{table: version} for the main database; studies per shard when sharded
+
+    pools narrows the shards read to those given (e.g. one patient's).
+    """
+    main = [t for t in tables if t != 'studies' or not storage.sharded()]
+    versions = {}
+    if main:
+        rows = db.get_db().execute(
+            f"SELECT name, version FROM table_versions WHERE name IN ({','.join('?' * len(main))})",
+            main).fetchall()
+        versions.update(rows)
+    if 'studies' in tables and storage.sharded():
+        pools = storage.pools() if pools is None else pools
+        counts = storage.fan_out(pools, lambda conn: conn.execute(
+            "SELECT version FROM table_versions WHERE name = 'studies'").fetchone())
+        # Named per shard: a new shard appearing changes the tag as well
+        for pool, row in zip(pools, counts):
+            versions['studies:' + os.path.basename(pool.database)] = row[0] if row else 0
+    return versions
+
+
+def etag(tables, pools=None):
+    """Weak ETag of the current request's response, given the tables (and shards) it reads
+
+    The URL and the Accept header (NDJSON or JSON) pick the representation;
+    the table versions say whether its content can have changed.
+    """
+    return content_etag(sorted(table_versions(tables, pools).items()))
+
+
+def content_etag(digest):
+    """Weak ETag of the current request's response, given what its content is known by
+
+    A digest of the content itself, or the versions of what it was read from.
+    """
+    raw = f"{request.full_path}\n{request.headers.get('Accept', '')}\n{digest}"
+    return hashlib.sha1(raw.encode()).hexdigest()[:24]
+
+
+def conditional(*tables, unless=None, pools=None):
+    """Decorator: ETag GET responses by the tables they read; 304 without running the view
+
+    unless(), when given and true for a request, disables it (e.g. responses
+    decorated with live data from elsewhere). pools(**view_kwargs), when
+    given, names the shards the view reads studies from, so that a listing
+    of one hospital doesn't open every shard. The versions are read before
+    the view runs, so a write landing in between leaves the tag older than
+    the body, which only costs the client a refetch. A view whose body may
+    come from a cache tags it with respond() instead.
+    """
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or (unless and unless()):
+                return view(*args, **kwargs)
+            return respond(etag(tables, pools(**kwargs) if pools else None),
+                           functools.partial(view, *args, **kwargs))
+        return wrapper
+    return decorate
+
+
+def respond(tag, build):
+    """A 304 when If-None-Match has tag, else build()'s response, tagged
+
+    For a view that only knows its tag once it has its content (e.g. from a
+    cache, by content_etag()); conditional() is the decorator for the rest.
+    """
+    if request.if_none_match.contains_weak(tag):
+        response = Response(status=304)
+    else:
+        response = make_response(build())
+        if response.status_code != 200:
+            return response
+    response.set_etag(tag, weak=True)
+    # Records of patients: only the client may keep them, and it revalidates every time
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Accept')
+    return response
+
+
+# -- compression -------------------------------------------------------------
+
+def negotiate():
+    """'br', 'gzip' or None for the current request's Accept-Encoding"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br'] and accepted['br'] >= accepted['gzip']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+class _Encoder:
+    def __init__(self, encoding):
+        if encoding == 'br':
+            self._brotli = brotli.Compressor(quality=_settings['brotli_quality'])
+        else:
+            self._brotli = None
+            self._zlib = zlib.compressobj(_settings['gzip_level'], zlib.DEFLATED, 31)  # gzip container
+
+    def compress(self, data):
+        return self._brotli.process(data) if self._brotli else self._zlib.compress(data)
+
+    def finish(self):
+        return self._brotli.finish() if self._brotli else self._zlib.flush()
+
+
+class _CompressedStream:
+    """A streamed body encoded chunk by chunk; closing it closes the original"""
+
+    def __init__(self, chunks, encoding):
+        self.chunks = chunks
+        self.encoding = encoding
+
+    def __iter__(self):
+        encoder = _Encoder(self.encoding)
+        for chunk in self.chunks:
+            out = encoder.compress(chunk.encode() if isinstance(chunk, str) else chunk)
+            if out:  # the encoder buffers small chunks (e.g. one NDJSON line each)
+                yield out
+        yield encoder.finish()
+
+    def close(self):
+        # Even if iteration never started (client gone), e.g. for a file being sent
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+
+def compress_response(response):
+    """after_request hook: encode compressible responses the client accepts compressed"""
+    if (response.status_code < 200 or response.status_code in (204, 206, 304)
+            or response.mimetype not in COMPRESSIBLE or 'Content-Encoding' in response.headers
+            or request.method == 'HEAD'):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = _CompressedStream(response.response, encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < _settings['min_size']:
+            return response
+        encoder = _Encoder(encoding)
+        response.set_data(encoder.compress(data) + encoder.finish())
+    response.headers['Content-Encoding'] = encoding
+    # Byte ranges would address the encoded body, which isn't stable
+    response.headers.pop('Accept-Ranges', None)
+    # A strong ETag names exact bytes, which now depend on the encoding. Weak
+    # keeps the same value, so conditional requests still match it.
+    tag, weak = response.get_etag()
+    if tag and not weak:
+        response.set_etag(tag, weak=True)
+    return response
+
+
+def init_app(app):
+    _settings.update(
+        min_size=app.config.get('COMPRESSION_MIN_SIZE', DEFAULT_MIN_SIZE),
+        gzip_level=app.config.get('COMPRESSION_GZIP_LEVEL', DEFAULT_GZIP_LEVEL),
+        brotli_quality=app.config.get('COMPRESSION_BROTLI_QUALITY', DEFAULT_BROTLI_QUALITY),
+    )
+    if compress_response not in app.after_request_funcs.setdefault(None, []):
+        app.after_request(compress_response)
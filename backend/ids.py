@@ -0,0 +1,152 @@
+"""
+XRay Federation System - Public identifier generation
+"""
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime
+
+# Study keys count milliseconds from here: 41 bits of them last until 2093
+KEY_EPOCH_MS = 1704067200000   # 2024-01-01 UTC
+_SEQUENCE_BITS = 12
+_PROCESS_BITS = 10
+# Fresh IDs tried for one study or patient before its insert fails
+ID_RETRIES = 3
+
+_key_lock = threading.Lock()
+_last_ms = 0
+_last_sequence = 0
+
+
+def patient_id_for(national_id):
+    """The ID a new patient is given first: the last 6 digits of the national ID
+
+    Two national IDs can end alike; the second one registered then gets
+    new_patient_id() instead (see insert_patient/insert_patients).
+    """
+    return f"PAT-{national_id[-6:]}"
+
+
+def new_patient_id(national_id):
+    """patient_id_for(national_id) plus 24 random bits, for when that is taken"""
+    return f"{patient_id_for(national_id)}-{uuid.uuid4().hex[:6]}"
+
+
+def new_study_id():
+    """Timestamp plus a short UUID suffix to ensure uniqueness"""
+    return f"STU-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+def new_study_key():
+    """Time-ordered 63-bit integer key of a new study (its rowid)
+
+    milliseconds since KEY_EPOCH_MS | 10 bits of the process id | 12-bit
+    sequence. Keys from one process only ever increase, so new studies are
+    appended at the right-hand edge of every B-tree keyed on them instead
+    of landing at random pages; the process bits keep gunicorn workers
+    apart, and the sequence starts at a random value each millisecond so
+    that two workers whose pids share those bits still rarely meet.
+    """
+    global _last_ms, _last_sequence
+    now = int(time.time() * 1000) - KEY_EPOCH_MS
+    with _key_lock:
+        if now > _last_ms:
+            ms, sequence = now, random.getrandbits(_SEQUENCE_BITS - 1)
+        else:
+            # Same millisecond (or the clock stepped back): continue from the last key
+            ms, sequence = _last_ms, _last_sequence + 1
+            if sequence >> _SEQUENCE_BITS:
+                ms, sequence = ms + 1, random.getrandbits(_SEQUENCE_BITS - 1)
+        _last_ms, _last_sequence = ms, sequence
+    process = os.getpid() & ((1 << _PROCESS_BITS) - 1)
+    return (ms << (_PROCESS_BITS + _SEQUENCE_BITS)) | (process << _SEQUENCE_BITS) | sequence
+
+
+def id_collision(error):
+    """Whether an IntegrityError is a generated study ID or key that is already taken
+
+    IDs carry 32 random bits per second, and keys can meet between workers
+    whose pids share their low bits; a study with the same UID or Orthanc
+    ID is a genuine duplicate instead, which callers deal with themselves.
+    """
+    return isinstance(error, sqlite3.IntegrityError) and (
+        'studies.id' in str(error) or 'studies.rowid' in str(error))
+
+
+def patient_id_collision(error):
+    """Whether an IntegrityError is a patient ID that another national ID already has"""
+    return isinstance(error, sqlite3.IntegrityError) and 'patients.id' in str(error)
+
+
+def with_new_patient_id(row):
+    """Patient parameters (id, national_id, ...) with a fresh ID"""
+    return (new_patient_id(row[1]),) + tuple(row[1:])
+
+
+def with_new_ids(row):
+    """Study parameters that start with its ID and end with its key, both regenerated"""
+    return (new_study_id(),) + tuple(row[1:-1]) + (new_study_key(),)
+
+
+def _insert(conn, sql, row, reissue, collided):
+    """(row inserted, rowcount, collisions) for one row"""
+    for collisions in range(ID_RETRIES + 1):
+        try:
+            return row, conn.execute(sql, row).rowcount, collisions
+        except sqlite3.IntegrityError as e:
+            if collisions == ID_RETRIES or not collided(e):
+                raise
+            row = reissue(row)
+
+
+def _insert_many(conn, sql, rows, reissue, collided):
+    if len(rows) > 1:
+        conn.execute('SAVEPOINT new_ids')
+        try:
+            inserted = conn.executemany(sql, rows).rowcount
+            conn.execute('RELEASE new_ids')
+            return inserted, 0
+        except sqlite3.IntegrityError as e:
+            conn.execute('ROLLBACK TO new_ids')
+            conn.execute('RELEASE new_ids')
+            if not collided(e):
+                raise
+    inserted = collisions = 0
+    for row in rows:
+        _, count, clashes = _insert(conn, sql, row, reissue, collided)
+        inserted += count
+        collisions += clashes
+    return inserted, collisions
+
+
+def insert_study(conn, sql, row, reissue=with_new_ids):
+    """Insert one new study, with fresh IDs while they collide; returns the row inserted"""
+    return _insert(conn, sql, row, reissue, id_collision)[0]
+
+
+def insert_studies(conn, sql, rows, reissue=with_new_ids):
+    """executemany(sql, rows) for new studies, reissuing the IDs of rows that collide
+
+    Runs inside the caller's transaction. The rows are written together
+    under a savepoint; if one of them collides, that is undone and they are
+    written one by one. Returns (rows inserted, collisions), the former
+    leaving out rows the statement itself skipped (duplicates it ignores).
+    """
+    return _insert_many(conn, sql, rows, reissue, id_collision)
+
+
+def insert_patient(conn, sql, row):
+    """Insert one new patient (id, national_id, ...), with a fresh ID while it is taken
+
+    Returns the row inserted. A national ID that is already registered is
+    not retried: sql either handles it (ON CONFLICT) or raises.
+    """
+    return _insert(conn, sql, row, with_new_patient_id, patient_id_collision)[0]
+
+
+def insert_patients(conn, sql, rows):
+    """insert_studies() for new patients: (rows inserted, collisions)"""
+    return _insert_many(conn, sql, rows, with_new_patient_id, patient_id_collision)
@@ -0,0 +1,34 @@
+"""
+XRay Federation System - Background job worker
+Runs queued jobs (see jobs.py) in a process of its own, so web workers
+only submit and report on them. gunicorn.conf.py starts one next to the
+web workers; it can also be run by hand or under a process supervisor:
+    cd backend
+    python job_worker.py
+
+JOB_WORKERS sets how many jobs run at once. On SIGTERM or Ctrl+C, running
+jobs get JOB_SHUTDOWN_GRACE seconds to finish before they are marked failed.
+"""
+import logging
+import os
+import signal
+
+import jobs
+from app import create_app
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    app = create_app(os.environ.get('FLASK_CONFIG', 'production'))
+    runner = jobs.runner
+    if not runner.workers:
+        raise SystemExit("JOB_WORKERS is 0; nothing to run")
+    # Stop on SIGTERM (supervisors, gunicorn's on_exit) exactly as on Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    print(f"⚙️  Running background jobs from {app.config['DATABASE_PATH']} "
+          f"({runner.workers} at a time, files in {runner.job_dir})")
+    runner.run_forever(grace=float(os.environ.get('JOB_SHUTDOWN_GRACE') or 10))
+
+
+if __name__ == '__main__':
+    main()
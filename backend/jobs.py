@@ -0,0 +1,349 @@
+"""
+XRay Federation System - Background jobs
+Slow operations (bulk imports, the demo reset, QR sheets, Orthanc catch-up)
+run on worker threads instead of in the request: submitting returns a job
+ID at once, and the job's progress, result or error is read back later.
+
+Jobs are rows of the jobs table, so every process sees the same queue: any
+process with a free worker thread claims the oldest queued job, and any
+process can report on or cancel one. Handlers are registered per kind with
+@handler and called as fn(job, params).
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import db
+
+log = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 2
+POLL_INTERVAL = 1.0
+# Progress and cancellation checks touch the database at most this often per job
+PROGRESS_INTERVAL = 0.5
+RETENTION_DAYS = 7
+STATUSES = ('queued', 'running', 'succeeded', 'failed', 'cancelled')
+FINISHED = ('succeeded', 'failed', 'cancelled')
+
+
+class JobCancelled(Exception):
+    """Raised inside a handler by Job.check_cancelled() once a cancel was requested"""
+
+
+def new_job_id():
+    return f"JOB-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+
+class Job:
+    """What a handler sees of its job: progress reporting, cancellation, files"""
+
+    def __init__(self, runner, job_id):
+        self.runner = runner
+        self.id = job_id
+        self._last_write = 0.0
+        self._last_check = 0.0
+        self._cancelled = False
+
+    def progress(self, done, total=None, message=None, force=False):
+        """Record progress; throttled so a tight loop doesn't queue on the writer lock"""
+        now = time.monotonic()
+        if not force and now - self._last_write < PROGRESS_INTERVAL:
+            return
+        self._last_write = now
+        with db.connection() as conn, db.transaction(conn):
+            conn.execute('UPDATE jobs SET progress_done = ?, progress_total = ?, message = ? WHERE id = ?',
+                         (done, total, message, self.id))
+
+    def check_cancelled(self):
+        """Raise JobCancelled if a cancel was requested; call between units of work"""
+        now = time.monotonic()
+        if not self._cancelled and now - self._last_check >= PROGRESS_INTERVAL:
+            self._last_check = now
+            with db.connection() as conn:
+                row = conn.execute('SELECT cancel_requested FROM jobs WHERE id = ?', (self.id,)).fetchone()
+            self._cancelled = bool(row and row[0])
+        if self._cancelled:
+            raise JobCancelled()
+
+    def file_path(self, name):
+        return self.runner.file_path(self.id, name)
+
+    def file_result(self, name, mimetype, **extra):
+        """Result pointing at a file written to file_path(name); served by the result endpoint"""
+        return dict(extra, file=name, mimetype=mimetype)
+
+
+class JobRunner:
+    """The queue (the jobs table) plus this process's worker threads"""
+
+    def __init__(self, workers=DEFAULT_WORKERS, job_dir='jobs', context=None,
+                 poll_interval=POLL_INTERVAL, retention_days=RETENTION_DAYS):
+        self.workers = workers
+        self.job_dir = job_dir
+        self.context = context          # e.g. app.app_context, entered around each job
+        self.poll_interval = poll_interval
+        self.retention_days = retention_days
+        self.handlers = {}
+        self._wake = threading.Condition()
+        self._stop = threading.Event()
+        self._threads = []
+        self._pid = None
+        self._next_cleanup = 0.0
+
+    # -- submitting and inspecting --------------------------------------------
+
+    def handler(self, kind):
+        def register(fn):
+            self.handlers[kind] = fn
+            return fn
+        return register
+
+    def submit(self, kind, params=None, job_id=None):
+        """Queue a job; returns its ID. job_id lets callers spool files under it first."""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        job_id = job_id or new_job_id()
+        with db.connection() as conn, db.transaction(conn):
+            conn.execute('INSERT INTO jobs (id, kind, params) VALUES (?, ?, ?)',
+                         (job_id, kind, json.dumps(params or {})))
+        self.start()
+        with self._wake:
+            self._wake.notify()
+        return job_id
+
+    def get(self, job_id):
+        with db.connection() as conn:
+            row = conn.execute(f'SELECT {_COLUMNS} FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        return _job_dict(row) if row else None
+
+    def list(self, status=None, kind=None, limit=50):
+        query, params = f'SELECT {_COLUMNS} FROM jobs WHERE 1=1', []
+        if status:
+            query += ' AND status = ?'
+            params.append(status)
+        if kind:
+            query += ' AND kind = ?'
+            params.append(kind)
+        query += ' ORDER BY created_date DESC, id DESC LIMIT ?'
+        params.append(limit)
+        with db.connection() as conn:
+            return [_job_dict(row) for row in conn.execute(query, params)]
+
+    def cancel(self, job_id):
+        """Cancel a queued job outright; ask a running one to stop at its next check
+
+        Returns the job afterwards, or None if there is no such job.
+        """
+        with db.connection() as conn, db.transaction(conn):
+            conn.execute('''
+                UPDATE jobs SET status = 'cancelled', cancel_requested = 1, finished_date = CURRENT_TIMESTAMP
+                WHERE id = ? AND status = 'queued'
+            ''', (job_id,))
+            conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (job_id,))
+        return self.get(job_id)
+
+    def file_path(self, job_id, name):
+        """Path for a file kept with a job (a spooled upload, a rendered result)"""
+        directory = os.path.join(self.job_dir, job_id)
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, name)
+
+    def result_file(self, job):
+        """Absolute path of a finished job's file result, or None"""
+        result = job.get('result') or {}
+        if job['status'] != 'succeeded' or 'file' not in result:
+            return None
+        return os.path.abspath(os.path.join(self.job_dir, job['id'], result['file']))
+
+    # -- running ------------------------------------------------------------
+
+    def start(self):
+        """Start this process's worker threads (once per process; a no-op with 0 workers)
+
+        Called lazily, like the metrics flusher, so threads start in each
+        forked worker rather than in the gunicorn master.
+        """
+        if not self.workers or self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._wake = threading.Condition()
+        self._threads = [threading.Thread(target=self._work, name=f'job-worker-{n}', daemon=True)
+                         for n in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        with self._wake:
+            self._wake.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def run_forever(self, grace=10.0):
+        """Block running jobs until interrupted (the standalone job_worker.py)
+
+        On the way out, running jobs get `grace` seconds to finish and are
+        then marked failed, rather than left 'running' until reaped.
+        """
+        self.start()
+        try:
+            while not self._stop.wait(60):
+                pass
+        except KeyboardInterrupt:
+            pass
+        self.stop(timeout=grace)
+        self.interrupt_running()
+
+    def interrupt_running(self):
+        """Fail the jobs this process is still running (it is exiting)"""
+        with db.connection() as conn, db.transaction(conn):
+            conn.execute('''
+                UPDATE jobs SET status = 'failed', error = 'Interrupted: worker process exited',
+                                finished_date = CURRENT_TIMESTAMP
+                WHERE status = 'running' AND worker = ?
+            ''', (str(os.getpid()),))
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                claimed = self._claim()
+            except Exception:
+                log.exception("Claiming a job failed")
+                claimed = None
+            if claimed is None:
+                with self._wake:
+                    self._wake.wait(self.poll_interval)
+                continue
+            self._run(*claimed)
+
+    def _claim(self):
+        """Take the oldest queued job; (id, kind, params) or None"""
+        self._maintain()
+        with db.connection() as conn:
+            # IMMEDIATE takes the writer lock up front, so two processes can't claim the same row
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('''
+                    SELECT id, kind, params FROM jobs
+                    WHERE status = 'queued'
+                    ORDER BY created_date, id
+                    LIMIT 1
+                ''').fetchone()
+                if row:
+                    conn.execute('''
+                        UPDATE jobs SET status = 'running', worker = ?, started_date = CURRENT_TIMESTAMP
+                        WHERE id = ?
+                    ''', (str(os.getpid()), row[0]))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        if row is None:
+            return None
+        return row[0], row[1], json.loads(row[2] or '{}')
+
+    def _run(self, job_id, kind, params):
+        job = Job(self, job_id)
+        status, result, error = 'succeeded', None, None
+        try:
+            fn = self.handlers.get(kind)
+            if fn is None:
+                raise ValueError(f"No handler for job kind {kind} in this process")
+            if self.context:
+                with self.context():
+                    result = fn(job, params)
+            else:
+                result = fn(job, params)
+        except JobCancelled:
+            status = 'cancelled'
+        except Exception as e:
+            log.exception("Job %s (%s) failed", job_id, kind)
+            status, error = 'failed', str(e) or type(e).__name__
+        with db.connection() as conn, db.transaction(conn):
+            conn.execute('''
+                UPDATE jobs SET status = ?, result = ?, error = ?, finished_date = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (status, json.dumps(result) if result is not None else None, error, job_id))
+
+    def _maintain(self):
+        """Now and then: fail jobs whose process died, and drop old finished jobs"""
+        now = time.monotonic()
+        if now < self._next_cleanup:
+            return
+        self._next_cleanup = now + 60
+        with db.connection() as conn:
+            running = conn.execute("SELECT id, worker FROM jobs WHERE status = 'running'").fetchall()
+            dead = [job_id for job_id, worker in running if not _alive(worker)]
+            expired = [row[0] for row in conn.execute(f'''
+                SELECT id FROM jobs
+                WHERE status IN ({','.join('?' * len(FINISHED))})
+                  AND finished_date < datetime('now', ?)
+            ''', FINISHED + (f'-{int(self.retention_days)} days',))]
+            with db.transaction(conn):
+                conn.executemany('''
+                    UPDATE jobs SET status = 'failed', error = 'Interrupted: worker process exited',
+                                    finished_date = CURRENT_TIMESTAMP
+                    WHERE id = ? AND status = 'running'
+                ''', [(job_id,) for job_id in dead])
+                conn.executemany('DELETE FROM jobs WHERE id = ?', [(job_id,) for job_id in expired])
+        for job_id in expired:
+            shutil.rmtree(os.path.join(self.job_dir, job_id), ignore_errors=True)
+
+
+def _alive(worker):
+    """Whether the process that claimed a job still exists (jobs share one host's database)"""
+    if os.name == 'nt':
+        return True   # os.kill() would terminate it there; such jobs are failed on exit instead
+    try:
+        os.kill(int(worker), 0)
+    except (TypeError, ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+_COLUMNS = ('id, kind, status, params, progress_done, progress_total, message, result, error, '
+            'cancel_requested, created_date, started_date, finished_date')
+
+
+def _job_dict(row):
+    (job_id, kind, status, params, done, total, message, result, error,
+     cancel_requested, created, started, finished) = row
+    return {
+        "id": job_id,
+        "kind": kind,
+        "status": status,
+        "params": json.loads(params or '{}'),
+        "progress": {"done": done, "total": total, "message": message},
+        "result": json.loads(result) if result else None,
+        "error": error,
+        "cancel_requested": bool(cancel_requested),
+        "created_date": created,
+        "started_date": started,
+        "finished_date": finished,
+    }
+
+
+runner = JobRunner()
+handler = runner.handler
+
+
+def configure(workers=None, job_dir=None, context=None):
+    """Apply settings to the shared runner; handlers stay registered"""
+    runner.workers = DEFAULT_WORKERS if workers is None else workers
+    runner.job_dir = job_dir or runner.job_dir
+    runner.context = context
+    return runner
+
+
+def reset_after_fork():
+    """Forked workers start their own threads (on first use), not the parent's"""
+    runner._pid = None
+    runner._threads = []
@@ -0,0 +1,427 @@
+"""
+XRay Federation System - Request, SQL and QR render metrics
+Counters and histograms kept in process memory and exposed in the
+Prometheus text format on /metrics.
+
+Recording is a lock, a bisect and a few additions per observation, cheap
+enough to leave on. Under gunicorn every worker keeps its own numbers; when
+METRICS_DIR is set each worker also writes a snapshot there once a second
+and /metrics sums the snapshots of every worker, so a scrape that
+lands on any one of them sees the whole server (at most a second behind).
+"""
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-process waitress, nothing to merge
+    fcntl = None
+
+# Seconds; spans a cached QR hit (~0.1 ms) to a slow federation enrichment
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SQL_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+               0.05, 0.1, 0.25, 1.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+FLUSH_INTERVAL = 1.0
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), self._copy(value)] for key, value in self._series.items()]
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._series[label_values] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                # per-bucket counts (not cumulative; the last slot is +Inf), sum, count
+                series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @staticmethod
+    def _copy(value):
+        return [list(value[0]), value[1], value[2]]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self.metrics_dir = None
+        self._flusher_pid = None
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, buckets, labels=()):
+        return self.register(Histogram(name, help, buckets, labels))
+
+    def collector(self, fn):
+        """fn() -> [(name, kind, help, labels, [(label_values, value), ...])], read at scrape time"""
+        self._collectors.append(fn)
+        return fn
+
+    def reset(self):
+        """Zero every metric, e.g. in a forked worker that inherited the parent's counts"""
+        for metric in self._metrics:
+            metric.reset()
+
+    # -- snapshots -----------------------------------------------------------
+
+    def snapshot(self):
+        families = {}
+        for metric in self._metrics:
+            families[metric.name] = {
+                "kind": metric.kind, "help": metric.help, "labels": list(metric.labels),
+                "buckets": list(getattr(metric, 'buckets', ())), "series": metric.snapshot(),
+            }
+        for collect in self._collectors:
+            for name, kind, help, labels, series in collect():
+                families[name] = {"kind": kind, "help": help, "labels": list(labels),
+                                  "buckets": [], "series": [[list(k), v] for k, v in series]}
+        return families
+
+    def start_flusher(self):
+        """Publish snapshots from a background thread once a second
+
+        Started lazily from the first request a process serves, so it runs
+        in each forked worker rather than in the gunicorn master.
+        """
+        if not self.metrics_dir or self._flusher_pid == os.getpid():
+            return
+        self._flusher_pid = os.getpid()
+        threading.Thread(target=self._flush_forever, name='metrics-flush', daemon=True).start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError:
+                pass  # METRICS_DIR removed or full; try again next tick
+
+    def flush(self):
+        """Write this process's snapshot to METRICS_DIR for the other workers to merge"""
+        if not self.metrics_dir:
+            return
+        path = os.path.join(self.metrics_dir, f'{os.getpid()}.json')
+        tmp = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f, separators=(',', ':'))
+        os.replace(tmp, path)
+
+    def collect(self):
+        """This process's families, summed with every other worker's when METRICS_DIR is set"""
+        if not self.metrics_dir:
+            return self.snapshot()
+        self.flush()
+        with _dir_lock(self.metrics_dir):
+            _retire_dead_workers(self.metrics_dir)
+            merged = {}
+            for path in glob.glob(os.path.join(self.metrics_dir, '*.json')):
+                try:
+                    with open(path) as f:
+                        _merge(merged, json.load(f))
+                except (OSError, ValueError):
+                    continue  # replaced mid-read; the next scrape gets it
+        return merged
+
+    def render(self):
+        return render_text(self.collect())
+
+
+def _merge(into, families, gauges=True):
+    for name, family in families.items():
+        if family['kind'] == 'gauge' and not gauges:
+            continue
+        target = into.setdefault(name, dict(family, series=[]))
+        index = {tuple(key): i for i, (key, _) in enumerate(target['series'])}
+        for key, value in family['series']:
+            i = index.get(tuple(key))
+            if i is None:
+                target['series'].append([key, value])
+                index[tuple(key)] = len(target['series']) - 1
+            elif family['kind'] == 'histogram':
+                current = target['series'][i][1]
+                target['series'][i][1] = [[a + b for a, b in zip(current[0], value[0])],
+                                          current[1] + value[1], current[2] + value[2]]
+            else:
+                target['series'][i][1] += value
+
+
+def _retire_dead_workers(metrics_dir):
+    """Fold exited workers' counters into retired.json so totals never go backwards
+
+    Their gauges (in-flight requests, pool sizes) are dropped: they describe
+    a process that no longer exists.
+    """
+    retired_path = os.path.join(metrics_dir, 'retired.json')
+    dead = []
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+        stem = os.path.basename(path)[:-5]
+        if stem.isdigit() and int(stem) != os.getpid() and not _alive(int(stem)):
+            dead.append(path)
+    if not dead:
+        return
+    retired = {}
+    if os.path.exists(retired_path):
+        with open(retired_path) as f:
+            retired = json.load(f)
+    for path in dead:
+        try:
+            with open(path) as f:
+                _merge(retired, json.load(f), gauges=False)
+        except (OSError, ValueError):
+            pass
+    with open(retired_path + '.tmp', 'w') as f:
+        json.dump(retired, f, separators=(',', ':'))
+    os.replace(retired_path + '.tmp', retired_path)
+    for path in dead:
+        os.remove(path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class _dir_lock:
+    def __init__(self, metrics_dir):
+        self.path = os.path.join(metrics_dir, '.lock')
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        if fcntl:
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+
+    def __exit__(self, *exc):
+        if fcntl:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_text(families):
+    """Prometheus text exposition format (version 0.0.4)"""
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        lines.append(f'# HELP {name} {family["help"]}')
+        lines.append(f'# TYPE {name} {family["kind"]}')
+        names = family['labels']
+        for key, value in sorted(family['series'], key=lambda s: [str(v) for v in s[0]]):
+            if family['kind'] != 'histogram':
+                lines.append(f'{name}{_labels(names, key)} {_number(value)}')
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, n in zip(list(family['buckets']) + [float('inf')], counts):
+                cumulative += n
+                le = 'le="' + _number(bound) + '"'
+                lines.append(f'{name}_bucket{_labels(names, key, le)} {cumulative}')
+            lines.append(f'{name}_sum{_labels(names, key)} {_number(float(total))}')
+            lines.append(f'{name}_count{_labels(names, key)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+# -- the process-wide registry and the metrics the app records -----------------
+
+REGISTRY = Registry()
+
+http_requests = REGISTRY.counter(
+    'xray_http_requests_total', 'HTTP requests by route, method and status code',
+    ('method', 'route', 'status'))
+http_latency = REGISTRY.histogram(
+    'xray_http_request_duration_seconds', 'Time from request start to last response byte',
+    LATENCY_BUCKETS, ('method', 'route'))
+http_response_size = REGISTRY.histogram(
+    'xray_http_response_size_bytes', 'Response body size', SIZE_BUCKETS, ('route',))
+http_in_flight = REGISTRY.gauge(
+    'xray_http_requests_in_flight', 'Requests currently being served')
+
+sql_statements = REGISTRY.histogram(
+    'xray_sql_statement_duration_seconds',
+    'SQLite execute()/executemany() time by statement type (row fetching not included)',
+    SQL_BUCKETS, ('statement',))
+
+qr_render = REGISTRY.histogram(
+    'xray_qr_render_duration_seconds', 'QR code and QR sheet render time (cache misses only)',
+    LATENCY_BUCKETS, ('kind',))
+
+dicom_preview = REGISTRY.histogram(
+    'xray_dicom_preview_duration_seconds', 'DICOM thumbnail fetch and render time (cache misses only)',
+    LATENCY_BUCKETS, ('source',))
+
+federation_peer = REGISTRY.histogram(
+    'xray_federation_peer_duration_seconds', 'Federation peer query time, by peer and outcome',
+    LATENCY_BUCKETS, ('peer', 'status'))
+
+export_rows = REGISTRY.counter(
+    'xray_export_rows_total', 'Rows streamed by /api/export/studies', ('format',))
+
+audit_events = REGISTRY.counter(
+    'xray_audit_events_total', 'Access audit events: written, dropped, or rejected (request refused)',
+    ('outcome',))
+audit_queue = REGISTRY.gauge(
+    'xray_audit_queue_depth', 'Audit events waiting for the writer, after its last batch')
+admission_refused = REGISTRY.counter(
+    'xray_admission_refused_total', 'Requests refused by admission control: rate_limited (429) or saturated (503)',
+    ('route_class', 'reason'))
+
+_STATEMENT_TYPES = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'BEGIN', 'COMMIT', 'PRAGMA')
+
+
+def statement_type(sql):
+    word = sql.lstrip()[:6].upper()
+    for kind in _STATEMENT_TYPES:
+        if word.startswith(kind):
+            return kind
+    return 'OTHER'
+
+
+def configure(metrics_dir=None):
+    REGISTRY.metrics_dir = metrics_dir
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+
+
+class MetricsMiddleware:
+    """WSGI wrapper timing each request until its last body byte is sent
+
+    Wrapping the WSGI app rather than using Flask's after_request hooks
+    means streamed responses (NDJSON listings) are timed and sized in full.
+    The route label is the URL rule, which the app stores in the environ.
+    """
+
+    def __init__(self, wsgi_app, registry=REGISTRY):
+        self.wsgi_app = wsgi_app
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        status = ['500']
+        self.registry.start_flusher()
+        http_in_flight.inc()
+
+        def recording_start_response(status_line, headers, exc_info=None):
+            status[0] = status_line.split(' ', 1)[0]
+            return start_response(status_line, headers, exc_info)
+
+        try:
+            body = self.wsgi_app(environ, recording_start_response)
+        except Exception:
+            self._finish(environ, start, status[0], 0)
+            raise
+        return _TimedBody(body, lambda size: self._finish(environ, start, status[0], size))
+
+    def _finish(self, environ, start, status, size):
+        route = environ.get('xray.route', '<unmatched>')
+        method = environ.get('REQUEST_METHOD', '')
+        http_in_flight.dec()
+        http_latency.observe(time.perf_counter() - start, method, route)
+        http_requests.inc(method, route, status)
+        http_response_size.observe(size, route)
+
+
+class _TimedBody:
+    def __init__(self, body, on_close):
+        self.body = body
+        self.on_close = on_close
+        self.size = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.on_close(self.size)
@@ -0,0 +1,544 @@
+"""
+XRay Federation System - Schema migrations
+Versioned with SQLite's PRAGMA user_version; each step runs exactly once
+"""
+
+# (version, description, statements) - append new steps, never edit old ones
+MIGRATIONS = [
+    (1, 'initial schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS hospitals (
+            id TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            address TEXT,
+            phone TEXT,
+            email TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS patients (
+            id TEXT PRIMARY KEY,
+            national_id TEXT UNIQUE NOT NULL,
+            first_name TEXT NOT NULL,
+            last_name TEXT NOT NULL,
+            date_of_birth DATE,
+            gender TEXT,
+            phone TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS studies (
+            id TEXT PRIMARY KEY,
+            patient_id TEXT,
+            hospital_id TEXT,
+            study_date TIMESTAMP,
+            modality TEXT,
+            description TEXT,
+            orthanc_study_id TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (patient_id) REFERENCES patients (id),
+            FOREIGN KEY (hospital_id) REFERENCES hospitals (id)
+        )
+        ''',
+    ]),
+    (2, 'secondary indexes on studies', [
+        # /api/hospitals/<id>/studies filters by hospital, ordered by date
+        'CREATE INDEX IF NOT EXISTS idx_studies_hospital_date ON studies (hospital_id, study_date)',
+        # federation_query joins patients -> studies
+        'CREATE INDEX IF NOT EXISTS idx_studies_patient_date ON studies (patient_id, study_date)',
+        'CREATE INDEX IF NOT EXISTS idx_studies_orthanc ON studies (orthanc_study_id)',
+        'ANALYZE',
+    ]),
+    (3, 'keyset pagination index for hospital studies', [
+        # (study_date, id) is the page key of /api/hospitals/<id>/studies
+        'CREATE INDEX IF NOT EXISTS idx_studies_hospital_date_id ON studies (hospital_id, study_date, id)',
+        'DROP INDEX IF EXISTS idx_studies_hospital_date',
+    ]),
+    (4, 'orthanc change-feed sync state', [
+        '''
+        CREATE TABLE IF NOT EXISTS orthanc_sync_state (
+            source TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Stable studies whose DICOM PatientID has no registered patient yet
+        '''
+        CREATE TABLE IF NOT EXISTS orthanc_sync_pending (
+            orthanc_study_id TEXT PRIMARY KEY,
+            dicom_patient_id TEXT NOT NULL,
+            hospital_id TEXT NOT NULL,
+            study_date TIMESTAMP,
+            modality TEXT,
+            description TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_orthanc_sync_pending_patient ON orthanc_sync_pending (dicom_patient_id)',
+    ]),
+    (5, 'dashboard summary indexes', [
+        # Per-hospital/per-modality totals are an index-only scan instead of a table scan
+        'CREATE INDEX IF NOT EXISTS idx_studies_hospital_modality ON studies (hospital_id, modality)',
+        # Most recent studies across all hospitals
+        'CREATE INDEX IF NOT EXISTS idx_studies_date ON studies (study_date)',
+    ]),
+    (6, 'full-text search over patients and studies', [
+        # External-content FTS5 tables: the index only, rows stay in patients/studies
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS patients_fts USING fts5(
+            first_name, last_name, national_id,
+            content='patients', content_rowid='rowid',
+            prefix='2 3 4', tokenize='unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_insert AFTER INSERT ON patients BEGIN
+            INSERT INTO patients_fts (rowid, first_name, last_name, national_id)
+            VALUES (new.rowid, new.first_name, new.last_name, new.national_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_delete AFTER DELETE ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, first_name, last_name, national_id)
+            VALUES ('delete', old.rowid, old.first_name, old.last_name, old.national_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patients_fts_update AFTER UPDATE OF first_name, last_name, national_id ON patients BEGIN
+            INSERT INTO patients_fts (patients_fts, rowid, first_name, last_name, national_id)
+            VALUES ('delete', old.rowid, old.first_name, old.last_name, old.national_id);
+            INSERT INTO patients_fts (rowid, first_name, last_name, national_id)
+            VALUES (new.rowid, new.first_name, new.last_name, new.national_id);
+        END
+        ''',
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS studies_fts USING fts5(
+            description, modality,
+            content='studies', content_rowid='rowid',
+            prefix='2 3 4', tokenize='unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_fts_insert AFTER INSERT ON studies BEGIN
+            INSERT INTO studies_fts (rowid, description, modality)
+            VALUES (new.rowid, new.description, new.modality);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_fts_delete AFTER DELETE ON studies BEGIN
+            INSERT INTO studies_fts (studies_fts, rowid, description, modality)
+            VALUES ('delete', old.rowid, old.description, old.modality);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_fts_update AFTER UPDATE OF description, modality ON studies BEGIN
+            INSERT INTO studies_fts (studies_fts, rowid, description, modality)
+            VALUES ('delete', old.rowid, old.description, old.modality);
+            INSERT INTO studies_fts (rowid, description, modality)
+            VALUES (new.rowid, new.description, new.modality);
+        END
+        ''',
+        # Index whatever was already in the tables
+        "INSERT INTO patients_fts (patients_fts) VALUES ('rebuild')",
+        "INSERT INTO studies_fts (studies_fts) VALUES ('rebuild')",
+    ]),
+    (7, 'global patient index for per-hospital study shards', [
+        # Which shards (see storage.py) hold studies of each patient; only
+        # written when STUDY_SHARD_DIR is set
+        '''
+        CREATE TABLE IF NOT EXISTS patient_shards (
+            patient_id TEXT NOT NULL,
+            shard TEXT NOT NULL,
+            PRIMARY KEY (patient_id, shard)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (8, 'background jobs', [
+        # Queue and history of jobs.py; params/result are JSON
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            params TEXT,
+            progress_done INTEGER NOT NULL DEFAULT 0,
+            progress_total INTEGER,
+            message TEXT,
+            result TEXT,
+            error TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0,
+            worker TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_date TIMESTAMP,
+            finished_date TIMESTAMP
+        )
+        ''',
+        # Claiming the oldest queued job, and listings by status
+        'CREATE INDEX IF NOT EXISTS idx_jobs_status_created ON jobs (status, created_date)',
+        'CREATE INDEX IF NOT EXISTS idx_jobs_created ON jobs (created_date)',
+    ]),
+    (9, 'DICOM StudyInstanceUID on studies', [
+        # Set by dicom_ingest.py, so re-ingesting a folder skips the studies it already has
+        'ALTER TABLE studies ADD COLUMN study_instance_uid TEXT',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_studies_instance_uid ON studies (study_instance_uid)
+        WHERE study_instance_uid IS NOT NULL
+        ''',
+    ]),
+    (10, 'per-table change counters', [
+        # Bumped by triggers on every write, so http_cache.py can tell whether a
+        # listing changed (its ETag) without running the listing's query
+        '''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+        "INSERT OR IGNORE INTO table_versions (name) VALUES ('hospitals'), ('patients'), ('studies')",
+        '''
+        CREATE TRIGGER IF NOT EXISTS hospitals_version_insert AFTER INSERT ON hospitals BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'hospitals';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS hospitals_version_update AFTER UPDATE ON hospitals BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'hospitals';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS hospitals_version_delete AFTER DELETE ON hospitals BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'hospitals';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patients_version_insert AFTER INSERT ON patients BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'patients';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patients_version_update AFTER UPDATE ON patients BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'patients';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patients_version_delete AFTER DELETE ON patients BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'patients';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_version_insert AFTER INSERT ON studies BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'studies';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_version_update AFTER UPDATE ON studies BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'studies';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_version_delete AFTER DELETE ON studies BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'studies';
+        END
+        ''',
+    ]),
+    (11, 'change counters bumped once per batch', [
+        # A batch writer (db.batched_versions) bumps a counter once and sets
+        # batched for the length of its transaction, muting the row triggers;
+        # other connections never see batched set, as it is cleared before commit
+        'ALTER TABLE table_versions ADD COLUMN batched INTEGER NOT NULL DEFAULT 0',
+        'DROP TRIGGER IF EXISTS patients_version_insert',
+        '''
+        CREATE TRIGGER patients_version_insert AFTER INSERT ON patients
+        WHEN (SELECT batched FROM table_versions WHERE name = 'patients') = 0 BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'patients';
+        END
+        ''',
+        'DROP TRIGGER IF EXISTS patients_version_update',
+        '''
+        CREATE TRIGGER patients_version_update AFTER UPDATE ON patients
+        WHEN (SELECT batched FROM table_versions WHERE name = 'patients') = 0 BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'patients';
+        END
+        ''',
+        'DROP TRIGGER IF EXISTS patients_version_delete',
+        '''
+        CREATE TRIGGER patients_version_delete AFTER DELETE ON patients
+        WHEN (SELECT batched FROM table_versions WHERE name = 'patients') = 0 BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'patients';
+        END
+        ''',
+        'DROP TRIGGER IF EXISTS studies_version_insert',
+        '''
+        CREATE TRIGGER studies_version_insert AFTER INSERT ON studies
+        WHEN (SELECT batched FROM table_versions WHERE name = 'studies') = 0 BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'studies';
+        END
+        ''',
+        'DROP TRIGGER IF EXISTS studies_version_update',
+        '''
+        CREATE TRIGGER studies_version_update AFTER UPDATE ON studies
+        WHEN (SELECT batched FROM table_versions WHERE name = 'studies') = 0 BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'studies';
+        END
+        ''',
+        'DROP TRIGGER IF EXISTS studies_version_delete',
+        '''
+        CREATE TRIGGER studies_version_delete AFTER DELETE ON studies
+        WHEN (SELECT batched FROM table_versions WHERE name = 'studies') = 0 BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'studies';
+        END
+        ''',
+    ]),
+    (12, 'per-patient change log', [
+        # Every write to a patient's record or studies appends the patient here,
+        # so each process's federation cache (federation_cache.py) can read what
+        # is new since it last looked and evict exactly those patients. One
+        # insert per row, like the search index; the oldest entries are pruned
+        # past the last 100000, and a reader that finds entries gone that it
+        # hadn't read starts afresh
+        '''
+        CREATE TABLE IF NOT EXISTS patient_changes (
+            seq INTEGER PRIMARY KEY,
+            patient_id TEXT,
+            national_id TEXT
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patient_changes_prune AFTER INSERT ON patient_changes
+        WHEN NEW.seq % 10000 = 0 BEGIN
+            DELETE FROM patient_changes WHERE seq <= NEW.seq - 100000;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patients_change_insert AFTER INSERT ON patients BEGIN
+            INSERT INTO patient_changes (patient_id, national_id) VALUES (NEW.id, NEW.national_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patients_change_update AFTER UPDATE ON patients BEGIN
+            INSERT INTO patient_changes (patient_id, national_id) VALUES (NEW.id, NEW.national_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patients_change_delete AFTER DELETE ON patients BEGIN
+            INSERT INTO patient_changes (patient_id, national_id) VALUES (OLD.id, OLD.national_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_patient_change_insert AFTER INSERT ON studies
+        WHEN NEW.patient_id IS NOT NULL BEGIN
+            INSERT INTO patient_changes (patient_id) VALUES (NEW.patient_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_patient_change_update AFTER UPDATE ON studies BEGIN
+            INSERT INTO patient_changes (patient_id)
+            SELECT NEW.patient_id WHERE NEW.patient_id IS NOT NULL
+            UNION ALL SELECT OLD.patient_id WHERE OLD.patient_id IS NOT NULL AND OLD.patient_id IS NOT NEW.patient_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_patient_change_delete AFTER DELETE ON studies
+        WHEN OLD.patient_id IS NOT NULL BEGIN
+            INSERT INTO patient_changes (patient_id) VALUES (OLD.patient_id);
+        END
+        ''',
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Schema of a per-hospital study shard (storage.py), versioned separately.
+# patients and hospitals are not here: shard connections attach the main
+# database, where those names resolve.
+SHARD_MIGRATIONS = [
+    (1, 'studies shard schema', [
+        '''
+        CREATE TABLE IF NOT EXISTS studies (
+            id TEXT PRIMARY KEY,
+            patient_id TEXT,
+            hospital_id TEXT,
+            study_date TIMESTAMP,
+            modality TEXT,
+            description TEXT,
+            orthanc_study_id TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_studies_hospital_date_id ON studies (hospital_id, study_date, id)',
+        'CREATE INDEX IF NOT EXISTS idx_studies_patient_date ON studies (patient_id, study_date)',
+        'CREATE INDEX IF NOT EXISTS idx_studies_orthanc ON studies (orthanc_study_id)',
+        'CREATE INDEX IF NOT EXISTS idx_studies_hospital_modality ON studies (hospital_id, modality)',
+        'CREATE INDEX IF NOT EXISTS idx_studies_date ON studies (study_date)',
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS studies_fts USING fts5(
+            description, modality,
+            content='studies', content_rowid='rowid',
+            prefix='2 3 4', tokenize='unicode61 remove_diacritics 2'
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_fts_insert AFTER INSERT ON studies BEGIN
+            INSERT INTO studies_fts (rowid, description, modality)
+            VALUES (new.rowid, new.description, new.modality);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_fts_delete AFTER DELETE ON studies BEGIN
+            INSERT INTO studies_fts (studies_fts, rowid, description, modality)
+            VALUES ('delete', old.rowid, old.description, old.modality);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_fts_update AFTER UPDATE OF description, modality ON studies BEGIN
+            INSERT INTO studies_fts (studies_fts, rowid, description, modality)
+            VALUES ('delete', old.rowid, old.description, old.modality);
+            INSERT INTO studies_fts (rowid, description, modality)
+            VALUES (new.rowid, new.description, new.modality);
+        END
+        ''',
+        # The Orthanc synchronizer of a hospital commits its feed position in
+        # the same transaction as the studies, so that state lives in the shard
+        '''
+        CREATE TABLE IF NOT EXISTS orthanc_sync_state (
+            source TEXT PRIMARY KEY,
+            last_seq INTEGER NOT NULL DEFAULT 0,
+            updated_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS orthanc_sync_pending (
+            orthanc_study_id TEXT PRIMARY KEY,
+            dicom_patient_id TEXT NOT NULL,
+            hospital_id TEXT NOT NULL,
+            study_date TIMESTAMP,
+            modality TEXT,
+            description TEXT,
+            created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_orthanc_sync_pending_patient ON orthanc_sync_pending (dicom_patient_id)',
+    ]),
+    (2, 'DICOM StudyInstanceUID on studies', [
+        'ALTER TABLE studies ADD COLUMN study_instance_uid TEXT',
+        '''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_studies_instance_uid ON studies (study_instance_uid)
+        WHERE study_instance_uid IS NOT NULL
+        ''',
+    ]),
+    (3, 'studies change counter', [
+        '''
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        ''',
+        "INSERT OR IGNORE INTO table_versions (name) VALUES ('studies')",
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_version_insert AFTER INSERT ON studies BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'studies';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_version_update AFTER UPDATE ON studies BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'studies';
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_version_delete AFTER DELETE ON studies BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'studies';
+        END
+        ''',
+    ]),
+    (4, 'studies change counter bumped once per batch', [
+        'ALTER TABLE table_versions ADD COLUMN batched INTEGER NOT NULL DEFAULT 0',
+        'DROP TRIGGER IF EXISTS studies_version_insert',
+        '''
+        CREATE TRIGGER studies_version_insert AFTER INSERT ON studies
+        WHEN (SELECT batched FROM table_versions WHERE name = 'studies') = 0 BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'studies';
+        END
+        ''',
+        'DROP TRIGGER IF EXISTS studies_version_update',
+        '''
+        CREATE TRIGGER studies_version_update AFTER UPDATE ON studies
+        WHEN (SELECT batched FROM table_versions WHERE name = 'studies') = 0 BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'studies';
+        END
+        ''',
+        'DROP TRIGGER IF EXISTS studies_version_delete',
+        '''
+        CREATE TRIGGER studies_version_delete AFTER DELETE ON studies
+        WHEN (SELECT batched FROM table_versions WHERE name = 'studies') = 0 BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'studies';
+        END
+        ''',
+    ]),
+    (5, 'per-patient change log', [
+        # Studies written here, per patient; see the main schema's version 12
+        '''
+        CREATE TABLE IF NOT EXISTS patient_changes (
+            seq INTEGER PRIMARY KEY,
+            patient_id TEXT,
+            national_id TEXT
+        )
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS patient_changes_prune AFTER INSERT ON patient_changes
+        WHEN NEW.seq % 10000 = 0 BEGIN
+            DELETE FROM patient_changes WHERE seq <= NEW.seq - 100000;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_patient_change_insert AFTER INSERT ON studies
+        WHEN NEW.patient_id IS NOT NULL BEGIN
+            INSERT INTO patient_changes (patient_id) VALUES (NEW.patient_id);
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_patient_change_update AFTER UPDATE ON studies BEGIN
+            INSERT INTO patient_changes (patient_id)
+            SELECT NEW.patient_id WHERE NEW.patient_id IS NOT NULL
+            UNION ALL SELECT OLD.patient_id WHERE OLD.patient_id IS NOT NULL AND OLD.patient_id IS NOT NEW.patient_id;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS studies_patient_change_delete AFTER DELETE ON studies
+        WHEN OLD.patient_id IS NOT NULL BEGIN
+            INSERT INTO patient_changes (patient_id) VALUES (OLD.patient_id);
+        END
+        ''',
+    ]),
+]
+
+
+def current_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn, target=None, migrations=MIGRATIONS, verbose=True):
+    """Apply pending migrations in order; returns the list of versions applied"""
+    target = migrations[-1][0] if target is None else target
+    version = current_version(conn)
+    applied = []
+
+    for step, description, statements in migrations:
+        if step <= version or step > target:
+            continue
+        try:
+            conn.execute('BEGIN')
+            for statement in statements:
+                conn.execute(statement)
+            # PRAGMA values can't be bound as parameters
+            conn.execute(f'PRAGMA user_version = {int(step)}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(step)
+        if verbose:
+            print(f"  ↳ migration {step}: {description}")
+
+    return applied
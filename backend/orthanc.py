@@ -0,0 +1,184 @@
+"""
+XRay Federation System - Orthanc REST client
+Keep-alive connection pool, timeouts, retry with backoff, and parallel
+study lookups so enrichment costs one round trip rather than one per study.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class OrthancError(Exception):
+    pass
+
+
+class OrthancNotFound(OrthancError):
+    pass
+
+
+class OrthancClient:
+    def __init__(self, base_url, timeout=5.0, connect_timeout=2.0, retries=3, backoff=0.3,
+                 max_connections=16, username=None, password=None):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, timeout)
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if username:
+            self.session.auth = (username, password or '')
+
+        self._executor = ThreadPoolExecutor(max_workers=max_connections,
+                                            thread_name_prefix='orthanc')
+
+    def get(self, path, params=None, timeout=None):
+        try:
+            response = self.session.get(self.base_url + path, params=params,
+                                        timeout=timeout or self.timeout)
+        except requests.RequestException as e:
+            raise OrthancError(f"Orthanc unreachable: {e}")
+        if response.status_code == 404:
+            raise OrthancNotFound(f"Not found in Orthanc: {path}")
+        if response.status_code >= 400:
+            raise OrthancError(f"Orthanc returned {response.status_code} for {path}")
+        try:
+            return response.json()
+        except ValueError:
+            raise OrthancError(f"Orthanc returned invalid JSON for {path}")
+
+    def get_bytes(self, path, timeout=None):
+        """Raw body of a GET, e.g. a DICOM file"""
+        try:
+            response = self.session.get(self.base_url + path, timeout=timeout or self.timeout)
+        except requests.RequestException as e:
+            raise OrthancError(f"Orthanc unreachable: {e}")
+        if response.status_code == 404:
+            raise OrthancNotFound(f"Not found in Orthanc: {path}")
+        if response.status_code >= 400:
+            raise OrthancError(f"Orthanc returned {response.status_code} for {path}")
+        return response.content
+
+    def system(self, timeout=None):
+        return self.get('/system', timeout=timeout)
+
+    def probe(self, timeout=2.0):
+        """One /system request outside the retrying session, for health checks"""
+        try:
+            response = requests.get(self.base_url + '/system', timeout=timeout,
+                                    auth=self.session.auth)
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError) as e:
+            raise OrthancError(f"Orthanc unreachable: {e}")
+
+    def study(self, orthanc_study_id):
+        return self.get(f'/studies/{orthanc_study_id}')
+
+    def study_statistics(self, orthanc_study_id):
+        return self.get(f'/studies/{orthanc_study_id}/statistics')
+
+    def study_series(self, orthanc_study_id):
+        return self.get(f'/studies/{orthanc_study_id}/series')
+
+    def study_instances(self, orthanc_study_id):
+        return self.get(f'/studies/{orthanc_study_id}/instances')
+
+    def instance_file(self, orthanc_instance_id):
+        return self.get_bytes(f'/instances/{orthanc_instance_id}/file')
+
+    def changes(self, since=0, limit=100):
+        """One page of the change feed: {"Changes": [...], "Done": bool, "Last": seq}"""
+        return self.get('/changes', params={"since": since, "limit": limit})
+
+    def map(self, fn, items):
+        """Run fn over items on the client's connection-sized thread pool"""
+        return list(self._executor.map(fn, items))
+
+    def study_summaries(self, orthanc_study_ids, deadline=None):
+        """Metadata plus series/instance counts for many studies, fetched concurrently
+
+        Returns {orthanc_study_id: summary}; a study that failed or missed
+        the deadline (seconds) maps to {"error": ...} instead.
+        """
+        ids = [i for i in dict.fromkeys(orthanc_study_ids) if i]
+        futures = {}
+        for study_id in ids:
+            futures[study_id] = (self._executor.submit(self.study, study_id),
+                                 self._executor.submit(self.study_statistics, study_id))
+
+        pending = [f for pair in futures.values() for f in pair]
+        wait(pending, timeout=deadline)
+
+        summaries = {}
+        for study_id, (study_future, stats_future) in futures.items():
+            if not (study_future.done() and stats_future.done()):
+                study_future.cancel()
+                stats_future.cancel()
+                summaries[study_id] = {"error": "Orthanc lookup timed out"}
+                continue
+            try:
+                summaries[study_id] = _summarize(study_future.result(), stats_future.result())
+            except OrthancError as e:
+                summaries[study_id] = {"error": str(e)}
+        return summaries
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+
+def _summarize(study, statistics):
+    tags = study.get('MainDicomTags', {})
+    patient_tags = study.get('PatientMainDicomTags', {})
+    return {
+        "study_instance_uid": tags.get('StudyInstanceUID'),
+        "study_date": tags.get('StudyDate'),
+        "study_time": tags.get('StudyTime'),
+        "study_description": tags.get('StudyDescription'),
+        "accession_number": tags.get('AccessionNumber'),
+        "institution_name": tags.get('InstitutionName'),
+        "dicom_patient_id": patient_tags.get('PatientID'),
+        "series_count": statistics.get('CountSeries', len(study.get('Series', []))),
+        "instance_count": statistics.get('CountInstances'),
+        "disk_size": statistics.get('DiskSize'),
+        "last_update": study.get('LastUpdate'),
+    }
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client(config):
+    """Process-wide client built from the ORTHANC_* settings"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OrthancClient(
+                config.get('ORTHANC_URL', 'http://localhost:8042'),
+                timeout=config.get('ORTHANC_TIMEOUT', 5.0),
+                retries=config.get('ORTHANC_RETRIES', 3),
+                max_connections=config.get('ORTHANC_MAX_CONNECTIONS', 16),
+                username=config.get('ORTHANC_USERNAME'),
+                password=config.get('ORTHANC_PASSWORD'),
+            )
+        return _client
+
+
+def reset_client():
+    """Forget the shared client, e.g. in a forked worker (its session and
+    thread pool belong to the parent process)"""
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
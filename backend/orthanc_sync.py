@@ -0,0 +1,258 @@
+"""
+XRay Federation System - Orthanc change-feed synchronizer
+Tails Orthanc's /changes feed and registers every StableStudy in the
+studies table. The last processed sequence number is committed in the same
+transaction as the studies it produced, so a restart resumes exactly where
+it stopped instead of rescanning the archive. With sharded storage both
+live in the hospital's shard, which keeps that a single-file transaction.
+
+Run inside the app (ORTHANC_SYNC_ENABLED=1) or standalone:
+    cd backend
+    python orthanc_sync.py
+"""
+import logging
+import threading
+
+import db
+import storage
+from ids import new_study_id, new_study_key, insert_studies, with_new_ids
+from orthanc import OrthancError, OrthancNotFound
+
+log = logging.getLogger(__name__)
+
+INSERT_STUDY = '''
+    INSERT INTO studies (id, patient_id, hospital_id, study_date, modality, description, orthanc_study_id, rowid)
+    SELECT ?, ?, ?, ?, ?, ?, ?, ?
+    WHERE NOT EXISTS (SELECT 1 FROM studies WHERE orthanc_study_id = ?)
+'''
+
+INSERT_PENDING = '''
+    INSERT OR REPLACE INTO orthanc_sync_pending
+        (orthanc_study_id, dicom_patient_id, hospital_id, study_date, modality, description)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+
+def _reissue(row):
+    # INSERT_STUDY rows end with the Orthanc ID again, after the key
+    return with_new_ids(row[:-1]) + row[-1:]
+
+
+def dicom_datetime(date, time=None):
+    """DICOM DA/TM ('20240115', '103000.123') -> '2024-01-15 10:30:00'"""
+    if not date or len(date) < 8:
+        return None
+    value = f"{date[0:4]}-{date[4:6]}-{date[6:8]}"
+    time = (time or '').split('.')[0]
+    if len(time) >= 4:
+        value += f" {time[0:2]}:{time[2:4]}:{(time[4:6] or '00')}"
+    return value
+
+
+class OrthancSynchronizer:
+    def __init__(self, client, hospital_id, source=None, batch_size=100, poll_interval=5.0,
+                 on_written=None):
+        self.client = client
+        self.on_written = on_written    # called with the patient ids that gained studies
+        self.hospital_id = hospital_id
+        self.source = source or client.base_url
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_error = None
+        self.studies_synced = 0
+
+    # -- state ---------------------------------------------------------------
+
+    def last_seq(self, conn):
+        row = conn.execute('SELECT last_seq FROM orthanc_sync_state WHERE source = ?',
+                           (self.source,)).fetchone()
+        return row[0] if row else 0
+
+    def _save_seq(self, conn, seq):
+        conn.execute('''
+            INSERT INTO orthanc_sync_state (source, last_seq, updated_date)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (source) DO UPDATE SET last_seq = excluded.last_seq,
+                                               updated_date = excluded.updated_date
+        ''', (self.source, seq))
+
+    # -- one pass ------------------------------------------------------------
+
+    def _describe(self, orthanc_study_id):
+        """Fields for one study: /studies/{id} plus its series for the modalities
+
+        None if the study was deleted from Orthanc after it became stable.
+        """
+        try:
+            study = self.client.study(orthanc_study_id)
+            series = self.client.study_series(orthanc_study_id)
+        except OrthancNotFound:
+            return None
+        tags = study.get('MainDicomTags', {})
+        modalities = sorted({s.get('MainDicomTags', {}).get('Modality') for s in series} - {None})
+        return {
+            "orthanc_study_id": orthanc_study_id,
+            "dicom_patient_id": study.get('PatientMainDicomTags', {}).get('PatientID'),
+            "study_date": dicom_datetime(tags.get('StudyDate'), tags.get('StudyTime')),
+            "modality": '/'.join(modalities) or None,
+            "description": tags.get('StudyDescription'),
+        }
+
+    def run_once(self):
+        """Process one page of the change feed; returns a small stats dict"""
+        with storage.connection(self.hospital_id) as conn:
+            since = self.last_seq(conn)
+
+        # Network first, so no pooled connection is held while waiting on Orthanc
+        page = self.client.changes(since=since, limit=self.batch_size)
+        study_ids = list(dict.fromkeys(
+            change['ID'] for change in page.get('Changes', [])
+            if change.get('ChangeType') == 'StableStudy'
+        ))
+        # Detail lookups run concurrently on the client's keep-alive pool
+        details = [d for d in self.client.map(self._describe, study_ids) if d]
+
+        with storage.connection(self.hospital_id) as conn:
+            dicom_ids = list({d['dicom_patient_id'] for d in details if d['dicom_patient_id']})
+            patients = {}
+            for start in range(0, len(dicom_ids), 500):
+                chunk = dicom_ids[start:start + 500]
+                rows = conn.execute(
+                    f"SELECT national_id, id FROM patients WHERE national_id IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                patients.update(rows)
+
+            matched, pending = [], []
+            for d in details:
+                patient_id = patients.get(d['dicom_patient_id'])
+                if patient_id:
+                    matched.append((new_study_id(), patient_id, self.hospital_id, d['study_date'],
+                                    d['modality'], d['description'], d['orthanc_study_id'],
+                                    new_study_key(), d['orthanc_study_id']))
+                elif d['dicom_patient_id']:
+                    pending.append((d['orthanc_study_id'], d['dicom_patient_id'], self.hospital_id,
+                                    d['study_date'], d['modality'], d['description']))
+
+            resolvable = self._resolvable(conn)
+            # Global patient index first, so it never misses a committed study
+            storage.record_patients(self.hospital_id,
+                                    {row[1] for row in matched} | {row[1] for row in resolvable})
+            with db.transaction(conn), db.batched_versions(conn, 'studies'):
+                insert_studies(conn, INSERT_STUDY, matched, reissue=_reissue)
+                conn.executemany(INSERT_PENDING, pending)
+                resolved = self._resolve_pending(conn, resolvable)
+                self._save_seq(conn, page.get('Last', since))
+
+        if self.on_written:
+            patient_ids = {row[1] for row in matched} | set(resolved)
+            if patient_ids:
+                self.on_written(patient_ids)
+
+        self.studies_synced += len(matched) + len(resolved)
+        return {"since": since, "last": page.get('Last', since), "done": page.get('Done', True),
+                "studies": len(matched) + len(resolved), "pending": len(pending)}
+
+    def _resolvable(self, conn):
+        """Parked studies whose patient has since been registered"""
+        return conn.execute('''
+            SELECT pe.orthanc_study_id, p.id, pe.hospital_id, pe.study_date, pe.modality, pe.description
+            FROM orthanc_sync_pending pe
+            JOIN patients p ON p.national_id = pe.dicom_patient_id
+        ''').fetchall()
+
+    def _resolve_pending(self, conn, rows):
+        """Register the _resolvable() studies
+
+        Returns the patient id of each study registered.
+        """
+        if not rows:
+            return []
+        insert_studies(conn, INSERT_STUDY, [
+            (new_study_id(), patient_id, hospital_id, study_date, modality, description, oid,
+             new_study_key(), oid)
+            for oid, patient_id, hospital_id, study_date, modality, description in rows
+        ], reissue=_reissue)
+        conn.executemany('DELETE FROM orthanc_sync_pending WHERE orthanc_study_id = ?',
+                         [(row[0],) for row in rows])
+        return [row[1] for row in rows]
+
+    # -- background loop -----------------------------------------------------
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            try:
+                stats = self.run_once()
+                self.last_error = None
+                if stats['studies'] or stats['pending']:
+                    log.info("Orthanc sync: %s", stats)
+                if not stats['done']:
+                    continue  # more changes already waiting; don't sleep
+            except OrthancError as e:
+                self.last_error = str(e)
+                log.warning("Orthanc sync failed: %s", e)
+            except Exception as e:
+                self.last_error = str(e)
+                log.exception("Orthanc sync failed")
+            self._stop.wait(self.poll_interval)
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self.run_forever, name='orthanc-sync', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def status(self):
+        with storage.connection(self.hospital_id) as conn:
+            last_seq = self.last_seq(conn)
+            pending = conn.execute('SELECT COUNT(*) FROM orthanc_sync_pending').fetchone()[0]
+        return {
+            "source": self.source,
+            "hospital_id": self.hospital_id,
+            "running": self._thread is not None and self._thread.is_alive(),
+            "last_seq": last_seq,
+            "pending_studies": pending,
+            "studies_synced": self.studies_synced,
+            "last_error": self.last_error,
+        }
+
+
+def from_config(client, config, on_written=None):
+    return OrthancSynchronizer(
+        client,
+        hospital_id=config.get('ORTHANC_SYNC_HOSPITAL_ID'),
+        batch_size=config.get('ORTHANC_SYNC_BATCH_SIZE', 100),
+        poll_interval=config.get('ORTHANC_SYNC_POLL_INTERVAL', 5.0),
+        on_written=on_written,
+    )
+
+
+if __name__ == '__main__':
+    import os
+    from config import config
+    from migrations import migrate
+    import orthanc
+
+    logging.basicConfig(level=logging.INFO)
+    config_class = config[os.environ.get('FLASK_CONFIG', 'default')]
+    settings = {k: getattr(config_class, k) for k in dir(config_class) if k.isupper()}
+    db.configure(database=settings['DATABASE_PATH'])
+    with db.connection() as conn:
+        migrate(conn)
+    storage.configure(shard_dir=settings.get('STUDY_SHARD_DIR'),
+                      pool_size=settings.get('STUDY_SHARD_POOL_SIZE'), layout=settings.get('STUDY_LAYOUT'))
+
+    if not settings.get('ORTHANC_SYNC_HOSPITAL_ID'):
+        raise SystemExit("Set ORTHANC_SYNC_HOSPITAL_ID to the hospital this Orthanc belongs to")
+    synchronizer = from_config(orthanc.get_client(settings), settings)
+    print(f"🔄 Syncing {synchronizer.source} into {settings['DATABASE_PATH']} "
+          f"as {synchronizer.hospital_id} (from seq {synchronizer.status()['last_seq']})")
+    synchronizer.run_forever()
@@ -0,0 +1,127 @@
+"""
+XRay Federation System - Keyset pagination and streaming helpers
+"""
+import base64
+import json
+from urllib.parse import urlencode
+
+from flask import Response, request
+
+from fastjson import dumps
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def encode_cursor(values):
+    """Opaque cursor for the sort key of the last row on a page"""
+    raw = json.dumps(list(values), separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    padded = token + '=' * (-len(token) % 4)
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def paged():
+    """Whether the request asks for one page (?limit= or ?after=) rather than the full listing"""
+    return 'limit' in request.args or 'after' in request.args
+
+
+def page_args():
+    """Read ?limit= and ?after= from the request
+
+    limit is None when the caller asked for no paging (the legacy full
+    listing); it is then streamed rather than built in memory.
+    """
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValueError("limit must be an integer")
+        if limit < 1:
+            raise ValueError("limit must be positive")
+        limit = min(limit, MAX_LIMIT)
+    elif after is not None:
+        limit = DEFAULT_LIMIT
+
+    return limit, decode_cursor(after) if after else None
+
+
+def wants_ndjson():
+    if request.args.get('format') == 'ndjson':
+        return True
+    best = request.accept_mimetypes.best_match([NDJSON_MIMETYPE, 'application/json'])
+    return best == NDJSON_MIMETYPE and request.accept_mimetypes[NDJSON_MIMETYPE] > 0
+
+
+def _fetch_page(rows, limit, to_dict, cursor_of):
+    """Yield dicts for up to `limit` rows, then (None, next_cursor) if more exist"""
+    last = None
+    for count, row in enumerate(rows):
+        if limit is not None and count == limit:
+            yield None, encode_cursor(cursor_of(last))
+            return
+        last = row
+        yield to_dict(row), None
+
+
+def stream_ndjson(open_rows, limit, to_dict, cursor_of):
+    """One JSON object per line; a trailing {"next_cursor": ...} line when more rows exist
+
+    open_rows is a context manager factory yielding a row iterator, so the
+    database cursor lives exactly as long as the response is streaming.
+    """
+    def generate():
+        with open_rows() as rows:
+            for item, next_cursor in _fetch_page(rows, limit, to_dict, cursor_of):
+                if item is None:
+                    yield dumps({"next_cursor": next_cursor}) + '\n'
+                else:
+                    yield dumps(item) + '\n'
+
+    return Response(generate(), mimetype=NDJSON_MIMETYPE)
+
+
+def stream_json_array(open_rows, to_dict):
+    """Unpaged listing written as a JSON array without materializing it"""
+    def generate():
+        with open_rows() as rows:
+            yield '['
+            first = True
+            for row in rows:
+                yield ('' if first else ',') + dumps(to_dict(row))
+                first = False
+            yield ']'
+
+    return Response(generate(), mimetype='application/json')
+
+
+def json_page(rows, limit, to_dict, cursor_of):
+    """A single page as a plain JSON list; the next cursor goes in headers"""
+    items = []
+    next_cursor = None
+    for item, cursor in _fetch_page(rows, limit, to_dict, cursor_of):
+        if item is None:
+            next_cursor = cursor
+        else:
+            items.append(item)
+
+    response = Response(dumps(items), mimetype='application/json')
+    if next_cursor:
+        args = request.args.to_dict()
+        args.update(limit=str(limit), after=next_cursor)
+        response.headers['X-Next-Cursor'] = next_cursor
+        response.headers['Link'] = f'<{request.path}?{urlencode(args)}>; rel="next"'
+    return response
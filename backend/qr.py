@@ -0,0 +1,123 @@
+"""
+XRay Federation System - QR code rendering with a content-addressed PNG cache
+"""
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+
+import qrcode
+
+from cache import LRUCache
+import metrics
+
+ERROR_CORRECTION = {
+    'L': qrcode.constants.ERROR_CORRECT_L,
+    'M': qrcode.constants.ERROR_CORRECT_M,
+    'Q': qrcode.constants.ERROR_CORRECT_Q,
+    'H': qrcode.constants.ERROR_CORRECT_H,
+}
+
+DEFAULT_PARAMS = {"box_size": 10, "border": 4, "error_correction": 'L'}
+
+
+def render_params(args):
+    """Validated render parameters from a query string, falling back to the defaults"""
+    params = dict(DEFAULT_PARAMS)
+    for name, low, high in (('box_size', 1, 40), ('border', 0, 10)):
+        if name in args:
+            try:
+                value = int(args[name])
+            except ValueError:
+                raise ValueError(f"{name} must be an integer")
+            if not low <= value <= high:
+                raise ValueError(f"{name} must be between {low} and {high}")
+            params[name] = value
+    if 'error_correction' in args:
+        level = args['error_correction'].upper()
+        if level not in ERROR_CORRECTION:
+            raise ValueError("error_correction must be one of L, M, Q, H")
+        params['error_correction'] = level
+    return params
+
+
+def cache_key(data, params):
+    """The PNG for (data, params) never changes, so its hash doubles as the ETag"""
+    raw = json.dumps([data, params], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def make_qr(data, params):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=ERROR_CORRECTION[params['error_correction']],
+        box_size=params['box_size'],
+        border=params['border'],
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    return qr
+
+
+def render_png(data, params):
+    img = make_qr(data, params).make_image(fill_color="black", back_color="white")
+    img_bytes = io.BytesIO()
+    img.save(img_bytes, format='PNG')
+    return img_bytes.getvalue()
+
+
+class QRRenderer:
+    """Memory LRU in front of an optional on-disk cache in front of the renderer"""
+
+    def __init__(self, max_entries=1024, cache_dir=None):
+        self.memory = LRUCache(max_entries)
+        self.cache_dir = cache_dir
+        self.renders = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.png')
+
+    def png(self, data, params, key=None):
+        key = key or cache_key(data, params)
+        png = self.memory.get(key)
+        if png is not None:
+            return png
+
+        if self.cache_dir:
+            try:
+                with open(self._disk_path(key), 'rb') as f:
+                    png = f.read()
+            except OSError:
+                png = None
+
+        if png is None:
+            start = time.perf_counter()
+            png = render_png(data, params)
+            metrics.qr_render.observe(time.perf_counter() - start, 'code')
+            self.renders += 1
+            if self.cache_dir:
+                self._write_disk(key, png)
+
+        self.memory.set(key, png)
+        return png
+
+    def _write_disk(self, key, png):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write-then-rename so concurrent readers never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(png)
+            os.replace(tmp, path)
+        except OSError:
+            pass  # the disk cache is best effort
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats.update(renders=self.renders, cache_dir=self.cache_dir)
+        return stats
@@ -0,0 +1,167 @@
+"""
+XRay Federation System - Batch QR sheets (wristband/label printing)
+Many QR codes composited onto one PNG grid or a multi-page PDF
+"""
+import io
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageDraw, ImageFont
+
+from cache import LRUCache
+import metrics
+import qr
+
+MAX_CODES = 2000
+# Below this many uncached codes the process-pool round trip costs more than it saves
+POOL_THRESHOLD = 64
+LABEL_HEIGHT = 24
+PDF_RESOLUTION = 150.0
+# Pixels per page, one byte each while drawn (Pillow keeps even 1-bit images that way): a PNG is
+# one page, so a large one is drawn with smaller modules than asked for until it fits. PDF pages
+# are written out whenever this many pixels of them are waiting
+MAX_PAGE_PIXELS = 40_000_000
+
+_matrices = LRUCache(8192)
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def matrix_pixels(data, params):
+    """QR module matrix (border included) as an 8-bit grayscale mask: (side, bytes)
+
+    Runs in worker processes, so it returns plain bytes rather than qrcode objects.
+    """
+    matrix = qr.make_qr(data, params).get_matrix()
+    return len(matrix), bytes(0 if dark else 255 for row in matrix for dark in row)
+
+
+def _matrix_params(params):
+    # box_size only affects scaling, which happens once on the composited sheet
+    return {"border": params['border'], "error_correction": params['error_correction'],
+            "box_size": 1}
+
+
+def _get_pool(workers=None):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count())
+        return _pool
+
+
+def shutdown_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+            _pool = None
+
+
+def reset_pool():
+    """Forget the parent's process pool in a forked worker without shutting it down"""
+    global _pool, _pool_lock
+    _pool = None
+    _pool_lock = threading.Lock()
+
+
+def matrices(payloads, params, workers=None):
+    """Module matrices for every payload, reusing cached ones; misses are
+    computed across a process pool when there are enough of them"""
+    mparams = _matrix_params(params)
+    keys = [qr.cache_key(data, mparams) for data in payloads]
+    result = [_matrices.get(key) for key in keys]
+    missing = [i for i, m in enumerate(result) if m is None]
+
+    if len(missing) >= POOL_THRESHOLD:
+        pool = _get_pool(workers)
+        chunksize = max(1, len(missing) // ((workers or os.cpu_count() or 1) * 4))
+        computed = pool.map(matrix_pixels, [payloads[i] for i in missing],
+                            [mparams] * len(missing), chunksize=chunksize)
+    else:
+        computed = (matrix_pixels(payloads[i], mparams) for i in missing)
+
+    for i, m in zip(missing, computed):
+        _matrices.set(keys[i], m)
+        result[i] = m
+    return result
+
+
+def fit_box_size(side, count, columns, box_size, max_pixels=MAX_PAGE_PIXELS):
+    """The largest box size up to box_size that keeps a page of count codes within max_pixels
+
+    side is the widest code's module count. ValueError if even 1 pixel per module is too many.
+    """
+    columns = max(1, min(columns, count))
+    rows = -(-count // columns)
+    for box in range(box_size, 0, -1):
+        if columns * side * box * rows * (side * box + LABEL_HEIGHT) <= max_pixels:
+            return box
+    raise ValueError(f"Sheet too large: {count} codes don't fit on one page; "
+                     "use fewer codes or format=pdf")
+
+
+def render_sheet(items, params, columns=4, fmt='png', rows_per_page=6, workers=None):
+    """items: list of (payload, label). Returns (bytes, mimetype)
+
+    ValueError when a page can't be drawn within MAX_PAGE_PIXELS.
+    """
+    start = time.perf_counter()
+    try:
+        return _render_sheet(items, params, columns, fmt, rows_per_page, workers)
+    finally:
+        metrics.qr_render.observe(time.perf_counter() - start, 'sheet')
+
+
+def _render_sheet(items, params, columns, fmt, rows_per_page, workers):
+    mats = matrices([payload for payload, _ in items], params, workers=workers)
+    columns = max(1, min(columns, len(items)))
+    per_page = columns * rows_per_page if fmt == 'pdf' else len(items)
+
+    modules = max(n for n, _ in mats)
+    box = fit_box_size(modules, min(per_page, len(items)), columns, params['box_size'])
+    side = modules * box
+    cell_w, cell_h = side, side + LABEL_HEIGHT
+    font = ImageFont.load_default()
+
+    def new_page(count):
+        rows = -(-count // columns)
+        return Image.new('L', (columns * cell_w, rows * cell_h), 255)
+
+    out = io.BytesIO()
+    pages, waiting, written = [], 0, False
+    for start in range(0, len(items), per_page):
+        batch = list(zip(items[start:start + per_page], mats[start:start + per_page]))
+        page = new_page(len(batch))
+        draw = ImageDraw.Draw(page)
+        for i, ((_, label), (n, pixels)) in enumerate(batch):
+            x, y = (i % columns) * cell_w, (i // columns) * cell_h
+            code = Image.frombytes('L', (n, n), pixels).resize((n * box, n * box), Image.NEAREST)
+            page.paste(code, (x + (side - n * box) // 2, y))
+            if label:
+                width = draw.textlength(label, font=font)
+                draw.text((x + (cell_w - width) / 2, y + side + 4), label, fill=0, font=font)
+        pages.append(page.convert('1'))
+        waiting += page.width * page.height
+        if fmt == 'pdf' and waiting >= MAX_PAGE_PIXELS:
+            _save_pdf(out, pages, append=written)
+            pages, waiting, written = [], 0, True
+
+    if fmt == 'pdf':
+        if pages:
+            _save_pdf(out, pages, append=written)
+        return out.getvalue(), 'application/pdf'
+    pages[0].save(out, format='PNG', optimize=True)
+    return out.getvalue(), 'image/png'
+
+
+def _save_pdf(out, pages, append):
+    """Write pages to the PDF in out, appending them to the ones already there if append"""
+    rest = pages[1:]
+    pages[0].save(out, format='PDF', save_all=True, append_images=rest, append=append,
+                  resolution=PDF_RESOLUTION)
+    # Pillow leaves this list in every page's encoderinfo, a cycle that would keep the
+    # pages alive until the next garbage collection
+    rest.clear()
@@ -0,0 +1,240 @@
+"""
+XRay Federation System - Full-text search over patients and studies
+Backed by the FTS5 indexes from migration 6 (patients_fts, studies_fts),
+which triggers keep in step with the base tables.
+
+A query is free text such as "maria 1990", "chest x-ray last month" or
+"CT yesterday": relative-date phrases become a study_date range, the
+remaining words become prefix terms, and an all-digit term also matches
+national_id prefixes through the unique index.
+"""
+import re
+from datetime import datetime, timedelta
+
+from storage import STUDY_COLUMNS
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+MAX_TERMS = 8
+# bm25 needs per-term document counts, i.e. a walk of every match, so it
+# only ranks queries with at most this many hits. Commoner queries ("chest",
+# "smith") are listed newest first instead, which FTS5 streams in rowid
+# order and stops after one page.
+RANK_WINDOW = 1000
+# Prefix lengths FTS5 keeps precomputed doclists for (the prefix= option in
+# migration 6); these stream, longer prefixes are merged in memory first
+INDEXED_PREFIX = 4
+# Shorter digit runs would match a large slice of the national_id index
+MIN_NATIONAL_ID_PREFIX = 3
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+_UNITS = {'day': 1, 'week': 7, 'month': 30, 'year': 365}
+_RELATIVE = re.compile(
+    r'\b(?:(today)|(yesterday)|(?:last|past)\s+(?:(\d+)\s+)?(day|week|month|year)s?|this\s+(week|month|year))\b',
+    re.IGNORECASE,
+)
+
+
+def parse_query(text, now=None):
+    """Split free text into (terms, date_range)
+
+    date_range is (start, end) as 'YYYY-MM-DD HH:MM:SS' strings (end
+    exclusive, either may be None) or None when no date phrase was found.
+    """
+    now = now or datetime.now()
+    today = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    date_range = None
+
+    match = _RELATIVE.search(text)
+    if match:
+        today_word, yesterday_word, count, unit, this_unit = match.groups()
+        if today_word:
+            start, end = today, None
+        elif yesterday_word:
+            start, end = today - timedelta(days=1), today
+        elif unit:
+            start, end = today - timedelta(days=int(count or 1) * _UNITS[unit.lower()]), None
+        elif this_unit.lower() == 'week':
+            start, end = today - timedelta(days=today.weekday()), None
+        elif this_unit.lower() == 'month':
+            start, end = today.replace(day=1), None
+        else:
+            start, end = today.replace(month=1, day=1), None
+        date_range = (_sql_datetime(start), _sql_datetime(end))
+        text = text[:match.start()] + ' ' + text[match.end():]
+
+    terms = [t.lower() for t in _TOKEN.findall(text)][:MAX_TERMS]
+    return terms, date_range
+
+
+def _sql_datetime(value):
+    return value.strftime('%Y-%m-%d %H:%M:%S') if value else None
+
+
+def match_expression(conn, table, terms):
+    """FTS5 MATCH string: every term must match a word in some indexed column
+
+    The last term is the one still being typed, so it matches as a prefix
+    when that prefix is indexed (2-4 characters, which FTS5 streams). A
+    longer one that is already a complete word matches only that word;
+    expanding it would merge every longer word's doclist in memory. Terms
+    come from \\w+ and are quoted, so user input can never reach the FTS5
+    query syntax (AND/OR/NEAR/column filters).
+    """
+    quoted = [f'"{term}"' for term in terms]
+    last = terms[-1]
+    if 1 < len(last) <= INDEXED_PREFIX or (len(last) > INDEXED_PREFIX and not _is_word(conn, table, last)):
+        quoted[-1] += '*'
+    return ' AND '.join(quoted)
+
+
+def _is_word(conn, table, term):
+    return conn.execute(f'SELECT 1 FROM {table} WHERE {table} MATCH ? LIMIT 1',
+                        (f'"{term}"',)).fetchone() is not None
+
+
+def _matches(conn, table, expression):
+    """Number of matches, counted up to RANK_WINDOW + 1"""
+    return conn.execute(
+        f'SELECT COUNT(*) FROM (SELECT rowid FROM {table} WHERE {table} MATCH ? LIMIT ?)',
+        (expression, RANK_WINDOW + 1)
+    ).fetchone()[0]
+
+
+def _ranked(conn, table, expression):
+    """Whether the query is rare enough to rank every match with bm25"""
+    return _matches(conn, table, expression) <= RANK_WINDOW
+
+
+def study_matches(conn, terms):
+    """This database's share of the matches for the terms, counted up to RANK_WINDOW + 1
+
+    When sharded, the shards' counts added up decide whether every shard
+    ranks (see search_studies), so they all order their rows the same way.
+    """
+    return _matches(conn, 'studies_fts', match_expression(conn, 'studies_fts', terms)) if terms else 0
+
+
+def national_id_prefix(terms):
+    """The digit run to prefix-match against national_id, if the query is one"""
+    if len(terms) == 1 and terms[0].isdigit() and len(terms[0]) >= MIN_NATIONAL_ID_PREFIX:
+        return terms[0]
+    return None
+
+
+def search_patients(conn, terms, limit, offset):
+    """Patients matching every term, best first
+
+    Ranked by bm25 (last name weighted above first name) when the query
+    is specific enough, otherwise newest registration first. An all-digit
+    query is a national_id prefix lookup: a range scan of the unique
+    index, ordered by national_id.
+    """
+    prefix = national_id_prefix(terms)
+    if prefix:
+        # [prefix, prefix + 1) on the text index; ':' sorts right after '9'
+        return conn.execute('''
+            SELECT p.*, NULL AS score
+            FROM patients p
+            WHERE p.national_id >= ? AND p.national_id < ?
+            ORDER BY p.national_id
+            LIMIT ? OFFSET ?
+        ''', (prefix, prefix + ':', limit, offset)).fetchall()
+
+    if not terms:
+        return []
+    expression = match_expression(conn, 'patients_fts', terms)
+    if _ranked(conn, 'patients_fts', expression):
+        return conn.execute('''
+            SELECT p.*, bm25(patients_fts, 1.0, 2.0, 1.0) AS score
+            FROM patients_fts
+            JOIN patients p ON p.rowid = patients_fts.rowid
+            WHERE patients_fts MATCH ?
+            ORDER BY score, p.rowid DESC
+            LIMIT ? OFFSET ?
+        ''', (expression, limit, offset)).fetchall()
+    return conn.execute('''
+        SELECT p.*, NULL AS score
+        FROM patients_fts
+        JOIN patients p ON p.rowid = patients_fts.rowid
+        WHERE patients_fts MATCH ?
+        ORDER BY patients_fts.rowid DESC
+        LIMIT ? OFFSET ?
+    ''', (expression, limit, offset)).fetchall()
+
+
+def search_studies(conn, terms, date_range, limit, offset, ranked=None):
+    """Studies matching every term within the date range, best first
+
+    Ranked by bm25 on description/modality (modality weighted higher) when
+    the query is specific enough, otherwise newest registration first (by
+    key). ranked, when given, makes that choice instead (for all shards at
+    once). Rows end with the study's key and its score (None if unranked).
+
+    With no terms but a date phrase ("last week") this lists that window
+    newest first, straight off the study_date index.
+
+    Ties are broken by study_date, newest first, then study ID, the same
+    keys merge_studies() orders rows from several shards by.
+    """
+    where, params = [], []
+    if date_range:
+        start, end = date_range
+        if start:
+            where.append('s.study_date >= ?')
+            params.append(start)
+        if end:
+            where.append('s.study_date < ?')
+            params.append(end)
+    filters = ''.join(f' AND {clause}' for clause in where)
+
+    if terms:
+        expression = match_expression(conn, 'studies_fts', terms)
+        if ranked is None:
+            ranked = _ranked(conn, 'studies_fts', expression)
+        if ranked:
+            score, order = 'bm25(studies_fts, 1.0, 2.0)', 'score, s.study_date DESC, s.id'
+        else:
+            score, order = 'NULL', 'studies_fts.rowid DESC'   # keys are unique: no tie to break
+        return conn.execute(f'''
+            SELECT {STUDY_COLUMNS}, p.first_name, p.last_name, p.national_id, s.rowid, {score} AS score
+            FROM studies_fts
+            JOIN studies s ON s.rowid = studies_fts.rowid
+            JOIN patients p ON p.id = s.patient_id
+            WHERE studies_fts MATCH ?{filters}
+            ORDER BY {order}
+            LIMIT ? OFFSET ?
+        ''', [expression] + params + [limit, offset]).fetchall()
+
+    if not where:
+        return []
+    return conn.execute(f'''
+        SELECT {STUDY_COLUMNS}, p.first_name, p.last_name, p.national_id, s.rowid, NULL AS score
+        FROM studies s
+        JOIN patients p ON p.id = s.patient_id
+        WHERE 1=1{filters}
+        ORDER BY s.study_date DESC, s.id
+        LIMIT ? OFFSET ?
+    ''', params + [limit, offset]).fetchall()
+
+
+def merge_studies(results, limit, offset, by_key=False):
+    """One page out of per-shard search_studies() results (each fetched from offset 0)
+
+    Rows are merged in the order every shard returned them in: ranked rows
+    by score, then study_date newest first, then study ID; unranked ones
+    newest key first when by_key (a term query), otherwise by study_date
+    and study ID. bm25 weighs terms by each shard's own statistics, so
+    scores from different shards are close to but not exactly comparable.
+    """
+    rows = [row for shard_rows in results for row in shard_rows]
+    ranked = [row for row in rows if row[-1] is not None]
+    unranked = [row for row in rows if row[-1] is None]
+    # Stable sorts, least significant key first
+    for group in (ranked, unranked):
+        group.sort(key=lambda row: row[0])
+        group.sort(key=lambda row: (row[3] is not None, row[3] or ''), reverse=True)
+    ranked.sort(key=lambda row: row[-1])
+    if by_key:
+        unranked.sort(key=lambda row: row[-2], reverse=True)
+    return (ranked + unranked)[offset:offset + limit]
@@ -0,0 +1,159 @@
+"""
+XRay Federation System - Frontend assets served from memory
+Every file under the frontend directory is read once at startup, hashed,
+and compressed ahead of time (gzip, plus brotli when installed), so pages
+such as the patient access page opened by each QR scan never touch the
+filesystem. Responses carry the content hash as ETag.
+
+Assets can also be requested by a fingerprinted name with the hash in it
+(federation-access.3f2a9c1b0d.js), which is cached as immutable for a
+year; HTML pages have their /frontend/ references rewritten to those
+names, so a changed script gets a new URL instead of a stale cache hit.
+With reload on (development), the directory is re-read whenever a file's
+mtime changes.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from flask import Response, request
+
+import http_cache
+
+URL_PREFIX = '/frontend/'
+HASH_LENGTH = 10
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# Pages (and assets asked for by their plain name) are revalidated with their ETag
+REVALIDATE = 'no-cache'
+
+_FINGERPRINTED = re.compile(r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{%d})(?P<ext>\.[^./]+)$' % HASH_LENGTH)
+_REFERENCE = re.compile(r'''(["'])%s([^"'?#]+)\1''' % re.escape(URL_PREFIX))
+
+
+class Asset:
+    """One file: its bytes in each encoding, the hash of the original"""
+
+    def __init__(self, path, data, mimetype, mtime, min_size):
+        self.path = path
+        self.mimetype = mimetype
+        self.mtime = mtime
+        self.hash = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+        self.bodies = {None: data}
+        if mimetype in http_cache.COMPRESSIBLE and len(data) >= min_size:
+            encoded = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+            if http_cache.brotli is not None:
+                encoded['br'] = http_cache.brotli.compress(data, quality=11)
+            # Maximum effort is affordable: it is spent once per file, not per request
+            self.bodies.update((enc, body) for enc, body in encoded.items() if len(body) < len(data))
+
+    @property
+    def fingerprinted(self):
+        stem, ext = os.path.splitext(self.path)
+        return f"{stem}.{self.hash}{ext}"
+
+    def etag(self, encoding):
+        return self.hash if encoding is None else f"{self.hash}-{encoding}"
+
+
+class AssetStore:
+    def __init__(self, root, reload=False, min_size=http_cache.DEFAULT_MIN_SIZE):
+        self.root = os.path.abspath(root)
+        self.reload = reload
+        self.min_size = min_size
+        self._assets = {}
+        self._mtimes = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def _scan(self):
+        """{relative path: mtime} of every file under root"""
+        mtimes = {}
+        for directory, dirs, files in os.walk(self.root):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    mtimes[os.path.relpath(path, self.root).replace(os.sep, '/')] = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+        return mtimes
+
+    def load(self):
+        """Read, fingerprint and compress every file; pages last, once the URLs they use are known"""
+        mtimes = self._scan()
+        raw = {}
+        for path in mtimes:
+            try:
+                with open(os.path.join(self.root, *path.split('/')), 'rb') as f:
+                    raw[path] = f.read()
+            except OSError:
+                continue
+        types = {path: mimetypes.guess_type(path)[0] or 'application/octet-stream' for path in raw}
+        assets = {path: Asset(path, data, types[path], mtimes[path], self.min_size)
+                  for path, data in raw.items() if types[path] != 'text/html'}
+        for path, data in raw.items():
+            if types[path] == 'text/html':
+                data = self._rewrite(data, assets)
+                assets[path] = Asset(path, data, 'text/html', mtimes[path], self.min_size)
+        with self._lock:
+            self._assets = assets
+            self._mtimes = mtimes
+
+    @staticmethod
+    def _rewrite(html, assets):
+        def fingerprint(match):
+            asset = assets.get(match.group(2))
+            if asset is None:
+                return match.group(0)
+            return f"{match.group(1)}{URL_PREFIX}{asset.fingerprinted}{match.group(1)}"
+        return _REFERENCE.sub(fingerprint, html.decode('utf-8')).encode('utf-8')
+
+    def get(self, path):
+        """(asset, requested by its current fingerprint) for a path, or (None, False)"""
+        if self.reload and self._scan() != self._mtimes:
+            self.load()
+        asset = self._assets.get(path)
+        if asset is not None:
+            return asset, False
+        match = _FINGERPRINTED.match(path)
+        if match:
+            asset = self._assets.get(match.group('stem') + match.group('ext'))
+            if asset is not None:
+                # An outdated fingerprint still gets the current file, just not cached for long
+                return asset, asset.hash == match.group('hash')
+        return None, False
+
+    def url(self, path):
+        """Fingerprinted URL of an asset (its plain URL if there is no such file)"""
+        asset, _ = self.get(path)
+        return URL_PREFIX + (asset.fingerprinted if asset else path)
+
+    def response(self, path):
+        """The asset as a response for the current request; None if there is no such file"""
+        asset, immutable = self.get(path)
+        if asset is None:
+            return None
+        encoding = http_cache.negotiate()
+        if encoding not in asset.bodies:
+            encoding = 'gzip' if 'gzip' in asset.bodies and request.accept_encodings['gzip'] else None
+        tag = asset.etag(encoding)
+        if request.if_none_match.contains_weak(tag):
+            response = Response(status=304)
+        else:
+            response = Response(asset.bodies[encoding], mimetype=asset.mimetype)
+            if encoding:
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(tag)
+        response.headers['Cache-Control'] = IMMUTABLE if immutable else REVALIDATE
+        if len(asset.bodies) > 1:
+            response.vary.add('Accept-Encoding')
+        return response
+
+    def stats(self):
+        return {"root": self.root, "reload": self.reload, "files": len(self._assets),
+                "bytes": sum(len(a.bodies[None]) for a in self._assets.values())}
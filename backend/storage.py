@@ -0,0 +1,275 @@
+"""
+XRay Federation System - Where studies are stored
+Either in the main database with everything else (the default), or
+partitioned by hospital_id into one SQLite file per hospital
+(STUDY_SHARD_DIR), so each hospital's writes take only its own writer lock.
+
+Routes go through the module-level functions (get_db, connection, pools,
+fan_out), which behave the same for both stores.
+"""
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import g, has_app_context
+
+from cache import LRUCache
+import db
+import study_layout
+from migrations import migrate, SHARD_MIGRATIONS
+
+DEFAULT_SHARD_POOL_SIZE = 4
+DEFAULT_FANOUT_WORKERS = 8
+SHARD_SUFFIX = '.db'
+# Schema name the main database is attached under on shard connections
+MAIN_SCHEMA = 'federation'
+
+_SAFE_NAME = re.compile(r'^[A-Za-z0-9_-]+$')
+
+# Study columns in the order the routes index rows by (s.* would shift with new columns)
+STUDY_COLUMNS = ('s.id, s.patient_id, s.hospital_id, s.study_date, s.modality, s.description, '
+                 's.orthanc_study_id, s.created_date')
+
+
+class SingleStore:
+    """Studies live in the main database; every call resolves to its pool"""
+
+    sharded = False
+
+    def pool_for(self, hospital_id, create=True):
+        return db.get_pool()
+
+    def pools(self, hospital_ids=None):
+        return [db.get_pool()]
+
+    def pools_for_patient(self, patient_id):
+        return [db.get_pool()]
+
+    def record_patients(self, hospital_id, patient_ids):
+        pass
+
+
+class ShardedStore:
+    """One studies database per hospital under shard_dir
+
+    Shard connections attach the main database read-only as 'federation',
+    so queries joining patients and hospitals run unchanged: a shard has
+    no such tables and unqualified names fall through to the attached
+    schema. The global patient index (patient_shards, in the main
+    database) lists the shards holding each patient's studies; it is
+    written before the studies themselves, so it can only over-report.
+    """
+
+    sharded = True
+
+    def __init__(self, shard_dir, pool_size=DEFAULT_SHARD_POOL_SIZE, mmap_size=None, cache_size=None,
+                 layout=study_layout.ROWID):
+        self.shard_dir = shard_dir
+        self.pool_size = pool_size
+        self.layout = layout
+        self.mmap_size = mmap_size
+        self.cache_size = cache_size
+        self._pools = {}
+        self._lock = threading.Lock()
+        # (shard, patient_id) pairs known to be in patient_shards
+        self._indexed = LRUCache(100000)
+        os.makedirs(shard_dir, exist_ok=True)
+
+    @staticmethod
+    def shard_name(hospital_id):
+        """File stem for a hospital's shard: the ID itself when filename safe, else a hash"""
+        if _SAFE_NAME.match(hospital_id):
+            return hospital_id
+        return '_' + hashlib.sha1(hospital_id.encode('utf-8')).hexdigest()[:20]
+
+    def _pool(self, name):
+        with self._lock:
+            pool = self._pools.get(name)
+            if pool is None:
+                main = db.get_pool()
+                pool = db.ConnectionPool(
+                    database=os.path.join(self.shard_dir, name + SHARD_SUFFIX),
+                    size=self.pool_size,
+                    mmap_size=main.mmap_size if self.mmap_size is None else self.mmap_size,
+                    cache_size=main.cache_size if self.cache_size is None else self.cache_size,
+                    attach={MAIN_SCHEMA: main.database},
+                )
+                with pool.connection() as conn:
+                    migrate(conn, migrations=SHARD_MIGRATIONS, verbose=False)
+                    study_layout.apply(conn, self.layout)
+                self._pools[name] = pool
+            return pool
+
+    def pool_for(self, hospital_id, create=True):
+        """The hospital's shard; with create=False, None if it has no studies yet"""
+        name = self.shard_name(hospital_id)
+        if not create and name not in self._pools and not os.path.exists(
+                os.path.join(self.shard_dir, name + SHARD_SUFFIX)):
+            return None
+        return self._pool(name)
+
+    def pools(self, hospital_ids=None):
+        """Every existing shard, or those of the given hospitals"""
+        if hospital_ids is not None:
+            return [pool for pool in (self.pool_for(h, create=False) for h in hospital_ids) if pool]
+        names = sorted(entry.name[:-len(SHARD_SUFFIX)] for entry in os.scandir(self.shard_dir)
+                       if entry.name.endswith(SHARD_SUFFIX))
+        return [self._pool(name) for name in names]
+
+    def pools_for_patient(self, patient_id):
+        with db.connection() as conn:
+            names = [row[0] for row in conn.execute(
+                'SELECT shard FROM patient_shards WHERE patient_id = ?', (patient_id,))]
+        return [self._pool(name) for name in names]
+
+    def record_patients(self, hospital_id, patient_ids):
+        """Add (patient, shard) pairs to the global index before their studies are written"""
+        name = self.shard_name(hospital_id)
+        missing = [p for p in set(patient_ids) if self._indexed.get((name, p)) is None]
+        if not missing:
+            return
+        with db.connection() as conn, db.transaction(conn):
+            conn.executemany('INSERT OR IGNORE INTO patient_shards (patient_id, shard) VALUES (?, ?)',
+                             [(p, name) for p in missing])
+        for p in missing:
+            self._indexed.set((name, p), True)
+
+    def close_all(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close_all()
+            self._pools.clear()
+
+
+_store = SingleStore()
+_executor = None
+_executor_lock = threading.Lock()
+_fanout_workers = DEFAULT_FANOUT_WORKERS
+
+
+def configure(shard_dir=None, pool_size=None, fanout_workers=None, mmap_size=None, cache_size=None,
+              layout=None):
+    """Pick the store: sharded under shard_dir, or the main database when None
+
+    layout is the study_layout new shards are created with.
+    """
+    global _store, _fanout_workers
+    if isinstance(_store, ShardedStore):
+        _store.close_all()
+    if shard_dir:
+        _store = ShardedStore(shard_dir, pool_size=pool_size or DEFAULT_SHARD_POOL_SIZE,
+                              mmap_size=mmap_size, cache_size=cache_size,
+                              layout=layout or study_layout.ROWID)
+    else:
+        _store = SingleStore()
+    _fanout_workers = fanout_workers or DEFAULT_FANOUT_WORKERS
+    return _store
+
+
+def get_store():
+    return _store
+
+
+def sharded():
+    return _store.sharded
+
+
+def pools(hospital_ids=None):
+    return _store.pools(hospital_ids)
+
+
+def pools_for_patient(patient_id):
+    return _store.pools_for_patient(patient_id)
+
+
+def record_patients(hospital_id, patient_ids):
+    _store.record_patients(hospital_id, patient_ids)
+
+
+def pool_for(hospital_id, create=True):
+    return _store.pool_for(hospital_id, create)
+
+
+def connection(hospital_id):
+    """Context manager for a connection to the hospital's studies outside a request"""
+    return _store.pool_for(hospital_id).connection()
+
+
+def reader_pool(hospital_id):
+    """Pool to read a hospital's studies from, without creating a shard for it
+
+    A hospital with no shard yet reads from the main database, whose
+    studies table is empty when sharded: the same empty answer.
+    """
+    return _store.pool_for(hospital_id, create=False) or db.get_pool()
+
+
+def get_db(hospital_id, create=True):
+    """Request-bound connection holding the hospital's studies
+
+    The main connection (db.get_db) unless sharded; shard connections are
+    returned to their pools on teardown like it. create=False is for
+    readers, see reader_pool().
+    """
+    pool = _store.pool_for(hospital_id) if create else reader_pool(hospital_id)
+    if pool is db.get_pool():
+        return db.get_db()
+    if 'shard_dbs' not in g:
+        g.shard_dbs = {}
+    if pool.database not in g.shard_dbs:
+        g.shard_dbs[pool.database] = (pool, pool.acquire())
+    return g.shard_dbs[pool.database][1]
+
+
+def close_dbs(exc=None):
+    for pool, conn in g.pop('shard_dbs', {}).values():
+        pool.release(conn)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_fanout_workers, thread_name_prefix='shard-fanout')
+        return _executor
+
+
+def fan_out(pools, fn):
+    """fn(conn) on a connection from each pool, concurrently; results in pool order
+
+    A single pool (always the case unsharded) runs inline on this thread,
+    on the request's own connection when that is the main database.
+    """
+    def run(pool):
+        with pool.connection() as conn:
+            return fn(conn)
+
+    if len(pools) == 1 and pools[0] is db.get_pool() and has_app_context():
+        return [fn(db.get_db())]
+    if len(pools) <= 1:
+        return [run(pool) for pool in pools]
+    return list(_get_executor().map(run, pools))
+
+
+def reset_after_fork():
+    """Forget the parent's fan-out threads (shard pools reset themselves on first use)"""
+    global _executor, _executor_lock
+    _executor = None
+    _executor_lock = threading.Lock()
+    if isinstance(_store, ShardedStore):
+        _store._lock = threading.Lock()
+
+
+def init_app(app):
+    configure(
+        shard_dir=app.config.get('STUDY_SHARD_DIR'),
+        pool_size=app.config.get('STUDY_SHARD_POOL_SIZE'),
+        fanout_workers=app.config.get('FEDERATION_FANOUT_WORKERS'),
+        mmap_size=app.config.get('DATABASE_MMAP_SIZE'),
+        cache_size=app.config.get('DATABASE_CACHE_SIZE'),
+        layout=app.config.get('STUDY_LAYOUT'),
+    )
+    if close_dbs not in app.teardown_appcontext_funcs:
+        app.teardown_appcontext(close_dbs)
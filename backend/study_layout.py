@@ -0,0 +1,142 @@
+"""
+XRay Federation System - Physical layout of the studies table
+'rowid' (the default) is the table the migrations create: rows stored in
+key order, the public study ID as its TEXT primary key, every other
+access path a secondary index. 'clustered' rebuilds it WITHOUT ROWID
+with the primary key (patient_id, rowid), so a patient's studies sit
+next to each other in the table itself and federation_query reads them
+with one range scan instead of an index probe per study; the public
+study ID becomes a unique secondary index.
+
+Both layouts keep an integer `rowid` per study (a real column when
+clustered, the rowid itself otherwise) holding the time-ordered key from
+ids.new_study_key(), so the search index and the routes address rows the
+same way whichever layout a database has. New keys only grow, which in
+the clustered layout puts each patient's studies in the order they were
+registered, normally also that of their study_date. study_date itself
+can't be part of the key: it may be NULL, and WITHOUT ROWID key columns
+can't.
+
+convert() switches a database between the layouts in one transaction,
+keeping every rowid, indexes and triggers; scripts/cluster_studies.py
+runs it over the main database and the shards.
+"""
+ROWID = 'rowid'
+CLUSTERED = 'clustered'
+LAYOUTS = (ROWID, CLUSTERED)
+
+# Every column of studies, in table order, with its definition for each layout
+COLUMNS = [
+    ('id', 'TEXT PRIMARY KEY', 'TEXT NOT NULL'),
+    ('patient_id', 'TEXT', 'TEXT NOT NULL'),
+    ('hospital_id', 'TEXT', 'TEXT'),
+    ('study_date', 'TIMESTAMP', 'TIMESTAMP'),
+    ('modality', 'TEXT', 'TEXT'),
+    ('description', 'TEXT', 'TEXT'),
+    ('orthanc_study_id', 'TEXT', 'TEXT'),
+    ('created_date', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
+    ('study_instance_uid', 'TEXT', 'TEXT'),
+]
+
+# Indexes only one layout needs; the rest (migrations.py) are kept as they are
+LAYOUT_INDEXES = {
+    ROWID: {
+        # federation_query's access path; the clustered primary key is that already
+        'idx_studies_patient_date': 'CREATE INDEX idx_studies_patient_date ON studies (patient_id, study_date)',
+    },
+    CLUSTERED: {
+        'idx_studies_id': 'CREATE UNIQUE INDEX idx_studies_id ON studies (id)',
+        # The search index joins on rowid, and keys must stay unique
+        'idx_studies_rowid': 'CREATE UNIQUE INDEX idx_studies_rowid ON studies (rowid)',
+    },
+}
+
+
+def layout(conn):
+    """The layout of the connection's studies table"""
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'studies'").fetchone()
+    if row is None:
+        raise ValueError("no studies table; run the migrations first")
+    return CLUSTERED if 'WITHOUT ROWID' in row[0].upper() else ROWID
+
+
+def _create_table(target, foreign_keys):
+    columns = [f"{name} {rowid if target == ROWID else clustered}" for name, rowid, clustered in COLUMNS]
+    if target == CLUSTERED:
+        # First: with the key column last, SQLite 3.40's integrity_check misreads the NOT NULL ones
+        columns = ['rowid INTEGER NOT NULL'] + columns + ['PRIMARY KEY (patient_id, rowid)']
+    if foreign_keys:
+        columns += ['FOREIGN KEY (patient_id) REFERENCES patients (id)',
+                    'FOREIGN KEY (hospital_id) REFERENCES hospitals (id)']
+    suffix = ' WITHOUT ROWID' if target == CLUSTERED else ''
+    return 'CREATE TABLE studies_new (\n    ' + ',\n    '.join(columns) + f'\n){suffix}'
+
+
+def convert(conn, target):
+    """Rebuild studies in the target layout; returns False if it already has it
+
+    Rows keep their rowid, so the external-content search index stays
+    valid without a rebuild. Runs under a write lock for the whole copy.
+    """
+    if target not in LAYOUTS:
+        raise ValueError(f"unknown study layout {target!r}; expected one of {', '.join(LAYOUTS)}")
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        current = layout(conn)
+        if current == target:
+            conn.rollback()
+            return False
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(studies)')]
+        expected = (['rowid'] if current == CLUSTERED else []) + [name for name, _, _ in COLUMNS]
+        if columns != expected:
+            raise ValueError(f"studies has columns {columns}, expected {expected}; "
+                             "apply the pending migrations first")
+        if target == CLUSTERED:
+            missing = conn.execute(
+                'SELECT COUNT(*) FROM studies WHERE patient_id IS NULL OR id IS NULL').fetchone()[0]
+            if missing:
+                raise ValueError(f"{missing} studies have no patient_id or id; "
+                                 "the clustered layout requires both")
+
+        # Indexes and triggers as they are now; dropping the table drops them
+        schema = conn.execute(
+            "SELECT type, name, sql FROM sqlite_master "
+            "WHERE tbl_name = 'studies' AND type IN ('index', 'trigger') AND sql IS NOT NULL").fetchall()
+        foreign_keys = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'patients'"
+                                    ).fetchone() is not None
+
+        conn.execute(_create_table(target, foreign_keys))
+        names = ', '.join(name for name, _, _ in COLUMNS)
+        # Clustered: in primary-key order, so the new table's pages are filled front to back
+        order = 'patient_id, rowid' if target == CLUSTERED else 'rowid'
+        conn.execute(f'INSERT INTO studies_new ({names}, rowid) '
+                     f'SELECT {names}, rowid FROM studies ORDER BY {order}')
+        conn.execute('DROP TABLE studies')
+        conn.execute('ALTER TABLE studies_new RENAME TO studies')
+
+        for kind, name, sql in schema:
+            if kind == 'index' and name in LAYOUT_INDEXES[current]:
+                continue
+            conn.execute(sql)
+        for sql in LAYOUT_INDEXES[target].values():
+            conn.execute(sql)
+        conn.execute("UPDATE table_versions SET version = version + 1 WHERE name = 'studies'")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return True
+
+
+def apply(conn, target):
+    """Give an empty studies table the target layout (new databases and shards)
+
+    Returns the layout the table has afterwards; a table that already
+    holds studies is left alone, converting it is scripts/cluster_studies.py's job.
+    """
+    current = layout(conn)
+    if current != target and conn.execute('SELECT 1 FROM studies LIMIT 1').fetchone() is None:
+        convert(conn, target)
+        return target
+    return current
+
@@ -0,0 +1,26 @@
+"""
+XRay Federation System - Production entry point
+
+Linux/macOS (multi-process, see gunicorn.conf.py):
+    cd backend
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Windows (gunicorn needs fork(); waitress serves with a thread pool instead):
+    cd backend
+    python wsgi.py
+"""
+import os
+
+from app import create_app
+
+app = create_app(os.environ.get('FLASK_CONFIG', 'production'))
+
+
+if __name__ == '__main__':
+    from waitress import serve
+
+    host = os.environ.get('HOST', '0.0.0.0')
+    port = int(os.environ.get('PORT') or 5000)
+    threads = int(os.environ.get('WAITRESS_THREADS') or 2 * (os.cpu_count() or 4))
+    print(f"🚀 Serving XRay Federation System on http://{host}:{port} ({threads} threads)")
+    serve(app, host=host, port=port, threads=threads)
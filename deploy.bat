@@ -31,7 +31,8 @@ echo ✅ Deployment completed successfully!
 echo.
 echo To start the system:
 echo   cd backend
-echo   python app.py
+echo   python wsgi.py          (production, multi-threaded)
+echo   python app.py           (development server)
 echo.
 echo Access points:
 echo   - Web Dashboard: http://localhost:5000/dashboard
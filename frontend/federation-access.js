@@ -0,0 +1,49 @@
+// Cross-hospital lookup of /federation-access?national_id=...
+// Everything from the URL or the API is inserted as text, never as HTML.
+(function () {
+    const nationalId = new URLSearchParams(window.location.search).get('national_id');
+    document.getElementById('national_id').value = nationalId || '';
+    if (!nationalId) {
+        return;
+    }
+    document.getElementById('results').hidden = false;
+    document.getElementById('searching-for').textContent = nationalId;
+
+    function element(tag, text) {
+        const node = document.createElement(tag);
+        if (text !== undefined) {
+            node.textContent = text;
+        }
+        return node;
+    }
+
+    const content = document.getElementById('results-content');
+    fetch('/api/federation/query?national_id=' + encodeURIComponent(nationalId))
+        .then(r => r.json())
+        .then(data => {
+            content.replaceChildren();
+            if (!data.studies || data.studies.length === 0) {
+                content.appendChild(element('p', 'No studies found for this patient.'));
+                return;
+            }
+            content.appendChild(element('h3', 'Patient: ' + data.patient.name));
+            content.appendChild(element('p',
+                `Total Studies: ${data.total_studies} across ${data.hospitals_accessed} hospitals`));
+            const list = element('ul');
+            for (const study of data.studies) {
+                const item = element('li');
+                item.appendChild(element('strong', study.description || ''));
+                item.appendChild(document.createTextNode(
+                    ` - ${study.hospital_name} - ${new Date(study.study_date).toLocaleDateString()} `));
+                const qr = element('a', 'QR Code');
+                qr.href = '/api/studies/' + encodeURIComponent(study.study_id) + '/qr';
+                qr.target = '_blank';
+                item.appendChild(qr);
+                list.appendChild(item);
+            }
+            content.appendChild(list);
+        })
+        .catch(() => {
+            content.textContent = 'Federation query failed.';
+        });
+})();
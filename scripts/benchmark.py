@@ -0,0 +1,628 @@
+"""
+Benchmark harness - latency, throughput and memory for every API route
+
+Seeds a synthetic database, drives each route through the Flask test client
+or over HTTP at a given concurrency, and writes the results as a JSON
+baseline that later runs can be compared against.
+
+    cd scripts
+
+    # 10k / 1m / 10m studies; the database is reused by later runs
+    python benchmark.py seed --size 1m
+    python benchmark.py seed --size 1m --layout clustered --db /tmp/xray-bench-1m-clustered.db
+
+    # In-process, through the Flask test client
+    python benchmark.py run --size 1m --concurrency 8 --out baseline.json
+
+    # Over HTTP: against a running server (pointed at the same database),
+    # or --serve to start gunicorn on it for the duration of the run
+    python benchmark.py run --size 1m --mode http --url http://localhost:5000 --concurrency 32
+    python benchmark.py run --size 1m --mode http --serve --concurrency 32 --out current.json
+
+    # Non-zero exit status when any route regressed by more than --threshold
+    python benchmark.py compare baseline.json current.json --threshold 0.2
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from urllib.parse import quote
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+sys.path.insert(0, BACKEND)
+
+from migrations import migrate  # noqa: E402
+import study_layout  # noqa: E402
+
+SIZES = {'10k': 10_000, '1m': 1_000_000, '10m': 10_000_000}
+
+# Seeded patient ids are PAT-<6 digits>, the form ids.patient_id_for gives, so at most 1M patients
+MAX_PATIENTS = 1_000_000
+STUDIES_PER_PATIENT = 4         # on average; see SKEW
+# Study i goes to patient floor(P * u**SKEW): with 3, the busiest 1% of patients
+# (chronic, oncology follow-up) hold about a fifth of all studies, most have one or two
+SKEW = 3.0
+HISTORY_DAYS = 6 * 365
+
+MODALITIES = [  # (modality, weight, descriptions)
+    ('CR', 30, ['Chest X-Ray', 'Chest X-Ray PA and Lateral', 'Hand X-Ray', 'Knee X-Ray', 'Spine X-Ray']),
+    ('DX', 10, ['Chest X-Ray Portable', 'Pelvis X-Ray', 'Foot X-Ray']),
+    ('CT', 20, ['CT Head', 'CT Chest with contrast', 'CT Abdomen Pelvis', 'CT Angiography']),
+    ('US', 15, ['Abdominal Ultrasound', 'Obstetric Ultrasound', 'Thyroid Ultrasound']),
+    ('MR', 10, ['MRI Brain', 'MRI Knee Left', 'MRI Lumbar Spine', 'MRI Shoulder']),
+    ('MG', 5, ['Mammogram Bilateral Screening', 'Mammogram Diagnostic']),
+    ('NM', 3, ['Bone Scan', 'Thyroid Scan']),
+    ('XA', 2, ['Coronary Angiography']),
+]
+FIRST_NAMES = ['John', 'Mary', 'Robert', 'Amina', 'Juma', 'Grace', 'Peter', 'Fatuma', 'Joseph',
+               'Neema', 'David', 'Rehema', 'Daniel', 'Zawadi', 'Emmanuel', 'Halima', 'James',
+               'Esther', 'Ali', 'Mwajuma', 'Michael', 'Upendo', 'Hassan', 'Anna', 'Said']
+LAST_NAMES = ['Mwangi', 'Kimaro', 'Mushi', 'Massawe', 'Juma', 'Hassan', 'Mollel', 'Swai',
+              'Lyimo', 'Shirima', 'Temba', 'Mrema', 'Urassa', 'Komba', 'Ngowi', 'Mbwana',
+              'Smith', 'Doe', 'Johnson', 'Minja', 'Kweka', 'Mtui', 'Makundi', 'Tarimo']
+
+
+# -- dataset -------------------------------------------------------------------
+
+def default_db_path(size):
+    return os.path.join(tempfile.gettempdir(), f'xray-bench-{size}.db')
+
+
+def parse_size(size):
+    return SIZES[size.lower()] if size.lower() in SIZES else int(size)
+
+
+def seed(path, studies, seed_value=42, layout=study_layout.ROWID):
+    """Create a benchmark database with `studies` studies
+
+    Rows are loaded at schema version 1 and the remaining migrations run
+    afterwards, so indexes and the search index are built once over the
+    finished tables instead of row by row; then studies is converted to
+    `layout`. Study rowids are 1..studies.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed_value)
+    patients = max(100, min(studies // STUDIES_PER_PATIENT, MAX_PATIENTS))
+    hospitals = 20 if studies <= 100_000 else 50
+    started = time.perf_counter()
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=OFF')
+    migrate(conn, target=1)
+
+    with conn:
+        conn.executemany(
+            'INSERT INTO hospitals (id, name, address) VALUES (?, ?, ?)',
+            [(f"HOS-{h:03d}", f"Hospital {h}", f"{h} Hospital Road") for h in range(1, hospitals + 1)]
+        )
+
+        def patient_rows():
+            for p in range(patients):
+                born = datetime(1940, 1, 1) + timedelta(days=rng.randrange(80 * 365))
+                national_id = f"{born:%Y%m%d}{rng.randrange(10000):04d}{p:06d}"
+                yield (f"PAT-{p:06d}", national_id, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES),
+                       born.strftime('%Y-%m-%d'), rng.choice('MF'), f"+255-7{rng.randrange(10**8):08d}")
+        conn.executemany('''
+            INSERT INTO patients (id, national_id, first_name, last_name, date_of_birth, gender, phone)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', patient_rows())
+
+        weights = [w for _, w, _ in MODALITIES]
+        now = datetime.now().replace(microsecond=0)
+
+        def study_rows():
+            for s in range(studies):
+                modality, _, descriptions = rng.choices(MODALITIES, weights)[0]
+                # recent years are busier than older ones
+                when = now - timedelta(days=int(HISTORY_DAYS * rng.random() ** 1.5),
+                                       seconds=rng.randrange(86400))
+                yield (f"STU-{when:%Y%m%d%H%M%S}-{s:08x}",
+                       f"PAT-{int(patients * rng.random() ** SKEW):06d}",
+                       f"HOS-{int(hospitals * rng.random() ** 2) + 1:03d}",
+                       when.strftime('%Y-%m-%d %H:%M:%S'), modality, rng.choice(descriptions),
+                       f"{rng.getrandbits(128):032x}" if rng.random() < 0.5 else None)
+        conn.executemany('''
+            INSERT INTO studies (id, patient_id, hospital_id, study_date, modality, description, orthanc_study_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', study_rows())
+
+    migrate(conn)
+    study_layout.convert(conn, layout)
+    conn.close()
+    print(f"Seeded {path}: {hospitals} hospitals, {patients} patients, {studies} studies ({layout}) "
+          f"in {time.perf_counter() - started:.1f}s")
+
+
+def load_samples(path, count=2000, seed_value=7):
+    """Identifiers to put in request URLs, drawn like real traffic: a patient
+    is picked as often as they have studies, so hot patients stay hot"""
+    rng = random.Random(seed_value)
+    conn = sqlite3.connect(path)
+    # The seeded rowids; studies added by write routes since have time-ordered keys far above them
+    seeded = conn.execute('SELECT COUNT(*) FROM studies WHERE rowid <= ?', (2 ** 32,)).fetchone()[0]
+    rowids = [rng.randint(1, seeded) for _ in range(count)] if seeded else []
+    rows = []
+    for start in range(0, len(rowids), 500):
+        chunk = rowids[start:start + 500]
+        rows += conn.execute(f'''
+            SELECT s.id, s.patient_id, p.national_id, p.last_name
+            FROM studies s JOIN patients p ON p.id = s.patient_id
+            WHERE s.rowid IN ({','.join('?' * len(chunk))})
+        ''', chunk).fetchall()
+    samples = {
+        "hospitals": [r[0] for r in conn.execute('SELECT id FROM hospitals')],
+        "studies": [r[0] for r in rows],
+        "patients": [r[1] for r in rows],
+        "national_ids": [r[2] for r in rows],
+        "last_names": [r[3] for r in rows],
+        "counts": {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                   for table in ('hospitals', 'patients', 'studies')},
+    }
+    conn.close()
+    if not samples["studies"]:
+        raise SystemExit(f"{path} has no studies; run `benchmark.py seed` first")
+    return samples
+
+
+# -- routes --------------------------------------------------------------------
+
+def build_routes(samples):
+    """name -> fn(rng) returning (method, url, json_body)
+
+    Every route in app.py is here or in SKIPPED_RULES; run() warns about any
+    URL rule that is in neither, so new routes don't go unbenchmarked.
+    """
+    s = samples
+
+    def get(url):
+        return lambda rng: ('GET', url(rng), None)
+
+    def patient_rows(rng, n):
+        return [{"national_id": nid, "first_name": "Bench", "last_name": "Update",
+                 "phone": f"+255-6{rng.randrange(10**8):08d}"}
+                for nid in rng.sample(s["national_ids"], n)]
+
+    return {
+        "home": get(lambda rng: '/'),
+        "status": get(lambda rng: '/api/status'),
+        "hospitals": get(lambda rng: '/api/hospitals'),
+        "patients_page": get(lambda rng: '/api/patients?limit=100'),
+        "patients_page_ndjson": get(lambda rng: '/api/patients?limit=1000&format=ndjson'),
+        "patient": get(lambda rng: f"/api/patients/{rng.choice(s['patients'])}"),
+        "patient_qr": get(lambda rng: f"/api/patients/{rng.choice(s['patients'])}/qr"),
+        "study_qr": get(lambda rng: f"/api/studies/{rng.choice(s['studies'])}/qr"),
+        "hospital_studies": get(lambda rng: f"/api/hospitals/{rng.choice(s['hospitals'])}/studies?limit=100"),
+        "federation_national_id": get(
+            lambda rng: f"/api/federation/query?national_id={rng.choice(s['national_ids'])}"),
+        "federation_patient_id": get(
+            lambda rng: f"/api/federation/query?patient_id={rng.choice(s['patients'])}"),
+        "federation_cache": get(lambda rng: '/api/federation/cache'),
+        "federation_peers": get(lambda rng: '/api/federation/peers'),
+        "admission": get(lambda rng: '/api/admission'),
+        "search_name": get(lambda rng: f"/api/search?q={quote(rng.choice(s['last_names'])[:4])}"),
+        "search_national_id": get(lambda rng: f"/api/search?q={rng.choice(s['national_ids'])[:8]}&type=patients"),
+        "search_studies": get(lambda rng: '/api/search?q=chest%20x-ray%20last%20month&type=studies'),
+        "dashboard_summary": get(lambda rng: '/api/dashboard/summary'),
+        "export_csv": get(lambda rng: f"/api/export/studies?hospital_id={rng.choice(s['hospitals'])}"
+                                      f"&from={(datetime.now() - timedelta(days=30)):%Y-%m-%d}"),
+        "qr_sheet": lambda rng: ('POST', '/api/qr/sheet', {
+            "patient_ids": rng.sample(s["patients"], min(24, len(s["patients"])))}),
+        "patients_bulk": lambda rng: ('POST', '/api/patients/bulk', patient_rows(rng, 50)),
+        "register_study": lambda rng: ('POST', f"/api/hospitals/{rng.choice(s['hospitals'])}/studies", {
+            "patient_id": rng.choice(s["patients"]), "modality": "CR",
+            "description": "Benchmark Chest X-Ray", "study_date": datetime.now().strftime('%Y-%m-%d %H:%M:%S')}),
+        "patient_access_page": get(lambda rng: f"/patient-access/{rng.choice(s['patients'])}"),
+        "federation_access_page": get(
+            lambda rng: f"/federation-access?national_id={rng.choice(s['national_ids'])}"),
+        "dashboard_page": get(lambda rng: '/dashboard'),
+        "frontend_asset": get(lambda rng: '/frontend/dashboard.html'),
+        "metrics": get(lambda rng: '/metrics'),
+        "jobs": get(lambda rng: '/api/jobs?limit=50'),
+        # The audited routes above fill the log these read
+        "audit_events": get(lambda rng: '/api/audit/events?limit=100'),
+        "audit_events_patient": get(lambda rng: f"/api/audit/events?patient_id={rng.choice(s['patients'])}"),
+        "audit_patient": get(lambda rng: f"/api/audit/patients/{rng.choice(s['patients'])}"),
+        "audit_status": get(lambda rng: '/api/audit/status'),
+    }
+
+
+# Routes that mutate the dataset; only run with --writes
+WRITE_ROUTES = {"patients_bulk", "register_study"}
+
+# Deliberately not benchmarked: destructive, or they depend on a live Orthanc
+SKIPPED_RULES = {'/api/admin/reset-demo', '/api/orthanc/sync', '/api/patients/bulk',
+                 '/api/hospitals/<hospital_id>/studies/bulk', '/api/studies/bulk', '/static/<path:filename>',
+                 # Need DICOMs in Orthanc or DICOM_DIR, which the synthetic data has none of
+                 '/api/studies/<study_id>/preview', '/api/studies/<study_id>/instances',
+                 '/api/studies/<study_id>/instances/<path:instance_id>/preview',
+                 # Job IDs only exist once something was submitted
+                 '/api/jobs/<job_id>', '/api/jobs/<job_id>/cancel', '/api/jobs/<job_id>/result'}
+
+
+def uncovered_rules(routes, samples):
+    """URL rules of the app that no benchmark route exercises"""
+    from app import app
+    rng = random.Random(0)
+    adapter = app.url_map.bind('localhost')
+    covered = set()
+    for make in routes.values():
+        method, url, _ = make(rng)
+        rule, _ = adapter.match(url.split('?')[0], method=method, return_rule=True)
+        covered.add(rule.rule)
+    return sorted({r.rule for r in app.url_map.iter_rules()} - covered - SKIPPED_RULES)
+
+
+# -- drivers -------------------------------------------------------------------
+
+class ClientDriver:
+    """In-process requests through the Flask test client (one per thread)"""
+
+    def __init__(self):
+        from app import app
+        self.app = app
+        self._local = threading.local()
+
+    def request(self, method, url, body):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = self.app.test_client()
+        response = client.open(url, method=method, json=body)
+        response.get_data()  # drain streamed bodies
+        response.close()
+        return response.status_code
+
+
+class HTTPDriver:
+    """Requests over keep-alive HTTP connections (one session per thread)"""
+
+    def __init__(self, base_url):
+        import requests
+        self.requests = requests
+        self.base_url = base_url.rstrip('/')
+        self._local = threading.local()
+
+    def request(self, method, url, body):
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self.requests.Session()
+        response = session.request(method, self.base_url + url, json=body, timeout=60)
+        response.content
+        return response.status_code
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def bench_route(driver, make_request, requests, concurrency, warmup, seed_value):
+    """Run `requests` requests over `concurrency` threads; returns the stats dict"""
+    rng = random.Random(seed_value)
+    planned = [make_request(rng) for _ in range(requests + warmup)]
+    for method, url, body in planned[:warmup]:
+        driver.request(method, url, body)
+
+    work = iter(planned[warmup:])
+    lock = threading.Lock()
+    latencies, statuses, errors = [], {}, []
+
+    def worker():
+        while True:
+            with lock:
+                item = next(work, None)
+            if item is None:
+                return
+            start = time.perf_counter()
+            try:
+                status = driver.request(*item)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda v: None if v is None else round(v * 1000, 3)  # noqa: E731
+    return {
+        "requests": len(latencies),
+        "errors": len(errors) + sum(n for code, n in statuses.items() if code >= 500),
+        "statuses": {str(code): n for code, n in sorted(statuses.items())},
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p95_ms": ms(percentile(latencies, 0.95)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "max_ms": ms(latencies[-1] if latencies else None),
+        "mean_ms": ms(sum(latencies) / len(latencies) if latencies else None),
+        "throughput_rps": round(len(latencies) / wall, 1) if wall else None,
+        "first_error": errors[0] if errors else None,
+    }
+
+
+class RSSMonitor:
+    """Peak resident memory of a process tree, sampled from /proc (Linux)"""
+
+    def __init__(self, pid, interval=0.25):
+        self.pid = pid
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _tree(pid):
+        pids, stack = [], [pid]
+        while stack:
+            current = stack.pop()
+            pids.append(current)
+            try:
+                for task in os.listdir(f'/proc/{current}/task'):
+                    with open(f'/proc/{current}/task/{task}/children') as f:
+                        stack.extend(int(c) for c in f.read().split())
+            except OSError:
+                pass
+        return pids
+
+    @staticmethod
+    def _rss_kb(pid):
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_kb = max(self.peak_kb, sum(self._rss_kb(p) for p in self._tree(self.pid)))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        if os.path.isdir('/proc'):
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+
+
+def peak_rss_mb_self():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def start_server(db_path, workers=None, admission=False):
+    """gunicorn on a free local port against db_path; returns (process, base_url)"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    env = dict(os.environ, DATABASE_PATH=os.path.abspath(db_path), GUNICORN_BIND=f'127.0.0.1:{port}',
+               GUNICORN_ACCESS_LOG='/dev/null', FLASK_CONFIG='production',
+               METRICS_DIR=tempfile.mkdtemp(prefix='xray-bench-metrics-'),
+               AUDIT_DIR=os.environ.get('AUDIT_DIR') or os.path.join(tempfile.gettempdir(), 'xray-bench-audit'))
+    if workers:
+        env['GUNICORN_WORKERS'] = str(workers)
+    if not admission:
+        env['RATE_LIMIT_ENABLED'] = '0'
+    elif 'RATE_LIMIT_ENABLED' in env:
+        del env['RATE_LIMIT_ENABLED']
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+                               cwd=BACKEND, env=env, stdout=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    import requests
+    deadline = time.monotonic() + 120  # migrations on a fresh 10M-row database take a while
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("gunicorn exited during startup")
+        try:
+            requests.get(base_url + '/api/status', timeout=1)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.5)
+    process.terminate()
+    raise SystemExit("gunicorn did not start in time")
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BACKEND,
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    db_path = args.db or default_db_path(args.size)
+    if not os.path.exists(db_path):
+        seed(db_path, parse_size(args.size))
+    samples = load_samples(db_path)
+
+    if args.mode == 'client':
+        # Must be set before app.py is imported: it configures the pool from them
+        os.environ['DATABASE_PATH'] = db_path
+        os.environ.setdefault('FLASK_CONFIG', 'production')
+        os.environ.setdefault('AUDIT_DIR', os.path.join(tempfile.gettempdir(), 'xray-bench-audit'))
+        if not args.admission:
+            os.environ['RATE_LIMIT_ENABLED'] = '0'
+
+    routes = build_routes(samples)
+    if args.mode == 'client':
+        missing = uncovered_rules(routes, samples)
+        if missing:
+            print(f"⚠️  Routes with no benchmark: {', '.join(missing)}")
+    selected = [name for name in routes
+                if (not args.routes or any(pattern in name for pattern in args.routes))
+                and (args.writes or name not in WRITE_ROUTES)]
+
+    server = None
+    if args.mode == 'http' and args.serve:
+        server, args.url = start_server(db_path, args.workers, args.admission)
+    driver = ClientDriver() if args.mode == 'client' else HTTPDriver(args.url)
+
+    results = {}
+    monitor = RSSMonitor(server.pid if server else os.getpid())
+    try:
+        with monitor:
+            for i, name in enumerate(selected):
+                results[name] = stats = bench_route(driver, routes[name], args.requests,
+                                                    args.concurrency, args.warmup, seed_value=i)
+                print(f"{name:28} p50 {stats['p50_ms']:>9} ms  p95 {stats['p95_ms']:>9} ms  "
+                      f"p99 {stats['p99_ms']:>9} ms  {stats['throughput_rps']:>8} req/s"
+                      + (f"  ❌ {stats['errors']} errors" if stats['errors'] else ''))
+    finally:
+        if server:
+            server.send_signal(signal.SIGINT)  # quick shutdown; TERM would wait out keep-alives
+            server.wait(timeout=30)
+
+    if monitor.peak_kb:
+        peak_rss = round(monitor.peak_kb / 1024, 1)
+    elif args.mode == 'client':
+        peak_rss = peak_rss_mb_self()
+    else:
+        peak_rss = None  # remote server: not observable from here
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec='seconds'),
+            "revision": git_revision(),
+            "mode": args.mode,
+            "url": args.url if args.mode == 'http' else None,
+            "size": args.size,
+            "rows": samples["counts"],
+            "concurrency": args.concurrency,
+            "requests_per_route": args.requests,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "peak_rss_mb": peak_rss,
+        "routes": results,
+    }
+    print(f"Peak RSS: {peak_rss} MiB")
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved {args.out}")
+    return report
+
+
+def compare(args):
+    """Print per-route changes; exit status 1 if any route regressed beyond the threshold"""
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    for key in ('mode', 'size', 'concurrency'):
+        if baseline['meta'].get(key) != current['meta'].get(key):
+            print(f"⚠️  {key} differs: {baseline['meta'].get(key)} vs {current['meta'].get(key)}")
+
+    regressions = []
+    print(f"{'route':28} {'p50 ms':>17} {'p95 ms':>17} {'p99 ms':>17} {'req/s':>17}")
+    for name, now in current['routes'].items():
+        before = baseline['routes'].get(name)
+        if not before:
+            print(f"{name:28} (new)")
+            continue
+        cells, bad = [], []
+        for metric, higher_is_worse in (('p50_ms', True), ('p95_ms', True), ('p99_ms', True),
+                                        ('throughput_rps', False)):
+            old, new = before.get(metric), now.get(metric)
+            if not old or new is None:
+                cells.append(f"{'-':>17}")
+                continue
+            change = (new - old) / old
+            cells.append(f"{new:>9} ({change:+.0%})".rjust(17))
+            # p99 is too noisy on short runs to gate on; it is reported only
+            if metric != 'p99_ms' and (change > args.threshold if higher_is_worse
+                                       else change < -args.threshold):
+                bad.append(metric)
+        if now.get('errors', 0) > before.get('errors', 0):
+            bad.append('errors')
+        print(f"{name:28} " + ' '.join(cells) + ('  ❌ ' + ', '.join(bad) if bad else ''))
+        if bad:
+            regressions.append(name)
+
+    old_rss, new_rss = baseline.get('peak_rss_mb'), current.get('peak_rss_mb')
+    if old_rss and new_rss:
+        change = (new_rss - old_rss) / old_rss
+        print(f"Peak RSS: {old_rss} -> {new_rss} MiB ({change:+.0%})")
+        if change > args.threshold:
+            regressions.append('peak_rss_mb')
+
+    if regressions:
+        print(f"❌ Regressed beyond {args.threshold:.0%}: {', '.join(regressions)}")
+        return 1
+    print("✅ No regressions")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('seed', help='generate a synthetic database')
+    p.add_argument('--size', default='10k', help='10k, 1m, 10m or a study count')
+    p.add_argument('--db', help='database path (default: in the temp directory, per size)')
+    p.add_argument('--layout', choices=study_layout.LAYOUTS, default=study_layout.ROWID,
+                   help='studies table layout (see backend/study_layout.py)')
+
+    p = commands.add_parser('run', help='benchmark the routes')
+    p.add_argument('--size', default='10k')
+    p.add_argument('--db')
+    p.add_argument('--mode', choices=('client', 'http'), default='client')
+    p.add_argument('--url', default='http://localhost:5000', help='server for --mode http')
+    p.add_argument('--serve', action='store_true', help='start gunicorn on the database for --mode http')
+    p.add_argument('--workers', type=int, help='gunicorn workers for --serve (default: CPU count)')
+    p.add_argument('--concurrency', type=int, default=4)
+    p.add_argument('--requests', type=int, default=200, help='measured requests per route')
+    p.add_argument('--warmup', type=int, default=10, help='unmeasured requests per route first')
+    p.add_argument('--routes', nargs='*', help='only routes whose name contains one of these')
+    p.add_argument('--writes', action='store_true', help='include routes that modify the data')
+    p.add_argument('--admission', action='store_true',
+                   help='keep rate limits and concurrency caps on (every benchmark request comes from one client)')
+    p.add_argument('--out', help='save results as JSON')
+
+    p = commands.add_parser('compare', help='compare two saved runs')
+    p.add_argument('baseline')
+    p.add_argument('current')
+    p.add_argument('--threshold', type=float, default=0.2, help='allowed relative change (0.2 = 20%%)')
+
+    args = parser.parse_args(argv)
+    if args.command == 'seed':
+        seed(args.db or default_db_path(args.size), parse_size(args.size), layout=args.layout)
+    elif args.command == 'run':
+        run(args)
+    else:
+        return compare(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""
+Convert the studies tables of an existing deployment to another layout
+
+Rebuilds studies in the main database and in every shard under
+--shard-dir as 'clustered' (stored by patient, see backend/study_layout.py)
+or back as 'rowid'. Each database is converted in one transaction that
+holds its write lock throughout, so run it while the API is stopped or
+expect writes to wait; databases already in the target layout are
+skipped, so it is safe to re-run. Then set STUDY_LAYOUT to the same
+value, so new shards are created that way too.
+
+    cd scripts
+    python cluster_studies.py ../backend/federation.db
+    python cluster_studies.py ../backend/federation.db --shard-dir ../backend/shards --vacuum
+    python cluster_studies.py ../backend/federation.db --to rowid
+"""
+import sys
+import os
+import argparse
+import sqlite3
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import storage
+import study_layout
+from migrations import migrate, MIGRATIONS, SHARD_MIGRATIONS
+
+
+def convert_database(path, target, migrations, vacuum=False):
+    start = time.perf_counter()
+    # Autocommit: convert() manages its own transaction, and VACUUM can't run in one
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute('PRAGMA busy_timeout = 30000')
+        migrate(conn, migrations=migrations, verbose=False)
+        converted = study_layout.convert(conn, target)
+        count = conn.execute('SELECT COUNT(*) FROM studies').fetchone()[0]
+        if converted and vacuum:
+            # The old table's pages are free now; give them back to the filesystem
+            conn.execute('VACUUM')
+    finally:
+        conn.close()
+    name = os.path.basename(path)
+    if converted:
+        print(f"  {name}: {count} studies -> {target} ({time.perf_counter() - start:.1f}s)")
+    else:
+        print(f"  {name}: already {target}")
+    return converted
+
+
+def cluster_studies(database, shard_dir=None, target=study_layout.CLUSTERED, vacuum=False):
+    converted = convert_database(database, target, MIGRATIONS, vacuum)
+    if shard_dir:
+        shards = sorted(entry.path for entry in os.scandir(shard_dir)
+                        if entry.name.endswith(storage.SHARD_SUFFIX))
+        for path in shards:
+            converted += convert_database(path, target, SHARD_MIGRATIONS, vacuum)
+    return converted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('database', help='main database (DATABASE_PATH)')
+    parser.add_argument('--shard-dir', help='directory of the study shards (STUDY_SHARD_DIR)')
+    parser.add_argument('--to', choices=study_layout.LAYOUTS, default=study_layout.CLUSTERED,
+                        help='layout to convert to (default: clustered)')
+    parser.add_argument('--vacuum', action='store_true', help='VACUUM each converted database afterwards')
+    args = parser.parse_args()
+    try:
+        converted = cluster_studies(args.database, args.shard_dir, args.to, args.vacuum)
+    except ValueError as e:
+        sys.exit(f"❌ {e}")
+    print(f"✅ {converted} database(s) converted; set STUDY_LAYOUT={args.to}")
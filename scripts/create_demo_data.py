@@ -6,6 +6,7 @@ import os
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
 
 from app import app
+import db
 import json
 
 def create_demo_data():
@@ -43,31 +44,23 @@ def create_demo_data():
             {"national_id": "197808997766554433", "first_name": "Robert", "last_name": "Johnson", "date_of_birth": "1978-08-09", "gender": "M"}
         ]
         
-        patient_ids = []
-        # Fetch existing patients to avoid duplicates
-        existing_patients_resp = client.get('/api/patients')
-        existing_by_national = {}
-        if existing_patients_resp.status_code == 200:
-            try:
-                for p in existing_patients_resp.json:
-                    existing_by_national[p.get('national_id')] = p.get('id')
-            except Exception:
-                pass
-
-        for patient in patients:
-            if patient['national_id'] in existing_by_national:
-                pid = existing_by_national[patient['national_id']]
-                patient_ids.append(pid)
-                print(f"Skipping existing patient: {patient['first_name']} {patient['last_name']} - {pid}")
-                continue
-
-            response = client.post('/api/patients', json=patient)
-            if response.status_code == 201:
-                patient_id = response.json.get('patient_id')
-                patient_ids.append(patient_id)
-                print(f"Created patient: {patient['first_name']} {patient['last_name']} - {patient_id}")
-            else:
-                print(f"Failed creating patient {patient.get('first_name')} {patient.get('last_name')}: {response.status_code}")
+        # Upsert all patients in one batched request (existing national IDs are updated)
+        response = client.post('/api/patients/bulk', json=patients)
+        if response.status_code != 200:
+            print(f"Failed creating patients: {response.status_code}")
+            return
+        result = response.json
+        print(f"Upserted {result['upserted']} patients ({result['failed']} failed)")
+        for failure in result['failures']:
+            patient = patients[failure['index']]
+            print(f"  Failed patient {patient['first_name']} {patient['last_name']}: {failure['error']}")
+        
+        failed_indexes = {f['index'] for f in result['failures']}
+        # The IDs the patients were given: a derived ID another national ID already had is reissued
+        with db.connection() as conn:
+            patient_ids = [conn.execute('SELECT id FROM patients WHERE national_id = ?',
+                                        (p['national_id'],)).fetchone()[0]
+                           for i, p in enumerate(patients) if i not in failed_indexes]
         
         # Create studies
         studies = [
@@ -83,24 +76,24 @@ def create_demo_data():
         if len(patient_ids) == 0:
             print("No patients available; skipping study creation.")
         else:
+            rows = []
             for i, study in enumerate(studies):
-                if i >= len(patient_ids) and 'patient_id' in study and study['patient_id'] is None:
-                    # skip if we don't have enough patients
-                    continue
                 # ensure study references an available patient
-                study_patient_id = study.get('patient_id') or patient_ids[i % len(patient_ids)]
-                body = {
-                    'patient_id': study_patient_id,
+                rows.append({
+                    'patient_id': study.get('patient_id') or patient_ids[i % len(patient_ids)],
+                    'hospital_id': hospital_ids[i % len(hospital_ids)],
                     'study_date': study.get('study_date'),
                     'modality': study.get('modality'),
                     'description': study.get('description')
-                }
-                hospital_id = hospital_ids[i % len(hospital_ids)]
-                response = client.post(f'/api/hospitals/{hospital_id}/studies', json=body)
-                if response.status_code == 201:
-                    print(f"Created study at {hospital_id}: {study['description']}")
-                else:
-                    print(f"Failed creating study at {hospital_id}: {response.status_code}")
+                })
+            response = client.post('/api/studies/bulk', json=rows)
+            if response.status_code == 200:
+                failed_indexes = {f['index'] for f in response.json['failures']}
+                for i, row in enumerate(rows):
+                    status = "Failed creating" if i in failed_indexes else "Created"
+                    print(f"{status} study at {row['hospital_id']}: {row['description']}")
+            else:
+                print(f"Failed creating studies: {response.status_code}")
         
         print("\n✅ Demo data created successfully!")
         print(f"\nTo access the system:")
@@ -0,0 +1,85 @@
+"""
+Move the studies of a single-file database into per-hospital shards
+
+Copies each hospital's studies (and its parked Orthanc sync studies) from
+the main database into <shard dir>/<hospital_id>.db and fills the global
+patient index, so the API can then run with STUDY_SHARD_DIR=<shard dir>.
+Safe to re-run: rows already copied are skipped.
+
+    cd scripts
+    python shard_studies.py ../backend/federation.db ../backend/shards
+    python shard_studies.py ../backend/federation.db ../backend/shards --sync-hospital HOS-001 --delete-source
+"""
+import sys
+import os
+import argparse
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import db
+import storage
+from migrations import migrate
+
+# rowid too: it is the study's key (and the search index's), in either layout
+STUDY_COLUMNS = ('id, patient_id, hospital_id, study_date, modality, description, orthanc_study_id, '
+                 'study_instance_uid, created_date, rowid')
+PENDING_COLUMNS = 'orthanc_study_id, dicom_patient_id, hospital_id, study_date, modality, description, created_date'
+
+
+def shard_studies(database, shard_dir, sync_hospital=None, delete_source=False):
+    db.configure(database=database)
+    store = storage.configure(shard_dir=shard_dir)
+    with db.connection() as conn:
+        migrate(conn)
+        hospitals = [row[0] for row in conn.execute(
+            'SELECT DISTINCT hospital_id FROM studies WHERE hospital_id IS NOT NULL')]
+        unassigned = conn.execute('SELECT COUNT(*) FROM studies WHERE hospital_id IS NULL').fetchone()[0]
+
+    for hospital_id in hospitals:
+        start = time.perf_counter()
+        name = store.shard_name(hospital_id)
+        # Index first, as the API does, then copy through the attached main database
+        with db.connection() as conn, db.transaction(conn):
+            conn.execute('INSERT OR IGNORE INTO patient_shards (patient_id, shard) '
+                         'SELECT DISTINCT patient_id, ? FROM studies WHERE hospital_id = ?',
+                         (name, hospital_id))
+        with storage.connection(hospital_id) as conn, db.transaction(conn), \
+                db.batched_versions(conn, 'studies'):
+            copied = conn.execute(
+                f'INSERT OR IGNORE INTO main.studies ({STUDY_COLUMNS}) '
+                f'SELECT {STUDY_COLUMNS} FROM {storage.MAIN_SCHEMA}.studies WHERE hospital_id = ?',
+                (hospital_id,)).rowcount
+            conn.execute(
+                f'INSERT OR IGNORE INTO main.orthanc_sync_pending ({PENDING_COLUMNS}) '
+                f'SELECT {PENDING_COLUMNS} FROM {storage.MAIN_SCHEMA}.orthanc_sync_pending WHERE hospital_id = ?',
+                (hospital_id,))
+            if hospital_id == sync_hospital:
+                conn.execute(
+                    f'INSERT OR REPLACE INTO main.orthanc_sync_state (source, last_seq, updated_date) '
+                    f'SELECT source, last_seq, updated_date FROM {storage.MAIN_SCHEMA}.orthanc_sync_state')
+        print(f"  {hospital_id}: {copied} studies -> {name}{storage.SHARD_SUFFIX} "
+              f"({time.perf_counter() - start:.1f}s)")
+
+    if delete_source:
+        with db.connection() as conn, db.transaction(conn), db.batched_versions(conn, 'studies'):
+            conn.execute('DELETE FROM studies WHERE hospital_id IS NOT NULL')
+            conn.execute('DELETE FROM orthanc_sync_pending')
+        print("  Removed the copied studies from the main database")
+    if unassigned:
+        print(f"⚠️  {unassigned} studies have no hospital_id and were left in the main database")
+    store.close_all()
+    db.get_pool().close_all()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('database', help='main database (DATABASE_PATH)')
+    parser.add_argument('shard_dir', help='directory for the shards (STUDY_SHARD_DIR)')
+    parser.add_argument('--sync-hospital', help='hospital whose shard takes the Orthanc sync position '
+                                                '(ORTHANC_SYNC_HOSPITAL_ID)')
+    parser.add_argument('--delete-source', action='store_true',
+                        help='delete the copied studies from the main database afterwards')
+    args = parser.parse_args()
+    print(f"Sharding studies of {args.database} into {args.shard_dir}")
+    shard_studies(args.database, args.shard_dir, args.sync_hospital, args.delete_source)
+    print(f"✅ Done. Start the API with STUDY_SHARD_DIR={args.shard_dir}")
@@ -0,0 +1,102 @@
+"""
+Admission control tests: who a client is, and which requests it is charged for
+
+Every test starts a fresh AdmissionControl with one token per client, so
+a client's second charged request is refused.
+
+    cd scripts
+    python -m pytest test_admission.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-admission-audit-'))
+
+import pytest
+
+import admission
+import app as app_module
+import db
+import storage
+from migrations import migrate
+
+
+@pytest.fixture
+def client():
+    """A migrated temporary database, and listing and federation limits of one request per client"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-admission-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute("INSERT INTO patients (id, national_id, first_name, last_name) "
+                     "VALUES ('PAT-ADM-1', 'NID-ADM-1', 'Amani', 'Mrema')")
+        conn.commit()
+    previous = admission.admission
+    admission.configure(rates={'listing': (0.001, 1), 'federation': (0.001, 1)}, api_keys=['peer-key'])
+    yield app_module.app.test_client()
+    admission.admission = previous
+    pool.close_all()
+
+
+def listing(client, forwarded_for, **headers):
+    return client.get('/api/patients', headers=dict(headers, **{'X-Forwarded-For': forwarded_for}),
+                      environ_base={'REMOTE_ADDR': '10.0.0.1'}).status_code
+
+
+def test_clients_behind_an_untrusted_proxy_share_its_bucket(client):
+    assert listing(client, '203.0.113.7') == 200
+    assert listing(client, '203.0.113.8') == 429
+
+
+def test_trusted_proxy_hops_give_each_forwarded_client_a_bucket(client, monkeypatch):
+    monkeypatch.setattr(app_module._proxy_fix, 'x_for', 1)
+    assert listing(client, '203.0.113.7') == 200
+    assert listing(client, '203.0.113.8') == 200
+    assert listing(client, '203.0.113.7') == 429
+    # Only the entry the trusted proxy appended counts, not what the client claimed before it
+    assert listing(client, '198.51.100.1, 203.0.113.8') == 429
+
+
+def test_known_api_key_is_its_own_client(client):
+    assert listing(client, '203.0.113.7') == 200
+    assert listing(client, '203.0.113.7', **{'X-API-Key': 'peer-key'}) == 200
+    assert listing(client, '203.0.113.7', **{'X-API-Key': 'made-up-key'}) == 429
+
+
+def test_listing_pages_are_not_charged(client):
+    for _ in range(3):
+        assert client.get('/api/patients?limit=10').status_code == 200
+    assert client.get('/api/patients').status_code == 200
+    assert client.get('/api/patients').status_code == 429
+
+
+def test_revalidation_is_answered_before_the_limit(client):
+    tag = client.get('/api/patients').headers['ETag']
+    for _ in range(3):
+        assert client.get('/api/patients', headers={'If-None-Match': tag}).status_code == 304
+    assert client.get('/api/patients').status_code == 429
+
+
+def test_pages_and_revalidations_need_no_slot(client):
+    with client.get('/api/patients') as full:     # a streamed listing holds its slot until closed
+        tag = full.headers['ETag']
+    control = admission.admission
+    slots = [control.acquire('listing') for _ in range(control.concurrency['listing'])]
+    try:
+        assert client.get('/api/patients', headers={'If-None-Match': tag}).status_code == 304
+        assert client.get('/api/patients?limit=10').status_code == 200
+    finally:
+        for slot in slots:
+            slot.release()
+
+
+def test_federation_revalidation_is_not_charged(client):
+    url = '/api/federation/query?patient_id=PAT-ADM-1'
+    tag = client.get(url).headers['ETag']
+    for _ in range(3):
+        assert client.get(url, headers={'If-None-Match': tag}).status_code == 304
+    assert client.get(url, headers={'If-None-Match': '"stale"'}).status_code == 429
+    assert client.get(url).status_code == 429
@@ -0,0 +1,172 @@
+"""
+Access audit log tests: the queue, its writer and the /api/audit routes
+
+Every test gets a fresh audit log in a temporary directory. The writer is
+held inside a write where a test needs events to pile up behind it.
+
+    cd scripts
+    python -m pytest test_audit.py
+"""
+import sys
+import os
+import tempfile
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+from datetime import datetime, timezone
+
+import pytest
+
+import audit
+import db
+import storage
+from app import app
+from migrations import migrate
+
+
+@pytest.fixture
+def database():
+    """A migrated temporary database with one patient"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-audit-db-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute("INSERT INTO hospitals (id, name) VALUES ('HOS-AUD', 'Audit Hospital')")
+        conn.execute("INSERT INTO patients (id, national_id, first_name, last_name) "
+                     "VALUES ('PAT-AUD-1', 'NID-AUD-1', 'Subira', 'Kimaro')")
+        conn.commit()
+    yield pool
+    pool.close_all()
+
+
+@pytest.fixture
+def new_log():
+    """audit.configure() into a temporary directory; the app's own log is put back afterwards"""
+    previous, logs = audit.audit_log, []
+
+    def configure(**settings):
+        logs.append(audit.configure(directory=tempfile.mkdtemp(prefix='xray-audit-'), **settings))
+        return logs[-1]
+
+    yield configure
+    for log in logs:
+        log.close()
+    audit.audit_log = previous
+
+
+def hold_writer(log, monkeypatch):
+    """Stop the writer inside its next write until the returned event is set"""
+    entered, release = threading.Event(), threading.Event()
+    write = log._write
+
+    def held(batch):
+        entered.set()
+        release.wait(5)
+        write(batch)
+
+    monkeypatch.setattr(log, '_write', held)
+    return entered, release
+
+
+def test_events_queued_behind_a_write_share_one_commit(new_log, monkeypatch):
+    log = new_log()
+    entered, release = hold_writer(log, monkeypatch)
+    with app.test_request_context('/api/patients/PAT-AUD-0'):
+        log.record('patient.read', patient_id='PAT-AUD-0', status=200)
+        assert entered.wait(5)
+        for i in range(1, 51):
+            log.record('patient.read', patient_id=f'PAT-AUD-{i}', status=200)
+    release.set()
+    log.close()
+
+    assert (log.written, log.batches) == (51, 2)
+    assert len(log.events(100)) == 51
+
+
+def test_full_queue_refuses_the_access(new_log, database, monkeypatch):
+    log = new_log(queue_size=1, enqueue_timeout=0.05)
+    entered, release = hold_writer(log, monkeypatch)
+    try:
+        with app.test_request_context('/api/patients/PAT-AUD-1'):
+            log.record('patient.read', patient_id='PAT-AUD-1', status=200)   # taken by the writer
+            assert entered.wait(5)
+            log.record('patient.read', patient_id='PAT-AUD-1', status=200)   # fills the queue
+            with pytest.raises(audit.AuditUnavailable):
+                log.record('patient.read', patient_id='PAT-AUD-1', status=200)
+
+        response = app.test_client().get('/api/patients/PAT-AUD-1')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+        assert 'Subira' not in response.get_data(as_text=True)
+        assert log.rejected == 2
+    finally:
+        release.set()
+
+
+def test_full_queue_drops_the_event_when_told_to(new_log, database, monkeypatch):
+    log = new_log(queue_size=1, on_full='drop')
+    entered, release = hold_writer(log, monkeypatch)
+    try:
+        client = app.test_client()
+        assert client.get('/api/patients/PAT-AUD-1').status_code == 200
+        assert entered.wait(5)
+        assert client.get('/api/patients/PAT-AUD-1').status_code == 200
+        assert client.get('/api/patients/PAT-AUD-1').status_code == 200
+        assert (log.dropped, log.rejected) == (1, 0)
+    finally:
+        release.set()
+
+
+def test_segments_rotate_by_day_and_expire_whole(new_log, monkeypatch):
+    log = new_log(segment='day', retention_days=30)
+    today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    stamps = iter(['2020-01-01 23:59:59.999', '2020-01-02 00:00:00.000', f'{today} 08:00:00.000'])
+    monkeypatch.setattr(audit, '_now', lambda: next(stamps))
+    with app.test_request_context('/api/patients/PAT-AUD-1'):
+        for _ in range(3):
+            log.record('patient.read', patient_id='PAT-AUD-1', status=200)
+    log.close()
+
+    assert log.segments() == [today, '2020-01-02', '2020-01-01']
+    # Newest first across segments, and the cursor carries on into older ones
+    first, second = log.events(1), log.events(1, after=['2020-01-02', 10 ** 9])
+    assert [row[2] for row in first] == [f'{today} 08:00:00.000', '2020-01-02 00:00:00.000']
+    assert [row[2] for row in second] == ['2020-01-02 00:00:00.000', '2020-01-01 23:59:59.999']
+
+    log._cleanup()
+    assert log.segments() == [today]
+
+
+def test_audit_routes_report_a_patients_accesses(new_log, database):
+    new_log()
+    client = app.test_client()
+    study_id = client.post('/api/hospitals/HOS-AUD/studies', json={
+        "patient_id": 'PAT-AUD-1', "study_date": '2024-05-01'}).get_json()['study_id']
+    assert client.get('/api/patients/PAT-AUD-1', headers={'X-User': 'dr-mushi'}).status_code == 200
+    assert client.get(f'/api/studies/{study_id}/qr', headers={'X-User': 'kiosk-2'}).status_code == 200
+    assert client.post('/api/qr/sheet', json={"study_ids": [study_id]}).status_code == 200
+    assert client.get('/api/patients/PAT-NONE').status_code == 404
+    audit.audit_log.close()     # write out the queue
+
+    events = client.get('/api/audit/events?patient_id=PAT-AUD-1').get_json()
+    assert [e['action'] for e in events] == ['qr.sheet', 'study.qr', 'patient.read']
+    assert events[1]['study_id'] == study_id and events[1]['actor'] == 'kiosk-2'
+
+    page = client.get('/api/audit/events?limit=2')
+    assert [e['patient_id'] for e in page.get_json()] == ['PAT-NONE', 'PAT-AUD-1']
+    assert page.get_json()[0]['status'] == 404
+    rest = client.get('/api/audit/events', query_string={"limit": 2, "after": page.headers['X-Next-Cursor']})
+    assert [e['action'] for e in rest.get_json()] == ['study.qr', 'patient.read']
+
+    report = client.get('/api/audit/patients/PAT-AUD-1').get_json()
+    assert report['accesses'] == 3
+    assert {a['actor']: a['actions'] for a in report['accessors']} == {
+        'dr-mushi': {'patient.read': 1}, 'kiosk-2': {'study.qr': 1}, None: {'qr.sheet': 1}}
+
+    assert client.get('/api/audit/events?from=2026-13-01').status_code == 400
+    assert client.get('/api/audit/status').get_json()['written'] == 4
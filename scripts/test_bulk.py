@@ -0,0 +1,90 @@
+"""
+Bulk ingestion tests: a chunk with failing rows
+
+A chunk is written with one executemany; if a row fails, the chunk is
+replayed row by row so the good rows still commit together and each bad
+one is reported by its position in the request body.
+
+    cd scripts
+    python -m pytest test_bulk.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import pytest
+
+import bulk
+import db
+from migrations import migrate
+
+INSERT_PATIENT = 'INSERT INTO patients (id, national_id, first_name, last_name) VALUES (?, ?, ?, ?)'
+
+
+@pytest.fixture
+def conn():
+    """A migrated temporary database with one patient"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-bulk-'), 'federation.db')
+    pool = db.configure(database=path)
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute(INSERT_PATIENT, ('PAT-BLK-1', 'NID-BLK-1', 'Esther', 'Lema'))
+        conn.commit()
+        yield conn
+    pool.close_all()
+
+
+def patients_version(conn):
+    return conn.execute("SELECT version FROM table_versions WHERE name = 'patients'").fetchone()[0]
+
+
+def test_mixed_chunk_commits_the_valid_rows_and_reports_the_rest(conn):
+    result = bulk.BulkResult()
+    before = patients_version(conn)
+    params = [
+        (0, ('PAT-BLK-2', 'NID-BLK-2', 'Daniel', 'Urio')),
+        (1, ('PAT-BLK-1', 'NID-BLK-9', 'Taken', 'Id')),             # IntegrityError: patients.id
+        (2, ('PAT-BLK-3', 'NID-BLK-3', 'Rehema', 'Mtui')),
+        (3, ('PAT-BLK-4', 'NID-BLK-4', {'not': 'bindable'}, 'X')),  # ProgrammingError
+        (4, ('PAT-BLK-5', 'NID-BLK-5', 'Ali', 2 ** 70)),            # OverflowError
+        (5, ('PAT-BLK-6', 'NID-BLK-6', 'Upendo', 'Kimaro')),
+    ]
+    written = bulk._write_chunk(conn, 'patients', INSERT_PATIENT, params, result)
+
+    assert written == [params[0][1], params[2][1], params[5][1]]
+    assert result.written == 3 and result.failed_count == 3
+    assert [f['index'] for f in result.failures] == [1, 3, 4]
+    assert 'patients.id' in result.failures[0]['error']
+    assert not conn.in_transaction
+    assert [r[0] for r in conn.execute('SELECT id FROM patients ORDER BY id')] == [
+        'PAT-BLK-1', 'PAT-BLK-2', 'PAT-BLK-3', 'PAT-BLK-6']
+    assert patients_version(conn) == before + 1     # one bump for the replayed chunk
+
+
+def test_reissue_retries_a_failed_row_once(conn):
+    result = bulk.BulkResult()
+    params = [(0, ('PAT-BLK-1', 'NID-BLK-7', 'Said', 'Msuya')), (1, ('PAT-BLK-8', 'NID-BLK-8', 'Anna', 'Mbwambo'))]
+    written = bulk._write_chunk(conn, 'patients', INSERT_PATIENT, params, result,
+                                reissue=lambda p, error: ('PAT-BLK-7',) + p[1:])
+    assert written == [('PAT-BLK-7', 'NID-BLK-7', 'Said', 'Msuya'), ('PAT-BLK-8', 'NID-BLK-8', 'Anna', 'Mbwambo')]
+    assert (result.written, result.failed_count) == (2, 0)
+
+
+def test_upsert_reports_rows_failing_checks_by_index(conn):
+    result = bulk.upsert_patients(conn, [
+        {"national_id": '199001000001', "first_name": 'Amina', "last_name": 'Said'},
+        {"national_id": '199001000002', "first_name": 'Peter'},
+        "not a row",
+        ValueError("Invalid JSON line: Expecting value"),
+        {"national_id": '199001000003', "first_name": 'Grace', "last_name": ['Mushi']},
+        {"national_id": '199001000004', "first_name": 'Joseph', "last_name": 'Minja'},
+    ], chunk_size=4)
+    assert result.to_dict('upserted') == {
+        "upserted": 2, "failed": 4, "failures_truncated": False, "failures": [
+            {"index": 1, "error": "Missing required field(s): last_name"},
+            {"index": 2, "error": "Row must be an object"},
+            {"index": 3, "error": "Invalid JSON line: Expecting value"},
+            {"index": 4, "error": "Field(s) must be a string or number: last_name"},
+        ]}
+    assert conn.execute('SELECT COUNT(*) FROM patients').fetchone()[0] == 3
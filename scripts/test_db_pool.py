@@ -0,0 +1,65 @@
+"""
+Connection pool tests: bounds, busy timeout, forked workers
+
+    cd scripts
+    python -m pytest test_db_pool.py
+"""
+import sys
+import os
+import sqlite3
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import pytest
+
+import db
+
+
+@pytest.fixture
+def pool():
+    """A two-connection pool on an empty temporary database"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-pool-'), 'federation.db')
+    pool = db.ConnectionPool(path, size=2, timeout=7.5)
+    yield pool
+    pool.close_all()
+
+
+def test_exhausted_pool_raises_after_the_timeout(pool):
+    held = [pool.acquire(), pool.acquire()]
+    with pytest.raises(RuntimeError, match='exhausted'):
+        pool.acquire(timeout=0.05)
+    pool.release(held.pop())
+    assert pool.acquire(timeout=0.05) is not None
+    assert pool.stats() == {"size": 2, "open": 2, "idle": 0}
+
+
+def test_release_rolls_back_an_unfinished_transaction(pool):
+    with pool.connection() as conn:
+        conn.execute('CREATE TABLE t (x)')
+        conn.commit()
+        conn.execute('INSERT INTO t VALUES (1)')
+    with pool.connection() as conn:
+        assert not conn.in_transaction
+        assert conn.execute('SELECT COUNT(*) FROM t').fetchone()[0] == 0
+
+
+def test_busy_timeout_is_the_pools(pool):
+    with pool.connection() as conn:
+        assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == 7500
+    with pool.read_only() as conn:
+        assert conn.execute('PRAGMA busy_timeout').fetchone()[0] == 7500
+        with pytest.raises(sqlite3.OperationalError):
+            conn.execute('CREATE TABLE t (x)')
+
+
+def test_forked_worker_starts_with_an_empty_pool(pool):
+    with pool.connection() as parents:
+        pass
+    assert pool.stats()["idle"] == 1
+
+    pool._pid = -1      # as seen from a process forked after the parent used the pool
+    with pool.connection() as conn:
+        assert conn is not parents
+        assert pool.stats() == {"size": 2, "open": 1, "idle": 0}
+    assert pool._inherited == [parents]
+    assert pool._pid == os.getpid()
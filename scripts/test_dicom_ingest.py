@@ -0,0 +1,131 @@
+"""
+DICOM folder ingestion tests: header reading, merging per study, registration
+
+A small archive of header-only DICOM files (written here with pydicom),
+stray non-DICOM files among them, is ingested through the process pool.
+
+    cd scripts
+    python -m pytest test_dicom_ingest.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import pytest
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, SecondaryCaptureImageStorage, generate_uid
+
+import db
+import dicom_ingest
+import storage
+from migrations import migrate
+
+
+def write_dicom(path, **tags):
+    """A DICOM file with the given tags and no pixel data"""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    for name, value in tags.items():
+        setattr(ds, name, value)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ds.save_as(path, enforce_file_format=True)
+
+
+@pytest.fixture
+def archive():
+    """Three studies in five DICOM files, one of them without a PatientID, and files to skip"""
+    root = tempfile.mkdtemp(prefix='xray-ingest-archive-')
+    chest = dict(PatientID='198002290001', PatientName='Mwakasege^Anna^Joyce', PatientBirthDate='19800229',
+                 PatientSex='F', StudyInstanceUID='1.2.826.0.1.1', StudyDate='20240115', StudyTime='103000.5',
+                 StudyDescription='Chest PA')
+    write_dicom(os.path.join(root, 'A', 'CR', '1.dcm'), Modality='CR', **chest)
+    write_dicom(os.path.join(root, 'A', 'DX', '1.dcm'), Modality='DX', **chest)
+    write_dicom(os.path.join(root, 'B', '1.dcm'), Modality='CT', PatientID='197511110002', PatientName='Kimaro',
+                StudyInstanceUID='1.2.826.0.1.2', StudyDate='20230601')
+    write_dicom(os.path.join(root, 'C', '1.dcm'), Modality='CR', StudyInstanceUID='1.2.826.0.1.3')
+    write_dicom(os.path.join(root, 'D', '1.dcm'), Modality='CR', PatientID='197511110002')   # no StudyInstanceUID
+    with open(os.path.join(root, 'README.txt'), 'w') as f:
+        f.write('Exported from the old PACS\n')
+    open(os.path.join(root, 'B', 'empty'), 'w').close()
+    write_dicom(os.path.join(root, '.trash', '1.dcm'), Modality='CR', PatientID='X', StudyInstanceUID='9.9')
+    return root
+
+
+@pytest.fixture
+def conn():
+    """A migrated temporary database with the hospital and one of the archive's patients"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-ingest-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute("INSERT INTO hospitals (id, name) VALUES ('HOS-IN', 'Ingest Hospital')")
+        conn.execute("INSERT INTO patients (id, national_id, first_name, last_name) "
+                     "VALUES ('PAT-IN-KNOWN', '197511110002', 'Peter', 'Kimaro')")
+        conn.commit()
+        yield conn
+    pool.close_all()
+
+
+def test_header_is_read_without_pixel_data(archive):
+    header = dicom_ingest.read_header(os.path.join(archive, 'A', 'CR', '1.dcm'))
+    assert header == {
+        "study_uid": '1.2.826.0.1.1', "dicom_patient_id": '198002290001', "patient_name": 'Mwakasege^Anna^Joyce',
+        "birth_date": '19800229', "sex": 'F', "study_date": '2024-01-15 10:30:00',
+        "description": 'Chest PA', "modality": 'CR',
+    }
+    assert dicom_ingest.read_header(os.path.join(archive, 'README.txt')) is None
+    assert dicom_ingest.read_header(os.path.join(archive, 'B', 'empty')) is None
+
+
+def test_archive_is_registered_once(archive, conn):
+    stats = dicom_ingest.ingest(archive, 'HOS-IN', workers=1, batch_files=2)
+    assert stats == {"files": 7, "dicom_files": 4, "skipped_files": 3, "studies": 3, "registered": 2,
+                     "already_registered": 0, "patients_created": 1, "without_patient_id": 1,
+                     "patient_id_collisions": 0, "id_collisions": 0}
+
+    patient = conn.execute("SELECT id, first_name, last_name, date_of_birth, gender FROM patients "
+                           "WHERE national_id = '198002290001'").fetchone()
+    assert tuple(patient) == ('PAT-290001', 'Anna Joyce', 'Mwakasege', '1980-02-29', 'F')
+    studies = conn.execute('SELECT study_instance_uid, patient_id, hospital_id, study_date, modality, description '
+                           'FROM studies ORDER BY study_instance_uid').fetchall()
+    assert [tuple(s) for s in studies] == [
+        ('1.2.826.0.1.1', 'PAT-290001', 'HOS-IN', '2024-01-15 10:30:00', 'CR/DX', 'Chest PA'),
+        ('1.2.826.0.1.2', 'PAT-IN-KNOWN', 'HOS-IN', '2023-06-01', 'CT', None),
+    ]
+    # The registry's own patient record is left as it was
+    assert conn.execute("SELECT first_name FROM patients WHERE id = 'PAT-IN-KNOWN'").fetchone()[0] == 'Peter'
+
+    again = dicom_ingest.ingest(archive, 'HOS-IN', workers=1)
+    assert (again["registered"], again["already_registered"], again["patients_created"]) == (0, 2, 0)
+    assert conn.execute('SELECT COUNT(*) FROM studies').fetchone()[0] == 2
+
+
+def test_dry_run_writes_nothing(archive, conn):
+    stats = dicom_ingest.ingest(archive, 'HOS-IN', workers=1, dry_run=True)
+    assert stats["studies"] == 3 and stats["registered"] == 0
+    assert conn.execute('SELECT COUNT(*) FROM studies').fetchone()[0] == 0
+
+
+def test_unknown_hospital_is_refused(archive, conn):
+    with pytest.raises(ValueError, match='Unknown hospital'):
+        dicom_ingest.ingest(archive, 'HOS-NONE', workers=1)
+
+
+def test_study_is_written_once_unseen_for_settle_batches():
+    run = dicom_ingest.Ingest('HOS-IN', chunk_size=1, dry_run=True)
+    study = {"study_uid": '1.2.3', "dicom_patient_id": None, "modalities": {'CR'}}
+    run.add([study], 1, 0)
+    run.add([dict(study, modalities={'PR'})], 1, 0)       # more files of it, a batch later
+    for _ in range(dicom_ingest.SETTLE_BATCHES - 1):
+        run.add([], 0, 0)
+    assert run.stats["studies"] == 0 and run.pending['1.2.3'][0]['modalities'] == {'CR', 'PR'}
+    run.add([], 0, 0)
+    assert run.stats["studies"] == 1 and not run.pending
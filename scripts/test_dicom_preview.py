@@ -0,0 +1,196 @@
+"""
+DICOM preview tests: windowing, thumbnails, the disk cache, the preview routes
+
+Thumbnails are decoded from small DICOM files written here with pydicom,
+in a one-process pool, from a local DICOM_DIR laid out as
+<study_id>/<series>/<file>.
+
+    cd scripts
+    python -m pytest test_dicom_preview.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-preview-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import io
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, SecondaryCaptureImageStorage, generate_uid
+
+import app as app_module
+import db
+import dicom_preview
+import storage
+from migrations import migrate
+
+
+def write_dicom(path, pixels=None, **tags):
+    """A monochrome DICOM file of uint16 pixels (rows x columns, or frames x rows x columns)"""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = SecondaryCaptureImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = 'CR'
+    if pixels is not None:
+        pixels = np.asarray(pixels, dtype=np.uint16)
+        if pixels.ndim == 3:
+            ds.NumberOfFrames = pixels.shape[0]
+        ds.Rows, ds.Columns = pixels.shape[-2:]
+        ds.SamplesPerPixel = 1
+        ds.PhotometricInterpretation = 'MONOCHROME2'
+        ds.BitsAllocated = ds.BitsStored = 16
+        ds.HighBit = 15
+        ds.PixelRepresentation = 0
+        ds.PixelData = pixels.tobytes()
+    for name, value in tags.items():
+        setattr(ds, name, value)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ds.save_as(path, enforce_file_format=True)
+    return path
+
+
+def decoded(data):
+    return Image.open(io.BytesIO(data))
+
+
+@pytest.fixture(autouse=True)
+def one_process():
+    yield
+    dicom_preview.shutdown_pool()
+
+
+def header(**tags):
+    ds = Dataset()
+    for name, value in tags.items():
+        setattr(ds, name, value)
+    return ds
+
+
+def test_window_applies_rescale_and_voi_then_inverts_monochrome1():
+    pixels = np.array([[0, 50, 100]], dtype=np.uint16)
+    # Stored 0..100 -> 0..200 (slope 2), shown through the 0..200 window
+    ds = header(RescaleSlope=2, RescaleIntercept=0, WindowCenter=100, WindowWidth=200)
+    assert dicom_preview.window(ds, pixels).tolist() == [[0, 127, 255]]
+    ds.PhotometricInterpretation = 'MONOCHROME1'
+    assert dicom_preview.window(ds, pixels).tolist() == [[255, 127, 0]]
+    # Without a window the 1st-99th percentile range is stretched over 0..255
+    assert dicom_preview.window(header(), np.arange(101, dtype=np.uint16).reshape(1, -1))[0, [0, 50, 100]].tolist() \
+        == [0, 127, 255]
+
+
+def test_thumbnail_fits_the_size_and_shows_the_middle_frame(tmp_path):
+    wide = write_dicom(str(tmp_path / 'wide.dcm'), np.full((512, 1024), 700), WindowCenter=500, WindowWidth=1000)
+    image = decoded(dicom_preview.render(wide, 64, 'jpeg'))
+    assert image.format == 'JPEG' and image.size == (64, 32)
+
+    frames = np.stack([np.full((40, 40), value) for value in (0, 500, 1000)])
+    multi = write_dicom(str(tmp_path / 'multi.dcm'), frames, WindowCenter=500, WindowWidth=1000)
+    with open(multi, 'rb') as f:
+        image = decoded(dicom_preview.render(f.read(), 32, 'webp'))
+    assert image.format == 'WEBP' and abs(np.asarray(image.convert('L')).mean() - 127) < 3
+
+
+def test_file_without_pixel_data_is_a_preview_error(tmp_path):
+    with pytest.raises(dicom_preview.PreviewError, match='Cannot decode'):
+        dicom_preview.render(write_dicom(str(tmp_path / 'sr.dcm')), 64, 'jpeg')
+
+
+def test_representative_is_the_middle_of_the_first_series():
+    instances = [('2', 1, 'b1'), ('1', 3, 'a3'), ('1', 1, 'a1'), ('1', 2, 'a2'), ('1', 4, 'a4')]
+    assert dicom_preview.representative(instances) == 'a3'
+
+
+def test_cache_evicts_least_recently_read_down_to_90_percent(tmp_path):
+    cache = dicom_preview.PreviewCache(str(tmp_path), max_bytes=100)
+    for n, key in enumerate(('aa-old', 'bb-read', 'cc-new')):
+        cache.set(key, b'x' * 40)
+        os.utime(cache._path(key), (time.time() - 100 + n, time.time() - 100 + n))
+        if key == 'bb-read':
+            assert cache.get('aa-old') == b'x' * 40        # reading refreshes it past bb-read
+    # The third file takes it to 120 bytes: the least recently used go until <= 90
+    assert cache.get('bb-read') is None
+    assert cache.get('aa-old') == cache.get('cc-new') == b'x' * 40
+    assert cache.stats()["bytes"] == 80
+
+
+@pytest.fixture
+def study_dir(monkeypatch):
+    """A study with two series on disk, one without images, and a previewer reading them"""
+    dicom_dir = tempfile.mkdtemp(prefix='xray-preview-dicom-')
+    for series, count in (('1', 3), ('2', 1)):
+        for n in range(count):
+            write_dicom(os.path.join(dicom_dir, 'STU-PV-1', series, f'{n}.dcm'),
+                        np.full((64, 64), 100 * n), InstanceNumber=n + 1)
+    write_dicom(os.path.join(dicom_dir, 'STU-PV-SR', '1', 'report.dcm'))
+    previewer = dicom_preview.Previewer(get_client=None, dicom_dir=dicom_dir,
+                                        cache_dir=tempfile.mkdtemp(prefix='xray-preview-cache-'), workers=1)
+    monkeypatch.setattr(app_module, 'dicom_previews', previewer)
+    return previewer
+
+
+def test_local_study_is_rendered_once_then_served_from_the_cache(study_dir):
+    source = study_dir.source('STU-PV-1', None)
+    assert study_dir.instances(source) == ['1/0.dcm', '1/1.dcm', '1/2.dcm', '2/0.dcm']
+    first = study_dir.thumbnail(source, None, 64, 'jpeg')
+    assert study_dir.thumbnail(source, None, 64, 'jpeg') == first
+    assert study_dir.renders == 1 and study_dir.cache.hits == 1
+    with pytest.raises(dicom_preview.PreviewNotFound):
+        study_dir.thumbnail(source, '../STU-PV-SR/1/report.dcm', 64, 'jpeg')
+    with pytest.raises(dicom_preview.PreviewNotFound):
+        study_dir.source('..', None)
+
+
+@pytest.fixture
+def client(study_dir):
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-preview-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.executemany('INSERT INTO studies (id, patient_id, hospital_id) VALUES (?, ?, ?)',
+                         [('STU-PV-1', 'PAT-PV-1', 'HOS-PV'), ('STU-PV-SR', 'PAT-PV-1', 'HOS-PV'),
+                          ('STU-PV-EMPTY', 'PAT-PV-1', 'HOS-PV')])
+        conn.commit()
+    yield app_module.app.test_client()
+    pool.close_all()
+
+
+def test_preview_routes_tag_and_revalidate(client, study_dir):
+    listed = client.get('/api/studies/STU-PV-1/instances').get_json()['instances']
+    assert listed[1] == {"id": '1/1.dcm', "preview_url": '/api/studies/STU-PV-1/instances/1/1.dcm/preview'}
+
+    response = client.get('/api/studies/STU-PV-1/preview?size=48&format=webp')
+    assert response.status_code == 200 and response.mimetype == 'image/webp'
+    assert decoded(response.get_data()).size == (48, 48)
+    tag, _ = response.get_etag()
+    revalidated = client.get('/api/studies/STU-PV-1/preview?size=48&format=webp',
+                             headers={'If-None-Match': f'"{tag}"'})
+    assert revalidated.status_code == 304 and study_dir.renders == 1
+
+    response = client.get(listed[3]['preview_url'] + '?size=32')
+    assert response.status_code == 200 and response.get_etag()[0] != tag
+
+
+@pytest.mark.parametrize('url, status', [
+    ('/api/studies/STU-PV-1/preview?size=8', 400),
+    ('/api/studies/STU-PV-1/preview?format=gif', 400),
+    ('/api/studies/STU-PV-NONE/preview', 404),
+    ('/api/studies/STU-PV-EMPTY/preview', 404),
+    ('/api/studies/STU-PV-1/instances/9/9.dcm/preview', 404),
+    ('/api/studies/STU-PV-SR/preview', 422),
+])
+def test_preview_errors(client, url, status):
+    assert client.get(url).status_code == status
@@ -0,0 +1,107 @@
+"""
+Study export tests: what the CSV stream holds, export slots, optional pyarrow
+
+    cd scripts
+    python -m pytest test_export.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-export-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import csv
+import gzip
+import io
+
+import pytest
+
+import db
+import export
+import storage
+from app import app
+from migrations import migrate
+
+
+@pytest.fixture
+def client():
+    """A migrated temporary database with two studies, and one export slot"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-export-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute("INSERT INTO hospitals (id, name) VALUES ('HOS-EXP', 'Export Hospital')")
+        conn.execute("INSERT INTO patients (id, national_id, first_name, last_name, date_of_birth) "
+                     "VALUES ('PAT-EXP-1', 'NID-EXP-1', 'Halima', 'Shirima', '1980-02-03')")
+        conn.executemany(
+            'INSERT INTO studies (id, patient_id, hospital_id, study_date, modality, description, rowid) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)', [
+                ('STU-EXP-1', 'PAT-EXP-1', 'HOS-EXP', '2024-03-01 09:00:00', 'CT', 'CT Head, "contrast"', 1),
+                ('STU-EXP-2', 'PAT-EXP-1', 'HOS-EXP', '2024-05-01 09:00:00', 'XR', 'Chest X-Ray', 2),
+            ])
+        conn.commit()
+    export.configure(1)
+    yield app.test_client()
+    export.configure(app.config.get('EXPORT_MAX_CONCURRENT'))
+    pool.close_all()
+
+
+def csv_rows(response):
+    return list(csv.reader(io.StringIO(gzip.decompress(response.get_data()).decode('utf-8'))))
+
+
+def test_csv_export_streams_studies_with_patient_and_hospital(client):
+    response = client.get('/api/export/studies')
+    assert response.status_code == 200
+    assert response.mimetype == 'application/gzip'
+    assert response.headers['Content-Disposition'].endswith('.csv.gz"')
+    rows = csv_rows(response)
+    assert rows[0] == [name for name, _ in export.COLUMNS]
+    assert sorted(rows[1:]) == [
+        ['STU-EXP-1', '2024-03-01 09:00:00', 'CT', 'CT Head, "contrast"', '', 'PAT-EXP-1', 'NID-EXP-1',
+         'Halima', 'Shirima', '1980-02-03', '', 'HOS-EXP', 'Export Hospital'],
+        ['STU-EXP-2', '2024-05-01 09:00:00', 'XR', 'Chest X-Ray', '', 'PAT-EXP-1', 'NID-EXP-1',
+         'Halima', 'Shirima', '1980-02-03', '', 'HOS-EXP', 'Export Hospital'],
+    ]
+
+
+def test_csv_export_filters_and_chunks(client, monkeypatch):
+    monkeypatch.setitem(app.config, 'EXPORT_CHUNK_ROWS', 1)
+    rows = csv_rows(client.get('/api/export/studies?from=2024-03-01&to=2024-03-01&modality=CT,MR'))
+    assert [row[0] for row in rows[1:]] == ['STU-EXP-1']
+    assert client.get('/api/export/studies?from=March').status_code == 400
+    assert client.get('/api/export/studies?format=xlsx').status_code == 400
+
+
+def test_export_beyond_the_slots_is_refused(client):
+    with client.get('/api/export/studies') as streaming:    # holds the slot until closed
+        assert streaming.status_code == 200
+        refused = client.get('/api/export/studies')
+        assert refused.status_code == 429
+        assert refused.headers['Retry-After'] == '30'
+    assert client.get('/api/export/studies').status_code == 200
+
+
+def test_arrow_formats_without_pyarrow(client, monkeypatch):
+    monkeypatch.setattr(export, 'pa', None)
+    with pytest.raises(LookupError):
+        export.check_format('parquet')
+    export.check_format('csv')
+    for fmt in ('arrow', 'parquet'):
+        response = client.get(f'/api/export/studies?format={fmt}')
+        assert response.status_code == 501
+        assert 'pyarrow' in response.get_json()['error']
+    # A refused format doesn't take the slot
+    assert client.get('/api/export/studies').status_code == 200
+
+
+def test_parquet_export_reads_back(client):
+    pq = pytest.importorskip('pyarrow.parquet')
+    response = client.get('/api/export/studies?format=parquet&modality=XR')
+    table = pq.read_table(io.BytesIO(response.get_data()))
+    assert table.column_names == [name for name, _ in export.COLUMNS]
+    assert table.column('study_id').to_pylist() == ['STU-EXP-2']
@@ -0,0 +1,190 @@
+"""
+Federation result cache tests: writes made outside this process
+
+Another gunicorn worker, job_worker.py, orthanc_sync.py or dicom_ingest.py
+write through their own SQLite connections and can't call invalidate() on
+this process's cache; a plain sqlite3 connection stands in for them here.
+What the cache relies on instead is the patient_changes log the triggers
+keep, which evicts the patients written and no others. The change counters
+behind the listings' ETags are covered as well: batch writers bump them
+once per transaction.
+
+    cd scripts
+    python -m pytest test_federation_cache.py
+"""
+import sys
+import os
+import sqlite3
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-cache-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import pytest
+
+import app as app_module
+import bulk
+import db
+import storage
+from app import app
+from federation_cache import FederationCache
+from migrations import migrate
+
+
+@pytest.fixture
+def database(monkeypatch):
+    """A migrated temporary database with two patients who have one study each
+
+    The cache reads the change log on every query, unless a test says otherwise.
+    """
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-cache-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute("INSERT INTO hospitals (id, name) VALUES ('HOS-FC', 'Cache Hospital')")
+        conn.execute("INSERT INTO patients (id, national_id, first_name, last_name) "
+                     "VALUES ('PAT-FC-1', 'NID-FC-1', 'Neema', 'Kweka'), ('PAT-FC-2', 'NID-FC-2', 'Juma', 'Mollel')")
+        conn.execute("INSERT INTO studies (id, patient_id, hospital_id, study_date) "
+                     "VALUES ('STU-FC-1', 'PAT-FC-1', 'HOS-FC', '2024-01-15 10:30:00'), "
+                     "('STU-FC-9', 'PAT-FC-2', 'HOS-FC', '2024-01-20 10:30:00')")
+        conn.commit()
+    monkeypatch.setattr(app_module, 'federation_cache', FederationCache(sync_interval=0))
+    yield path
+    pool.close_all()
+
+
+def write_elsewhere(path, sql, params=()):
+    """A write through a connection this process's cache knows nothing about"""
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute(sql, params)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def add_study(path, study_id, patient_id):
+    write_elsewhere(path, "INSERT INTO studies (id, patient_id, hospital_id, study_date) "
+                          "VALUES (?, ?, 'HOS-FC', '2024-02-15 10:30:00')", (study_id, patient_id))
+
+
+def test_result_computed_across_an_eviction_is_not_cached():
+    cache = FederationCache()
+    token = cache.token()
+    cache.invalidate(patient_id='PAT-X')
+    cache.set('x', {"total_studies": 1}, {('patient_id', 'PAT-X')}, token)
+    cache.set('y', {"total_studies": 2}, {('patient_id', 'PAT-Y')}, token)
+    assert cache.get('x') is None
+    assert cache.get('y') == {"total_studies": 2}
+
+
+def test_write_from_another_process_is_seen(database):
+    client = app.test_client()
+    url = '/api/federation/query?patient_id=PAT-FC-1'
+    first = client.get(url)
+    assert first.get_json()['total_studies'] == 1
+    assert client.get(url).get_json()['total_studies'] == 1     # now served from the cache
+
+    add_study(database, 'STU-FC-2', 'PAT-FC-1')
+
+    second = client.get(url)
+    assert second.get_json()['total_studies'] == 2
+    assert second.headers['ETag'] != first.headers['ETag']
+    # The new tag revalidates; the old one gets the new body
+    assert client.get(url, headers={'If-None-Match': second.headers['ETag']}).status_code == 304
+    refreshed = client.get(url, headers={'If-None-Match': first.headers['ETag']})
+    assert refreshed.status_code == 200
+    assert refreshed.get_json()['total_studies'] == 2
+
+
+def test_write_for_another_patient_keeps_the_entry(database):
+    client = app.test_client()
+    url = '/api/federation/query?patient_id=PAT-FC-1'
+    tag = client.get(url).headers['ETag']
+
+    add_study(database, 'STU-FC-10', 'PAT-FC-2')
+    write_elsewhere(database, "UPDATE patients SET phone = '0700' WHERE id = 'PAT-FC-2'")
+
+    assert client.get(url, headers={'If-None-Match': tag}).status_code == 304
+    stats = app_module.federation_cache.stats()
+    assert (stats['hits'], stats['misses']) == (1, 1)
+    assert client.get('/api/federation/query?patient_id=PAT-FC-2').get_json()['total_studies'] == 2
+
+
+def test_patient_update_from_another_process_is_seen(database):
+    client = app.test_client()
+    url = '/api/federation/query?national_id=NID-FC-1'
+    assert client.get(url).get_json()['patient']['name'] == 'Neema Kweka'
+
+    write_elsewhere(database, "UPDATE patients SET last_name = 'Massawe' WHERE id = 'PAT-FC-1'")
+
+    assert client.get(url).get_json()['patient']['name'] == 'Neema Massawe'
+
+
+def test_log_pruned_past_what_was_read_clears_the_cache(database):
+    client = app.test_client()
+    client.get('/api/federation/query?patient_id=PAT-FC-1')
+    # Entries this process never read, as if the prune trigger had removed them
+    write_elsewhere(database, "INSERT INTO patient_changes (seq, patient_id) "
+                              "SELECT MAX(seq) + 5, 'PAT-ELSEWHERE' FROM patient_changes")
+
+    client.get('/api/federation/query?patient_id=PAT-FC-1')
+
+    assert app_module.federation_cache.stats()['hits'] == 0
+
+
+def test_hit_between_syncs_reads_no_database(database, monkeypatch):
+    app_module.federation_cache.sync_interval = 60
+    client = app.test_client()
+    url = '/api/federation/query?patient_id=PAT-FC-1'
+    expected = client.get(url).get_json()
+
+    def no_database(*args, **kwargs):
+        raise AssertionError("a cache hit read the database")
+
+    monkeypatch.setattr(db.ConnectionPool, 'acquire', no_database)
+    monkeypatch.setattr(db, 'get_db', no_database)
+    assert client.get(url).get_json() == expected
+
+
+def versions(conn):
+    return dict(conn.execute('SELECT name, version FROM table_versions').fetchall())
+
+
+def test_bulk_writes_bump_each_counter_once_per_transaction(database):
+    rows = [{"national_id": f"NID-FC-B{i}", "first_name": "Bulk", "last_name": str(i)} for i in range(50)]
+    with db.connection() as conn:
+        before = versions(conn)
+        result = bulk.upsert_patients(conn, rows + [{"national_id": "NID-FC-X", "first_name": {"x": 1}}],
+                                      chunk_size=20)
+        assert result.written == 50 and len(result.failures) == 1
+        # Three chunks, one bump each (the bad row is reported, not written)
+        assert versions(conn)['patients'] == before['patients'] + 3
+        assert conn.execute('SELECT SUM(batched) FROM table_versions').fetchone()[0] == 0
+        # Single writes still bump through the triggers
+        conn.execute("UPDATE patients SET last_name = 'Once' WHERE id = 'PAT-FC-1'")
+        conn.commit()
+        assert versions(conn)['patients'] == before['patients'] + 4
+
+
+def test_study_in_a_shard_this_process_has_not_seen_is_seen(database):
+    storage.configure(shard_dir=os.path.join(os.path.dirname(database), 'shards'))
+    client = app.test_client()
+    url = '/api/federation/query?patient_id=PAT-FC-3'
+    write_elsewhere(database, "INSERT INTO patients (id, national_id, first_name, last_name) "
+                              "VALUES ('PAT-FC-3', 'NID-FC-3', 'Halima', 'Said')")
+    try:
+        assert client.get(url).get_json()['total_studies'] == 0
+        for study_id in ('STU-FC-S1', 'STU-FC-S2'):
+            # Not through the app, which would invalidate the entry itself
+            storage.record_patients('HOS-FC', ['PAT-FC-3'])
+            with storage.connection('HOS-FC') as conn:
+                conn.execute("INSERT INTO studies (id, patient_id, hospital_id, study_date) "
+                             "VALUES (?, 'PAT-FC-3', 'HOS-FC', '2024-03-01 08:00:00')", (study_id,))
+                conn.commit()
+            assert client.get(url).get_json()['total_studies'] == int(study_id[-1])
+    finally:
+        storage.configure()
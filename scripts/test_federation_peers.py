@@ -0,0 +1,232 @@
+"""
+Federation peer fan-out tests against mock peer nodes
+
+Each mock is a small HTTP server answering /api/federation/query from
+memory, and can be told to answer slowly, with an HTTP error, or with a
+malformed result. It keeps the headers of the last request it was sent.
+
+    cd scripts
+    python -m pytest test_federation_peers.py
+"""
+import sys
+import os
+import json
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-peers-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import pytest
+
+import app as app_module
+import db
+import federation_peers
+import storage
+from migrations import migrate
+
+
+class MockPeer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, studies=()):
+        super().__init__(('127.0.0.1', 0), MockPeerHandler)
+        self.body = {"patient": {"id": "PAT-PEER-1", "name": "Zawadi Mushi", "national_id": "NID-PEER-1"},
+                     "studies": list(studies)}
+        self.delay = 0
+        self.status = 200
+        self.requests = 0
+        self.headers = {}
+        self.url = f'http://127.0.0.1:{self.server_address[1]}'
+        threading.Thread(target=self.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True).start()
+
+
+class MockPeerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        peer = self.server
+        peer.requests += 1
+        peer.headers = dict(self.headers)
+        time.sleep(peer.delay)
+        body = json.dumps(peer.body).encode()
+        self.send_response(peer.status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def study(study_id, hospital_id='HOS-PEER', study_date='2024-01-15 10:30:00', **fields):
+    return dict(fields, study_id=study_id, hospital_id=hospital_id, study_date=study_date)
+
+
+@pytest.fixture
+def peers():
+    """Start mock peers by name; all are shut down after the test"""
+    started, registries = {}, []
+
+    def start(**bodies):
+        for name, studies in bodies.items():
+            started[name] = MockPeer(studies)
+        return started
+
+    def registry(keys=None, **settings):
+        keys = keys or {}
+        reg = federation_peers.PeerRegistry({name: {"url": peer.url, "api_key": keys.get(name)}
+                                             for name, peer in started.items()}, **settings)
+        registries.append(reg)
+        return reg
+
+    start.registry = registry
+    yield start
+    for reg in registries:
+        reg.close()
+    for peer in started.values():
+        peer.shutdown()
+        peer.server_close()
+
+
+def by_name(statuses):
+    return {status['name']: status for status in statuses}
+
+
+def test_slow_peer_costs_only_the_deadline(peers):
+    started = peers(fast=[study('STU-FAST')], slow=[study('STU-SLOW')])
+    started['slow'].delay = 2.0
+    registry = peers.registry(deadline=0.3)
+
+    begin = time.monotonic()
+    results, statuses = registry.query('NID-PEER-1', None)
+    elapsed = time.monotonic() - begin
+
+    assert elapsed < 1.0
+    assert list(results) == ['fast']
+    assert by_name(statuses)['fast']['status'] == 'ok'
+    assert by_name(statuses)['slow']['status'] == 'timeout'
+
+
+def test_breaker_opens_then_lets_one_trial_through(peers):
+    started = peers(flaky=[study('STU-FLAKY')])
+    started['flaky'].status = 500
+    registry = peers.registry(breaker_failures=2, breaker_reset=0.3)
+    breaker = registry.peers['flaky'].breaker
+
+    for _ in range(2):
+        assert by_name(registry.query('NID-PEER-1', None)[1])['flaky']['status'] == 'error'
+    assert breaker.state == 'open'
+    assert by_name(registry.query('NID-PEER-1', None)[1])['flaky']['status'] == 'circuit_open'
+    assert started['flaky'].requests == 2       # skipped while open
+
+    time.sleep(0.35)
+    assert breaker.state == 'half-open'
+    started['flaky'].status = 200
+    results, statuses = registry.query('NID-PEER-1', None)
+    assert by_name(statuses)['flaky']['status'] == 'ok'
+    assert breaker.state == 'closed'
+    assert started['flaky'].requests == 3
+
+
+def test_failed_trial_reopens_the_breaker(peers):
+    started = peers(down=[])
+    started['down'].status = 503
+    registry = peers.registry(breaker_failures=1, breaker_reset=0.2)
+    registry.query('NID-PEER-1', None)
+    time.sleep(0.25)
+    assert registry.peers['down'].breaker.state == 'half-open'
+    assert by_name(registry.query('NID-PEER-1', None)[1])['down']['status'] == 'error'
+    assert registry.peers['down'].breaker.state == 'open'
+
+
+def test_api_key_is_sent_in_the_rate_limit_header(peers):
+    started = peers(own=[], shared=[], anonymous=[])
+    registry = peers.registry(keys={"own": 'key-for-own'}, api_key='node-key', key_header='X-Node-Key')
+    registry.query('NID-PEER-1', None)
+    assert started['own'].headers['X-Node-Key'] == 'key-for-own'
+    assert started['shared'].headers['X-Node-Key'] == 'node-key'
+
+    registry = peers.registry()
+    registry.query('NID-PEER-1', None)
+    assert 'X-API-Key' not in started['anonymous'].headers
+
+
+def test_rate_limited_peer_does_not_trip_the_breaker(peers):
+    started = peers(busy=[study('STU-BUSY')])
+    started['busy'].status = 429
+    registry = peers.registry(breaker_failures=1)
+
+    for _ in range(3):
+        assert by_name(registry.query('NID-PEER-1', None)[1])['busy']['status'] == 'rate_limited'
+    assert registry.peers['busy'].breaker.state == 'closed'
+    assert started['busy'].requests == 3
+
+
+def test_parse_peers_reads_the_api_key():
+    peers = federation_peers.parse_peers('{"a": {"Url": "http://a:5000/", "ApiKey": "k"}, "b": "http://b"}')
+    assert peers['a'] == {"url": 'http://a:5000', "username": None, "password": None, "api_key": 'k'}
+    assert peers['b']['api_key'] is None
+
+
+@pytest.mark.parametrize('bad_study', [
+    {"study_id": "STU-NO-HOSPITAL", "study_date": "2024-01-15"},
+    "not a study",
+    study('STU-DICT-DATE', study_date={"year": 2024}),
+])
+def test_malformed_study_fails_only_its_peer(peers, bad_study):
+    peers(good=[study('STU-GOOD')], bad=[study('STU-FINE'), bad_study])
+    registry = peers.registry()
+
+    results, statuses = registry.query('NID-PEER-1', None)
+
+    assert by_name(statuses)['good']['status'] == 'ok'
+    assert by_name(statuses)['bad']['status'] == 'error'
+    assert list(results) == ['good']
+
+
+def test_numeric_fields_are_normalized_before_merging(peers):
+    peers(numbers=[study(1042, study_date=20240115), study('STU-TEXT', study_date='2023-06-01')])
+    results, _ = peers.registry().query('NID-PEER-1', None)
+    local = {"patient": {"id": None, "name": None, "national_id": None}, "studies": []}
+
+    merged = federation_peers.merge(local, results)
+
+    assert [(s['study_id'], s['study_date']) for s in merged['studies']] == [
+        ('STU-TEXT', '2023-06-01'), ('1042', '20240115')]
+    assert merged['patient']['id'] == 'PAT-PEER-1'
+
+
+@pytest.fixture
+def database():
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-peers-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute("INSERT INTO hospitals (id, name) VALUES ('HOS-LOCAL', 'Local Hospital')")
+        conn.execute("INSERT INTO patients (id, national_id, first_name, last_name) "
+                     "VALUES ('PAT-PEER-1', 'NID-PEER-1', 'Zawadi', 'Mushi')")
+        conn.execute("INSERT INTO studies (id, patient_id, hospital_id, study_date) "
+                     "VALUES ('STU-LOCAL', 'PAT-PEER-1', 'HOS-LOCAL', '2024-03-01 09:00:00')")
+        conn.commit()
+    yield pool
+    pool.close_all()
+
+
+def test_federation_query_reports_malformed_peer_as_partial(peers, database, monkeypatch):
+    peers(good=[study('STU-GOOD')], bad=[{"study_id": "STU-NO-HOSPITAL"}])
+    monkeypatch.setattr(app_module, 'peer_registry', peers.registry())
+
+    response = app_module.app.test_client().get('/api/federation/query?national_id=NID-PEER-1')
+
+    assert response.status_code == 200
+    result = response.get_json()
+    assert result['partial'] is True
+    assert by_name(result['peers'])['bad']['status'] == 'error'
+    assert [s['study_id'] for s in result['studies']] == ['STU-GOOD', 'STU-LOCAL']
@@ -0,0 +1,109 @@
+"""
+Background job queue tests: claiming, reaping and cancelling
+
+Each test gets a migrated temporary database and its own JobRunner.
+Runners built with workers=0 start no threads, so a test can claim and
+maintain by hand exactly as a worker thread would.
+
+    cd scripts
+    python -m pytest test_jobs.py
+"""
+import sys
+import os
+import subprocess
+import tempfile
+import threading
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+
+import pytest
+
+import db
+import jobs
+from migrations import migrate
+
+
+@pytest.fixture
+def pool():
+    """A migrated temporary database"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-jobs-'), 'federation.db')
+    pool = db.configure(database=path)
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+    yield pool
+    pool.close_all()
+
+
+def new_runner(workers=0, **settings):
+    runner = jobs.JobRunner(workers=workers, job_dir=tempfile.mkdtemp(prefix='xray-jobs-files-'), **settings)
+    runner.handler('echo')(lambda job, params: params)
+    return runner
+
+
+def test_two_workers_claim_one_job_once(pool):
+    runners = [new_runner(), new_runner()]
+    job_id = runners[0].submit('echo', {"n": 1})
+    start = threading.Barrier(2)
+    claimed = []
+
+    def claim(runner):
+        start.wait()
+        claimed.append(runner._claim())
+
+    threads = [threading.Thread(target=claim, args=(runner,)) for runner in runners]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed, key=bool) == [None, (job_id, 'echo', {"n": 1})]
+    job = runners[1].get(job_id)
+    assert job['status'] == 'running' and job['started_date']
+
+
+def test_jobs_of_a_dead_worker_are_failed(pool):
+    runner = new_runner()
+    exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+    exited.wait()
+    orphan, alive = runner.submit('echo'), runner.submit('echo')
+    with db.connection() as conn, db.transaction(conn):
+        conn.execute("UPDATE jobs SET status = 'running', worker = ? WHERE id = ?", (str(exited.pid), orphan))
+        conn.execute("UPDATE jobs SET status = 'running', worker = ? WHERE id = ?", (str(os.getpid()), alive))
+
+    assert runner._claim() is None      # maintenance runs first, then finds nothing queued
+    assert runner.get(orphan)['status'] == 'failed'
+    assert runner.get(orphan)['error'] == 'Interrupted: worker process exited'
+    assert runner.get(alive)['status'] == 'running'
+
+
+def test_cancelled_queued_job_is_never_run(pool):
+    runner = new_runner()
+    job_id = runner.submit('echo')
+    job = runner.cancel(job_id)
+    assert job['status'] == 'cancelled' and job['cancel_requested'] and job['finished_date']
+    assert runner._claim() is None
+    assert runner.cancel('JOB-NONE') is None
+
+
+def test_running_job_stops_at_its_next_check(pool, monkeypatch):
+    monkeypatch.setattr(jobs, 'PROGRESS_INTERVAL', 0)
+    runner = new_runner(workers=1, poll_interval=0.05)
+    started = threading.Event()
+
+    @runner.handler('loop')
+    def loop(job, params):
+        started.set()
+        while True:
+            job.check_cancelled()
+            time.sleep(0.01)
+
+    job_id = runner.submit('loop')
+    try:
+        assert started.wait(5)
+        assert runner.cancel(job_id)['cancel_requested']
+        deadline = time.monotonic() + 5
+        while runner.get(job_id)['status'] == 'running' and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert runner.get(job_id)['status'] == 'cancelled'
+    finally:
+        runner.stop(timeout=5)
@@ -0,0 +1,144 @@
+"""
+Metrics and health check tests: exposition format, worker merging, request timing, /api/status
+
+Every gunicorn worker counts its own requests and publishes snapshots to
+METRICS_DIR; a scrape of any of them sums all, and an exited worker's
+counters are kept so totals never go backwards.
+
+    cd scripts
+    python -m pytest test_metrics.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-metrics-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import json
+
+import pytest
+
+import app as app_module
+import db
+import metrics
+import orthanc
+import storage
+from migrations import migrate, LATEST_VERSION
+
+
+def samples(text):
+    """{'name{labels}': value} from the exposition text"""
+    return {line.rsplit(' ', 1)[0]: float(line.rsplit(' ', 1)[1])
+            for line in text.splitlines() if line and not line.startswith('#')}
+
+
+def test_histograms_are_exposed_as_cumulative_buckets():
+    registry = metrics.Registry()
+    latency = registry.histogram('xray_test_seconds', 'Test latency', (0.1, 1.0), ('route',))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        latency.observe(value, '/api/x')
+    registry.counter('xray_test_total', 'Test count', ('path',)).inc('say "hi"\n')
+
+    text = registry.render()
+    assert '# TYPE xray_test_seconds histogram' in text
+    assert samples(text) == {
+        'xray_test_seconds_bucket{route="/api/x",le="0.1"}': 1,
+        'xray_test_seconds_bucket{route="/api/x",le="1.0"}': 3,
+        'xray_test_seconds_bucket{route="/api/x",le="+Inf"}': 4,
+        'xray_test_seconds_sum{route="/api/x"}': 4.25,
+        'xray_test_seconds_count{route="/api/x"}': 4,
+        'xray_test_total{path="say \\"hi\\"\\n"}': 1,
+    }
+
+
+def test_workers_are_summed_and_exited_ones_keep_their_counters():
+    metrics_dir = tempfile.mkdtemp(prefix='xray-metrics-')
+    registry = metrics.Registry()
+    registry.metrics_dir = metrics_dir
+    requests = registry.counter('xray_test_requests_total', 'Requests', ('route',))
+    in_flight = registry.gauge('xray_test_in_flight', 'In flight')
+    requests.inc('/a', amount=2)
+    in_flight.set(1)
+
+    # A worker that has since exited (no such pid) left a snapshot behind
+    exited = metrics.Registry()
+    exited.counter('xray_test_requests_total', 'Requests', ('route',)).inc('/a', amount=5)
+    exited.gauge('xray_test_in_flight', 'In flight').set(3)
+    with open(os.path.join(metrics_dir, '999999999.json'), 'w') as f:
+        json.dump(exited.snapshot(), f)
+
+    assert samples(registry.render()) == {'xray_test_requests_total{route="/a"}': 7, 'xray_test_in_flight': 1}
+    assert not os.path.exists(os.path.join(metrics_dir, '999999999.json'))
+    requests.inc('/a')
+    assert samples(registry.render())['xray_test_requests_total{route="/a"}'] == 8
+
+
+@pytest.fixture
+def client(monkeypatch):
+    """A migrated temporary database, and an Orthanc that is never reached"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-metrics-db-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute("INSERT INTO patients (id, national_id, first_name, last_name) "
+                     "VALUES ('PAT-MT-1', 'NID-MT-1', 'Halima', 'Juma')")
+        conn.commit()
+    monkeypatch.setattr(app_module, '_orthanc_probe', (0.0, None))
+    monkeypatch.setattr(orthanc, 'get_client', lambda config: Unreachable())
+    yield app_module.app.test_client()
+    pool.close_all()
+
+
+class Unreachable:
+    def probe(self, timeout=2.0):
+        raise orthanc.OrthancError('Orthanc unreachable: connection refused')
+
+
+def get(client, url):
+    """Status of a request, counted: the middleware records it when the server closes the body"""
+    with client.get(url) as response:
+        return response.status_code
+
+
+def scrape(client):
+    response = client.get('/metrics')
+    assert response.status_code == 200 and response.mimetype == 'text/plain'
+    return samples(response.get_data(as_text=True))
+
+
+def test_requests_are_counted_by_url_rule_and_status(client):
+    key = 'xray_http_requests_total{method="GET",route="/api/patients/<patient_id>",status="%s"}'
+    before = scrape(client)
+    assert get(client, '/api/patients/PAT-MT-1') == 200
+    assert get(client, '/api/patients/PAT-MT-1') == 200
+    assert get(client, '/api/patients/PAT-NONE') == 404
+    assert get(client, '/no/such/route') == 404
+
+    after = scrape(client)
+    assert after[key % 200] - before.get(key % 200, 0) == 2
+    assert after[key % 404] - before.get(key % 404, 0) == 1
+    assert after['xray_http_requests_total{method="GET",route="<unmatched>",status="404"}'] >= 1
+    assert after['xray_sql_statement_duration_seconds_count{statement="SELECT"}'] > \
+        before.get('xray_sql_statement_duration_seconds_count{statement="SELECT"}', 0)
+    assert after['xray_db_pool_connections{state="open"}'] >= 1
+
+
+def test_status_is_degraded_without_orthanc(client):
+    response = client.get('/api/status')
+    body = response.get_json()
+    assert response.status_code == 200 and body['status'] == 'degraded'
+    assert body['checks']['database']['status'] == 'ok'
+    assert body['checks']['database']['schema_version'] == LATEST_VERSION
+    assert body['checks']['orthanc']['status'] == 'unreachable'
+
+
+def test_status_is_down_while_migrations_are_pending(client):
+    with db.connection() as conn:
+        conn.execute(f'PRAGMA user_version = {LATEST_VERSION - 1}')
+    response = client.get('/api/status')
+    assert response.status_code == 503 and response.get_json()['status'] == 'down'
+    assert response.get_json()['checks']['database']['status'] == 'migrations_pending'
@@ -0,0 +1,316 @@
+"""
+Orthanc client and change-feed sync tests against a fake Orthanc HTTP server
+
+The fake serves the few REST resources the backend uses (/system,
+/studies/{id}[/statistics|/series], /changes) from memory, and can be told
+to answer a path slowly or with a number of 503s first.
+
+    cd scripts
+    python -m pytest test_orthanc_client.py
+"""
+import sys
+import os
+import json
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-orthanc-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import pytest
+
+import db
+import orthanc
+import storage
+from app import app
+from migrations import migrate
+from orthanc_sync import OrthancSynchronizer
+
+
+class FakeOrthanc(ThreadingHTTPServer):
+    daemon_threads = True
+    # Tests open many connections at once; the default backlog of 5 drops some (connect timeouts)
+    request_queue_size = 64
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeOrthancHandler)
+        self.studies = {}       # orthanc id -> (study, statistics, series)
+        self.changes = []       # [{"Seq", "ChangeType", "ID"}]
+        self.delays = {}        # path -> seconds before answering
+        self.failures = {}      # path -> 503s still to return
+        self.requests = []      # (path, query) in arrival order
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def add_study(self, orthanc_id, patient_id, date='20240115', description='Chest X-Ray', modality='CR'):
+        study = {"ID": orthanc_id, "LastUpdate": "20240115T103000", "Series": [orthanc_id + '-s1'],
+                 "MainDicomTags": {"StudyInstanceUID": f"1.2.3.{len(self.studies) + 1}", "StudyDate": date,
+                                   "StudyTime": "103000", "StudyDescription": description},
+                 "PatientMainDicomTags": {"PatientID": patient_id}}
+        statistics = {"CountSeries": 1, "CountInstances": 2, "DiskSize": "1024"}
+        series = [{"ID": orthanc_id + '-s1', "MainDicomTags": {"Modality": modality}}]
+        self.studies[orthanc_id] = (study, statistics, series)
+
+    def add_change(self, change_type, orthanc_id):
+        self.changes.append({"Seq": len(self.changes) + 1, "ChangeType": change_type, "ID": orthanc_id})
+
+    def answer(self, path, query):
+        with self._lock:
+            self.requests.append((path, query))
+            failures = self.failures.get(path, 0)
+            if failures:
+                self.failures[path] = failures - 1
+                return 503, {"Message": "busy"}
+        delay = self.delays.get(path)
+        if delay:
+            time.sleep(delay)
+
+        parts = path.strip('/').split('/')
+        if parts == ['system']:
+            return 200, {"Name": "FakeOrthanc", "Version": "1.12.0"}
+        if parts[0] == 'changes':
+            since, limit = int(query.get('since', 0)), int(query.get('limit', 100))
+            newer = [c for c in self.changes if c['Seq'] > since]
+            page = newer[:limit]
+            last = page[-1]['Seq'] if page else (self.changes[-1]['Seq'] if self.changes else 0)
+            return 200, {"Changes": page, "Done": len(newer) <= limit, "Last": last}
+        if parts[0] == 'studies' and len(parts) >= 2 and parts[1] in self.studies:
+            study, statistics, series = self.studies[parts[1]]
+            resource = {2: study}.get(len(parts)) or {'statistics': statistics, 'series': series}.get(parts[2])
+            if resource is not None:
+                return 200, resource
+        return 404, {"Message": "Unknown resource"}
+
+
+class FakeOrthancHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        status, body = self.server.answer(url.path, {k: v[0] for k, v in parse_qs(url.query).items()})
+        data = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client gave up waiting (timeout tests)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_orthanc():
+    server = FakeOrthanc()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def database():
+    """A migrated temporary database with one hospital and two patients"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-orthanc-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute("INSERT INTO hospitals (id, name) VALUES ('HOS-ORT', 'Orthanc Hospital')")
+        conn.executemany('INSERT INTO patients (id, national_id, first_name, last_name) VALUES (?, ?, ?, ?)',
+                         [('PAT-ORT-1', 'DICOM-1', 'Asha', 'Mollel'), ('PAT-ORT-2', 'DICOM-2', 'Juma', 'Said')])
+        conn.commit()
+    yield pool
+    pool.close_all()
+
+
+def client_for(server, **settings):
+    settings = dict({"timeout": 1.0, "connect_timeout": 1.0, "backoff": 0.01}, **settings)
+    return orthanc.OrthancClient(server.url, **settings)
+
+
+# -- client ----------------------------------------------------------------------
+
+def test_retries_busy_answers_with_backoff(fake_orthanc):
+    fake_orthanc.failures['/system'] = 2
+    client = client_for(fake_orthanc, retries=3)
+    try:
+        assert client.system()['Name'] == 'FakeOrthanc'
+    finally:
+        client.close()
+    assert [path for path, _ in fake_orthanc.requests] == ['/system'] * 3
+
+
+def test_gives_up_after_the_retries(fake_orthanc):
+    fake_orthanc.failures['/system'] = 10
+    client = client_for(fake_orthanc, retries=2)
+    try:
+        with pytest.raises(orthanc.OrthancError, match='503'):
+            client.system()
+    finally:
+        client.close()
+    assert len(fake_orthanc.requests) == 3
+
+
+def test_not_found_is_distinguished(fake_orthanc):
+    client = client_for(fake_orthanc)
+    try:
+        with pytest.raises(orthanc.OrthancNotFound):
+            client.study('missing')
+    finally:
+        client.close()
+
+
+def test_read_timeout(fake_orthanc):
+    fake_orthanc.delays['/system'] = 2.0
+    client = client_for(fake_orthanc, timeout=0.2, retries=0)
+    start = time.monotonic()
+    try:
+        with pytest.raises(orthanc.OrthancError, match='unreachable'):
+            client.system()
+    finally:
+        client.close()
+    assert time.monotonic() - start < 1.0
+
+
+def test_study_summaries_run_concurrently(fake_orthanc):
+    ids = [f"study-{i}" for i in range(8)]
+    for orthanc_id in ids:
+        fake_orthanc.add_study(orthanc_id, 'DICOM-1')
+        fake_orthanc.delays[f'/studies/{orthanc_id}'] = 0.3
+    client = client_for(fake_orthanc, max_connections=16)
+    start = time.monotonic()
+    try:
+        summaries = client.study_summaries(ids, deadline=5.0)
+    finally:
+        client.close()
+    # Serially this is 8 x 0.3 s
+    assert time.monotonic() - start < 1.2
+    assert all(summaries[i]['instance_count'] == 2 and summaries[i]['series_count'] == 1 for i in ids)
+
+
+def test_study_summaries_deadline(fake_orthanc):
+    fake_orthanc.add_study('fast', 'DICOM-1')
+    fake_orthanc.add_study('slow', 'DICOM-1')
+    fake_orthanc.delays['/studies/slow'] = 2.0
+    client = client_for(fake_orthanc, timeout=5.0)
+    start = time.monotonic()
+    try:
+        summaries = client.study_summaries(['fast', 'slow', 'missing'], deadline=0.5)
+    finally:
+        client.close()
+    assert time.monotonic() - start < 1.0
+    assert summaries['fast']['study_instance_uid'] == '1.2.3.1'
+    assert summaries['slow'] == {"error": "Orthanc lookup timed out"}
+    assert 'Not found' in summaries['missing']['error']
+
+
+def test_federation_query_enrichment(fake_orthanc, database):
+    fake_orthanc.add_study('orthanc-a', 'DICOM-1')
+    fake_orthanc.add_study('orthanc-b', 'DICOM-1')
+    fake_orthanc.delays['/studies/orthanc-b'] = 2.0
+    with db.connection() as conn:
+        conn.executemany(
+            'INSERT INTO studies (id, patient_id, hospital_id, study_date, orthanc_study_id, rowid) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            [('STU-ORT-1', 'PAT-ORT-1', 'HOS-ORT', '2024-01-15 10:30:00', 'orthanc-a', 1),
+             ('STU-ORT-2', 'PAT-ORT-1', 'HOS-ORT', '2024-02-15 10:30:00', 'orthanc-b', 2),
+             ('STU-ORT-3', 'PAT-ORT-1', 'HOS-ORT', '2024-03-15 10:30:00', None, 3)])
+        conn.commit()
+
+    saved = {k: app.config.get(k) for k in ('ORTHANC_URL', 'ORTHANC_ENRICH_DEADLINE')}
+    app.config.update(ORTHANC_URL=fake_orthanc.url, ORTHANC_ENRICH_DEADLINE=0.5)
+    orthanc.reset_client()
+    try:
+        start = time.monotonic()
+        response = app.test_client().get('/api/federation/query?patient_id=PAT-ORT-1&enrich=1')
+        elapsed = time.monotonic() - start
+    finally:
+        app.config.update(saved)
+        orthanc.get_client(app.config).close()
+        orthanc.reset_client()
+
+    assert response.status_code == 200
+    assert elapsed < 1.5
+    studies = {s['study_id']: s for s in response.get_json()['studies']}
+    assert studies['STU-ORT-1']['orthanc']['study_instance_uid'] == '1.2.3.1'
+    assert studies['STU-ORT-2']['orthanc'] == {"error": "Orthanc lookup timed out"}
+    assert 'orthanc' not in studies['STU-ORT-3']
+
+
+# -- change feed -----------------------------------------------------------------
+
+def synced_studies():
+    with db.connection() as conn:
+        return dict(conn.execute('SELECT orthanc_study_id, patient_id FROM studies').fetchall())
+
+
+def test_change_feed_pages_and_resumes(fake_orthanc, database):
+    for i in range(25):
+        fake_orthanc.add_study(f'orthanc-{i}', 'DICOM-1' if i % 2 else 'DICOM-2')
+        fake_orthanc.add_change('NewInstance', f'orthanc-{i}')
+        fake_orthanc.add_change('StableStudy', f'orthanc-{i}')
+    client = client_for(fake_orthanc)
+    try:
+        sync = OrthancSynchronizer(client, 'HOS-ORT', batch_size=10)
+        pages = []
+        while True:
+            stats = sync.run_once()
+            pages.append(stats)
+            if stats['done']:
+                break
+        assert [p['since'] for p in pages] == [0, 10, 20, 30, 40]
+        assert sum(p['studies'] for p in pages) == 25
+        assert len(synced_studies()) == 25
+
+        # A new synchronizer (a restart) continues from the stored sequence number
+        fake_orthanc.add_study('orthanc-new', 'DICOM-1')
+        fake_orthanc.add_change('StableStudy', 'orthanc-new')
+        fake_orthanc.requests.clear()
+        restarted = OrthancSynchronizer(client, 'HOS-ORT', batch_size=10)
+        stats = restarted.run_once()
+        assert stats == {"since": 50, "last": 51, "done": True, "studies": 1, "pending": 0}
+        assert [q for path, q in fake_orthanc.requests if path == '/changes'] == [{"since": "50", "limit": "10"}]
+        # Only the new study was looked up, not the archive
+        assert {path for path, _ in fake_orthanc.requests} == {
+            '/changes', '/studies/orthanc-new', '/studies/orthanc-new/series'}
+        assert synced_studies()['orthanc-new'] == 'PAT-ORT-1'
+    finally:
+        client.close()
+
+
+def test_change_feed_parks_unknown_patients(fake_orthanc, database):
+    fake_orthanc.add_study('orthanc-x', 'DICOM-9')
+    fake_orthanc.add_change('StableStudy', 'orthanc-x')
+    fake_orthanc.add_change('StableStudy', 'orthanc-x')   # repeated events register it once
+    client = client_for(fake_orthanc)
+    try:
+        sync = OrthancSynchronizer(client, 'HOS-ORT')
+        assert sync.run_once()['pending'] == 1
+        assert synced_studies() == {}
+
+        with db.connection() as conn:
+            conn.execute("INSERT INTO patients (id, national_id, first_name, last_name) "
+                         "VALUES ('PAT-ORT-9', 'DICOM-9', 'Neema', 'Kweka')")
+            conn.commit()
+        assert sync.run_once()['studies'] == 1
+        assert synced_studies() == {'orthanc-x': 'PAT-ORT-9'}
+        assert sync.status()['pending_studies'] == 0
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__, '-q']))
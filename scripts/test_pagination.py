@@ -0,0 +1,117 @@
+"""
+Keyset pagination tests: patient and hospital study listings
+
+Walking every page by its cursor must give the full listing, in order,
+with nothing repeated or skipped, in JSON (cursor in X-Next-Cursor) and
+NDJSON (cursor on a trailing line) alike.
+
+    cd scripts
+    python -m pytest test_pagination.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-pagination-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import json
+
+import pytest
+
+import db
+import pagination
+import storage
+from app import app
+from migrations import migrate
+
+NDJSON = {'Accept': pagination.NDJSON_MIMETYPE}
+
+
+@pytest.fixture
+def client():
+    """Five patients, and seven studies at one hospital, two of them undated and two on one date"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-pagination-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute("INSERT INTO hospitals (id, name) VALUES ('HOS-PG', 'Paging Hospital')")
+        conn.executemany('INSERT INTO patients (id, national_id, first_name, last_name) VALUES (?, ?, ?, ?)',
+                         [(f'PAT-PG-{n}', f'NID-PG-{n}', 'Neema', f'Mushi{n}') for n in range(5)])
+        conn.executemany(
+            'INSERT INTO studies (id, patient_id, hospital_id, study_date, rowid) VALUES (?, ?, ?, ?, ?)', [
+                ('STU-PG-A', 'PAT-PG-0', 'HOS-PG', '2024-02-01 08:00:00', 1),
+                ('STU-PG-B', 'PAT-PG-1', 'HOS-PG', None, 2),
+                ('STU-PG-C', 'PAT-PG-2', 'HOS-PG', '2024-01-01 08:00:00', 3),
+                ('STU-PG-D', 'PAT-PG-3', 'HOS-PG', '2024-02-01 08:00:00', 4),
+                ('STU-PG-E', 'PAT-PG-4', 'HOS-PG', None, 5),
+                ('STU-PG-F', 'PAT-PG-0', 'HOS-PG', '2024-03-01 08:00:00', 6),
+                ('STU-PG-G', 'PAT-PG-1', 'HOS-PG', '2023-12-31 23:59:59', 7),
+            ])
+        conn.commit()
+    yield app.test_client()
+    pool.close_all()
+
+
+def json_pages(client, url, limit):
+    """IDs page by page, following X-Next-Cursor"""
+    pages, after = [], None
+    while True:
+        response = client.get(url, query_string=dict({"limit": limit}, **({"after": after} if after else {})))
+        assert response.status_code == 200
+        pages.append([item['id'] for item in response.get_json()])
+        after = response.headers.get('X-Next-Cursor')
+        if not after:
+            assert 'Link' not in response.headers
+            return pages
+        assert f'after={after}' in response.headers['Link']
+
+
+def ndjson_pages(client, url, limit):
+    """IDs page by page, following the trailing next_cursor line"""
+    pages, after = [], None
+    while True:
+        response = client.get(url, headers=NDJSON,
+                              query_string=dict({"limit": limit}, **({"after": after} if after else {})))
+        assert response.mimetype == pagination.NDJSON_MIMETYPE
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        after = lines.pop()['next_cursor'] if lines and 'next_cursor' in lines[-1] else None
+        pages.append([line['id'] for line in lines])
+        if not after:
+            return pages
+
+
+def test_patient_pages_cover_the_listing(client):
+    full = [p['id'] for p in client.get('/api/patients').get_json()]
+    assert full == [f'PAT-PG-{n}' for n in range(5)]
+    assert json_pages(client, '/api/patients', 2) == [full[0:2], full[2:4], full[4:]]
+    assert ndjson_pages(client, '/api/patients', 2) == [full[0:2], full[2:4], full[4:]]
+
+
+def test_study_pages_run_through_undated_then_dated_studies(client):
+    url = '/api/hospitals/HOS-PG/studies'
+    full = [s['id'] for s in client.get(url).get_json()]
+    assert full == ['STU-PG-B', 'STU-PG-E', 'STU-PG-G', 'STU-PG-C', 'STU-PG-A', 'STU-PG-D', 'STU-PG-F']
+    for limit in (1, 2, 3):
+        assert sum(json_pages(client, url, limit), []) == full
+        assert sum(ndjson_pages(client, url, limit), []) == full
+
+
+def test_exact_last_page_has_no_cursor(client):
+    response = client.get('/api/patients?limit=5')
+    assert len(response.get_json()) == 5 and 'X-Next-Cursor' not in response.headers
+
+
+def test_after_alone_pages_by_the_default_limit(client):
+    after = pagination.encode_cursor(['PAT-PG-2'])
+    assert [p['id'] for p in client.get(f'/api/patients?after={after}').get_json()] == ['PAT-PG-3', 'PAT-PG-4']
+
+
+@pytest.mark.parametrize('query', ['limit=0', 'limit=ten', 'after=not-a-cursor',
+                                   'after=' + pagination.encode_cursor(['PAT-PG-1', 'STU-PG-B', 3])])
+def test_bad_page_arguments_are_refused(client, query):
+    assert client.get(f'/api/patients?{query}').status_code == 400
+    assert client.get(f'/api/hospitals/HOS-PG/studies?{query}').status_code == 400
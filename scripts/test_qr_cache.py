@@ -0,0 +1,90 @@
+"""
+QR code cache tests: content-addressed keys, memory and disk tiers, ETags
+
+A QR PNG is a pure function of its data and render parameters, so it is
+rendered once per key, kept in memory and optionally on disk, and a client
+holding the key as its ETag is answered 304 without any rendering.
+
+    cd scripts
+    python -m pytest test_qr_cache.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-qr-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import pytest
+
+import app as app_module
+import qr
+
+URL = 'http://localhost:5000/patient-access/PAT-QR-1'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+@pytest.fixture
+def renders(monkeypatch):
+    """Every render_png call, by data"""
+    calls, render = [], qr.render_png
+
+    def counted(data, params):
+        calls.append(data)
+        return render(data, params)
+
+    monkeypatch.setattr(qr, 'render_png', counted)
+    return calls
+
+
+def test_key_depends_on_data_and_parameters_only():
+    params = qr.render_params({})
+    assert qr.cache_key(URL, params) == qr.cache_key(URL, dict(reversed(list(params.items()))))
+    assert qr.cache_key(URL, params) != qr.cache_key(URL + '2', params)
+    assert qr.cache_key(URL, params) != qr.cache_key(URL, qr.render_params({'box_size': '5'}))
+
+
+def test_each_png_is_rendered_once_across_memory_and_disk(renders):
+    cache_dir = tempfile.mkdtemp(prefix='xray-qr-cache-')
+    params = qr.render_params({})
+    renderer = qr.QRRenderer(max_entries=1, cache_dir=cache_dir)
+    png = renderer.png(URL, params)
+    assert png.startswith(PNG_SIGNATURE)
+    assert renderer.png(URL, params) is png                     # memory
+    renderer.png(URL + '2', params)                             # evicts the first from memory
+    assert renderer.png(URL, params) == png                     # disk
+    assert renders == [URL, URL + '2']
+
+    restarted = qr.QRRenderer(cache_dir=cache_dir)
+    assert restarted.png(URL, params) == png
+    assert restarted.renders == 0 and len(renders) == 2
+    assert not [name for _, _, files in os.walk(cache_dir) for name in files if name.endswith('.tmp')]
+
+
+def test_unwritable_disk_cache_still_serves(renders):
+    renderer = qr.QRRenderer(cache_dir=tempfile.mkdtemp(prefix='xray-qr-cache-'))
+    renderer.cache_dir = os.path.join(os.devnull, 'not-a-directory')
+    assert renderer.png(URL, qr.render_params({})).startswith(PNG_SIGNATURE)
+    assert len(renders) == 1
+
+
+def test_route_tags_the_png_and_revalidates_without_rendering(renders, monkeypatch):
+    monkeypatch.setattr(app_module, 'qr_renderer', qr.QRRenderer())
+    client = app_module.app.test_client()
+    response = client.get('/api/patients/PAT-QR-1/qr?box_size=4')
+    assert response.status_code == 200 and response.mimetype == 'image/png'
+    tag, weak = response.get_etag()
+    assert not weak and tag == qr.cache_key(renders[0], qr.render_params({'box_size': '4'}))
+    assert response.headers['Cache-Control'].startswith('public, max-age=')
+
+    revalidated = client.get('/api/patients/PAT-QR-1/qr?box_size=4', headers={'If-None-Match': f'"{tag}"'})
+    assert revalidated.status_code == 304 and revalidated.get_etag() == (tag, False)
+    assert client.get('/api/patients/PAT-QR-1/qr', headers={'If-None-Match': f'"{tag}"'}).status_code == 200
+    assert len(renders) == 2
+
+
+@pytest.mark.parametrize('query', ['box_size=0', 'box_size=big', 'border=11', 'error_correction=X'])
+def test_bad_render_parameters_are_refused(query):
+    assert app_module.app.test_client().get(f'/api/patients/PAT-QR-1/qr?{query}').status_code == 400
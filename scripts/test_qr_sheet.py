@@ -0,0 +1,130 @@
+"""
+QR sheet tests: grid layout, page size bounds, PDF pages, the sheet route
+
+Codes on a sheet are drawn from their module matrices, so each cell must
+hold exactly the code a single QR render would give, scaled by box_size.
+
+    cd scripts
+    python -m pytest test_qr_sheet.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-qr-sheet-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import io
+import re
+
+import pytest
+from PIL import Image, ImageChops
+
+import db
+import qr
+import qr_sheet
+import storage
+from app import app
+from migrations import migrate
+
+ITEMS = [(f'http://localhost:5000/patient-access/PAT-SHEET-{n}', f'PAT-SHEET-{n}') for n in range(5)]
+
+
+def expected_code(data, box):
+    side, pixels = qr_sheet.matrix_pixels(data, qr_sheet._matrix_params(qr.DEFAULT_PARAMS))
+    return Image.frombytes('L', (side, side), pixels).resize((side * box, side * box), Image.NEAREST).convert('1')
+
+
+def pdf_pages(body):
+    """Page count of the document's latest page tree (appends rewrite it after the earlier one)"""
+    return int(re.findall(rb'/Count\s+(\d+)', body)[-1])
+
+
+def test_png_sheet_holds_each_code_in_its_cell():
+    params = dict(qr.DEFAULT_PARAMS, box_size=3)
+    body, mimetype = qr_sheet.render_sheet(ITEMS, params, columns=2)
+    assert mimetype == 'image/png'
+    sheet = Image.open(io.BytesIO(body)).convert('1')
+
+    code = expected_code(ITEMS[0][0], 3)
+    cell_w, cell_h = code.width, code.height + qr_sheet.LABEL_HEIGHT
+    assert sheet.size == (2 * cell_w, 3 * cell_h)
+    for i, (data, _) in enumerate(ITEMS):
+        x, y = (i % 2) * cell_w, (i // 2) * cell_h
+        cell = sheet.crop((x, y, x + code.width, y + code.height))
+        assert ImageChops.difference(cell, expected_code(data, 3)).getbbox() is None
+        label = sheet.crop((x, y + code.height, x + cell_w, y + cell_h))
+        assert label.convert('L').getextrema()[0] == 0      # the label text is drawn under it
+
+
+def test_matrices_are_computed_once(monkeypatch):
+    qr_sheet._matrices.clear()
+    computed, compute = [], qr_sheet.matrix_pixels
+
+    def counted(data, params):
+        computed.append(data)
+        return compute(data, params)
+
+    monkeypatch.setattr(qr_sheet, 'matrix_pixels', counted)
+    qr_sheet.render_sheet(ITEMS, qr.DEFAULT_PARAMS)
+    # box_size only scales the sheet: another one reuses the matrices
+    qr_sheet.render_sheet(ITEMS[:2], dict(qr.DEFAULT_PARAMS, box_size=2))
+    assert computed == [data for data, _ in ITEMS]
+
+
+def test_box_size_shrinks_to_fit_the_page_bound():
+    # 5 codes of 29 modules in 2 columns (3 rows): box 4 needs 2*116 * 3*(116+24) pixels
+    assert qr_sheet.fit_box_size(29, 5, 2, 10, max_pixels=2 * 116 * 3 * 140) == 4
+    assert qr_sheet.fit_box_size(29, 5, 2, 3, max_pixels=10 ** 9) == 3
+    with pytest.raises(ValueError, match='format=pdf'):
+        qr_sheet.fit_box_size(29, 5, 2, 10, max_pixels=1000)
+
+
+def test_pdf_has_one_page_per_grid_and_writes_out_large_runs(monkeypatch):
+    body, mimetype = qr_sheet.render_sheet(ITEMS, qr.DEFAULT_PARAMS, columns=2, fmt='pdf', rows_per_page=1)
+    assert mimetype == 'application/pdf' and body.startswith(b'%PDF')
+    assert pdf_pages(body) == 3
+    # Pages written out in several appends make the same document
+    monkeypatch.setattr(qr_sheet, 'MAX_PAGE_PIXELS', 1)
+    appended, _ = qr_sheet.render_sheet(ITEMS, qr.DEFAULT_PARAMS, columns=2, fmt='pdf', rows_per_page=1)
+    assert pdf_pages(appended) == 3
+
+
+@pytest.fixture
+def client():
+    """A migrated temporary database with two of the sheet's patients"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-qr-sheet-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.executemany('INSERT INTO patients (id, national_id, first_name, last_name) VALUES (?, ?, ?, ?)',
+                         [('PAT-SHEET-0', 'NID-SHEET-0', 'Fatuma', 'Nyerere'),
+                          ('PAT-SHEET-1', 'NID-SHEET-1', 'Joseph', 'Mrisho')])
+        conn.commit()
+    yield app.test_client()
+    pool.close_all()
+
+
+def test_sheet_route_renders_png_and_pdf(client):
+    response = client.post('/api/qr/sheet', json={"patient_ids": ['PAT-SHEET-0', 'PAT-SHEET-1'],
+                                                  "study_ids": ['STU-SHEET-1'], "columns": 3, "box_size": 2})
+    assert response.status_code == 200 and response.mimetype == 'image/png'
+    assert Image.open(io.BytesIO(response.get_data())).width == 3 * expected_code(ITEMS[0][0], 2).width
+
+    response = client.post('/api/qr/sheet', json={"patient_ids": ['PAT-SHEET-0'], "format": 'pdf'})
+    assert response.mimetype == 'application/pdf' and pdf_pages(response.get_data()) == 1
+
+
+@pytest.mark.parametrize('body', [
+    {},
+    {"patient_ids": 'PAT-SHEET-0'},
+    {"patient_ids": ['PAT-SHEET-0'], "format": 'svg'},
+    {"patient_ids": ['PAT-SHEET-0'], "columns": 21},
+    {"patient_ids": ['PAT-SHEET-0'], "box_size": 0},
+    {"patient_ids": ['PAT-SHEET-0'] * (qr_sheet.MAX_CODES + 1)},
+])
+def test_bad_sheet_requests_are_refused(client, body):
+    assert client.post('/api/qr/sheet', json=body).status_code == 400
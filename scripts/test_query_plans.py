@@ -0,0 +1,161 @@
+"""
+Query-plan regression check - fails if any route's SQL falls back to a table scan
+
+Runs every API route through the Flask test client against a seeded
+temporary database, captures the SQL each route executes, and runs
+EXPLAIN QUERY PLAN on it; once per studies layout (study_layout.py).
+
+    cd scripts
+    python test_query_plans.py      (or: python -m pytest test_query_plans.py)
+"""
+import sys
+import os
+import re
+import tempfile
+import random
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-plans-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import db
+import study_layout
+from app import app
+from migrations import migrate
+from pagination import encode_cursor
+
+# Routes to exercise, with the tables each one is *meant* to scan in full
+ROUTES = [
+    ('GET', '/api/hospitals', {'hospitals'}),
+    ('GET', '/api/patients', {'patients'}),
+    ('GET', '/api/patients/PAT-000042', set()),
+    ('GET', '/api/patients?limit=50&after=' + encode_cursor(['PAT-000100']), set()),
+    ('GET', '/api/hospitals/HOS-002/studies', set()),
+    ('GET', '/api/hospitals/HOS-002/studies?limit=50&after='
+     + encode_cursor(['2024-06-01 10:00:00', 'STU-00000001']), set()),
+    ('GET', '/api/federation/query?national_id=190000000000000042', set()),
+    ('GET', '/api/federation/query?patient_id=PAT-000042', set()),
+    ('GET', '/api/federation/query?national_id=190000000009999999', set()),
+    ('GET', '/api/dashboard/summary', {'hospitals'}),
+    ('GET', '/api/search?q=last', set()),
+    ('GET', '/api/search?q=1900000000000004', set()),
+    ('GET', '/api/search?q=chest+x-ray+last+month&type=studies', set()),
+    ('GET', '/api/search?q=yesterday&type=studies', set()),
+    ('GET', '/api/export/studies?hospital_id=HOS-002&from=2024-03-01&to=2024-03-31', set()),
+    ('GET', '/api/export/studies', {'studies'}),
+    ('POST', '/api/admin/reset-demo', set()),
+    ('GET', '/api/studies/STU-00000042/preview', set()),
+    ('GET', '/api/jobs', set()),
+    ('GET', '/api/jobs?status=failed&kind=bulk_patients', set()),
+]
+
+SCAN_RE = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?$')
+
+
+def seed(conn, hospitals=20, patients=500, studies=5000):
+    """Enough rows that the planner's choices reflect a realistic distribution"""
+    rng = random.Random(42)
+    conn.executemany(
+        'INSERT INTO hospitals (id, name) VALUES (?, ?)',
+        [(f"HOS-{h:03d}", f"Hospital {h}") for h in range(1, hospitals + 1)]
+    )
+    conn.executemany(
+        'INSERT INTO patients (id, national_id, first_name, last_name) VALUES (?, ?, ?, ?)',
+        [(f"PAT-{p:06d}", f"19{p:016d}", "First", "Last") for p in range(patients)]
+    )
+    conn.executemany(
+        'INSERT INTO studies (id, patient_id, hospital_id, study_date, modality, description, rowid) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        [(f"STU-{s:08d}", f"PAT-{rng.randrange(patients):06d}",
+          f"HOS-{rng.randint(1, hospitals):03d}",
+          f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d} 10:00:00", "XR", "Chest X-Ray", s + 1)
+         for s in range(studies)]
+    )
+    conn.execute('ANALYZE')
+    conn.commit()
+
+
+def table_scans(conn, sql):
+    """Tables the statement reads with a plain full scan"""
+    scans = set()
+    for row in conn.execute('EXPLAIN QUERY PLAN ' + sql):
+        match = SCAN_RE.match(row[3])
+        if match:
+            scans.add(match.group(2) or match.group(1))
+    return scans
+
+
+def resolve_aliases(sql, names):
+    """Map 's' -> 'studies' etc. using the FROM/JOIN clauses of the statement"""
+    aliases = dict(re.findall(r'(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(\w+)', sql, re.I))
+    reverse = {alias: table for table, alias in aliases.items()}
+    return {reverse.get(name, name) for name in names}
+
+
+def collect_plans(layout=study_layout.ROWID):
+    """Returns a list of (route, sql, unexpected_scans)"""
+    workdir = tempfile.mkdtemp(prefix='xray-plans-')
+    pool = db.configure(database=os.path.join(workdir, 'federation.db'))
+
+    captured = []
+    connect = pool._connect
+
+    def traced_connect(**kwargs):
+        conn = connect(**kwargs)
+        conn.set_trace_callback(captured.append)
+        return conn
+
+    pool._connect = traced_connect
+
+    with db.connection() as conn:
+        migrate(conn)
+        study_layout.apply(conn, layout)
+        seed(conn)
+
+    failures = []
+    with app.test_client() as client, db.connection() as explain_conn:
+        explain_conn.set_trace_callback(None)
+        for method, url, allowed in ROUTES:
+            captured.clear()
+            response = client.open(url, method=method)
+            response.get_data()  # drain streamed bodies so their SQL runs
+            assert response.status_code < 500, f"{method} {url} -> {response.status_code}"
+
+            for sql in list(captured):
+                if not sql.lstrip().upper().startswith('SELECT'):
+                    continue
+                scans = resolve_aliases(sql, table_scans(explain_conn, sql)) - allowed
+                if scans:
+                    failures.append((f"{method} {url}", ' '.join(sql.split()), scans))
+
+    pool.close_all()
+    return failures
+
+
+def check(layout):
+    failures = collect_plans(layout)
+    message = '\n'.join(f"{route}: full scan of {sorted(scans)}\n    {sql}"
+                        for route, sql, scans in failures)
+    assert not failures, message
+
+
+def test_query_plans():
+    check(study_layout.ROWID)
+
+
+def test_query_plans_clustered():
+    check(study_layout.CLUSTERED)
+
+
+if __name__ == "__main__":
+    failed = False
+    for layout in study_layout.LAYOUTS:
+        failures = collect_plans(layout)
+        for route, sql, scans in failures:
+            print(f"❌ [{layout}] {route}: full scan of {', '.join(sorted(scans))}")
+            print(f"   {sql}")
+        failed = failed or bool(failures)
+    if failed:
+        sys.exit(1)
+    print(f"✅ No unexpected table scans across {len(ROUTES)} routes in either studies layout")
@@ -0,0 +1,142 @@
+"""
+Full-text search tests: query parsing, patient and study matches, the search route
+
+Every term must match a word of the record, the last one as a prefix
+while it is still being typed; relative-date phrases narrow studies to a
+study_date window, and an all-digit query looks up national_id prefixes.
+
+    cd scripts
+    python -m pytest test_search.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-search-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+from datetime import datetime, timedelta
+
+import pytest
+
+import db
+import search
+import storage
+from app import app
+from migrations import migrate
+
+NOW = datetime(2024, 5, 15, 10, 30)     # a Wednesday
+
+
+def days_ago(days):
+    return (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+
+
+@pytest.fixture
+def conn():
+    """Three patients, and four studies of theirs from two days to a year back"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-search-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute("INSERT INTO hospitals (id, name) VALUES ('HOS-SR', 'Search Hospital')")
+        conn.executemany('INSERT INTO patients (id, national_id, first_name, last_name) VALUES (?, ?, ?, ?)', [
+            ('PAT-SR-1', '199001110001', 'Maria', 'Kessy'),
+            ('PAT-SR-2', '199001120002', 'Marion', 'Swai'),
+            ('PAT-SR-3', '198505010003', 'John', 'Maro'),
+        ])
+        conn.executemany('INSERT INTO studies (id, patient_id, hospital_id, study_date, modality, description) '
+                         'VALUES (?, ?, ?, ?, ?, ?)', [
+            ('STU-SR-1', 'PAT-SR-1', 'HOS-SR', days_ago(2), 'CR', 'Chest X-Ray PA'),
+            ('STU-SR-2', 'PAT-SR-1', 'HOS-SR', days_ago(40), 'CR', 'Chest X-Ray Lateral'),
+            ('STU-SR-3', 'PAT-SR-2', 'HOS-SR', days_ago(3), 'CT', 'Head CT'),
+            ('STU-SR-4', 'PAT-SR-3', 'HOS-SR', days_ago(365), 'CR', 'Knee X-Ray'),
+        ])
+        conn.commit()
+        yield conn
+    pool.close_all()
+
+
+@pytest.fixture
+def client(conn):
+    return app.test_client()
+
+
+@pytest.mark.parametrize('text, terms, date_range', [
+    ('maria kessy', ['maria', 'kessy'], None),
+    ('CT yesterday', ['ct'], ('2024-05-14 00:00:00', '2024-05-15 00:00:00')),
+    ('chest today', ['chest'], ('2024-05-15 00:00:00', None)),
+    ('chest x-ray last month', ['chest', 'x', 'ray'], ('2024-04-15 00:00:00', None)),
+    ('knee past 2 weeks', ['knee'], ('2024-05-01 00:00:00', None)),
+    ('this week head', ['head'], ('2024-05-13 00:00:00', None)),
+    ('this year', [], ('2024-01-01 00:00:00', None)),
+])
+def test_date_phrases_become_a_study_date_range(text, terms, date_range):
+    assert search.parse_query(text, now=NOW) == (terms, date_range)
+
+
+def test_query_syntax_never_reaches_fts5(conn):
+    # OR, quotes, NEAR() and column filters are plain words to match, not FTS5 syntax
+    terms, _ = search.parse_query('kessy OR "maria" NEAR(swai) last_name:k*')
+    assert terms == ['kessy', 'or', 'maria', 'near', 'swai', 'last_name', 'k']
+    assert search.search_patients(conn, terms, 10, 0) == []
+
+
+def patient_ids(rows):
+    return sorted(row[0] for row in rows)
+
+
+def test_last_term_matches_as_a_prefix(conn):
+    assert patient_ids(search.search_patients(conn, ['mari'], 10, 0)) == ['PAT-SR-1', 'PAT-SR-2']
+    assert patient_ids(search.search_patients(conn, ['maria'], 10, 0)) == ['PAT-SR-1']
+    assert patient_ids(search.search_patients(conn, ['maro'], 10, 0)) == ['PAT-SR-3']
+    # Earlier terms are whole words: "mar" alone is no word of any of them
+    assert search.search_patients(conn, ['mar', 'kessy'], 10, 0) == []
+
+
+def test_digit_query_is_a_national_id_prefix(conn):
+    assert patient_ids(search.search_patients(conn, ['1990011'], 10, 0)) == ['PAT-SR-1', 'PAT-SR-2']
+    assert patient_ids(search.search_patients(conn, ['1985'], 10, 0)) == ['PAT-SR-3']
+    assert search.national_id_prefix(['19']) is None
+
+
+def test_studies_match_terms_within_the_date_range(conn):
+    rows = search.search_studies(conn, ['chest', 'x', 'ray'], None, 10, 0)
+    assert sorted(row[0] for row in rows) == ['STU-SR-1', 'STU-SR-2']
+    assert all(row[-1] is not None for row in rows)         # few matches: ranked by bm25
+
+    recent = (days_ago(30), None)
+    assert [row[0] for row in search.search_studies(conn, ['chest'], recent, 10, 0)] == ['STU-SR-1']
+    # A date phrase alone lists the window newest first
+    assert [row[0] for row in search.search_studies(conn, [], recent, 10, 0)] == ['STU-SR-1', 'STU-SR-3']
+
+
+def test_index_follows_updates_and_deletes(conn):
+    conn.execute("UPDATE patients SET last_name = 'Mollel' WHERE id = 'PAT-SR-1'")
+    conn.execute("DELETE FROM studies WHERE id = 'STU-SR-3'")
+    conn.commit()
+    assert search.search_patients(conn, ['kessy'], 10, 0) == []
+    assert patient_ids(search.search_patients(conn, ['mollel'], 10, 0)) == ['PAT-SR-1']
+    assert search.search_studies(conn, ['head'], None, 10, 0) == []
+
+
+def test_route_filters_by_type_and_pages(client):
+    body = client.get('/api/search?q=chest+last+month').get_json()
+    assert body['terms'] == ['chest'] and body['study_date_from'] and body['study_date_to'] is None
+    assert body['patients'] == [] and [s['id'] for s in body['studies']] == ['STU-SR-1']
+    assert body['studies'][0]['patient_name'] == 'Maria Kessy'
+
+    body = client.get('/api/search?q=mari&type=patients&limit=1').get_json()
+    assert 'studies' not in body and len(body['patients']) == 1 and body['more_patients']
+    assert client.get('/api/search?q=mari&type=patients&limit=1&offset=1').get_json()['more_patients'] is False
+
+    body = client.get('/api/search?q=ray&type=studies').get_json()
+    assert 'patients' not in body and len(body['studies']) == 3 and not body['more_studies']
+
+
+@pytest.mark.parametrize('query', ['', 'q=', 'q=maria&type=hospitals', 'q=maria&limit=ten', 'q=maria&offset=x'])
+def test_bad_search_requests_are_refused(client, query):
+    assert client.get(f'/api/search?{query}').status_code == 400
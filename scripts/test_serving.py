@@ -0,0 +1,138 @@
+"""
+Production serving tests: the app factory, per-worker reset, gunicorn settings
+
+create_app() runs once in the gunicorn master (preload_app) and must leave
+no SQLite connection open to cross fork(); each worker then starts with
+its own pool and clients. The last test serves the app with gunicorn itself.
+
+    cd scripts
+    python -m pytest test_serving.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-serving-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import json
+import runpy
+import socket
+import subprocess
+import time
+import urllib.request
+
+import pytest
+
+import app as app_module
+import db
+import metrics
+import orthanc
+from config import ProductionConfig
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+
+
+@pytest.fixture
+def production(monkeypatch):
+    """ProductionConfig pointed at a temporary directory; the app's own config is put back afterwards"""
+    directory = tempfile.mkdtemp(prefix='xray-serving-')
+    monkeypatch.setattr(ProductionConfig, 'DATABASE_PATH', os.path.join(directory, 'federation.db'))
+    monkeypatch.setattr(ProductionConfig, 'JOB_DIR', os.path.join(directory, 'jobs'))
+    monkeypatch.setattr(ProductionConfig, 'JOB_WORKERS', 0)
+    saved = dict(app_module.app.config)
+    yield directory
+    db.get_pool().close_all()
+    app_module.app.config.clear()
+    app_module.app.config.update(saved)
+    app_module.configure_app()
+
+
+def test_create_app_loads_the_config_migrates_and_leaves_no_connection_open(production):
+    app = app_module.create_app('production')
+    assert app is app_module.app and not app.debug
+    assert app.config['DATABASE_PATH'] == os.path.join(production, 'federation.db')
+
+    pool = db.get_pool()
+    assert pool.stats()["idle"] == 0
+    with db.connection() as conn:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'patients', 'studies', 'hospitals', 'patients_fts', 'jobs'} <= tables
+
+
+def test_worker_starts_with_its_own_pool_and_clients(production):
+    app_module.create_app('production')
+    with db.connection() as parents:
+        pass
+    orthanc.get_client(app_module.app.config)
+    metrics.export_rows.inc('csv', amount=10)
+
+    app_module.reset_after_fork()
+    assert orthanc._client is None
+    assert metrics.export_rows.snapshot() == []
+    with db.connection() as conn:
+        assert conn is not parents
+    assert db.get_pool()._inherited == [parents]
+
+
+def test_gunicorn_settings_follow_the_environment(monkeypatch):
+    monkeypatch.setattr(os, 'environ', {"GUNICORN_WORKERS": '3', "GUNICORN_THREADS": '6',
+                                        "GUNICORN_MAX_REQUESTS": '500', "GUNICORN_JOB_WORKERS": '0'})
+    settings = runpy.run_path(os.path.join(BACKEND, 'gunicorn.conf.py'))
+    assert (settings['workers'], settings['threads'], settings['worker_class']) == (3, 6, 'gthread')
+    assert settings['preload_app'] and settings['max_requests_jitter'] == 50
+    assert settings['job_workers'] == 0
+    # Every thread of a worker can hold a connection, and web workers only queue jobs
+    assert os.environ['DATABASE_POOL_SIZE'] == '12' and os.environ['JOB_WORKERS'] == '0'
+    assert os.environ['METRICS_DIR']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def get_json(url, data=None):
+    request = urllib.request.Request(url, data=data and json.dumps(data).encode(),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=5) as response:
+        return response.status, json.load(response)
+
+
+def test_gunicorn_serves_the_app_from_forked_workers():
+    pytest.importorskip('gunicorn')
+    directory = tempfile.mkdtemp(prefix='xray-gunicorn-')
+    base = f'http://127.0.0.1:{free_port()}'
+    env = dict(os.environ, FLASK_CONFIG='production', GUNICORN_BIND=base[len('http://'):],
+               GUNICORN_WORKERS='2', GUNICORN_JOB_WORKERS='0', GUNICORN_ACCESS_LOG=os.devnull,
+               DATABASE_PATH=os.path.join(directory, 'federation.db'), JOB_DIR=os.path.join(directory, 'jobs'),
+               METRICS_DIR=os.path.join(directory, 'metrics'), AUDIT_DIR=os.path.join(directory, 'audit'),
+               RATE_LIMIT_ENABLED='0')
+    with open(os.path.join(directory, 'gunicorn.log'), 'wb') as log:
+        server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'],
+                                  cwd=BACKEND, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            assert server.poll() is None, open(os.path.join(directory, 'gunicorn.log')).read()
+            try:
+                status, body = get_json(base + '/')
+                break
+            except OSError:
+                assert time.monotonic() < deadline, 'gunicorn did not start'
+                time.sleep(0.2)
+        assert status == 200 and body['message'].startswith('XRay Federation')
+
+        # Written by one worker, read by whichever answers next, from the database the master migrated
+        status, created = get_json(base + '/api/patients', {"national_id": '198801010042',
+                                                            "first_name": 'Neema', "last_name": 'Lyimo'})
+        assert status == 201
+        for _ in range(4):
+            status, patient = get_json(f"{base}/api/patients/{created['patient_id']}")
+            assert status == 200 and patient['national_id'] == '198801010042'
+    finally:
+        server.terminate()
+        server.wait(30)
@@ -0,0 +1,104 @@
+"""
+Study search over hospital shards: one page merged from every shard
+
+Each shard returns its best rows and merge_studies() interleaves them, so
+the page must come out as it would from a single database, whichever
+shard a study lives in and whether or not the query is ranked.
+
+    cd scripts
+    python -m pytest test_sharded_search.py
+"""
+import sys
+import os
+import tempfile
+from datetime import datetime, timedelta
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-search-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import pytest
+
+import db
+import search
+import storage
+from app import app
+from migrations import migrate
+
+DAY = timedelta(days=1)
+
+
+@pytest.fixture
+def client():
+    """A sharded temporary database with two hospitals and one patient"""
+    root = tempfile.mkdtemp(prefix='xray-search-')
+    pool = db.configure(database=os.path.join(root, 'federation.db'))
+    storage.configure(shard_dir=os.path.join(root, 'shards'))
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute("INSERT INTO hospitals (id, name) VALUES ('HOS-A', 'A'), ('HOS-B', 'B')")
+        conn.execute("INSERT INTO patients (id, national_id, first_name, last_name) "
+                     "VALUES ('PAT-SRCH-1', 'NID-SRCH-1', 'Baraka', 'Minja')")
+        conn.commit()
+    yield app.test_client()
+    storage.configure()
+    pool.close_all()
+
+
+def register(client, hospital_id, description, study_date):
+    response = client.post(f'/api/hospitals/{hospital_id}/studies', json={
+        "patient_id": 'PAT-SRCH-1', "description": description,
+        "study_date": study_date.strftime('%Y-%m-%d %H:%M:%S')})
+    assert response.status_code == 201
+    return response.get_json()['study_id']
+
+
+def pages(client, query, limit):
+    ids, offset = [], 0
+    while True:
+        result = client.get('/api/search', query_string={
+            "q": query, "type": 'studies', "limit": limit, "offset": offset}).get_json()
+        ids += [study['id'] for study in result['studies']]
+        if not result['more_studies']:
+            return ids
+        offset += limit
+
+
+def test_unranked_matches_are_newest_registration_first_across_shards(client, monkeypatch):
+    # Few enough for hospital A alone to rank, too many for both together
+    monkeypatch.setattr(search, 'RANK_WINDOW', 2)
+    now = datetime.now()
+    registered = [register(client, 'HOS-B', 'chest film', now - 9 * DAY),
+                  register(client, 'HOS-A', 'chest film', now - 30 * DAY),
+                  register(client, 'HOS-B', 'chest film', now - 1 * DAY),
+                  register(client, 'HOS-B', 'chest film', now - 20 * DAY)]
+
+    assert pages(client, 'chest', limit=1) == registered[::-1]
+    assert pages(client, 'chest', limit=3) == registered[::-1]
+
+
+def test_date_window_is_newest_study_first_across_shards(client):
+    now = datetime.now()
+    older = register(client, 'HOS-A', 'knee', now - 3 * DAY)
+    newest = register(client, 'HOS-B', 'hand', now - 1 * DAY)
+    middle = register(client, 'HOS-A', 'foot', now - 2 * DAY)
+    outside = register(client, 'HOS-B', 'spine', now - 40 * DAY)
+
+    found = pages(client, 'last week', limit=2)
+
+    assert found == [newest, middle, older]
+    assert outside not in found
+
+
+def test_ranked_pages_add_up_to_the_whole_result(client):
+    now = datetime.now()
+    for i, hospital_id in enumerate(['HOS-A', 'HOS-B'] * 3):
+        register(client, hospital_id, 'ankle fracture' if i % 2 else 'ankle', now - i * DAY)
+
+    everything = pages(client, 'ankle', limit=100)
+    assert len(everything) == 6
+    assert pages(client, 'ankle', limit=2) == everything
+    scores = [s['score'] for s in client.get('/api/search', query_string={
+        "q": 'ankle', "type": 'studies'}).get_json()['studies']]
+    assert None not in scores and scores == sorted(scores)
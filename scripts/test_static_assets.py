@@ -0,0 +1,132 @@
+"""
+Frontend asset tests: fingerprinted URLs, precompressed bodies, ETags, reload
+
+Pages link their scripts by a name with the content hash in it, which is
+cached for a year; the plain names and the pages themselves are
+revalidated by ETag, one per encoding.
+
+    cd scripts
+    python -m pytest test_static_assets.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-assets-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import gzip
+import hashlib
+import re
+import time
+
+import pytest
+
+import app as app_module
+import static_assets
+
+SCRIPT = b'// access page\n' + b'console.log("federation access");\n' * 100
+PAGE = b'''<html><head>
+<script src="/frontend/access.js"></script>
+<script src='/frontend/missing.js'></script>
+<link rel="stylesheet" href="https://cdn.example.org/frontend/site.css">
+</head></html>'''
+
+
+def fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:static_assets.HASH_LENGTH]
+
+
+@pytest.fixture
+def root():
+    """A frontend directory with a page, the script it uses, a tiny file and a hidden one"""
+    root = tempfile.mkdtemp(prefix='xray-assets-')
+    for name, data in (('page.html', PAGE), ('access.js', SCRIPT), ('tiny.txt', b'ok'), ('.swp', b'x')):
+        with open(os.path.join(root, name), 'wb') as f:
+            f.write(data)
+    return root
+
+
+def test_pages_link_fingerprinted_assets(root):
+    store = static_assets.AssetStore(root)
+    page, _ = store.get('page.html')
+    html = page.bodies[None].decode()
+    assert f'"/frontend/access.{fingerprint(SCRIPT)}.js"' in html
+    # Missing files and other hosts' URLs are left alone
+    assert "'/frontend/missing.js'" in html and 'https://cdn.example.org/frontend/site.css' in html
+    assert store.url('access.js') == f'/frontend/access.{fingerprint(SCRIPT)}.js'
+    assert store.stats()["files"] == 3
+
+
+def test_only_the_current_fingerprint_is_immutable(root):
+    store = static_assets.AssetStore(root)
+    current = f'access.{fingerprint(SCRIPT)}.js'
+    assert store.get(current) == (store.get('access.js')[0], True)
+    assert store.get('access.0123456789.js') == (store.get('access.js')[0], False)
+    assert store.get('access.js')[1] is False
+    assert store.get('other.0123456789.js') == (None, False)
+    assert store.get('.swp') == (None, False)
+
+
+def test_compressed_once_when_it_pays(root):
+    store = static_assets.AssetStore(root, min_size=1024)
+    script, _ = store.get('access.js')
+    assert gzip.decompress(script.bodies['gzip']) == SCRIPT
+    assert list(store.get('tiny.txt')[0].bodies) == [None]
+
+
+def test_reload_picks_up_a_changed_file(root):
+    store = static_assets.AssetStore(root, reload=True)
+    fixed = static_assets.AssetStore(root)
+    changed = SCRIPT + b'console.log("v2");\n'
+    with open(os.path.join(root, 'access.js'), 'wb') as f:
+        f.write(changed)
+    os.utime(os.path.join(root, 'access.js'), ns=(time.time_ns() + 10 ** 9,) * 2)
+
+    assert store.get('access.js')[0].hash == fingerprint(changed)
+    assert f'access.{fingerprint(changed)}.js' in store.get('page.html')[0].bodies[None].decode()
+    assert fixed.get('access.js')[0].hash == fingerprint(SCRIPT)
+
+
+@pytest.fixture
+def client(root, monkeypatch):
+    monkeypatch.setattr(app_module, 'frontend_assets', static_assets.AssetStore(root, min_size=1024))
+    return app_module.app.test_client()
+
+
+def test_fingerprinted_script_is_cached_for_a_year(client):
+    url = f'/frontend/access.{fingerprint(SCRIPT)}.js'
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200 and response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.get_data()) == SCRIPT
+    assert response.headers['Cache-Control'] == static_assets.IMMUTABLE
+    assert response.get_etag() == (f'{fingerprint(SCRIPT)}-gzip', False)
+    assert 'Accept-Encoding' in response.vary
+
+    plain = client.get('/frontend/access.js', headers={'Accept-Encoding': 'identity'})
+    assert plain.get_data() == SCRIPT and 'Content-Encoding' not in plain.headers
+    assert plain.headers['Cache-Control'] == static_assets.REVALIDATE
+    assert plain.get_etag() == (fingerprint(SCRIPT), False)
+
+
+def test_pages_revalidate_by_etag_per_encoding(client):
+    response = client.get('/frontend/page.html')
+    tag, _ = response.get_etag()
+    assert response.headers['Cache-Control'] == 'no-cache'
+    assert re.search(r'/frontend/access\.[0-9a-f]{10}\.js', response.get_data(as_text=True))
+    assert client.get('/frontend/page.html', headers={'If-None-Match': f'"{tag}"'}).status_code == 304
+
+    script = client.get('/frontend/access.js', headers={'Accept-Encoding': 'gzip'})
+    gzip_tag, _ = script.get_etag()
+    assert client.get('/frontend/access.js', headers={'Accept-Encoding': 'gzip',
+                                                      'If-None-Match': f'"{gzip_tag}"'}).status_code == 304
+    assert client.get('/frontend/access.js', headers={'Accept-Encoding': 'identity',
+                                                      'If-None-Match': f'"{gzip_tag}"'}).status_code == 200
+
+
+def test_missing_and_hidden_files_are_not_found(client):
+    assert client.get('/frontend/missing.js').status_code == 404
+    assert client.get('/frontend/.swp').status_code == 404
+    assert client.get('/frontend/../backend/config.py').status_code == 404
@@ -0,0 +1,160 @@
+"""
+Generated study ID, key and patient ID collisions
+
+Study IDs carry 32 random bits per second and keys can meet between
+workers, so every path that registers studies retries a clash with fresh
+IDs (ids.insert_study/insert_studies); a study that is genuinely already
+registered is not a clash. Keys are forced to collide here. Patient IDs
+come from the last 6 digits of the national ID, so a second national ID
+ending alike is given a fresh one (ids.insert_patient/insert_patients).
+
+    cd scripts
+    python -m pytest test_study_ids.py
+"""
+import sys
+import os
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'backend'))
+# Read by config.py on import: keep the access events of this run out of the working directory,
+# and let every request through, since they all come from the one test client
+os.environ.setdefault('AUDIT_DIR', tempfile.mkdtemp(prefix='xray-ids-audit-'))
+os.environ.setdefault('RATE_LIMIT_ENABLED', '0')
+
+import sqlite3
+
+import pytest
+
+import app as app_module
+import bulk
+import db
+import dicom_ingest
+import ids
+import storage
+from migrations import migrate
+
+TAKEN_KEY = 42
+INSERT = ('INSERT INTO studies (id, patient_id, hospital_id, study_date, study_instance_uid, rowid) '
+          'VALUES (?, ?, ?, ?, ?, ?)')
+
+
+@pytest.fixture
+def conn():
+    """A migrated temporary database with one study under rowid TAKEN_KEY"""
+    path = os.path.join(tempfile.mkdtemp(prefix='xray-ids-'), 'federation.db')
+    pool = db.configure(database=path)
+    storage.configure()
+    with db.connection() as conn:
+        migrate(conn, verbose=False)
+        conn.execute("INSERT INTO hospitals (id, name) VALUES ('HOS-IDS', 'Ids Hospital')")
+        conn.execute("INSERT INTO patients (id, national_id, first_name, last_name) "
+                     "VALUES ('PAT-IDS-1', 'NID-IDS-1', 'Rehema', 'Lyimo')")
+        conn.execute("INSERT INTO patients (id, national_id, first_name, last_name) "
+                     "VALUES ('PAT-123456', '199001123456', 'Baraka', 'Mollel')")
+        conn.execute(INSERT, ('STU-TAKEN', 'PAT-IDS-1', 'HOS-IDS', '2024-01-01', '1.2.840.1', TAKEN_KEY))
+        conn.commit()
+        yield conn
+    pool.close_all()
+
+
+def row(study_id, uid, key):
+    return (study_id, 'PAT-IDS-1', 'HOS-IDS', '2024-02-01', uid, key)
+
+
+def test_single_insert_reissues_a_taken_key(conn):
+    written = ids.insert_study(conn, INSERT, row('STU-NEW', '1.2.840.2', TAKEN_KEY))
+    conn.commit()
+    assert written[0] != 'STU-NEW' and written[-1] != TAKEN_KEY
+    assert conn.execute('SELECT study_instance_uid FROM studies WHERE rowid = ?',
+                        (written[-1],)).fetchone() == ('1.2.840.2',)
+
+
+def test_batch_replays_row_by_row_after_a_collision(conn):
+    rows = [row('STU-A', '1.2.840.3', 1000), row('STU-TAKEN', '1.2.840.4', 1001), row('STU-C', '1.2.840.5', 1002)]
+    inserted, collisions = ids.insert_studies(conn, INSERT, rows)
+    conn.commit()
+    assert (inserted, collisions) == (3, 1)
+    assert conn.execute('SELECT COUNT(*) FROM studies').fetchone()[0] == 4
+
+
+def test_other_constraint_failures_are_not_retried(conn):
+    with pytest.raises(sqlite3.IntegrityError, match='study_instance_uid'):
+        ids.insert_studies(conn, INSERT, [row('STU-A', '1.2.840.6', 2000), row('STU-B', '1.2.840.1', 2001)])
+    conn.rollback()
+    assert conn.execute('SELECT COUNT(*) FROM studies').fetchone()[0] == 1
+
+
+def test_dicom_ingest_counts_collisions_apart_from_duplicates(conn, monkeypatch):
+    keys = iter([TAKEN_KEY, 3000, 3001])
+    monkeypatch.setattr(dicom_ingest, 'new_study_key', lambda: next(keys))
+    header = {"dicom_patient_id": 'NID-IDS-1', "patient_name": 'Lyimo^Rehema', "birth_date": '',
+              "sex": '', "study_date": '2024-03-01 08:00:00', "modalities": {'CR'}, "description": ''}
+    ingest = dicom_ingest.Ingest('HOS-IDS')
+
+    # A new study whose first key is taken, and one already registered (same UID)
+    ingest._write_chunk([dict(header, study_uid='1.2.840.7'), dict(header, study_uid='1.2.840.1')])
+
+    assert ingest.stats["registered"] == 1
+    assert ingest.stats["already_registered"] == 1
+    assert ingest.stats["id_collisions"] == 1
+    assert conn.execute("SELECT COUNT(*) FROM studies WHERE study_instance_uid = '1.2.840.7'").fetchone()[0] == 1
+
+
+def test_study_registration_retries_a_taken_key(conn, monkeypatch):
+    monkeypatch.setattr(app_module, 'new_study_key', lambda: TAKEN_KEY)
+    response = app_module.app.test_client().post('/api/hospitals/HOS-IDS/studies',
+                                                 json={"patient_id": 'PAT-IDS-1', "study_date": '2024-04-01'})
+    assert response.status_code == 201
+    assert conn.execute('SELECT COUNT(*) FROM studies').fetchone()[0] == 2
+
+
+def patient_ids(conn):
+    return dict(conn.execute('SELECT national_id, id FROM patients').fetchall())
+
+
+def test_bulk_upsert_reissues_a_taken_patient_id(conn):
+    reported = []
+    result = bulk.upsert_patients(conn, [
+        {"national_id": '198502123456', "first_name": 'Neema', "last_name": 'Swai'},
+        {"national_id": '199001123456', "first_name": 'Baraka', "last_name": 'Mollel', "phone": '+255-700'},
+        {"national_id": '200011654321', "first_name": 'Juma', "last_name": 'Kessy'},
+    ], on_written=reported.extend)
+    assert (result.written, result.failed_count) == (3, 0)
+
+    ids_by_national_id = patient_ids(conn)
+    assert ids_by_national_id['198502123456'].startswith('PAT-123456-')
+    assert ids_by_national_id['199001123456'] == 'PAT-123456'
+    assert ids_by_national_id['200011654321'] == 'PAT-654321'
+    assert {(row[0], row[1]) for row in reported} == {(v, k) for k, v in ids_by_national_id.items()
+                                                      if k != 'NID-IDS-1'}
+
+    # Upserting the reissued patient again updates it under the ID it has
+    bulk.upsert_patients(conn, [{"national_id": '198502123456', "first_name": 'Neema', "last_name": 'Mushi'}])
+    assert patient_ids(conn) == ids_by_national_id
+
+
+def test_patient_registration_reissues_a_taken_patient_id(conn):
+    response = app_module.app.test_client().post('/api/patients', json={
+        "national_id": '197707123456', "first_name": 'Zawadi', "last_name": 'Massawe'})
+    assert response.status_code == 201
+    assert response.get_json()['patient_id'] == patient_ids(conn)['197707123456'] != 'PAT-123456'
+
+
+def test_dicom_ingest_registers_a_patient_whose_id_is_taken(conn):
+    header = {"dicom_patient_id": '196612123456', "patient_name": 'Kweka^Asha', "birth_date": '19661201',
+              "sex": 'F', "study_date": '2024-03-01 08:00:00', "modalities": {'CT'}, "description": ''}
+    ingest = dicom_ingest.Ingest('HOS-IDS')
+    ingest._write_chunk([dict(header, study_uid='1.2.840.8'), dict(header, study_uid='1.2.840.9')])
+
+    assert ingest.stats["patients_created"] == 1
+    assert ingest.stats["patient_id_collisions"] == 1
+    assert ingest.stats["registered"] == 2
+    patient_id = patient_ids(conn)['196612123456']
+    assert patient_id.startswith('PAT-123456-')
+    assert conn.execute('SELECT COUNT(*) FROM studies WHERE patient_id = ?', (patient_id,)).fetchone()[0] == 2
+
+
+def test_bulk_studies_are_keyed_in_patient_order(conn):
+    bulk.insert_studies(conn, [{"patient_id": patient} for patient in ('PAT-IDS-1', 'PAT-123456', 'PAT-IDS-1')],
+                        hospital_id='HOS-IDS')
+    rows = conn.execute('SELECT patient_id FROM studies WHERE rowid != ? ORDER BY rowid', (TAKEN_KEY,)).fetchall()
+    assert [r[0] for r in rows] == ['PAT-123456', 'PAT-IDS-1', 'PAT-IDS-1']